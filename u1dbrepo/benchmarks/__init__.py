@@ -0,0 +1,35 @@
+# Copyright 2012 Canonical Ltd.
+#
+# This file is part of u1db.
+#
+# u1db is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation.
+#
+# u1db is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with u1db.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Micro benchmarks for u1db.
+
+These are not part of the test suite, run them directly, eg:
+
+    python -m benchmarks.bench_inmemory_index
+"""
+
+import time
+
+
+def timed(func, *args, **kwargs):
+    """Call func and return (seconds taken, result)."""
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+
+def report(name, value, unit=''):
+    print '%-50s %12s %s' % (name, value, unit)
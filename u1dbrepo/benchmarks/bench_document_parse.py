@@ -0,0 +1,91 @@
+# Copyright 2012 Canonical Ltd.
+#
+# This file is part of u1db.
+#
+# u1db is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation.
+#
+# u1db is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with u1db.  If not, see <http://www.gnu.org/licenses/>.
+
+"""JSON parses done when reading documents back from a database."""
+
+import os
+import shutil
+import sys
+import tempfile
+
+import simplejson
+
+from u1db import Document
+from u1db.backends import inmemory, sqlite_backend
+
+from benchmarks import report, timed
+
+
+class CountingLoads(object):
+    """Stand in for simplejson.loads that counts its calls."""
+
+    def __init__(self, loads):
+        self._loads = loads
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        return self._loads(*args, **kwargs)
+
+
+def validating_factory(doc_id, rev, json, has_conflicts=False):
+    """A factory that always validates, like documents used to be built."""
+    return Document(doc_id, rev, json, has_conflicts)
+
+
+def measure(name, db, num_docs):
+    queries = [
+        ('get_all_docs', lambda: db.get_all_docs()),
+        ('get_from_index', lambda: db.get_from_index('done', 'false')),
+        ]
+    loads = CountingLoads(simplejson.loads)
+    simplejson.loads = loads
+    try:
+        for factory_name, factory in [('validating', validating_factory),
+                                      ('trusted', Document)]:
+            db.set_document_factory(factory)
+            for query_name, query in queries:
+                loads.calls = 0
+                seconds, _ = timed(query)
+                report('%s %s: %s' % (name, query_name, factory_name),
+                       '%.3f' % seconds, 's')
+                report('', '%.2f' % (loads.calls / float(num_docs)),
+                       'parses/doc')
+    finally:
+        simplejson.loads = loads._loads
+
+
+def main(num_docs=20000):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        dbs = [
+            ('mem', inmemory.InMemoryDatabase('bench')),
+            ('sql', sqlite_backend.SQLitePartialExpandDatabase(
+                os.path.join(tmpdir, 'bench.u1db'))),
+            ]
+        for name, db in dbs:
+            db.create_index('done', 'done')
+            for i in xrange(num_docs):
+                db.create_doc(
+                    '{"done": "false", "title": "task %d"}' % (i,))
+            measure(name, db, num_docs)
+            db.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,131 @@
+# Copyright 2012 Canonical Ltd.
+#
+# This file is part of u1db.
+#
+# u1db is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation.
+#
+# u1db is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with u1db.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Memory and time used by InMemoryIndex posting lists."""
+
+import sys
+import uuid
+
+from u1db.backends import inmemory
+
+from benchmarks import report, timed
+
+
+def postings_size(idx):
+    """Bytes held by the posting lists of idx."""
+    size = sys.getsizeof(idx._values)
+    for postings in idx._values.itervalues():
+        size += sys.getsizeof(postings)
+        if postings._bitmap is not None:
+            size += sys.getsizeof(postings._bitmap)
+        else:
+            size += sys.getsizeof(postings._items)
+    return size
+
+
+def set_postings_size(idx):
+    """Bytes the posting lists of idx would take if they were sets."""
+    size = sys.getsizeof(idx._values)
+    for postings in idx._values.itervalues():
+        size += sys.getsizeof(postings)
+        size += sys.getsizeof(set(postings))
+    return size
+
+
+def doc_ordinals_size(doc_ordinals):
+    """Bytes held by the doc_id => ordinal tables."""
+    size = sys.getsizeof(doc_ordinals._ordinals)
+    size += sys.getsizeof(doc_ordinals._doc_ids)
+    size += sys.getsizeof(doc_ordinals._refs)
+    size += sum(map(sys.getsizeof, doc_ordinals._ordinals.itervalues()))
+    return size
+
+
+def list_postings_size(idx):
+    """Bytes the same postings take as lists of doc_id strings.
+
+    This is the representation InMemoryIndex used to have, where documents
+    arriving by sync made every posting hold its own doc_id string.
+    """
+    size = sys.getsizeof(idx._values)
+    for postings in idx._values.itervalues():
+        doc_ids = idx._to_doc_ids(postings)
+        size += sys.getsizeof(doc_ids)
+        size += sum(map(sys.getsizeof, doc_ids))
+    return size
+
+
+def main(num_docs=200000):
+    doc_ordinals = inmemory.DocOrdinals()
+    indexes = [
+        inmemory.InMemoryIndex('done', ['done'], doc_ordinals),
+        inmemory.InMemoryIndex('project', ['project'], doc_ordinals),
+        inmemory.InMemoryIndex('tag', ['tag'], doc_ordinals),
+        inmemory.InMemoryIndex('title', ['title'], doc_ordinals),
+        ]
+    doc_ids = ['D-' + uuid.uuid4().hex for i in xrange(num_docs)]
+    docs = ['{"done": "%s", "project": "p%d", "tag": "t%d", '
+            '"title": "task %d"}'
+            % ('false' if i % 10 else 'true', i % 20, i % 1000, i)
+            for i in xrange(num_docs)]
+
+    def add_all():
+        for idx in indexes:
+            map(idx.add_json, doc_ids, docs)
+    seconds, _ = timed(add_all)
+    report('add_json', '%.3f' % seconds, 's')
+    num_postings = num_docs * len(indexes)
+    for idx in indexes:
+        report('%s: lists of doc_id strings' % (idx._name,),
+               list_postings_size(idx) / num_docs, 'bytes/posting')
+        report('%s: posting lists of ordinals' % (idx._name,),
+               postings_size(idx) / num_docs, 'bytes/posting')
+    idx = indexes[2]
+    report('tag: posting lists as sets', set_postings_size(idx) / num_docs,
+           'bytes/posting')
+    old_size = sum(map(list_postings_size, indexes))
+    new_size = sum(map(postings_size, indexes))
+    new_size += doc_ordinals_size(doc_ordinals)
+    report('all: lists of doc_id strings', old_size / num_postings,
+           'bytes/posting')
+    report('all: ordinals, including doc_id table', new_size / num_postings,
+           'bytes/posting')
+    # Update 1000 documents that share the low-cardinality 'false' key.
+    idx = indexes[0]
+    updates = range(1, num_docs, num_docs // 1000)
+
+    def update():
+        for i in updates:
+            idx.remove_json(doc_ids[i], docs[i])
+            idx.add_json(doc_ids[i], docs[i])
+    seconds, _ = timed(update)
+    report('1000 updates on the "false" key', '%.3f' % seconds, 's')
+    # Replace 1000 documents by new ones, as deleting and creating does.
+
+    def replace():
+        for i in updates:
+            for idx in indexes:
+                idx.remove_json(doc_ids[i], docs[i])
+            doc_ids[i] = 'D-' + uuid.uuid4().hex
+            for idx in indexes:
+                idx.add_json(doc_ids[i], docs[i])
+    seconds, _ = timed(replace)
+    report('1000 replacements', '%.3f' % seconds, 's')
+    report('doc ordinals after replacing', len(doc_ordinals), 'ordinals')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,72 @@
+# Copyright 2012 Canonical Ltd.
+#
+# This file is part of u1db.
+#
+# u1db is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation.
+#
+# u1db is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with u1db.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Encoding and decoding speed of the available JSON codecs.
+
+The payloads are task documents, as stored by the Tasks application, and
+the entries of a sync stream carrying them.
+"""
+
+import sys
+import uuid
+
+from u1db import json_codec
+
+from benchmarks import report, timed
+
+
+def task_payloads(num_docs):
+    return [{'title': u'Task number %d \xe9' % (i,),
+             'notes': 'Some longer notes about the task. ' * (i % 5),
+             'done': bool(i % 3),
+             'project': 'project-%d' % (i % 20,),
+             'tags': ['home', 'work', 'tag-%d' % (i % 7,)][:i % 4],
+             'due': 1349999999 + i,
+             'priority': i % 5}
+            for i in xrange(num_docs)]
+
+
+def sync_payloads(tasks):
+    codec = json_codec.get_codec('json')
+    return [{'id': 'D-' + uuid.uuid4().hex,
+             'rev': 'replica-%s:%d' % (uuid.uuid4().hex, i),
+             'content': codec.dumps(task),
+             'gen': i,
+             'trans_id': 'T-' + uuid.uuid4().hex}
+            for i, task in enumerate(tasks)]
+
+
+def measure(name, codec, payloads):
+    seconds, encoded = timed(map, codec.dumps, payloads)
+    report('%s: dumps %s' % (codec.name, name),
+           '%.1f' % (seconds * 1e6 / len(payloads)), 'us/payload')
+    seconds, _ = timed(map, codec.loads, encoded)
+    report('%s: loads %s' % (codec.name, name),
+           '%.1f' % (seconds * 1e6 / len(payloads)), 'us/payload')
+
+
+def main(num_docs=20000):
+    tasks = task_payloads(num_docs)
+    syncs = sync_payloads(tasks)
+    codecs = map(json_codec.get_codec, json_codec.available_codecs())
+    codecs.append(json_codec.get_codec())
+    for codec in codecs:
+        for name, payloads in [('task', tasks), ('sync', syncs)]:
+            measure(name, codec, payloads)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,102 @@
+# Copyright 2012 Canonical Ltd.
+#
+# This file is part of u1db.
+#
+# u1db is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation.
+#
+# u1db is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with u1db.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Throughput of u1db-serve with growing numbers of worker processes.
+
+Each run starts u1db-serve with --workers N, then as many client processes
+as there are CPUs fetch a document over and over. On a machine with enough
+cores requests per second should grow nearly linearly with N, up to the
+number of cores the clients leave free.
+"""
+
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import u1db
+from u1db.remote import http_database
+
+from benchmarks import report, timed
+
+
+def start_server(working_dir, workers, threads):
+    serve_path = os.path.join(os.path.dirname(u1db.__path__[0]),
+                              'u1db-serve')
+    p = subprocess.Popen(
+        [sys.executable, serve_path, '--working-dir', working_dir,
+         '--workers', str(workers), '--threads', str(threads)],
+        stdout=subprocess.PIPE)
+    line = p.stdout.readline()
+    port = int(line.rsplit(':', 1)[1])
+    return p, 'http://127.0.0.1:%d/bench.db' % (port,)
+
+
+def fetch(args):
+    url, doc_id, num_requests = args
+    db = http_database.HTTPDatabase(url)
+    try:
+        for i in xrange(num_requests):
+            db.get_doc(doc_id)
+    finally:
+        db.close()
+    return num_requests
+
+
+def measure(working_dir, doc_id, workers, threads, clients, num_requests):
+    p, url = start_server(working_dir, workers, threads)
+    try:
+        pool = multiprocessing.Pool(clients)
+        # warm up the workers and their database handles
+        pool.map(fetch, [(url, doc_id, 10)] * clients)
+        seconds, done = timed(
+            pool.map, fetch, [(url, doc_id, num_requests)] * clients)
+        pool.close()
+        pool.join()
+    finally:
+        p.terminate()
+        p.wait()
+    return sum(done) / seconds
+
+
+def main(max_workers=None, threads=4, num_requests=500):
+    cpus = multiprocessing.cpu_count()
+    if max_workers is None:
+        max_workers = max(1, cpus // 2)
+    working_dir = tempfile.mkdtemp(prefix='u1db-bench-')
+    try:
+        db = u1db.open(os.path.join(working_dir, 'bench.db'), create=True)
+        doc_id = db.create_doc('{"title": "benchmark", "done": false}').doc_id
+        db.close()
+        base = None
+        workers = 1
+        while workers <= max_workers:
+            rate = measure(working_dir, doc_id, workers, threads, cpus,
+                           num_requests)
+            if base is None:
+                base = rate
+            report('%d workers x %d threads' % (workers, threads),
+                   '%.0f' % (rate,), 'requests/s (x%.2f)' % (rate / base,))
+            workers *= 2
+    finally:
+        shutil.rmtree(working_dir)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
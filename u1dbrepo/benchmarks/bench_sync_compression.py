@@ -0,0 +1,87 @@
+# Copyright 2012 Canonical Ltd.
+#
+# This file is part of u1db.
+#
+# u1db is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation.
+#
+# u1db is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with u1db.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Bytes on the wire and CPU cost of compressing sync streams.
+
+The stream is the one HTTPSyncTarget sends for task documents, compressed
+and decompressed incrementally the way sync_exchange does it.
+"""
+
+import cStringIO
+import sys
+import time
+
+from u1db import Document
+from u1db.remote import (
+    http_target,
+    utils,
+    )
+
+from benchmarks import report
+from benchmarks.bench_json_codec import task_payloads, sync_payloads
+
+
+def sync_stream(num_docs):
+    docs_by_generations = [
+        (Document(entry['id'], entry['rev'], entry['content']),
+         entry['gen'], entry['trans_id'])
+        for entry in sync_payloads(task_payloads(num_docs))]
+    target = http_target.HTTPSyncTarget('http://localhost/db')
+    return list(target._iter_sync_stream(docs_by_generations, 0))
+
+
+def cpu_timed(func, *args):
+    """Call func and return (CPU seconds taken, result)."""
+    start = time.clock()
+    result = func(*args)
+    return time.clock() - start, result
+
+
+def decompress(data, encoding):
+    reader = utils.DecompressingReader(cStringIO.StringIO(data).read,
+                                       encoding)
+    return sum(1 for _ in utils.iter_lines(reader.read))
+
+
+def measure(entries, encoding, level):
+    raw_size = sum(map(len, entries))
+    name = '%s level %d' % (encoding, level)
+    seconds, data = cpu_timed(
+        lambda: ''.join(utils.iter_compressed(entries, encoding, level)))
+    report('%s: bytes' % (name,), len(data),
+           '(%.1f%% of %d)' % (len(data) * 100.0 / raw_size, raw_size))
+    report('%s: compress' % (name,),
+           '%.1f' % (seconds * 1e6 / len(entries)), 'us/entry')
+    seconds, _ = cpu_timed(decompress, data, encoding)
+    report('%s: decompress and split' % (name,),
+           '%.1f' % (seconds * 1e6 / len(entries)), 'us/entry')
+
+
+def main(num_docs=5000):
+    entries = sync_stream(num_docs)
+    report('identity: bytes', sum(map(len, entries)))
+    seconds, _ = cpu_timed(
+        lambda: sum(1 for _ in utils.iter_lines(
+            cStringIO.StringIO(''.join(entries)).read)))
+    report('identity: split', '%.1f' % (seconds * 1e6 / len(entries)),
+           'us/entry')
+    for encoding in utils.SYNC_ENCODINGS:
+        for level in (1, 6, 9):
+            measure(entries, encoding, level)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -74,6 +74,67 @@ initialize(u1database *db)
     return SQLITE_OK;
 }
 
+// Upgrade the schema of a database created by an older version. The content
+// digests are maintained by the python implementation only, we just have to
+// clear them when we change content.
+static int
+upgrade_schema(u1database *db)
+{
+    static const char *upgrade_0_to_1[] = {
+        "ALTER TABLE document ADD COLUMN content_digest TEXT",
+        "ALTER TABLE conflicts ADD COLUMN content_digest TEXT",
+        "UPDATE u1db_config SET value = '1' WHERE name = 'sql_schema'",
+    };
+    sqlite3_stmt *statement;
+    int i, status;
+
+    status = sqlite3_prepare_v2(db->sql_handle,
+        "SELECT 1 FROM u1db_config WHERE name = 'sql_schema' AND value = '0'",
+        -1, &statement, NULL);
+    if (status != SQLITE_OK) {
+        return status;
+    }
+    status = sqlite3_step(statement);
+    sqlite3_finalize(statement);
+    if (status != SQLITE_ROW) {
+        // Nothing to upgrade
+        return SQLITE_OK;
+    }
+    status = sqlite3_exec(db->sql_handle, "BEGIN EXCLUSIVE", NULL, NULL, NULL);
+    if (status != SQLITE_OK) {
+        return status;
+    }
+    for (i = 0; i < 3; i++) {
+        status = sqlite3_exec(db->sql_handle, upgrade_0_to_1[i], NULL, NULL,
+                              NULL);
+        if (status != SQLITE_OK) {
+            sqlite3_exec(db->sql_handle, "ROLLBACK", NULL, NULL, NULL);
+            return status;
+        }
+    }
+    return sqlite3_exec(db->sql_handle, "COMMIT", NULL, NULL, NULL);
+}
+
+// The python implementation can store revisions in a compact form, which
+// we do not support.
+static int
+uses_compact_revisions(u1database *db)
+{
+    sqlite3_stmt *statement;
+    int status;
+
+    status = sqlite3_prepare_v2(db->sql_handle,
+        "SELECT 1 FROM u1db_config"
+        " WHERE name = 'rev_encoding' AND value = 'compact'",
+        -1, &statement, NULL);
+    if (status != SQLITE_OK) {
+        return 0;
+    }
+    status = sqlite3_step(statement);
+    sqlite3_finalize(statement);
+    return status == SQLITE_ROW;
+}
+
 u1database *
 u1db_open(const char *fname)
 {
@@ -86,6 +147,11 @@ u1db_open(const char *fname)
         return NULL;
     }
     initialize(db);
+    upgrade_schema(db);
+    if (uses_compact_revisions(db)) {
+        u1db_free(&db);
+        return NULL;
+    }
     return db;
 }
 
@@ -366,7 +432,8 @@ write_doc(u1database *db, const char *doc_id, const char *doc_rev,
 
     if (is_update) {
         status = sqlite3_prepare_v2(db->sql_handle,
-            "UPDATE document SET doc_rev = ?, content = ? WHERE doc_id = ?", -1,
+            "UPDATE document SET doc_rev = ?, content = ?, content_digest = NULL"
+            " WHERE doc_id = ?", -1,
             &statement, NULL);
         if (status != SQLITE_OK) { goto finish; }
         status = delete_old_fields(db, doc_id);
@@ -458,7 +525,7 @@ write_conflict(u1database *db, const char *doc_id, const char *doc_rev,
     int status;
 
     status = sqlite3_prepare_v2(db->sql_handle,
-        "INSERT INTO conflicts VALUES (?, ?, ?)", -1,
+        "INSERT INTO conflicts (doc_id, doc_rev, content) VALUES (?, ?, ?)", -1,
         &statement, NULL);
     if (status != SQLITE_OK) {
         return status;
@@ -16,7 +16,10 @@
 
 """U1DB"""
 
-import simplejson
+import hashlib
+import json as _json
+
+from u1db import json_codec
 from u1db.errors import InvalidJSON
 
 __version_info__ = (0, 0, 1, 'dev', 0)
@@ -63,6 +66,17 @@ class Database(object):
         """
         raise NotImplementedError(self.set_document_factory)
 
+    def set_json_codec(self, codec):
+        """Set the JSON codec the database uses for its own parsing and
+        serialization, eg when indexing documents.
+
+        Documents use the codec of their class, see DocumentBase.codec.
+
+        :param codec: None for the default codec, the name of a codec
+            registered with u1db.json_codec, or a JSONCodec.
+        """
+        raise NotImplementedError(self.set_json_codec)
+
     def whats_changed(self, old_generation):
         """Return a list of documents that have changed since old_generation.
         This allows APPS to only store a db generation before going
@@ -256,6 +270,29 @@ class Database(object):
         """
         raise NotImplementedError(self.resolve_doc)
 
+    def set_conflict_policy(self, policy):
+        """Resolve the conflicts created by syncs as they happen.
+
+        A document that would be stored in conflict by a sync is resolved with
+        policy right away, when it returns a resolution.
+
+        :param policy: A conflict resolution policy, see u1db.conflicts, or
+            None to leave conflicts to the application.
+        """
+        raise NotImplementedError(self.set_conflict_policy)
+
+    def resolve_all_conflicts(self, policy):
+        """Resolve the conflicts of all documents with policy.
+
+        Conflicts are resolved as with resolve_doc, superseding all the
+        conflicted revisions, but in one go.
+
+        :param policy: A conflict resolution policy, see u1db.conflicts.
+        :return: The number of documents resolved. Those for which policy
+            returned None are left in conflict.
+        """
+        raise NotImplementedError(self.resolve_all_conflicts)
+
     def get_sync_target(self):
         """Return a SyncTarget object, for another u1db to synchronize with.
 
@@ -263,6 +300,32 @@ class Database(object):
         """
         raise NotImplementedError(self.get_sync_target)
 
+    def get_retired_replicas(self):
+        """Return the replica uids set with set_retired_replicas.
+
+        :return: A frozenset of replica uids.
+        """
+        return frozenset()
+
+    def set_retired_replicas(self, replica_uids):
+        """Leave the entries of replica_uids out of revisions.
+
+        Every replica that has ever edited a document keeps an entry in its
+        revision, so revisions of widely shared documents only ever grow.
+        Retiring a replica drops its entry from the revisions this database
+        creates, and ignores it when comparing revisions.
+
+        This is only safe for replicas that will not edit documents again and
+        whose changes have already reached every replica, eg a wiped phone
+        once everybody has synced with it since its last edit. Syncing
+        retires on both sides the replicas either side retired, see
+        Synchronizer.
+
+        :param replica_uids: An iterable of replica uids, not including the
+            one of this database.
+        """
+        raise NotImplementedError(self.set_retired_replicas)
+
     def close(self):
         """Release any resources associated with this database."""
         raise NotImplementedError(self.close)
@@ -345,6 +408,61 @@ class Database(object):
         """
         raise NotImplementedError(self._put_doc_if_newer)
 
+    def _put_docs_if_newer(self, docs_by_generation, save_conflict,
+                           replica_uid=None):
+        """Insert/update a batch of documents, see _put_doc_if_newer.
+
+        Backends apply the whole batch in one transaction where they can, and
+        record the sync information for replica_uid once, after the last
+        document. A failure leaves neither the documents nor the sync
+        information of the batch behind, so syncing again resumes after the
+        previous batch.
+
+        :param docs_by_generation: A list of (doc, replica_gen,
+            replica_trans_id) in replica generation order.
+        :param save_conflict: As for _put_doc_if_newer.
+        :param replica_uid: As for _put_doc_if_newer.
+        :return: A list with (state, at_gen) for each document.
+        """
+        return [self._put_doc_if_newer(doc, save_conflict,
+                                       replica_uid=replica_uid,
+                                       replica_gen=replica_gen,
+                                       replica_trans_id=replica_trans_id)
+                for doc, replica_gen, replica_trans_id in docs_by_generation]
+
+
+# Digests are stored, so the canonical form must not depend on the codec in
+# use: always encode with the stdlib json module.
+_canonical_encoder = _json.JSONEncoder(sort_keys=True, separators=(',', ':'))
+
+
+def _canonical_numbers(value):
+    """Return value with the numbers that compare equal in the same type.
+
+    Integral floats become ints, so that 1.0 is encoded like 1.
+    """
+    if isinstance(value, float):
+        if value.is_integer():
+            return int(value)
+        return value
+    if isinstance(value, dict):
+        return dict((key, _canonical_numbers(item))
+                    for key, item in value.iteritems())
+    if isinstance(value, list):
+        return [_canonical_numbers(item) for item in value]
+    return value
+
+
+def content_digest(content):
+    """Return the digest of the content of a document, a parsed JSON object.
+
+    The digest is computed from the canonical JSON encoding of the content,
+    so contents that only differ in key order, whitespace or how numbers
+    are written (1 or 1.0) share it, and others do not.
+    """
+    return hashlib.sha1(
+        _canonical_encoder.encode(_canonical_numbers(content))).hexdigest()
+
 
 class DocumentBase(object):
     """Container for handling a single document.
@@ -355,30 +473,88 @@ class DocumentBase(object):
     :ivar has_conflicts: Boolean indicating if this document has conflicts
     """
 
+    # The JSON codec used by this class of documents, None for the default.
+    # See u1db.json_codec.get_codec for the accepted values.
+    codec = None
+
     def __init__(self, doc_id, rev, json, has_conflicts=False):
+        self._init(doc_id, rev, json, has_conflicts)
+        if json is not None:
+            self._parsed = self._parse_json(json)
+
+    def _init(self, doc_id, rev, json, has_conflicts):
+        """Set up the document, without validating json."""
         self.doc_id = doc_id
         self.rev = rev
-        if json is not None:
-            try:
-                value = simplejson.loads(json)
-            except simplejson.JSONDecodeError:
-                raise InvalidJSON
-            if not isinstance(value, dict):
-                raise InvalidJSON
         self._json = json
+        # The parsed json, kept around once we had to parse it.
+        self._parsed = None
+        # The content_digest of json, if known.
+        self._digest = None
         self.has_conflicts = has_conflicts
 
+    @classmethod
+    def _from_trusted_json(cls, doc_id, rev, json, has_conflicts=False):
+        """Create a document from json that is known to be valid.
+
+        This is used by the backends for documents read back from storage,
+        which were validated when they were stored, so that their json only
+        gets parsed if the content is actually needed. Classes overriding
+        __init__ are constructed normally.
+        """
+        if cls.__init__.im_func is not DocumentBase.__init__.im_func:
+            return cls(doc_id, rev, json, has_conflicts)
+        doc = cls.__new__(cls)
+        doc._init(doc_id, rev, json, has_conflicts)
+        return doc
+
+    def _get_codec(self):
+        return json_codec.get_codec(self.codec)
+
+    def _parse_json(self, json):
+        """Parse json, raising InvalidJSON unless it is a JSON object."""
+        try:
+            value = self._get_codec().loads(json)
+        except ValueError:
+            raise InvalidJSON
+        if not isinstance(value, dict):
+            raise InvalidJSON
+        return value
+
+    def _get_parsed(self):
+        """Get the parsed json of this document, or None for a tombstone.
+
+        The result is cached and must not be modified.
+        """
+        if self._parsed is None and self._json:
+            self._parsed = self._get_codec().loads(self._json)
+        return self._parsed
+
+    def _get_digest(self):
+        """Get the content_digest of this document, or None for a tombstone.
+
+        The digest is cached for as long as the json does not change.
+        """
+        if self._digest is not None:
+            return self._digest
+        parsed = self._get_parsed()
+        if parsed is None:
+            return None
+        digest = content_digest(parsed)
+        if self._json is not None:
+            self._digest = digest
+        return digest
+
     def same_content_as(self, other):
-        """Compare the content of two documents."""
-        if self._json:
-            c1 = simplejson.loads(self._json)
-        else:
-            c1 = None
-        if other._json:
-            c2 = simplejson.loads(other._json)
-        else:
-            c2 = None
-        return c1 == c2
+        """Compare the content of two documents.
+
+        Their digests are compared, so a document read back from storage
+        with its digest is not parsed, and a document getting its digest
+        computed keeps it for when it is stored.
+        """
+        if self._json is not None and self._json == other._json:
+            return True
+        return self._get_digest() == other._get_digest()
 
     def __repr__(self):
         if self.has_conflicts:
@@ -419,18 +595,18 @@ class DocumentBase(object):
 
     def set_json(self, json):
         """Set the json serialization of this document."""
+        parsed = None
         if json is not None:
-            try:
-                self._content = simplejson.loads(json)
-            except simplejson.JSONDecodeError:
-                raise InvalidJSON
-            if not isinstance(self._content, dict):
-                raise InvalidJSON
+            parsed = self._parse_json(json)
         self._json = json
+        self._parsed = parsed
+        self._digest = None
 
     def make_tombstone(self):
         """Make this document into a tombstone."""
         self._json = None
+        self._parsed = None
+        self._digest = None
 
     def is_tombstone(self):
         """Return True if the document is a tombstone, False otherwise."""
@@ -452,24 +628,15 @@ class Document(DocumentBase):
     # have it but if the language supports dictionaries/hashtables, it makes
     # Documents a lot more user friendly.
 
-    def __init__(self, doc_id, rev, json, has_conflicts=False):
-        # TODO: We convert the json in the superclass to check its validity so
-        # we might as well set _content here directly since the price is
-        # already being paid.
-        super(Document, self).__init__(doc_id, rev, json, has_conflicts)
+    def _init(self, doc_id, rev, json, has_conflicts):
+        super(Document, self)._init(doc_id, rev, json, has_conflicts)
         self._content = None
 
-    def same_content_as(self, other):
-        """Compare the content of two documents."""
-        if self._json:
-            c1 = simplejson.loads(self._json)
-        else:
-            c1 = self._content
-        if other._json:
-            c2 = simplejson.loads(other._json)
-        else:
-            c2 = other._content
-        return c1 == c2
+    def _get_parsed(self):
+        """Get the parsed json of this document, or None for a tombstone."""
+        if self._content is not None:
+            return self._content
+        return super(Document, self)._get_parsed()
 
     def get_json(self):
         """Get the json serialization of this document."""
@@ -477,14 +644,11 @@ class Document(DocumentBase):
         if json is not None:
             return json
         if self._content is not None:
-            return simplejson.dumps(self._content)
+            return self._get_codec().dumps(self._content)
         return None
 
     def set_json(self, json):
         """Set the json serialization of this document."""
-        # TODO: We convert the json in the superclass to check its validity so
-        # we might as well set _content here directly since the price is
-        # already being paid.
         self._content = None
         super(Document, self).set_json(json)
 
@@ -502,8 +666,11 @@ class Document(DocumentBase):
     def _get_content(self):
         """Get the dictionary representing this document."""
         if self._json is not None:
-            self._content = simplejson.loads(self._json)
+            # Hand out the parsed json, it may be modified from now on.
+            self._content = self._get_parsed()
             self._json = None
+            self._parsed = None
+            self._digest = None
         if self._content is not None:
             return self._content
         return None
@@ -511,6 +678,8 @@ class Document(DocumentBase):
     def _set_content(self, content):
         """Set the dictionary representing this document."""
         self._json = None
+        self._parsed = None
+        self._digest = None
         self._content = content
 
     content = property(
@@ -560,7 +729,7 @@ class SyncTarget(object):
         raise NotImplementedError(self.record_sync_info)
 
     def sync_exchange(self, docs_by_generation, source_replica_uid,
-                      last_known_generation, return_doc_cb):
+                      last_known_generation, return_doc_cb, sync_filter=None):
         """Incorporate the documents sent from the source replica.
 
         This is not meant to be called by client code directly, but is used as
@@ -590,11 +759,37 @@ class SyncTarget(object):
                 be invoked in turn with Documents that have changed since
                 last_known_generation together with the generation of
                 their last change.
+        :param sync_filter: A u1db.sync.SyncFilter of the documents to
+            return, evaluated on this replica, or None to return them all.
+            Changed documents outside it are left out, or returned as
+            u1db.sync.FilteredOutDocuments if last_known_generation is not 0.
         :return: new_generation - After applying docs_by_generation, this is
             the current generation for this replica
         """
         raise NotImplementedError(self.sync_exchange)
 
+    def get_retired_replicas(self):
+        """Return the replica uids this replica retired.
+
+        See Database.set_retired_replicas.
+
+        :return: A frozenset of replica uids.
+        """
+        return frozenset()
+
+    def set_retired_replicas(self, replica_uids):
+        """Set the replica uids this replica retired.
+
+        See Database.set_retired_replicas.
+        """
+        raise NotImplementedError(self.set_retired_replicas)
+
+    def close(self):
+        """Release the resources held by this sync target, eg connections.
+
+        The sync target can still be used afterwards.
+        """
+
     def _set_trace_hook(self, cb):
         """Set a callback that will be invoked to trace database actions.
 
@@ -22,6 +22,7 @@ import uuid
 import u1db
 from u1db import (
     errors,
+    json_codec,
 )
 import u1db.sync
 from u1db.vectorclock import VectorClockRev
@@ -30,12 +31,35 @@ from u1db.vectorclock import VectorClockRev
 check_doc_id_re = re.compile("^" + u1db.DOC_ID_CONSTRAINTS + "$", re.UNICODE)
 
 
+def _distribution(values):
+    """Summarize a list of numbers, see get_revision_size_stats."""
+    if not values:
+        return dict.fromkeys(['min', 'median', 'mean', 'p90', 'p99', 'max'], 0)
+    values = sorted(values)
+    last = len(values) - 1
+    return {
+        'min': values[0],
+        'median': values[last // 2],
+        'mean': float(sum(values)) / len(values),
+        'p90': values[last * 90 // 100],
+        'p99': values[last * 99 // 100],
+        'max': values[-1],
+        }
+
+
 class CommonSyncTarget(u1db.sync.LocalSyncTarget):
     pass
 
 
 class CommonBackend(u1db.Database):
 
+    # The codec set with set_json_codec, None for the default.
+    _json_codec = None
+    # The replica uids set with set_retired_replicas.
+    _retired_replicas = frozenset()
+    # The policy set with set_conflict_policy.
+    _conflict_policy = None
+
     def _allocate_doc_id(self):
         """Generate a unique identifier for this document."""
         return 'D-' + uuid.uuid4().hex  # 'D-' stands for document
@@ -44,7 +68,7 @@ class CommonBackend(u1db.Database):
         return 'T-' + uuid.uuid4().hex  # 'T-' stands for transaction
 
     def _allocate_doc_rev(self, old_doc_rev):
-        vcr = VectorClockRev(old_doc_rev)
+        vcr = self._get_vcr(old_doc_rev)
         vcr.increment(self._replica_uid)
         return vcr.as_str()
 
@@ -52,6 +76,57 @@ class CommonBackend(u1db.Database):
         if not check_doc_id_re.match(doc_id):
             raise errors.InvalidDocId()
 
+    def set_json_codec(self, codec):
+        if codec is not None:
+            codec = json_codec.get_codec(codec)
+        self._json_codec = codec
+
+    def _get_json_codec(self):
+        return json_codec.get_codec(self._json_codec)
+
+    def get_retired_replicas(self):
+        return self._retired_replicas
+
+    def set_retired_replicas(self, replica_uids):
+        replica_uids = frozenset(replica_uids)
+        if self._replica_uid in replica_uids:
+            raise errors.InvalidReplicaUID(
+                "cannot retire the replica of the database itself")
+        self._set_retired_replicas(replica_uids)
+
+    def _set_retired_replicas(self, replica_uids):
+        """Store the replica uids checked by set_retired_replicas."""
+        self._retired_replicas = replica_uids
+
+    def _get_vcr(self, rev):
+        """Return the VectorClockRev for rev, without retired replicas."""
+        vcr = VectorClockRev(rev)
+        if self._retired_replicas:
+            vcr.prune(self._retired_replicas)
+        return vcr
+
+    def get_revision_size_stats(self):
+        """Describe the sizes of the revisions stored in this database.
+
+        Covers the revisions of all documents, tombstones and conflicts.
+
+        :return: A dict with the number of 'revisions', and the distribution
+            of the number of replica 'entries' and of the length in 'bytes'
+            of these revisions. Distributions are dicts of 'min', 'median',
+            'mean', 'p90', 'p99' and 'max'.
+        """
+        revs = []
+        for doc in self.get_all_docs(include_deleted=True)[1]:
+            revs.append(doc.rev)
+            if self._has_conflicts(doc.doc_id):
+                revs.extend([c_doc.rev for c_doc
+                             in self.get_doc_conflicts(doc.doc_id)[1:]])
+        return {
+            'revisions': len(revs),
+            'entries': _distribution([rev.count('|') + 1 for rev in revs]),
+            'bytes': _distribution([len(rev) for rev in revs]),
+            }
+
     def _get_generation(self):
         """Return the current generation.
 
@@ -72,10 +147,26 @@ class CommonBackend(u1db.Database):
         """
         raise NotImplementedError(self._get_doc)
 
+    def _get_doc_rev(self, doc_id):
+        """Return the current revision of the document, without reading its
+        content, or None if it doesn't exist.
+        """
+        raise NotImplementedError(self._get_doc_rev)
+
     def _has_conflicts(self, doc_id):
         """Return True if the doc has conflicts, False otherwise."""
         raise NotImplementedError(self._has_conflicts)
 
+    def _make_stored_doc(self, doc_id, doc_rev, content):
+        """Create a document for content read back from storage.
+
+        The content was validated when it was stored, so when the factory
+        supports it the document is created without parsing it again.
+        """
+        factory = getattr(
+            self._factory, '_from_trusted_json', self._factory)
+        return factory(doc_id, doc_rev, content)
+
     def create_doc(self, content, doc_id=None):
         if doc_id is None:
             doc_id = self._allocate_doc_id()
@@ -95,6 +186,8 @@ class CommonBackend(u1db.Database):
         result = []
         for doc_id in doc_ids:
             doc = self._get_doc(doc_id)
+            if doc is None:
+                continue
             if doc.is_tombstone() and not include_deleted:
                 continue
             if check_for_conflicts:
@@ -112,15 +205,20 @@ class CommonBackend(u1db.Database):
         raise NotImplementedError(self.validate_gen_and_trans_id)
 
     def _validate_source(self, other_replica_uid, other_generation,
-                         other_transaction_id, cur_vcr, other_vcr):
+                         other_transaction_id, cur_vcr, other_vcr,
+                         known_gen_info=None):
         """Validate the new generation and transaction id.
 
         other_generation must be greater than what we have stored for this
         replica, *or* it must be the same and the transaction_id must be the
         same as well.
+
+        :param known_gen_info: The (generation, transaction id) stored for
+            other_replica_uid, when the caller already has it.
         """
-        old_generation, old_transaction_id = self._get_sync_gen_info(
-            other_replica_uid)
+        if known_gen_info is None:
+            known_gen_info = self._get_sync_gen_info(other_replica_uid)
+        old_generation, old_transaction_id = known_gen_info
         if other_generation < old_generation:
             if cur_vcr.is_newer(other_vcr):
                 return 'superseded'
@@ -133,19 +231,53 @@ class CommonBackend(u1db.Database):
 
     def _put_doc_if_newer(self, doc, save_conflict, replica_uid=None,
                           replica_gen=None, replica_trans_id=None):
-        cur_doc = self._get_doc(doc.doc_id)
-        doc_vcr = VectorClockRev(doc.rev)
-        if cur_doc is None:
-            cur_vcr = VectorClockRev(None)
-        else:
-            cur_vcr = VectorClockRev(cur_doc.rev)
-        if replica_uid is not None and replica_gen is not None:
-            state = self._validate_source(
-                replica_uid, replica_gen, replica_trans_id, cur_vcr,
-                doc_vcr)
-            if state != 'ok':
-                return state, self._get_generation()
-        if doc_vcr.is_newer(cur_vcr):
+        return self._put_docs_if_newer(
+            [(doc, replica_gen, replica_trans_id)], save_conflict,
+            replica_uid=replica_uid)[0]
+
+    def _put_docs_if_newer(self, docs_by_generation, save_conflict,
+                           replica_uid=None):
+        results = []
+        if replica_uid is not None:
+            stored_gen_info = self._get_sync_gen_info(replica_uid)
+            known_gen_info = stored_gen_info
+        try:
+            for doc, replica_gen, replica_trans_id in docs_by_generation:
+                cur_doc = self._get_doc(doc.doc_id)
+                doc_vcr = self._get_vcr(doc.rev)
+                if cur_doc is None:
+                    cur_vcr = VectorClockRev(None)
+                else:
+                    cur_vcr = self._get_vcr(cur_doc.rev)
+                with_source = (replica_uid is not None
+                               and replica_gen is not None)
+                if with_source:
+                    state = self._validate_source(
+                        replica_uid, replica_gen, replica_trans_id, cur_vcr,
+                        doc_vcr, known_gen_info)
+                    if state != 'ok':
+                        results.append((state, self._get_generation()))
+                        continue
+                state = self._put_doc_vcr_if_newer(
+                    doc, doc_vcr, cur_doc, cur_vcr, save_conflict)
+                if with_source:
+                    known_gen_info = (replica_gen, replica_trans_id)
+                results.append((state, self._get_generation()))
+        finally:
+            # Backends without transactions keep the documents put before a
+            # failure, so record how far we got in any case.
+            if replica_uid is not None and known_gen_info != stored_gen_info:
+                self._do_set_sync_info(replica_uid, *known_gen_info)
+        return results
+
+    def _put_doc_vcr_if_newer(self, doc, doc_vcr, cur_doc, cur_vcr,
+                              save_conflict):
+        """Compare doc with cur_doc and store it accordingly.
+
+        :return: The state, as for _put_doc_if_newer.
+        """
+        # doc_vcr is empty when only retired replicas edited doc.
+        if cur_doc is None or doc_vcr.is_newer(cur_vcr):
             rev = doc.rev
             self._prune_conflicts(doc, doc_vcr)
             if doc.rev != rev:
@@ -173,13 +305,52 @@ class CommonBackend(u1db.Database):
             state = 'conflicted'
             if save_conflict:
                 self._force_doc_sync_conflict(doc)
-        if replica_uid is not None and replica_gen is not None:
-            self._do_set_sync_info(replica_uid, replica_gen, replica_trans_id)
-        return state, self._get_generation()
+                if self._conflict_policy is not None:
+                    self._resolve_with_policy(doc.doc_id,
+                                              self._conflict_policy)
+        return state
+
+    def set_conflict_policy(self, policy):
+        self._conflict_policy = policy
+
+    def _get_conflicted_doc_ids(self):
+        """Return the ids of the documents that have conflicts."""
+        raise NotImplementedError(self._get_conflicted_doc_ids)
+
+    def _get_doc_conflicts(self, doc_id):
+        """Return what get_doc_conflicts does, within a transaction."""
+        raise NotImplementedError(self._get_doc_conflicts)
+
+    def _resolve_doc(self, doc, conflicted_doc_revs):
+        """Do what resolve_doc does, within a transaction."""
+        raise NotImplementedError(self._resolve_doc)
+
+    def _resolve_with_policy(self, doc_id, policy):
+        """Resolve the conflicts of doc_id with policy, if it can.
+
+        :return: True if doc_id was resolved.
+        """
+        docs = self._get_doc_conflicts(doc_id)
+        if not docs:
+            return False
+        resolution = policy(docs)
+        if resolution is None:
+            return False
+        doc = self._make_stored_doc(doc_id, docs[0].rev,
+                                    resolution.get_json())
+        self._resolve_doc(doc, [c_doc.rev for c_doc in docs])
+        return True
+
+    def resolve_all_conflicts(self, policy):
+        resolved = 0
+        for doc_id in self._get_conflicted_doc_ids():
+            if self._resolve_with_policy(doc_id, policy):
+                resolved += 1
+        return resolved
 
     def _ensure_maximal_rev(self, cur_rev, extra_revs):
-        vcr = VectorClockRev(cur_rev)
+        vcr = self._get_vcr(cur_rev)
         for rev in extra_revs:
-            vcr.maximize(VectorClockRev(rev))
+            vcr.maximize(self._get_vcr(rev))
         vcr.increment(self._replica_uid)
         return vcr.as_str()
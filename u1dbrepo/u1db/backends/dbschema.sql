@@ -7,7 +7,8 @@ CREATE TABLE transaction_log (
 CREATE TABLE document (
     doc_id TEXT PRIMARY KEY,
     doc_rev TEXT NOT NULL,
-    content TEXT
+    content TEXT,
+    content_digest TEXT
 );
 CREATE TABLE document_fields (
     doc_id TEXT NOT NULL,
@@ -26,6 +27,7 @@ CREATE TABLE conflicts (
     doc_id TEXT,
     doc_rev TEXT,
     content TEXT,
+    content_digest TEXT,
     CONSTRAINT conflicts_pkey PRIMARY KEY (doc_id, doc_rev)
 );
 CREATE TABLE index_definitions (
@@ -38,4 +40,4 @@ CREATE TABLE u1db_config (
     name TEXT PRIMARY KEY,
     value TEXT
 );
-INSERT INTO u1db_config VALUES ('sql_schema', '0');
+INSERT INTO u1db_config VALUES ('sql_schema', '2');
@@ -16,15 +16,20 @@
 
 """The in-memory Database class for U1DB."""
 
-import simplejson
+import bisect
+import marshal
+import mmap
+import os
+import struct
 
 from u1db import (
     Document,
     errors,
+    json_codec,
     query_parser,
-    vectorclock,
     )
 from u1db.backends import CommonBackend, CommonSyncTarget
+from u1db.compat import OrderedDict
 
 
 def get_prefix(value):
@@ -32,23 +37,295 @@ def get_prefix(value):
     return key_prefix.rstrip('*')
 
 
+# For every byte value, the offsets of the bits that are set in it.
+_BITS_IN_BYTE = [tuple(bit for bit in range(8) if value & (1 << bit))
+                 for value in range(256)]
+
+
+class DocOrdinals(object):
+    """Intern doc_ids as small integer ordinals.
+
+    A database shares one of these between all its indexes, so that posting
+    lists don't hold on to their own copies of the doc_id strings. Every
+    index holding a document holds a reference to its ordinal, and the
+    ordinal is reused for another document once the last one is released,
+    so the table and the bitmaps of posting lists only grow with the number
+    of indexed documents, not with the number ever indexed.
+    """
+
+    def __init__(self):
+        self._ordinals = {}
+        # ordinal => doc_id, None for a free ordinal
+        self._doc_ids = []
+        # ordinal => how many indexes hold it
+        self._refs = []
+        # Free ordinals, the last one freed is reused first so that a
+        # document updated in its only index gets its ordinal back.
+        self._free = []
+
+    def __len__(self):
+        return len(self._doc_ids)
+
+    def acquire(self, doc_id):
+        """Return the ordinal for doc_id, allocating one if needed.
+
+        Every call must be matched by a call to release.
+        """
+        ordinal = self._ordinals.get(doc_id)
+        if ordinal is None:
+            if self._free:
+                ordinal = self._free.pop()
+                self._doc_ids[ordinal] = doc_id
+            else:
+                ordinal = len(self._doc_ids)
+                self._doc_ids.append(doc_id)
+                self._refs.append(0)
+            self._ordinals[doc_id] = ordinal
+        self._refs[ordinal] += 1
+        return ordinal
+
+    def release(self, ordinal):
+        """Drop a reference to ordinal, freeing it if it was the last one."""
+        self._refs[ordinal] -= 1
+        if not self._refs[ordinal]:
+            del self._ordinals[self._doc_ids[ordinal]]
+            self._doc_ids[ordinal] = None
+            self._free.append(ordinal)
+
+    def lookup(self, doc_id):
+        """Return the ordinal already allocated for doc_id."""
+        return self._ordinals[doc_id]
+
+    def to_doc_ids(self, ordinals):
+        """Convert an iterable of ordinals to the matching doc_ids."""
+        doc_ids = self._doc_ids
+        return [doc_ids[ordinal] for ordinal in ordinals]
+
+    def get_state(self):
+        """Return the table in a marshallable form."""
+        return (self._doc_ids, self._refs)
+
+    @classmethod
+    def from_state(cls, state):
+        """Create a DocOrdinals from the result of get_state."""
+        doc_ordinals = cls()
+        doc_ordinals._doc_ids, doc_ordinals._refs = state
+        for ordinal, doc_id in enumerate(doc_ordinals._doc_ids):
+            if doc_id is None:
+                doc_ordinals._free.append(ordinal)
+            else:
+                doc_ordinals._ordinals[doc_id] = ordinal
+        return doc_ordinals
+
+
+class PostingList(object):
+    """The ordinals of the documents indexed under a single key.
+
+    Iterating yields the ordinals in ascending order. Lists are kept sorted
+    in a list, and lists that hold a good fraction of all the ordinals of an
+    index (think of a 'done' field that is false for most tasks) switch to a
+    bitmap using one bit per ordinal. Adding or removing an ordinal is a
+    binary search plus moving at most capacity / DENSE list entries, or
+    constant time for a bitmap.
+
+    Sorted lists take about 9 bytes per ordinal against 42 for a set, as
+    reported by benchmarks/bench_inmemory_index.py, which is why they are
+    not turned into sets when they grow.
+    """
+
+    # Switch to a bitmap once at least 1 in DENSE ordinals is in the list, and
+    # back to a sorted list when it drops below 1 in SPARSE ordinals.
+    DENSE = 256
+    SPARSE = 512
+    MIN_BITMAP_SIZE = 64
+
+    __slots__ = ('_items', '_bitmap', '_count')
+
+    def __init__(self):
+        self._items = []
+        self._bitmap = None
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        if self._bitmap is not None:
+            return self._iter_bitmap()
+        return iter(self._items)
+
+    def _iter_bitmap(self):
+        for offset, value in enumerate(self._bitmap):
+            if value:
+                base = offset << 3
+                for bit in _BITS_IN_BYTE[value]:
+                    yield base + bit
+
+    def add(self, ordinal, capacity):
+        """Add ordinal, out of capacity ordinals known to the index."""
+        bitmap = self._bitmap
+        if bitmap is None:
+            items = self._items
+            offset = bisect.bisect_left(items, ordinal)
+            if offset < len(items) and items[offset] == ordinal:
+                return
+            items.insert(offset, ordinal)
+            self._count += 1
+            if (self._count >= self.MIN_BITMAP_SIZE
+                    and self._count * self.DENSE >= capacity):
+                self._to_bitmap(capacity)
+            return
+        offset = ordinal >> 3
+        if offset >= len(bitmap):
+            bitmap.extend('\x00' * (offset + 1 - len(bitmap)))
+        mask = 1 << (ordinal & 7)
+        if not bitmap[offset] & mask:
+            bitmap[offset] |= mask
+            self._count += 1
+        if self._count * self.SPARSE < capacity:
+            self._to_list()
+
+    def remove(self, ordinal, capacity):
+        """Remove ordinal, out of capacity ordinals known to the index."""
+        bitmap = self._bitmap
+        if bitmap is None:
+            items = self._items
+            offset = bisect.bisect_left(items, ordinal)
+            if offset == len(items) or items[offset] != ordinal:
+                raise KeyError(ordinal)
+            del items[offset]
+            self._count -= 1
+            return
+        offset = ordinal >> 3
+        mask = 1 << (ordinal & 7)
+        if offset >= len(bitmap) or not bitmap[offset] & mask:
+            raise KeyError(ordinal)
+        bitmap[offset] &= ~mask
+        self._count -= 1
+        if self._count * self.SPARSE < capacity:
+            self._to_list()
+
+    def get_state(self):
+        """Return the contents of this list in a marshallable form."""
+        if self._bitmap is not None:
+            return (str(self._bitmap), self._count)
+        return (list(self._items), self._count)
+
+    @classmethod
+    def from_state(cls, state):
+        """Create a PostingList from the result of get_state."""
+        postings = cls()
+        items, postings._count = state
+        if isinstance(items, str):
+            postings._bitmap = bytearray(items)
+            postings._items = None
+        else:
+            postings._items = items
+        return postings
+
+    def _to_bitmap(self, capacity):
+        bitmap = bytearray((capacity >> 3) + 1)
+        for ordinal in self._items:
+            bitmap[ordinal >> 3] |= 1 << (ordinal & 7)
+        self._bitmap = bitmap
+        self._items = None
+
+    def _to_list(self):
+        self._items = list(self._iter_bitmap())
+        self._bitmap = None
+
+
+# Snapshot files start with SNAPSHOT_MAGIC and a header giving the format
+# version and the offset and length of the metadata. Document and conflict
+# contents come next, and the marshalled metadata last.
+SNAPSHOT_MAGIC = 'U1DBSNAP'
+SNAPSHOT_VERSION = 2
+_snapshot_header = struct.Struct('>8sIIQQ')
+
+
+class MappedContent(object):
+    """Content of a document that is still only in a mapped snapshot."""
+
+    __slots__ = ('_map', '_offset', '_length')
+
+    def __init__(self, snapshot_map, offset, length):
+        self._map = snapshot_map
+        self._offset = offset
+        self._length = length
+
+    def read(self):
+        return self._map[self._offset:self._offset + self._length]
+
+
+class MappedDocs(dict):
+    """Map from doc_id => (doc_rev, content), reading contents lazily.
+
+    Values can hold a MappedContent, which is read from the snapshot and
+    replaced by the actual content the first time the document is accessed.
+    """
+
+    def _resolve(self, doc_id, value):
+        content = value[1]
+        if type(content) is MappedContent:
+            value = (value[0], content.read())
+            dict.__setitem__(self, doc_id, value)
+        return value
+
+    def __getitem__(self, doc_id):
+        return self._resolve(doc_id, dict.__getitem__(self, doc_id))
+
+    def get(self, doc_id, default=None):
+        if doc_id not in self:
+            return default
+        return self[doc_id]
+
+    def iteritems(self):
+        for doc_id, value in dict.items(self):
+            yield doc_id, self._resolve(doc_id, value)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def itervalues(self):
+        for doc_id, value in self.iteritems():
+            yield value
+
+    def values(self):
+        return list(self.itervalues())
+
+
 class InMemoryDatabase(CommonBackend):
     """A database that only stores the data internally."""
 
     def __init__(self, replica_uid, document_factory=None):
         self._transaction_log = []
+        # Number of leading transaction log entries dropped by
+        # trim_transaction_log, and the transaction id of the last of them.
+        self._trimmed_generation = 0
+        self._trimmed_trans_id = ''
+        # Map from doc_id => (generation, trans_id) of its latest change,
+        # ordered by generation.
+        self._latest_changes = OrderedDict()
         self._docs = {}
         # Map from doc_id => [(doc_rev, doc)] conflicts beyond 'winner'
         self._conflicts = {}
         self._other_generations = {}
         self._indexes = {}
+        self._doc_ordinals = DocOrdinals()
         self._replica_uid = replica_uid
         self._last_exchange_log = None
         self._factory = document_factory or Document
+        # The mapped file, when loaded from a snapshot
+        self._snapshot_map = None
 
     def set_document_factory(self, factory):
         self._factory = factory
 
+    def set_json_codec(self, codec):
+        super(InMemoryDatabase, self).set_json_codec(codec)
+        for index in self._indexes.itervalues():
+            index._codec = self._json_codec
+
     def close(self):
         # This is a no-op, We don't want to free the data because one client
         # may be closing it, while another wants to inspect the results.
@@ -72,25 +349,177 @@ class InMemoryDatabase(CommonBackend):
     def get_sync_target(self):
         return InMemorySyncTarget(self)
 
+    def save_snapshot(self, path):
+        """Save the whole state of the database to a snapshot file.
+
+        The snapshot can be turned back into a database with load_snapshot,
+        without having to re-validate documents or rebuild indexes. It uses
+        marshal for the metadata, so it should be loaded by the same Python
+        version that wrote it.
+
+        :param path: The file to write, it is replaced atomically.
+        :return: None
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(_snapshot_header.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                                          marshal.version, 0, 0))
+            offset = [_snapshot_header.size]
+
+            def write_content(content):
+                if content is None:
+                    return -1, 0
+                if type(content) is MappedContent:
+                    content = content.read()
+                elif isinstance(content, unicode):
+                    content = content.encode('utf-8')
+                f.write(content)
+                start = offset[0]
+                offset[0] += len(content)
+                return start, len(content)
+            docs = []
+            # Don't go through MappedDocs.iteritems, to not load every content
+            # of a database that came from a snapshot in memory.
+            for doc_id, (doc_rev, content) in dict.iteritems(self._docs):
+                docs.append((doc_id, doc_rev) + write_content(content))
+            conflicts = []
+            for doc_id, doc_conflicts in self._conflicts.iteritems():
+                conflicts.append((doc_id, [
+                    (c_rev,) + write_content(c_content)
+                    for c_rev, c_content in doc_conflicts]))
+            indexes = []
+            for index in self._indexes.itervalues():
+                indexes.append((index._name, index._definition, [
+                    (key, index._values[key].get_state())
+                    for key in index._sorted_keys]))
+            metadata = marshal.dumps({
+                'replica_uid': self._replica_uid,
+                'transaction_log': self._transaction_log,
+                'trimmed': (self._trimmed_generation, self._trimmed_trans_id),
+                'latest_changes': [
+                    (doc_id,) + change
+                    for doc_id, change in self._latest_changes.iteritems()],
+                'other_generations': self._other_generations,
+                'docs': docs,
+                'conflicts': conflicts,
+                'doc_ordinals': self._doc_ordinals.get_state(),
+                'indexes': indexes,
+                })
+            f.write(metadata)
+            f.seek(0)
+            f.write(_snapshot_header.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                                          marshal.version, offset[0],
+                                          len(metadata)))
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load_snapshot(cls, path, document_factory=None):
+        """Create a database from a file written by save_snapshot.
+
+        The file is memory mapped, and the content of every document is only
+        read when it is first accessed.
+
+        :param path: The snapshot file to load.
+        :return: An InMemoryDatabase.
+        """
+        with open(path, 'rb') as f:
+            try:
+                snapshot_map = mmap.mmap(f.fileno(), 0,
+                                         access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty file
+                raise errors.InvalidSnapshot
+        if len(snapshot_map) < _snapshot_header.size:
+            raise errors.InvalidSnapshot
+        (magic, version, marshal_version, metadata_offset,
+         metadata_length) = _snapshot_header.unpack_from(snapshot_map)
+        if (magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION
+                or marshal_version != marshal.version):
+            raise errors.InvalidSnapshot
+        try:
+            metadata = marshal.loads(snapshot_map[
+                metadata_offset:metadata_offset + metadata_length])
+        except (EOFError, ValueError, TypeError):
+            raise errors.InvalidSnapshot
+
+        def read_content(offset, length):
+            if offset == -1:
+                return None
+            return MappedContent(snapshot_map, offset, length)
+
+        db = cls(metadata['replica_uid'], document_factory=document_factory)
+        db._snapshot_map = snapshot_map
+        db._transaction_log = metadata['transaction_log']
+        db._trimmed_generation, db._trimmed_trans_id = metadata['trimmed']
+        db._latest_changes = OrderedDict(
+            (doc_id, (generation, trans_id))
+            for doc_id, generation, trans_id in metadata['latest_changes'])
+        db._other_generations = metadata['other_generations']
+        db._docs = MappedDocs(
+            (doc_id, (doc_rev, read_content(offset, length)))
+            for doc_id, doc_rev, offset, length in metadata['docs'])
+        for doc_id, doc_conflicts in metadata['conflicts']:
+            db._conflicts[doc_id] = [
+                (c_rev, None if offset == -1
+                 else read_content(offset, length).read())
+                for c_rev, offset, length in doc_conflicts]
+        db._doc_ordinals = DocOrdinals.from_state(metadata['doc_ordinals'])
+        for index_name, definition, values in metadata['indexes']:
+            index = InMemoryIndex(index_name, definition, db._doc_ordinals)
+            for key, state in values:
+                index._values[key] = PostingList.from_state(state)
+                index._sorted_keys.append(key)
+            db._indexes[index_name] = index
+        return db
+
     def _get_transaction_log(self):
         # snapshot!
         return self._transaction_log[:]
 
     def _get_generation(self):
-        return len(self._transaction_log)
+        return self._trimmed_generation + len(self._transaction_log)
 
     def _get_generation_info(self):
-        return len(self._transaction_log), self._transaction_log[-1][1]
+        return self._get_generation(), self._transaction_log[-1][1]
 
     def validate_gen_and_trans_id(self, generation, trans_id):
         if generation == 0:
             return
-        if generation > len(self._transaction_log):
+        if generation > self._get_generation():
+            raise errors.InvalidGeneration
+        if generation < self._trimmed_generation:
+            # We don't know the transaction id any more
             raise errors.InvalidGeneration
-        if self._transaction_log[generation - 1][1] == trans_id:
+        if generation == self._trimmed_generation:
+            known_trans_id = self._trimmed_trans_id
+        else:
+            known_trans_id = self._transaction_log[
+                generation - self._trimmed_generation - 1][1]
+        if known_trans_id == trans_id:
             return
         raise errors.InvalidTransactionId
 
+    def trim_transaction_log(self, generation):
+        """Forget the transaction log up to and including generation.
+
+        whats_changed keeps working from any generation, but
+        validate_gen_and_trans_id will reject generations older than the
+        trimmed one. So generation should be one that every replica syncing
+        from this database is known to be past, the database only ever being
+        a sync target makes any generation safe. The latest transaction is
+        always kept.
+
+        :param generation: The generation to trim the log up to.
+        :return: None
+        """
+        generation = min(generation, self._get_generation() - 1)
+        count = generation - self._trimmed_generation
+        if count <= 0:
+            return
+        self._trimmed_trans_id = self._transaction_log[count - 1][1]
+        self._trimmed_generation = generation
+        del self._transaction_log[:count]
+
     def put_doc(self, doc):
         if doc.doc_id is None:
             raise errors.InvalidDocId()
@@ -121,13 +550,22 @@ class InMemoryDatabase(CommonBackend):
         trans_id = self._allocate_transaction_id()
         self._docs[doc.doc_id] = (doc.rev, doc.get_json())
         self._transaction_log.append((doc.doc_id, trans_id))
+        # Move the document to the end of the changes
+        self._latest_changes.pop(doc.doc_id, None)
+        self._latest_changes[doc.doc_id] = (self._get_generation(), trans_id)
 
     def _get_doc(self, doc_id):
         try:
             doc_rev, content = self._docs[doc_id]
         except KeyError:
             return None
-        return self._factory(doc_id, doc_rev, content)
+        return self._make_stored_doc(doc_id, doc_rev, content)
+
+    def _get_doc_rev(self, doc_id):
+        try:
+            return self._docs[doc_id][0]
+        except KeyError:
+            return None
 
     def _has_conflicts(self, doc_id):
         return doc_id in self._conflicts
@@ -148,18 +586,23 @@ class InMemoryDatabase(CommonBackend):
         for doc_id, (doc_rev, content) in self._docs.items():
             if content is None and not include_deleted:
                 continue
-            results.append(self._factory(doc_id, doc_rev, content))
+            results.append(self._make_stored_doc(doc_id, doc_rev, content))
         return (generation, results)
 
+    def _get_conflicted_doc_ids(self):
+        return list(self._conflicts)
+
     def get_doc_conflicts(self, doc_id):
         if doc_id not in self._conflicts:
             return []
         result = [self._get_doc(doc_id)]
         result[0].has_conflicts = True
-        result.extend([self._factory(doc_id, rev, content)
+        result.extend([self._make_stored_doc(doc_id, rev, content)
                        for rev, content in self._conflicts[doc_id]])
         return result
 
+    _get_doc_conflicts = get_doc_conflicts
+
     def _replace_conflicts(self, doc, conflicts):
         if not conflicts:
             del self._conflicts[doc.doc_id]
@@ -173,10 +616,11 @@ class InMemoryDatabase(CommonBackend):
             remaining_conflicts = []
             cur_conflicts = self._conflicts[doc.doc_id]
             for c_rev, c_doc in cur_conflicts:
-                c_vcr = vectorclock.VectorClockRev(c_rev)
+                c_vcr = self._get_vcr(c_rev)
                 if doc_vcr.is_newer(c_vcr):
                     continue
-                if doc.same_content_as(Document(doc.doc_id, c_rev, c_doc)):
+                if doc.same_content_as(
+                        Document._from_trusted_json(doc.doc_id, c_rev, c_doc)):
                     doc_vcr.maximize(c_vcr)
                     autoresolved = True
                     continue
@@ -207,6 +651,8 @@ class InMemoryDatabase(CommonBackend):
             remaining_conflicts.append((new_rev, doc.get_json()))
         self._replace_conflicts(doc, remaining_conflicts)
 
+    _resolve_doc = resolve_doc
+
     def delete_doc(self, doc):
         if doc.doc_id not in self._docs:
             raise errors.DocumentDoesNotExist
@@ -221,14 +667,15 @@ class InMemoryDatabase(CommonBackend):
                     index_expressions):
                 return
             raise errors.IndexNameTakenError
-        index = InMemoryIndex(index_name, list(index_expressions))
+        index = InMemoryIndex(index_name, list(index_expressions),
+                              self._doc_ordinals, self._json_codec)
         for doc_id, (doc_rev, doc) in self._docs.iteritems():
             if doc is not None:
                 index.add_json(doc_id, doc)
         self._indexes[index_name] = index
 
     def delete_index(self, index_name):
-        del self._indexes[index_name]
+        self._indexes.pop(index_name).release_ordinals()
 
     def list_indexes(self):
         definitions = []
@@ -245,7 +692,7 @@ class InMemoryDatabase(CommonBackend):
         result = []
         for doc_id in doc_ids:
             doc_rev, doc = self._docs[doc_id]
-            result.append(self._factory(doc_id, doc_rev, doc))
+            result.append(self._make_stored_doc(doc_id, doc_rev, doc))
         return result
 
     def get_range_from_index(self, index_name, start_value=None,
@@ -263,7 +710,7 @@ class InMemoryDatabase(CommonBackend):
         result = []
         for doc_id in doc_ids:
             doc_rev, doc = self._docs[doc_id]
-            result.append(self._factory(doc_id, doc_rev, doc))
+            result.append(self._make_stored_doc(doc_id, doc_rev, doc))
         return result
 
     def get_index_keys(self, index_name):
@@ -276,29 +723,32 @@ class InMemoryDatabase(CommonBackend):
         return list(set([tuple(key.split('\x01')) for key in keys]))
 
     def whats_changed(self, old_generation=0):
-        changes = []
-        relevant_tail = self._transaction_log[old_generation:]
-        # We don't use len(self._transaction_log) because _transaction_log may
-        # get mutated by a concurrent operation.
-        cur_generation = old_generation + len(relevant_tail)
+        cur_generation = None
         last_trans_id = ''
-        if relevant_tail:
-            last_trans_id = relevant_tail[-1][1]
-        elif self._transaction_log:
-            last_trans_id = self._transaction_log[-1][1]
-        seen = set()
-        generation = cur_generation
-        for doc_id, trans_id in reversed(relevant_tail):
-            if doc_id not in seen:
-                changes.append((doc_id, generation, trans_id))
-                seen.add(doc_id)
-            generation -= 1
+        latest_changes = self._latest_changes
+        changes = []
+        # Walk back from the newest change, so only the documents that changed
+        # since old_generation are visited. A document updated by a concurrent
+        # operation meanwhile moves behind us, which is fine as we report the
+        # generation we started from and it will show up in a later call.
+        for doc_id in reversed(latest_changes):
+            try:
+                generation, trans_id = latest_changes[doc_id]
+            except KeyError:
+                continue
+            if cur_generation is None:
+                cur_generation, last_trans_id = generation, trans_id
+            if generation <= old_generation:
+                break
+            changes.append((doc_id, generation, trans_id))
+        if cur_generation is None:
+            cur_generation = 0
         changes.reverse()
         return (cur_generation, last_trans_id, changes)
 
     def _force_doc_sync_conflict(self, doc):
         my_doc = self._get_doc(doc.doc_id)
-        self._prune_conflicts(doc, vectorclock.VectorClockRev(doc.rev))
+        self._prune_conflicts(doc, self._get_vcr(doc.rev))
         self._conflicts.setdefault(doc.doc_id, []).append(
             (my_doc.rev, my_doc.get_json()))
         doc.has_conflicts = True
@@ -308,16 +758,25 @@ class InMemoryDatabase(CommonBackend):
 class InMemoryIndex(object):
     """Interface for managing an Index."""
 
-    def __init__(self, index_name, index_definition):
+    def __init__(self, index_name, index_definition, doc_ordinals=None,
+                 codec=None):
         self._name = index_name
         self._definition = index_definition
+        # Map from key => PostingList of doc ordinals
         self._values = {}
+        if doc_ordinals is None:
+            doc_ordinals = DocOrdinals()
+        self._doc_ordinals = doc_ordinals
+        # The keys of _values kept in sorted order, so that prefix and range
+        # lookups can seek with bisect instead of sorting the whole index.
+        self._sorted_keys = []
+        self._codec = codec
         parser = query_parser.Parser()
         self._getters = parser.parse_all(self._definition)
 
     def evaluate_json(self, doc):
         """Determine the 'key' after applying this index to the doc."""
-        raw = simplejson.loads(doc)
+        raw = json_codec.get_codec(self._codec).loads(doc)
         return self.evaluate(raw)
 
     def evaluate(self, obj):
@@ -334,23 +793,55 @@ class InMemoryIndex(object):
         all_rows = ['\x01'.join(row) for row in all_rows]
         return all_rows
 
+    def _to_doc_ids(self, postings):
+        """Convert a PostingList to the matching list of doc_ids."""
+        return self._doc_ordinals.to_doc_ids(postings)
+
     def add_json(self, doc_id, doc):
         """Add this json doc to the index."""
         keys = self.evaluate_json(doc)
         if not keys:
             return
-        for key in keys:
-            self._values.setdefault(key, []).append(doc_id)
+        ordinal = self._doc_ordinals.acquire(doc_id)
+        capacity = len(self._doc_ordinals)
+        for key in set(keys):
+            postings = self._values.get(key)
+            if postings is None:
+                postings = self._values[key] = PostingList()
+                bisect.insort_left(self._sorted_keys, key)
+            postings.add(ordinal, capacity)
 
     def remove_json(self, doc_id, doc):
         """Remove this json doc from the index."""
         keys = self.evaluate_json(doc)
         if keys:
-            for key in keys:
-                doc_ids = self._values[key]
-                doc_ids.remove(doc_id)
-                if not doc_ids:
+            ordinal = self._doc_ordinals.lookup(doc_id)
+            capacity = len(self._doc_ordinals)
+            for key in set(keys):
+                postings = self._values[key]
+                postings.remove(ordinal, capacity)
+                if not postings:
                     del self._values[key]
+                    self._remove_sorted_key(key)
+            self._doc_ordinals.release(ordinal)
+
+    def release_ordinals(self):
+        """Release the ordinals of all the documents in this index.
+
+        This is for an index that is being deleted.
+        """
+        ordinals = set()
+        for postings in self._values.itervalues():
+            ordinals.update(postings)
+        for ordinal in ordinals:
+            self._doc_ordinals.release(ordinal)
+        self._values = {}
+        self._sorted_keys = []
+
+    def _remove_sorted_key(self, key):
+        """Drop key from the sorted list of keys."""
+        offset = bisect.bisect_left(self._sorted_keys, key)
+        del self._sorted_keys[offset]
 
     def _find_non_wildcards(self, values):
         """Check if this should be a wildcard match.
@@ -393,8 +884,6 @@ class InMemoryIndex(object):
 
     def lookup_range(self, start_values, end_values):
         """Find docs within the range."""
-        # TODO: Wildly inefficient, which is unlikely to be a problem for the
-        # inmemory implementation.
         if start_values:
             self._find_non_wildcards(start_values)
             start_values = get_prefix(start_values)
@@ -404,17 +893,21 @@ class InMemoryIndex(object):
             else:
                 exact = False
             end_values = get_prefix(end_values)
+        sorted_keys = self._sorted_keys
+        if start_values:
+            offset = bisect.bisect_left(sorted_keys, start_values)
+        else:
+            offset = 0
         found = []
-        for key, doc_ids in sorted(self._values.iteritems()):
-            if start_values and start_values > key:
-                continue
+        for offset in xrange(offset, len(sorted_keys)):
+            key = sorted_keys[offset]
             if end_values and end_values < key:
                 if exact:
                     break
                 else:
                     if not key.startswith(end_values):
                         break
-            found.extend(doc_ids)
+            found.extend(self._to_doc_ids(self._values[key]))
         return found
 
     def keys(self):
@@ -423,20 +916,22 @@ class InMemoryIndex(object):
 
     def _lookup_prefix(self, value):
         """Find docs that match the prefix string in values."""
-        # TODO: We need a different data structure to make prefix style fast,
-        #       some sort of sorted list would work, but a plain dict doesn't.
         key_prefix = get_prefix(value)
+        sorted_keys = self._sorted_keys
         all_doc_ids = []
-        for key, doc_ids in sorted(self._values.iteritems()):
-            if key.startswith(key_prefix):
-                all_doc_ids.extend(doc_ids)
+        offset = bisect.bisect_left(sorted_keys, key_prefix)
+        for offset in xrange(offset, len(sorted_keys)):
+            key = sorted_keys[offset]
+            if not key.startswith(key_prefix):
+                break
+            all_doc_ids.extend(self._to_doc_ids(self._values[key]))
         return all_doc_ids
 
     def _lookup_exact(self, value):
         """Find docs that match exactly."""
         key = '\x01'.join(value)
         if key in self._values:
-            return self._values[key]
+            return self._to_doc_ids(self._values[key])
         return ()
 
 
@@ -444,7 +939,7 @@ class InMemorySyncTarget(CommonSyncTarget):
 
     def get_sync_info(self, source_replica_uid):
         source_gen, trans_id = self._db._get_sync_gen_info(source_replica_uid)
-        return (self._db._replica_uid, len(self._db._transaction_log),
+        return (self._db._replica_uid, self._db._get_generation(),
                 source_gen, trans_id)
 
     def record_sync_info(self, source_replica_uid, source_replica_generation,
@@ -16,9 +16,10 @@
 
 """A U1DB implementation that uses SQLite as its persistence layer."""
 
+from contextlib import contextmanager
 import errno
 import os
-import simplejson
+import random
 from sqlite3 import dbapi2
 import sys
 import time
@@ -28,6 +29,7 @@ import pkg_resources
 
 from u1db.backends import CommonBackend, CommonSyncTarget
 from u1db import (
+    content_digest,
     Document,
     errors,
     query_parser,
@@ -40,16 +42,199 @@ class SQLiteDatabase(CommonBackend):
 
     _sqlite_registry = {}
 
-    def __init__(self, sqlite_file, document_factory=None):
-        """Create a new sqlite file."""
-        self._db_handle = dbapi2.connect(sqlite_file)
+    def __init__(self, sqlite_file, document_factory=None,
+                 check_same_thread=True):
+        """Create a new sqlite file.
+
+        :param check_same_thread: If False, the database may be used from
+            other threads than the one creating it, one at a time.
+        """
+        self._db_handle = dbapi2.connect(sqlite_file,
+                                         check_same_thread=check_same_thread)
         self._real_replica_uid = None
         self._ensure_schema()
         self._factory = document_factory or Document
+        self._load_rev_encoding()
+        self._load_retired_replicas()
 
     def set_document_factory(self, factory):
         self._factory = factory
 
+    def _load_rev_encoding(self):
+        """Set up the translation of revisions to and from storage."""
+        # replica_uid => short id, and back
+        self._short_ids = {}
+        self._replica_uids_by_short_id = {}
+        # The replica uids we allocated a short id for in a transaction not
+        # committed yet. It might be rolled back, so they are checked
+        # against the database until _write_transaction commits.
+        self._allocated_replica_uids = set()
+        if not self._stores_compact_revs():
+            self._compact_revs = None
+            return
+        c = self._db_handle.cursor()
+        c.execute("SELECT replica_uid, short_id FROM replica_ids")
+        for replica_uid, short_id in c.fetchall():
+            self._short_ids[replica_uid] = short_id
+            self._replica_uids_by_short_id[short_id] = replica_uid
+        self._compact_revs = vectorclock.CompactRevCodec(
+            self._get_short_id, self._get_replica_uid_by_short_id)
+
+    def _stores_compact_revs(self):
+        c = self._db_handle.cursor()
+        c.execute("SELECT value FROM u1db_config"
+                  " WHERE name = 'rev_encoding'")
+        val = c.fetchone()
+        return val is not None and val[0] == 'compact'
+
+    @contextmanager
+    def _write_transaction(self):
+        """Run a transaction writing revisions.
+
+        It takes the write lock up front, and then checks the revision
+        encoding, which another connection may have changed since this one
+        opened: revisions must never be stored in the other form.
+
+        Once it commits, the short ids it allocated are known to be stored
+        and need not be checked anymore, see _get_short_id.
+        """
+        with self._db_handle:
+            self._db_handle.execute("BEGIN IMMEDIATE")
+            if self._stores_compact_revs() != (
+                    self._compact_revs is not None):
+                self._load_rev_encoding()
+            yield
+        self._allocated_replica_uids.clear()
+
+    def _get_short_id(self, replica_uid):
+        if replica_uid not in self._allocated_replica_uids:
+            short_id = self._short_ids.get(replica_uid)
+            if short_id is not None:
+                return short_id
+        c = self._db_handle.cursor()
+        while True:
+            c.execute("SELECT short_id FROM replica_ids WHERE replica_uid = ?",
+                      (replica_uid,))
+            val = c.fetchone()
+            if val is not None:
+                short_id = val[0]
+                break
+            # Random short ids are never reused for another replica, even
+            # when the transaction allocating one is rolled back.
+            short_id = '%x' % (random.getrandbits(32),)
+            try:
+                c.execute("INSERT INTO replica_ids VALUES (?, ?)",
+                          (replica_uid, short_id))
+            except dbapi2.IntegrityError:
+                # The short id is taken, or another connection allocated one
+                # for this replica in the meantime.
+                continue
+            self._allocated_replica_uids.add(replica_uid)
+            break
+        self._short_ids[replica_uid] = short_id
+        self._replica_uids_by_short_id[short_id] = replica_uid
+        return short_id
+
+    def _get_replica_uid_by_short_id(self, short_id):
+        try:
+            return self._replica_uids_by_short_id[short_id]
+        except KeyError:
+            pass
+        c = self._db_handle.cursor()
+        c.execute("SELECT replica_uid FROM replica_ids WHERE short_id = ?",
+                  (short_id,))
+        val = c.fetchone()
+        if val is None:
+            return None
+        replica_uid = val[0]
+        self._replica_uids_by_short_id[short_id] = replica_uid
+        return replica_uid
+
+    def _encode_rev(self, rev):
+        """Translate rev to how it is stored."""
+        if self._compact_revs is None:
+            return rev
+        return self._compact_revs.encode(rev)
+
+    def _decode_rev(self, stored_rev):
+        """Translate a stored revision back to its usual form."""
+        if self._compact_revs is None:
+            return stored_rev
+        return self._compact_revs.decode(stored_rev)
+
+    def set_compact_revisions(self, enabled):
+        """Store revisions in a compact form, or not.
+
+        In the compact form the replica uids in revisions are replaced by
+        short ids allocated per database, so they are not repeated in every
+        document and conflict. Revisions are translated back before they
+        leave the database, and the existing ones are rewritten.
+
+        Other connections to the database switch to it when they next write,
+        so they never store revisions in the old form.
+
+        The C implementation cannot open databases using compact revisions.
+        """
+        with self._write_transaction():
+            c = self._db_handle.cursor()
+            if enabled == (self._compact_revs is not None):
+                return
+            c.execute("CREATE TABLE IF NOT EXISTS replica_ids ("
+                      " replica_uid TEXT PRIMARY KEY,"
+                      " short_id TEXT UNIQUE NOT NULL)")
+            if enabled:
+                c.execute("INSERT OR REPLACE INTO u1db_config"
+                          " VALUES ('rev_encoding', 'compact')")
+                old_decode = lambda rev: rev
+                self._load_rev_encoding()
+                new_encode = self._encode_rev
+            else:
+                c.execute("DELETE FROM u1db_config"
+                          " WHERE name = 'rev_encoding'")
+                old_decode = self._decode_rev
+                new_encode = lambda rev: rev
+            for table in ['document', 'conflicts']:
+                c.execute("SELECT doc_id, doc_rev FROM %s" % (table,))
+                c.executemany(
+                    "UPDATE %s SET doc_rev = ?"
+                    " WHERE doc_id = ? AND doc_rev = ?" % (table,),
+                    [(new_encode(old_decode(doc_rev)), doc_id, doc_rev)
+                     for doc_id, doc_rev in c.fetchall()])
+            if not enabled:
+                self._load_rev_encoding()
+
+    def _load_retired_replicas(self):
+        """Read the replica uids set with set_retired_replicas.
+
+        Another connection may have changed them, so they are read again
+        before putting documents from other replicas.
+        """
+        c = self._db_handle.cursor()
+        c.execute("SELECT value FROM u1db_config"
+                  " WHERE name = 'retired_replicas'")
+        val = c.fetchone()
+        if val is None:
+            self._retired_replicas = frozenset()
+        else:
+            # like in revisions, replica uids cannot contain '|'
+            self._retired_replicas = frozenset(val[0].split('|'))
+
+    def get_retired_replicas(self):
+        self._load_retired_replicas()
+        return self._retired_replicas
+
+    def _set_retired_replicas(self, replica_uids):
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            if replica_uids:
+                c.execute("INSERT OR REPLACE INTO u1db_config"
+                          " VALUES ('retired_replicas', ?)",
+                          ('|'.join(sorted(replica_uids)),))
+            else:
+                c.execute("DELETE FROM u1db_config"
+                          " WHERE name = 'retired_replicas'")
+        self._retired_replicas = replica_uids
+
     def get_sync_target(self):
         return SQLiteSyncTarget(self)
 
@@ -67,7 +252,8 @@ class SQLiteDatabase(CommonBackend):
     WAIT_FOR_PARALLEL_INIT_HALF_INTERVAL = 0.5
 
     @classmethod
-    def _open_database(cls, sqlite_file, document_factory=None):
+    def _open_database(cls, sqlite_file, document_factory=None,
+                       check_same_thread=True):
         if not os.path.isfile(sqlite_file):
             raise errors.DatabaseDoesNotExist()
         tries = 2
@@ -88,21 +274,24 @@ class SQLiteDatabase(CommonBackend):
             tries -= 1
             time.sleep(cls.WAIT_FOR_PARALLEL_INIT_HALF_INTERVAL)
         return SQLiteDatabase._sqlite_registry[v](
-            sqlite_file, document_factory=document_factory)
+            sqlite_file, document_factory=document_factory,
+            check_same_thread=check_same_thread)
 
     @classmethod
     def open_database(cls, sqlite_file, create, backend_cls=None,
-                      document_factory=None):
+                      document_factory=None, check_same_thread=True):
         try:
             return cls._open_database(
-                sqlite_file, document_factory=document_factory)
+                sqlite_file, document_factory=document_factory,
+                check_same_thread=check_same_thread)
         except errors.DatabaseDoesNotExist:
             if not create:
                 raise
             if backend_cls is None:
                 # default is SQLitePartialExpandDatabase
                 backend_cls = SQLitePartialExpandDatabase
-            return backend_cls(sqlite_file, document_factory=document_factory)
+            return backend_cls(sqlite_file, document_factory=document_factory,
+                               check_same_thread=check_same_thread)
 
     @staticmethod
     def delete_database(sqlite_file):
@@ -180,11 +369,44 @@ class SQLiteDatabase(CommonBackend):
         c.execute("INSERT INTO u1db_config VALUES" " ('index_storage', ?)",
                   (self._index_storage_value,))
 
+    def _get_schema_version(self, c):
+        c.execute("SELECT value FROM u1db_config WHERE name = 'sql_schema'")
+        return c.fetchone()[0]
+
+    def _upgrade_schema(self, c):
+        """Upgrade the schema of a database created by an older version."""
+        old_isolation_level = self._db_handle.isolation_level
+        try:
+            self._db_handle.isolation_level = None
+            with self._db_handle:
+                c.execute("begin exclusive")
+                version = self._get_schema_version(c)
+                if version not in ('0', '1'):
+                    return
+                if version == '0':
+                    # 0 => 1: add the digests of the content of documents
+                    # and conflicts. Existing rows have NULL, ie unknown,
+                    # digests.
+                    c.execute("ALTER TABLE document"
+                              " ADD COLUMN content_digest TEXT")
+                    c.execute("ALTER TABLE conflicts"
+                              " ADD COLUMN content_digest TEXT")
+                # 1 => 2: the canonical form of numbers changed, forget the
+                # digests computed before.
+                c.execute("UPDATE document SET content_digest = NULL")
+                c.execute("UPDATE conflicts SET content_digest = NULL")
+                c.execute("UPDATE u1db_config SET value = '2'"
+                          " WHERE name = 'sql_schema'")
+        finally:
+            self._db_handle.isolation_level = old_isolation_level
+
     def _ensure_schema(self):
         """Ensure that the database schema has been created."""
         old_isolation_level = self._db_handle.isolation_level
         c = self._db_handle.cursor()
         if self._is_initialized(c):
+            if self._get_schema_version(c) in ('0', '1'):
+                self._upgrade_schema(c)
             return
         try:
             # autocommit/own mgmt of transactions
@@ -296,13 +518,24 @@ class SQLiteDatabase(CommonBackend):
     def _get_doc(self, doc_id):
         """Get just the document content, without fancy handling."""
         c = self._db_handle.cursor()
-        c.execute("SELECT doc_rev, content FROM document WHERE doc_id = ?",
-                  (doc_id,))
+        c.execute("SELECT doc_rev, content, content_digest FROM document"
+                  " WHERE doc_id = ?", (doc_id,))
         val = c.fetchone()
         if val is None:
             return None
-        doc_rev, content = val
-        return self._factory(doc_id, doc_rev, content)
+        doc_rev, content, digest = val
+        doc = self._make_stored_doc(
+            doc_id, self._decode_rev(doc_rev), content)
+        doc._digest = digest
+        return doc
+
+    def _get_doc_rev(self, doc_id):
+        c = self._db_handle.cursor()
+        c.execute("SELECT doc_rev FROM document WHERE doc_id = ?", (doc_id,))
+        val = c.fetchone()
+        if val is None:
+            return None
+        return self._decode_rev(val[0])
 
     def _has_conflicts(self, doc_id):
         c = self._db_handle.cursor()
@@ -334,14 +567,15 @@ class SQLiteDatabase(CommonBackend):
         for doc_id, doc_rev, content in rows:
             if content is None and not include_deleted:
                 continue
-            results.append(self._factory(doc_id, doc_rev, content))
+            results.append(self._make_stored_doc(
+                doc_id, self._decode_rev(doc_rev), content))
         return (generation, results)
 
     def put_doc(self, doc):
         if doc.doc_id is None:
             raise errors.InvalidDocId()
         self._check_doc_id(doc.doc_id)
-        with self._db_handle:
+        with self._write_transaction():
             if self._has_conflicts(doc.doc_id):
                 raise errors.ConflictedDoc()
             old_doc = self._get_doc(doc.doc_id)
@@ -428,7 +662,7 @@ class SQLiteDatabase(CommonBackend):
         return cur_gen, newest_trans_id, changes
 
     def delete_doc(self, doc):
-        with self._db_handle:
+        with self._write_transaction():
             old_doc = self._get_doc(doc.doc_id)
             if old_doc is None:
                 raise errors.DocumentDoesNotExist
@@ -446,19 +680,32 @@ class SQLiteDatabase(CommonBackend):
 
     def _get_conflicts(self, doc_id):
         c = self._db_handle.cursor()
-        c.execute("SELECT doc_rev, content FROM conflicts WHERE doc_id = ?",
-                  (doc_id,))
-        return [self._factory(doc_id, doc_rev, content)
-                for doc_rev, content in c.fetchall()]
+        c.execute("SELECT doc_rev, content, content_digest FROM conflicts"
+                  " WHERE doc_id = ?", (doc_id,))
+        conflicts = []
+        for doc_rev, content, digest in c.fetchall():
+            doc = self._make_stored_doc(
+                doc_id, self._decode_rev(doc_rev), content)
+            doc._digest = digest
+            conflicts.append(doc)
+        return conflicts
+
+    def _get_conflicted_doc_ids(self):
+        c = self._db_handle.cursor()
+        c.execute("SELECT DISTINCT doc_id FROM conflicts")
+        return [row[0] for row in c.fetchall()]
 
     def get_doc_conflicts(self, doc_id):
         with self._db_handle:
-            conflict_docs = self._get_conflicts(doc_id)
-            if not conflict_docs:
-                return []
-            this_doc = self._get_doc(doc_id)
-            this_doc.has_conflicts = True
-            return [this_doc] + conflict_docs
+            return self._get_doc_conflicts(doc_id)
+
+    def _get_doc_conflicts(self, doc_id):
+        conflict_docs = self._get_conflicts(doc_id)
+        if not conflict_docs:
+            return []
+        this_doc = self._get_doc(doc_id)
+        this_doc.has_conflicts = True
+        return [this_doc] + conflict_docs
 
     def _get_sync_gen_info(self, other_replica_uid):
         c = self._db_handle.cursor()
@@ -487,20 +734,21 @@ class SQLiteDatabase(CommonBackend):
                       (other_replica_uid, other_generation,
                        other_transaction_id))
 
-    def _put_doc_if_newer(self, doc, save_conflict, replica_uid=None,
-                          replica_gen=None, replica_trans_id=None):
-        with self._db_handle:
-            return super(SQLiteDatabase, self)._put_doc_if_newer(doc,
-                save_conflict=save_conflict,
-                replica_uid=replica_uid, replica_gen=replica_gen,
-                replica_trans_id=replica_trans_id)
+    def _put_docs_if_newer(self, docs_by_generation, save_conflict,
+                           replica_uid=None):
+        with self._write_transaction():
+            self._load_retired_replicas()
+            return super(SQLiteDatabase, self)._put_docs_if_newer(
+                docs_by_generation, save_conflict, replica_uid=replica_uid)
 
-    def _add_conflict(self, c, doc_id, my_doc_rev, my_content):
-        c.execute("INSERT INTO conflicts VALUES (?, ?, ?)",
-                  (doc_id, my_doc_rev, my_content))
+    def _add_conflict(self, c, doc_id, my_doc_rev, my_content, my_digest):
+        c.execute("INSERT INTO conflicts VALUES (?, ?, ?, ?)",
+                  (doc_id, self._encode_rev(my_doc_rev), my_content,
+                   my_digest))
 
     def _delete_conflicts(self, c, doc, conflict_revs):
-        deleting = [(doc.doc_id, c_rev) for c_rev in conflict_revs]
+        deleting = [(doc.doc_id, self._encode_rev(c_rev))
+                    for c_rev in conflict_revs]
         c.executemany("DELETE FROM conflicts"
                       " WHERE doc_id=? AND doc_rev=?", deleting)
         doc.has_conflicts = self._has_conflicts(doc.doc_id)
@@ -510,7 +758,7 @@ class SQLiteDatabase(CommonBackend):
             autoresolved = False
             c_revs_to_prune = []
             for c_doc in self._get_conflicts(doc.doc_id):
-                c_vcr = vectorclock.VectorClockRev(c_doc.rev)
+                c_vcr = self._get_vcr(c_doc.rev)
                 if doc_vcr.is_newer(c_vcr):
                     c_revs_to_prune.append(c_doc.rev)
                 elif doc.same_content_as(c_doc):
@@ -526,40 +774,49 @@ class SQLiteDatabase(CommonBackend):
     def _force_doc_sync_conflict(self, doc):
         my_doc = self._get_doc(doc.doc_id)
         c = self._db_handle.cursor()
-        self._prune_conflicts(doc, vectorclock.VectorClockRev(doc.rev))
-        self._add_conflict(c, doc.doc_id, my_doc.rev, my_doc.get_json())
+        self._prune_conflicts(doc, self._get_vcr(doc.rev))
+        self._add_conflict(c, doc.doc_id, my_doc.rev, my_doc.get_json(),
+                           my_doc._get_digest())
         doc.has_conflicts = True
         self._put_and_update_indexes(my_doc, doc)
 
     def resolve_doc(self, doc, conflicted_doc_revs):
-        with self._db_handle:
-            cur_doc = self._get_doc(doc.doc_id)
-            # TODO: https://bugs.launchpad.net/u1db/+bug/928274
-            #       I think we have a logic bug in resolve_doc
-            #       Specifically, cur_doc.rev is always in the final vector
-            #       clock of revisions that we supersede, even if it wasn't in
-            #       conflicted_doc_revs. We still add it as a conflict, but the
-            #       fact that _put_doc_if_newer propagates resolutions means I
-            #       think that conflict could accidentally be resolved. We need
-            #       to add a test for this case first. (create a rev, create a
-            #       conflict, create another conflict, resolve the first rev
-            #       and first conflict, then make sure that the resolved
-            #       rev doesn't supersede the second conflict rev.) It *might*
-            #       not matter, because the superseding rev is in as a
-            #       conflict, but it does seem incorrect
-            new_rev = self._ensure_maximal_rev(cur_doc.rev,
-                                               conflicted_doc_revs)
-            superseded_revs = set(conflicted_doc_revs)
-            c = self._db_handle.cursor()
-            doc.rev = new_rev
-            if cur_doc.rev in superseded_revs:
-                self._put_and_update_indexes(cur_doc, doc)
-            else:
-                self._add_conflict(c, doc.doc_id, new_rev, doc.get_json())
-            # TODO: Is there some way that we could construct a rev that would
-            #       end up in superseded_revs, such that we add a conflict, and
-            #       then immediately delete it?
-            self._delete_conflicts(c, doc, superseded_revs)
+        with self._write_transaction():
+            self._resolve_doc(doc, conflicted_doc_revs)
+
+    def _resolve_doc(self, doc, conflicted_doc_revs):
+        cur_doc = self._get_doc(doc.doc_id)
+        # TODO: https://bugs.launchpad.net/u1db/+bug/928274
+        #       I think we have a logic bug in resolve_doc
+        #       Specifically, cur_doc.rev is always in the final vector
+        #       clock of revisions that we supersede, even if it wasn't in
+        #       conflicted_doc_revs. We still add it as a conflict, but the
+        #       fact that _put_doc_if_newer propagates resolutions means I
+        #       think that conflict could accidentally be resolved. We need
+        #       to add a test for this case first. (create a rev, create a
+        #       conflict, create another conflict, resolve the first rev
+        #       and first conflict, then make sure that the resolved
+        #       rev doesn't supersede the second conflict rev.) It *might*
+        #       not matter, because the superseding rev is in as a
+        #       conflict, but it does seem incorrect
+        new_rev = self._ensure_maximal_rev(cur_doc.rev,
+                                           conflicted_doc_revs)
+        superseded_revs = set(conflicted_doc_revs)
+        c = self._db_handle.cursor()
+        doc.rev = new_rev
+        if cur_doc.rev in superseded_revs:
+            self._put_and_update_indexes(cur_doc, doc)
+        else:
+            self._add_conflict(c, doc.doc_id, new_rev, doc.get_json(),
+                               doc._get_digest())
+        # TODO: Is there some way that we could construct a rev that would
+        #       end up in superseded_revs, such that we add a conflict, and
+        #       then immediately delete it?
+        self._delete_conflicts(c, doc, superseded_revs)
+
+    def resolve_all_conflicts(self, policy):
+        with self._write_transaction():
+            return super(SQLiteDatabase, self).resolve_all_conflicts(policy)
 
     def list_indexes(self):
         """Return the list of indexes and their definitions."""
@@ -661,7 +918,8 @@ class SQLiteDatabase(CommonBackend):
             raise dbapi2.OperationalError(str(e) +
                 '\nstatement: %s\nargs: %s\n' % (statement, args))
         res = c.fetchall()
-        return [self._factory(r[0], r[1], r[2]) for r in res]
+        return [self._make_stored_doc(r[0], self._decode_rev(r[1]), r[2])
+                for r in res]
 
     def get_range_from_index(self, index_name, start_value=None,
                              end_value=None):
@@ -752,7 +1010,8 @@ class SQLiteDatabase(CommonBackend):
             raise dbapi2.OperationalError(str(e) +
                 '\nstatement: %s\nargs: %s\n' % (statement, args))
         res = c.fetchall()
-        return [self._factory(r[0], r[1], r[2]) for r in res]
+        return [self._make_stored_doc(r[0], self._decode_rev(r[1]), r[2])
+                for r in res]
 
     def get_index_keys(self, index_name):
         c = self._db_handle.cursor()
@@ -822,19 +1081,24 @@ class SQLitePartialExpandDatabase(SQLiteDatabase):
     def _put_and_update_indexes(self, old_doc, doc):
         c = self._db_handle.cursor()
         if doc and not doc.is_tombstone():
-            raw_doc = simplejson.loads(doc.get_json())
+            raw_doc = self._get_json_codec().loads(doc.get_json())
+            digest = doc._digest or content_digest(raw_doc)
         else:
             raw_doc = {}
+            digest = None
         if old_doc is not None:
-            c.execute("UPDATE document SET doc_rev=?, content=?"
-                      " WHERE doc_id = ?",
-                      (doc.rev, doc.get_json(), doc.doc_id))
+            c.execute("UPDATE document SET doc_rev=?, content=?,"
+                      " content_digest=? WHERE doc_id = ?",
+                      (self._encode_rev(doc.rev), doc.get_json(), digest,
+                       doc.doc_id))
             c.execute("DELETE FROM document_fields WHERE doc_id = ?",
                       (doc.doc_id,))
         else:
-            c.execute("INSERT INTO document (doc_id, doc_rev, content)"
-                      " VALUES (?, ?, ?)",
-                      (doc.doc_id, doc.rev, doc.get_json()))
+            c.execute("INSERT INTO document"
+                      " (doc_id, doc_rev, content, content_digest)"
+                      " VALUES (?, ?, ?, ?)",
+                      (doc.doc_id, self._encode_rev(doc.rev), doc.get_json(),
+                       digest))
         indexed_fields = self._get_indexed_fields()
         if indexed_fields:
             # It is expected that len(indexed_fields) is shorter than
@@ -883,10 +1147,11 @@ class SQLitePartialExpandDatabase(SQLiteDatabase):
         getters = [(field, self._parse_index_definition(field))
                    for field in new_fields]
         c = self._db_handle.cursor()
+        codec = self._get_json_codec()
         for doc_id, doc in self._iter_all_docs():
             if doc is None:
                 continue
-            raw_doc = simplejson.loads(doc)
+            raw_doc = codec.loads(doc)
             self._update_indexes(doc_id, raw_doc, getters, c)
 
 SQLiteDatabase.register_implementation(SQLitePartialExpandDatabase)
@@ -18,11 +18,11 @@
 
 import argparse
 import os
-import simplejson
 import sys
 
 from u1db import (
     Document,
+    json_codec,
     open as u1db_open,
     sync,
     errors,
@@ -172,7 +172,7 @@ class CmdGetDocConflicts(OneDbCmd):
         for i, doc in enumerate(conflicts):
             if i:
                 self.stdout.write(",")
-            self.stdout.write(simplejson.dumps(dict(rev=doc.rev,
+            self.stdout.write(json_codec.dumps(dict(rev=doc.rev,
                                                     content=doc.content),
                                                indent=4))
         self.stdout.write("]\n")
@@ -291,6 +291,8 @@ class CmdSync(command.Command):
     def _populate_subparser(cls, parser):
         parser.add_argument('source', help='database to sync from')
         parser.add_argument('target', help='database to sync to')
+        parser.add_argument('--resume', action='store_true', default=False,
+            help='Resume the sync if it gets interrupted')
 
     def _open_target(self, target):
         if target.startswith(('http://', 'https://')):
@@ -301,12 +303,12 @@ class CmdSync(command.Command):
             st = db.get_sync_target()
         return st
 
-    def run(self, source, target):
+    def run(self, source, target, resume=False):
         """Start a Sync request."""
         source_db = u1db_open(source, create=False)
         st = self._open_target(target)
         syncer = sync.Synchronizer(source_db, st)
-        syncer.sync()
+        syncer.sync(resume=resume)
         source_db.close()
 
 client_commands.register(CmdSync)
@@ -480,7 +482,7 @@ class CmdGetFromIndex(OneDbCmd):
             for i, doc in enumerate(docs):
                 if i:
                     self.stdout.write(",")
-                self.stdout.write(simplejson.dumps(dict(
+                self.stdout.write(json_codec.dumps(dict(
                             id=doc.doc_id,
                             rev=doc.rev,
                             content=doc.content), indent=4))
@@ -491,5 +493,32 @@ class CmdGetFromIndex(OneDbCmd):
 client_commands.register(CmdGetFromIndex)
 
 
+class CmdRevisionStats(command.Command):
+    """Show the distribution of revision sizes in a database"""
+
+    name = "rev-stats"
+
+    @classmethod
+    def _populate_subparser(cls, parser):
+        parser.add_argument('database', help='The local database to inspect',
+                            metavar='database-path')
+
+    def run(self, database):
+        try:
+            db = u1db_open(database, create=False)
+        except errors.DatabaseDoesNotExist:
+            self.stderr.write("Database does not exist.\n")
+            return 1
+        stats = db.get_revision_size_stats()
+        self.stdout.write("revisions: %d\n" % (stats['revisions'],))
+        for name in ['entries', 'bytes']:
+            self.stdout.write(
+                "%(name)s: min %(min)d, median %(median)d, mean %(mean).1f,"
+                " p90 %(p90)d, p99 %(p99)d, max %(max)d\n"
+                % dict(stats[name], name=name))
+
+client_commands.register(CmdRevisionStats)
+
+
 def main(args):
     return client_commands.run_argv(args, sys.stdin, sys.stdout, sys.stderr)
@@ -16,6 +16,14 @@
 
 """Build server for u1db-serve."""
 
+import errno
+import os
+import Queue
+import signal
+import threading
+import time
+import traceback
+
 from paste import httpserver
 
 from u1db.remote import (
@@ -24,11 +32,220 @@ from u1db.remote import (
     )
 
 
-def make_server(host, port, working_dir):
-    """Make a server on host and port exposing dbs living in working_dir."""
+class GracefulMixIn:
+    """Stop serving on request, letting the requests being served finish.
+
+    stop may be called from a signal handler; serve_until_stopped then
+    returns within timeout seconds, and drain waits for the requests being
+    served.
+    """
+    # a classic class, like the SocketServer ones it is mixed with
+
+    timeout = 0.5
+    _stopping = False
+
+    def _start(self):
+        """Get ready to serve, in the process serving."""
+
+    def stop(self):
+        self._stopping = True
+
+    def serve_until_stopped(self):
+        self._start()
+        while not self._stopping:
+            self.handle_request()
+
+    def drain(self):
+        current = threading.current_thread()
+        for thread in threading.enumerate():
+            if thread is not current and not thread.daemon:
+                thread.join()
+
+
+class WSGIHandler(httpserver.WSGIHandler):
+    """paste's handler, passing chunked request bodies on to the app.
+
+    paste cuts the request body to its content-length, which a chunked one
+    does not have; http_app decodes the chunks itself.
+    """
+
+    def wsgi_setup(self, environ=None):
+        httpserver.WSGIHandler.wsgi_setup(self, environ)
+        transfer_encoding = self.headers.get('transfer-encoding', '')
+        if transfer_encoding.lower() == 'chunked':
+            self.wsgi_environ['wsgi.input'] = self.rfile
+
+
+class ThreadingServer(GracefulMixIn, httpserver.WSGIServer):
+    """Serve each request from a thread of its own."""
+
+    def process_request(self, request, client_address):
+        # the listening socket is non-blocking when shared by workers
+        request.setblocking(1)
+        httpserver.WSGIServer.process_request(self, request, client_address)
+
+
+class ThreadPoolServer(GracefulMixIn, httpserver.WSGIServerBase):
+    """Serve requests from a fixed pool of threads.
+
+    Unlike paste's thread pool, the threads live as long as the server, so
+    the database handles the ServerState pins to them stay in use.
+    """
+
+    def __init__(self, wsgi_application, server_address,
+                 RequestHandlerClass, threads):
+        httpserver.WSGIServerBase.__init__(
+            self, wsgi_application, server_address, RequestHandlerClass)
+        self._requests = Queue.Queue()
+        self._num_threads = threads
+        self._threads = []
+
+    def _start(self):
+        # not any earlier, threads do not survive forking workers
+        while len(self._threads) < self._num_threads:
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def serve_forever(self, poll_interval=0.5):
+        self._start()
+        httpserver.WSGIServerBase.serve_forever(self, poll_interval)
+
+    def process_request(self, request, client_address):
+        request.setblocking(1)
+        self._requests.put((request, client_address))
+
+    def _work(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.close_request(request)
+
+    def drain(self):
+        for thread in self._threads:
+            self._requests.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+def make_server(host, port, working_dir, threads=None):
+    """Make a server on host and port exposing dbs living in working_dir.
+
+    :param threads: Serve requests from a pool of that many threads rather
+        than from a new thread each.
+    """
     state = server_state.ServerState()
     state.set_workingdir(working_dir)
+    # WSGIHandler passes chunked request bodies on
+    state.accept_chunked = True
     application = http_app.HTTPApp(state)
-    server = httpserver.WSGIServer(application, (host, port),
-                                   httpserver.WSGIHandler)
+    if threads is None:
+        server = ThreadingServer(application, (host, port), WSGIHandler)
+    else:
+        server = ThreadPoolServer(application, (host, port), WSGIHandler,
+                                  threads)
     return server
+
+
+def _shut_down(server):
+    server.drain()
+    server.wsgi_application.state.close_idle_databases()
+    server.server_close()
+
+
+def _run_worker(server):
+    """Serve in a forked worker until told to stop, then exit."""
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    # the parent decides what to do about signals sent to the whole group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    parent = os.getppid()
+    try:
+        server._start()
+        # stop as well when orphaned
+        while not server._stopping and os.getppid() == parent:
+            server.handle_request()
+        _shut_down(server)
+    except:
+        traceback.print_exc()
+        os._exit(1)
+    os._exit(0)
+
+
+def _spawn_worker(server):
+    pid = os.fork()
+    if pid == 0:
+        _run_worker(server)
+    return pid
+
+
+def _serve_workers(server, workers, poll_interval=0.2):
+    signals = []
+
+    def queue_signal(signum, frame):
+        signals.append(signum)
+
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, queue_signal)
+    server.socket.setblocking(0)
+    children = set(_spawn_worker(server) for i in range(workers))
+    retiring = set()
+    stopping = False
+    while children:
+        while signals:
+            signum = signals.pop(0)
+            if signum == signal.SIGHUP and not stopping:
+                retiring.update(children)
+                children.update(
+                    _spawn_worker(server) for i in range(workers))
+            else:
+                stopping = True
+                retiring.update(children)
+            for pid in retiring:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError, e:
+                    if e.errno != errno.ESRCH:
+                        raise
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except OSError, e:
+            if e.errno not in (errno.EINTR, errno.ECHILD):
+                raise
+            pid = 0
+        if not pid:
+            time.sleep(poll_interval)
+            continue
+        children.discard(pid)
+        if pid in retiring:
+            retiring.remove(pid)
+        elif not stopping:
+            # replace a worker that died
+            children.add(_spawn_worker(server))
+    server.server_close()
+
+
+def serve(server, workers=None):
+    """Serve requests until SIGTERM or SIGINT.
+
+    The requests being served are then finished before returning.
+
+    :param workers: Fork that many processes sharing the listening socket
+        of server, replacing the ones that die. SIGHUP then replaces them
+        all by new ones, the old ones finishing their requests first.
+    """
+    if workers is None:
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: server.stop())
+        server.serve_until_stopped()
+        _shut_down(server)
+    else:
+        _serve_workers(server, workers)
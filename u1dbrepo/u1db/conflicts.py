@@ -0,0 +1,110 @@
+# Copyright 2012 Canonical Ltd.
+#
+# This file is part of u1db.
+#
+# u1db is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation.
+#
+# u1db is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with u1db.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Policies resolving document conflicts without the application.
+
+A policy is a callable taking the Documents in conflict, as returned by
+get_doc_conflicts, the current revision first. It returns the Document
+whose content resolves the conflict, which may be one of them or a new
+one, or None to leave the conflict to the application. See
+Database.set_conflict_policy and Database.resolve_all_conflicts.
+"""
+
+from u1db import (
+    Document,
+    errors,
+    json_codec,
+    )
+
+
+class LastWriterWins(object):
+    """Take the document with the greatest value of a field.
+
+    Eg LastWriterWins('updated_at') for documents carrying an ISO 8601
+    timestamp of their last change. Documents without the field, and
+    deleted ones, lose; among equal values the current revision wins.
+    """
+
+    def __init__(self, field):
+        self.field = field
+
+    def _key(self, doc):
+        content = doc._get_parsed()
+        if not isinstance(content, dict) or self.field not in content:
+            return (False, None)
+        return (True, content[self.field])
+
+    def __call__(self, docs):
+        # max returns the first of equal ones
+        return max(docs, key=self._key)
+
+
+class MergeFields(object):
+    """Merge the fields of the documents.
+
+    The fields of one document, picked by the policy prefer or else the
+    current revision, are taken over those of the others; fields it lacks
+    are taken from the others in turn. Only the top level of the content
+    is merged, and deleted documents are left out unless all of them are.
+    """
+
+    def __init__(self, prefer=None):
+        self.prefer = prefer
+
+    def __call__(self, docs):
+        live = [doc for doc in docs if not doc.is_tombstone()]
+        if not live:
+            return docs[0]
+        if self.prefer is None:
+            winner = live[0]
+        else:
+            winner = self.prefer(live)
+            if winner is None:
+                return None
+        winner_content = winner._get_parsed()
+        if not isinstance(winner_content, dict):
+            return winner
+        merged = {}
+        for doc in reversed(live):
+            content = doc._get_parsed()
+            if doc is not winner and isinstance(content, dict):
+                merged.update(content)
+        merged.update(winner_content)
+        return Document(winner.doc_id, winner.rev, json_codec.dumps(merged))
+
+
+_registry = {}
+
+
+def register_policy(name, factory):
+    """Register a policy factory under name, see get_policy."""
+    _registry[name] = factory
+
+
+def get_policy(name, *args, **kwargs):
+    """Create the policy registered as name, with args and kwargs.
+
+    :raises UnknownConflictPolicy: when no policy is registered as name.
+    """
+    try:
+        factory = _registry[name]
+    except KeyError:
+        raise errors.UnknownConflictPolicy(name)
+    return factory(*args, **kwargs)
+
+
+register_policy('last-writer-wins', LastWriterWins)
+register_policy('merge-fields', MergeFields)
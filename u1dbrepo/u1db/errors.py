@@ -37,12 +37,26 @@ class InvalidJSON(U1DBError):
     """Content was not valid json."""
 
 
+class UnknownJSONCodec(U1DBError):
+    """The JSON codec asked for is not registered or not available."""
+
+
+class UnknownConflictPolicy(U1DBError):
+    """No conflict resolution policy is registered under that name."""
+
+
 class InvalidDocId(U1DBError):
     """A document was tried with an invalid document identifier."""
 
     wire_description = "invalid document id"
 
 
+class InvalidReplicaUID(U1DBError):
+    """A replica uid was used where it is not allowed."""
+
+    wire_description = "invalid replica uid"
+
+
 class InvalidTransactionId(U1DBError):
     """Invalid transaction for generation."""
 
@@ -58,11 +72,15 @@ class ConflictedDoc(U1DBError):
 class InvalidValueForIndex(U1DBError):
     """The values supplied does not match the index definition."""
 
+    wire_description = "invalid value for index"
+
 
 class InvalidGlobbing(U1DBError):
     """Raised if wildcard matches are not strictly at the tail of the request.
     """
 
+    wire_description = "invalid globbing"
+
 
 class DocumentDoesNotExist(U1DBError):
     """The document does not exist."""
@@ -85,14 +103,34 @@ class DatabaseDoesNotExist(U1DBError):
 class IndexNameTakenError(U1DBError):
     """The given index name is already taken."""
 
+    wire_description = "index name already taken"
+
 
 class IndexDefinitionParseError(U1DBError):
     """The index definition cannot be parsed."""
 
+    wire_description = "invalid index definition"
+
 
 class IndexDoesNotExist(U1DBError):
     """No index of that name exists."""
 
+    wire_description = "nonexistent index"
+
+
+class InvalidCursor(U1DBError):
+    """The document a cursor resumes after is no longer in the results."""
+
+    wire_description = "invalid cursor"
+
+
+class InvalidRevision(U1DBError):
+    """A stored revision mixes short ids and replica uids."""
+
+
+class InvalidSnapshot(U1DBError):
+    """The snapshot file is damaged or was written by another version."""
+
 
 class Unauthorized(U1DBError):
     """Request wasn't authorized properly."""
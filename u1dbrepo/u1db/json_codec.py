@@ -0,0 +1,193 @@
+# Copyright 2012 Canonical Ltd.
+#
+# This file is part of u1db.
+#
+# u1db is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation.
+#
+# u1db is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with u1db.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The JSON encoder and decoder used by u1db.
+
+Codecs are registered by name, in order of preference. The default codec
+takes the fastest available decoder and encoder, which need not come from
+the same library; run benchmarks.bench_json_codec to compare them.
+
+Decoders must raise ValueError (or a subclass) for invalid JSON, encoders
+must take the keyword arguments of json.dumps that u1db uses (indent).
+"""
+
+from u1db import errors
+from u1db.compat import OrderedDict
+
+
+class JSONCodec(object):
+    """A named pair of loads and dumps functions.
+
+    :ivar accelerated: True if the codec runs in C, such codecs are
+        preferred for the default.
+    """
+
+    def __init__(self, name, loads, dumps, accelerated=False):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+        self.accelerated = accelerated
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, self.name)
+
+
+def _simplejson():
+    import simplejson
+    accelerated = (simplejson.decoder.c_scanstring is not None and
+                   simplejson.encoder.c_make_encoder is not None)
+    return JSONCodec(
+        'simplejson', simplejson.loads, simplejson.dumps, accelerated)
+
+
+def _stdlib_json():
+    import json
+    accelerated = (json.decoder.c_scanstring is not None and
+                   json.encoder.c_make_encoder is not None)
+    return JSONCodec('json', json.loads, json.dumps, accelerated)
+
+
+# name => function returning a JSONCodec, raising ImportError when the
+# codec is not available.
+_registry = OrderedDict()
+# Preference order for the decoder and encoder of the default codec, as
+# measured by benchmarks.bench_json_codec.
+_decoder_preference = []
+_encoder_preference = []
+_loaded = {}
+# What set_default_codec was given, and the codec it currently resolves to.
+_default_choice = None
+_default = None
+
+
+def register_codec(name, loader, decoder_rank=None, encoder_rank=None):
+    """Register a codec.
+
+    :param name: The name to look the codec up by.
+    :param loader: A function returning a JSONCodec. It should raise
+        ImportError if the codec is not available.
+    :param decoder_rank: Where to insert the codec in the preference list for
+        the default decoder, None to append it.
+    :param encoder_rank: Likewise, for the default encoder.
+    """
+    global _default
+    _registry[name] = loader
+    for preference, rank in [(_decoder_preference, decoder_rank),
+                             (_encoder_preference, encoder_rank)]:
+        if name in preference:
+            preference.remove(name)
+        if rank is None:
+            preference.append(name)
+        else:
+            preference.insert(rank, name)
+    _loaded.pop(name, None)
+    _default = None
+
+
+def _load(name):
+    """Return the codec registered as name, or None if not available."""
+    try:
+        return _loaded[name]
+    except KeyError:
+        pass
+    try:
+        loader = _registry[name]
+    except KeyError:
+        raise errors.UnknownJSONCodec(name)
+    try:
+        codec = loader()
+    except ImportError:
+        codec = None
+    _loaded[name] = codec
+    return codec
+
+
+def available_codecs():
+    """Return the names of the registered codecs that can be used."""
+    return [name for name in _registry if _load(name) is not None]
+
+
+def _pick(preference):
+    """Return the first accelerated codec, or else the first available."""
+    codecs = [codec for codec in map(_load, preference) if codec is not None]
+    if not codecs:
+        raise errors.UnknownJSONCodec('no JSON codec is available')
+    for codec in codecs:
+        if codec.accelerated:
+            return codec
+    return codecs[0]
+
+
+def _select_default():
+    decoder = _pick(_decoder_preference)
+    encoder = _pick(_encoder_preference)
+    if decoder is encoder:
+        return decoder
+    return JSONCodec(
+        '%s/%s' % (decoder.name, encoder.name), decoder.loads, encoder.dumps,
+        decoder.accelerated and encoder.accelerated)
+
+
+def get_codec(codec=None):
+    """Return a JSONCodec.
+
+    :param codec: None for the default codec, the name of a registered codec,
+        or a JSONCodec which is returned as is.
+    """
+    global _default
+    if codec is None:
+        if _default is None:
+            if _default_choice is None:
+                _default = _select_default()
+            else:
+                _default = get_codec(_default_choice)
+        return _default
+    if isinstance(codec, JSONCodec):
+        return codec
+    result = _load(codec)
+    if result is None:
+        raise errors.UnknownJSONCodec('%s is not available' % (codec,))
+    return result
+
+
+def set_default_codec(codec):
+    """Set the codec used when none was chosen explicitly.
+
+    :param codec: As for get_codec; None reverts to the fastest available.
+    """
+    global _default, _default_choice
+    if codec is None:
+        _default = None
+    else:
+        _default = get_codec(codec)
+    _default_choice = codec
+
+
+def loads(json):
+    """Decode json with the default codec."""
+    return get_codec().loads(json)
+
+
+def dumps(obj, **kwargs):
+    """Encode obj with the default codec.
+
+    Keyword arguments, eg indent, are passed on as for the stdlib json.
+    """
+    return get_codec().dumps(obj, **kwargs)
+
+
+register_codec('simplejson', _simplejson)
+register_codec('json', _stdlib_json, encoder_rank=0)
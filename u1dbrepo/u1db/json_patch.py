@@ -0,0 +1,107 @@
+# Copyright 2012 Canonical Ltd.
+#
+# This file is part of u1db.
+#
+# u1db is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation.
+#
+# u1db is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with u1db.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compute and apply JSON patches between document contents.
+
+Patches are lists of RFC 6902 operations. Only the add, remove and replace
+operations are produced and understood, and only objects are descended
+into: a changed array or value is replaced as a whole.
+"""
+
+
+def _escape(key):
+    return key.replace('~', '~0').replace('/', '~1')
+
+
+def _unescape(token):
+    return token.replace('~1', '/').replace('~0', '~')
+
+
+def _same(old, new):
+    # 1 == True and 1 == 1.0, but they are different JSON, in arrays and
+    # objects as well
+    if type(old) is not type(new):
+        return False
+    if isinstance(old, list):
+        return (len(old) == len(new)
+                and all(_same(o, n) for o, n in zip(old, new)))
+    if isinstance(old, dict):
+        return (len(old) == len(new)
+                and all(key in new and _same(value, new[key])
+                        for key, value in old.iteritems()))
+    return old == new
+
+
+def make_patch(old, new, path=''):
+    """Return the operations that turn the object old into new."""
+    if not (isinstance(old, dict) and isinstance(new, dict)):
+        if _same(old, new):
+            return []
+        return [{'op': 'replace', 'path': path, 'value': new}]
+    ops = []
+    for key in old:
+        if key not in new:
+            ops.append({'op': 'remove', 'path': path + '/' + _escape(key)})
+    for key, value in new.iteritems():
+        key_path = path + '/' + _escape(key)
+        if key not in old:
+            ops.append({'op': 'add', 'path': key_path, 'value': value})
+        else:
+            ops.extend(make_patch(old[key], value, key_path))
+    return ops
+
+
+def apply_patch(obj, patch):
+    """Apply patch to obj, which is modified in place, and return the result.
+
+    :raises ValueError: when patch does not apply to obj.
+    """
+    for op in patch:
+        try:
+            kind = op['op']
+            path = op['path']
+        except (KeyError, TypeError):
+            raise ValueError('invalid operation: %r' % (op,))
+        if path == '':
+            if kind != 'replace':
+                raise ValueError('cannot %s the whole document' % (kind,))
+            obj = op['value']
+            continue
+        if not path.startswith('/'):
+            raise ValueError('invalid path: %r' % (path,))
+        tokens = map(_unescape, path[1:].split('/'))
+        parent = obj
+        for token in tokens[:-1]:
+            if not isinstance(parent, dict) or token not in parent:
+                raise ValueError('no such path: %r' % (path,))
+            parent = parent[token]
+        key = tokens[-1]
+        if not isinstance(parent, dict):
+            raise ValueError('no such path: %r' % (path,))
+        if kind == 'add' or kind == 'replace':
+            if kind == 'replace' and key not in parent:
+                raise ValueError('no such path: %r' % (path,))
+            try:
+                parent[key] = op['value']
+            except KeyError:
+                raise ValueError('invalid operation: %r' % (op,))
+        elif kind == 'remove':
+            if key not in parent:
+                raise ValueError('no such path: %r' % (path,))
+            del parent[key]
+        else:
+            raise ValueError('unsupported operation: %r' % (kind,))
+    return obj
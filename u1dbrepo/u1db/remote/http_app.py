@@ -19,8 +19,6 @@
 import functools
 import httplib
 import inspect
-import simplejson
-import sys
 import urlparse
 
 import routes.mapper
@@ -30,6 +28,7 @@ from u1db import (
     DBNAME_CONSTRAINTS,
     Document,
     errors,
+    json_codec,
     sync,
     )
 from u1db.remote import (
@@ -45,12 +44,69 @@ def parse_bool(expression):
     return False
 
 
+def parse_key(expression):
+    """Parse index key values querystring parameter, a JSON list."""
+    values = json_codec.loads(expression)
+    if not isinstance(values, list):
+        raise ValueError
+    for value in values:
+        if not isinstance(value, basestring):
+            raise ValueError
+    return tuple(values)
+
+
 class BadRequest(Exception):
     """Bad request."""
 
 
-class _FencedReader(object):
-    """Read and get lines from a file but not past a given length."""
+class _ChunkedInput(object):
+    """Decode a request body sent with chunked transfer encoding."""
+
+    MAX_SIZE_LINE = 1024
+
+    def __init__(self, rfile):
+        self.rfile = rfile
+        self._left = 0
+        self._done = False
+
+    def _next_chunk(self):
+        line = self.rfile.readline(self.MAX_SIZE_LINE)
+        try:
+            size = int(line.split(';', 1)[0], 16)
+        except ValueError:
+            raise BadRequest
+        if size < 0:
+            raise BadRequest
+        if size == 0:
+            # skip the trailer
+            while self.rfile.readline(self.MAX_SIZE_LINE) not in (
+                    '\r\n', '\n', ''):
+                pass
+            self._done = True
+        self._left = size
+
+    def read(self, atmost):
+        if self._left == 0 and not self._done:
+            self._next_chunk()
+        if self._done:
+            return ''
+        data = self.rfile.read(min(self._left, atmost))
+        if not data:  # truncated
+            raise BadRequest
+        self._left -= len(data)
+        if self._left == 0 and self.rfile.read(2) != '\r\n':
+            raise BadRequest
+        return data
+
+
+class _StreamReader(object):
+    """Read and get lines from a request body.
+
+    Only single lines are limited in size, by max_entry_size, so that streams
+    of any length can be processed one entry at a time.
+
+    :param total: The length of the body, or None to read rfile to its end.
+    """
 
     MAXCHUNK = 8192
 
@@ -65,12 +121,28 @@ class _FencedReader(object):
             # ignore atmost, kept data should be a subchunk anyway
             kept, self._kept = self._kept, None
             return kept
+        if self.remaining is None:
+            return self.rfile.read(atmost)
         if self.remaining == 0:
             return ''
         data = self.rfile.read(min(self.remaining, atmost))
         self.remaining -= len(data)
         return data
 
+    def read_body(self, max_size):
+        """Read the rest of the body, which must be at most max_size long."""
+        parts = []
+        size = 0
+        while True:
+            chunk = self.read_chunk(max_size + 1 - size)
+            if chunk == '':
+                break
+            size += len(chunk)
+            if size > max_size:
+                raise BadRequest
+            parts.append(chunk)
+        return ''.join(parts)
+
     def getline(self):
         line_parts = []
         size = 0
@@ -95,6 +167,16 @@ class _FencedReader(object):
         return ''.join(line_parts)
 
 
+class _DecodedInput(utils.DecompressingReader):
+    """Decompress a request body sent with a gzip or deflate encoding."""
+
+    def read(self, atmost):
+        try:
+            return super(_DecodedInput, self).read(atmost)
+        except errors.BrokenSyncStream:
+            raise BadRequest
+
+
 def http_method(**control):
     """Decoration for handling of query arguments and content for a HTTP
        method.
@@ -109,7 +191,7 @@ def http_method(**control):
 
        JSON deserialize content to arguments:
            w = http_method(content_as_args=True,...)(f)
-           w(self, args, content) => args.update(simplejson.loads(content));
+           w(self, args, content) => args.update(json_codec.loads(content));
                                      f(self, **args)
 
        Support conversions (e.g int):
@@ -142,7 +224,7 @@ def http_method(**control):
             if content is not None:
                 if content_as_args:
                     try:
-                        args.update(simplejson.loads(content))
+                        args.update(json_codec.loads(content))
                     except ValueError:
                         raise BadRequest()
                 else:
@@ -235,6 +317,7 @@ class DocResource(object):
     url_pattern = "/{dbname}/doc/{id:.*}"
 
     def __init__(self, dbname, id, state, responder):
+        self.dbname = dbname
         self.id = id
         self.responder = responder
         self.db = state.open_database(dbname)
@@ -257,6 +340,17 @@ class DocResource(object):
 
     @http_method(include_deleted=parse_bool)
     def get(self, include_deleted=False):
+        rev = self.db._get_doc_rev(self.id)
+        if (rev is not None and
+            self.responder.etag_matches(utils.rev_etag(rev))):
+            # the client has the content already, don't read it
+            self.responder.send_response_content('', status=304, headers={
+                'etag': utils.rev_etag(rev),
+                'x-u1db-rev': rev,
+                'x-u1db-has-conflicts': json_codec.dumps(
+                    self.db._has_conflicts(self.id))
+                })
+            return
         doc = self.db.get_doc(self.id, include_deleted=include_deleted)
         if doc is None:
             wire_descr = errors.DocumentDoesNotExist.wire_description
@@ -270,7 +364,7 @@ class DocResource(object):
             return
         headers = {
             'x-u1db-rev': doc.rev,
-            'x-u1db-has-conflicts': simplejson.dumps(doc.has_conflicts)
+            'x-u1db-has-conflicts': json_codec.dumps(doc.has_conflicts)
             }
         if doc.is_tombstone():
             self.responder.send_response_json(
@@ -279,10 +373,265 @@ class DocResource(object):
                error=errors.DOCUMENT_DELETED,
                headers=headers)
         else:
+            headers['etag'] = utils.rev_etag(doc.rev)
             self.responder.send_response_content(
                 doc.get_json(), headers=headers)
 
 
+@url_to_resource.register
+class DocsResource(object):
+    """Documents resource, to get many documents in one request.
+
+    The ids of the documents are posted as a stream, and the documents are
+    streamed back in the same order, leaving out the missing ones. An id
+    can come with the revision the client knows of the document; if it is
+    still the current one, the document is marked unchanged and its content
+    left out.
+    """
+
+    url_pattern = "/{dbname}/docs"
+    # posting only reads documents
+    reading_methods = ('GET', 'POST')
+    # How many documents are read in one go.
+    batch_size = 100
+
+    def __init__(self, dbname, state, responder):
+        self.dbname = dbname
+        self.responder = responder
+        self.db = state.open_database(dbname)
+
+    @http_method(check_for_conflicts=bool, include_deleted=bool,
+                 content_as_args=True)
+    def post_args(self, check_for_conflicts=True, include_deleted=False):
+        self._check_for_conflicts = check_for_conflicts
+        self._include_deleted = include_deleted
+        self._doc_ids = []
+        self._known_revs = {}
+
+    @http_method(content_as_args=True)
+    def post_stream_entry(self, id, known_rev=None):
+        self._doc_ids.append(id)
+        if known_rev is not None:
+            self._known_revs[id] = known_rev
+
+    def post_end(self):
+        self.responder.content_type = 'application/x-u1db-sync-stream'
+        self.responder.compress = True
+        self.responder.start_response(200)
+        self.responder.start_stream()
+        self.responder.stream_entry({})
+        for start in range(0, len(self._doc_ids), self.batch_size):
+            docs = self.db.get_docs(
+                self._doc_ids[start:start + self.batch_size],
+                check_for_conflicts=self._check_for_conflicts,
+                include_deleted=self._include_deleted)
+            for doc in docs:
+                if self._known_revs.get(doc.doc_id) == doc.rev:
+                    entry = dict(id=doc.doc_id, rev=doc.rev, unchanged=True)
+                else:
+                    entry = dict(id=doc.doc_id, rev=doc.rev,
+                                 content=doc.get_json())
+                if self._check_for_conflicts:
+                    entry['has_conflicts'] = doc.has_conflicts
+                self.responder.stream_entry(entry)
+        self.responder.end_stream()
+        self.responder.finish_response()
+
+
+@url_to_resource.register
+class BulkResource(object):
+    """Bulk resource, to put and delete many documents in one request.
+
+    The documents are posted as a stream, those without content are deleted.
+    A result is streamed back for each of them in the same order, either
+    its new revision or the error putting or deleting it failed with.
+    """
+
+    url_pattern = "/{dbname}/bulk"
+
+    def __init__(self, dbname, state, responder):
+        self.dbname = dbname
+        self.state = state
+        self.responder = responder
+        self.db = state.open_database(dbname)
+
+    @http_method(content_as_args=True)
+    def post_args(self):
+        self._results = []
+
+    @http_method(content_as_args=True)
+    def post_stream_entry(self, id, rev=None, content=None):
+        doc = Document(id, rev, content)
+        try:
+            # not while the stream is read
+            with self.state.writing(self.dbname):
+                if content is None:
+                    self.db.delete_doc(doc)
+                else:
+                    self.db.put_doc(doc)
+        except errors.U1DBError, e:
+            result = dict(id=id, error=e.wire_description)
+        else:
+            result = dict(id=id, rev=doc.rev)
+        self._results.append(result)
+
+    def post_end(self):
+        self.responder.content_type = 'application/x-u1db-sync-stream'
+        self.responder.compress = True
+        self.responder.start_response(200)
+        self.responder.start_stream()
+        self.responder.stream_entry({})
+        for result in self._results:
+            self.responder.stream_entry(result)
+        self.responder.end_stream()
+        self.responder.finish_response()
+
+
+@url_to_resource.register
+class IndexesResource(object):
+    """Resource listing the indexes of a database."""
+
+    url_pattern = "/{dbname}/indexes"
+
+    def __init__(self, dbname, state, responder):
+        self.dbname = dbname
+        self.responder = responder
+        self.db = state.open_database(dbname)
+
+    @http_method()
+    def get(self):
+        self.responder.send_response_json(
+            indexes=[{'name': name, 'expressions': expressions}
+                     for name, expressions in self.db.list_indexes()])
+
+
+@url_to_resource.register
+class RetiredReplicasResource(object):
+    """Resource of the replicas retired by a database."""
+
+    url_pattern = "/{dbname}/retired-replicas"
+
+    def __init__(self, dbname, state, responder):
+        self.responder = responder
+        self.db = state.open_database(dbname)
+
+    @http_method()
+    def get(self):
+        self.responder.send_response_json(
+            replica_uids=sorted(self.db.get_retired_replicas()))
+
+    @http_method(content_as_args=True)
+    def put(self, replica_uids):
+        if not isinstance(replica_uids, list):
+            raise BadRequest()
+        self.db.set_retired_replicas(replica_uids)
+        self.responder.send_response_json(200, ok=True)
+
+
+@url_to_resource.register
+class IndexResource(object):
+    """Index resource.
+
+    Getting it queries the index, either for the documents matching key or
+    for those between start and end, all lists of values encoded as JSON.
+    Matching documents are streamed back, at most limit of them if given;
+    the first entry of the stream then holds the cursor to pass to get the
+    next ones, if any. The cursor names the last document returned, and
+    the next page resumes after it even if documents were added or removed
+    before it; if it is not matched anymore, InvalidCursor is raised.
+    """
+
+    url_pattern = "/{dbname}/index/{index}"
+
+    def __init__(self, dbname, index, state, responder):
+        self.dbname = dbname
+        self.index = index
+        self.responder = responder
+        self.db = state.open_database(dbname)
+
+    @http_method(content_as_args=True)
+    def put(self, expressions):
+        if not isinstance(expressions, list):
+            raise BadRequest()
+        self.db.create_index(self.index, *expressions)
+        self.responder.send_response_json(200, ok=True)
+
+    @http_method()
+    def delete(self):
+        self.db.delete_index(self.index)
+        self.responder.send_response_json(200, ok=True)
+
+    @staticmethod
+    def _resume(docs, cursor):
+        """Return where the page after the one cursor ends begins in docs."""
+        try:
+            offset, doc_id = cursor.split(':', 1)
+            offset = int(offset)
+        except ValueError:
+            raise BadRequest()
+        if offset < 1:
+            raise BadRequest()
+        if offset <= len(docs) and docs[offset - 1].doc_id == doc_id:
+            return offset
+        # Documents came or went before it, look for it nearest to where it
+        # was, as documents matching several times are returned as often.
+        found = [i for i, doc in enumerate(docs) if doc.doc_id == doc_id]
+        if not found:
+            raise errors.InvalidCursor()
+        return min(found, key=lambda i: abs(i + 1 - offset)) + 1
+
+    @http_method(key=parse_key, start=parse_key, end=parse_key, limit=int)
+    def get(self, key=None, start=None, end=None, limit=None, cursor=None):
+        if limit is not None and limit < 1:
+            raise BadRequest()
+        if key is not None:
+            if start is not None or end is not None:
+                raise BadRequest()
+            docs = self.db.get_from_index(self.index, *key)
+        else:
+            docs = self.db.get_range_from_index(self.index, start, end)
+        res = {}
+        offset = 0
+        if cursor is not None:
+            offset = self._resume(docs, cursor)
+        if limit is None:
+            docs = docs[offset:]
+        else:
+            end_offset = offset + limit
+            if end_offset < len(docs):
+                res['cursor'] = '%d:%s' % (end_offset,
+                                           docs[end_offset - 1].doc_id)
+            docs = docs[offset:end_offset]
+        self.responder.content_type = 'application/x-u1db-sync-stream'
+        self.responder.compress = True
+        self.responder.start_response(200)
+        self.responder.start_stream()
+        self.responder.stream_entry(res)
+        for doc in docs:
+            self.responder.stream_entry(
+                dict(id=doc.doc_id, rev=doc.rev, content=doc.get_json()))
+        self.responder.end_stream()
+        self.responder.finish_response()
+
+
+@url_to_resource.register
+class IndexKeysResource(object):
+    """Resource of the keys under which an index has documents."""
+
+    url_pattern = "/{dbname}/index/{index}/keys"
+
+    def __init__(self, dbname, index, state, responder):
+        self.dbname = dbname
+        self.index = index
+        self.responder = responder
+        self.db = state.open_database(dbname)
+
+    @http_method()
+    def get(self):
+        self.responder.send_response_json(
+            keys=self.db.get_index_keys(self.index))
+
+
 @url_to_resource.register
 class SyncResource(object):
     """Sync endpoint resource."""
@@ -291,9 +640,14 @@ class SyncResource(object):
 
     # pluggable
     sync_exchange_class = sync.SyncExchange
+    # How many incoming documents are inserted in one go, see
+    # SyncExchange.insert_docs_from_source.
+    batch_size = 100
 
     def __init__(self, dbname, source_replica_uid, state, responder):
+        self.dbname = dbname
         self.source_replica_uid = source_replica_uid
+        self.state = state
         self.responder = responder
         self.db = state.open_database(dbname)
         self.target = self.db.get_sync_target()
@@ -301,11 +655,21 @@ class SyncResource(object):
     @http_method()
     def get(self):
         result = self.target.get_sync_info(self.source_replica_uid)
-        self.responder.send_response_json(
-            target_replica_uid=result[0], target_replica_generation=result[1],
-            source_replica_uid=self.source_replica_uid,
-            source_replica_generation=result[2],
-            source_transaction_id=result[3])
+        info = dict(target_replica_uid=result[0],
+                    target_replica_generation=result[1],
+                    source_replica_uid=self.source_replica_uid,
+                    source_replica_generation=result[2],
+                    source_transaction_id=result[3])
+        retired_replicas = self.target.get_retired_replicas()
+        if retired_replicas:
+            # saves the Synchronizer asking for them
+            info['retired_replicas'] = sorted(retired_replicas)
+        # let the client know it can compress the sync stream it sends
+        headers = {'accept-encoding': ', '.join(utils.SYNC_ENCODINGS)}
+        if self.state.accept_chunked:
+            # and send it without computing its length first
+            headers['accept-transfer-encoding'] = 'chunked'
+        self.responder.send_response_json(headers=headers, **info)
 
     @http_method(generation=int,
                  content_as_args=True, no_query=True)
@@ -316,29 +680,70 @@ class SyncResource(object):
 
     # Implements the same logic as LocalSyncTarget.sync_exchange
 
-    @http_method(last_known_generation=int,
-                 content_as_args=True)
-    def post_args(self, last_known_generation):
+    @http_method(last_known_generation=int, deltas=bool,
+                 sync_filter=sync.SyncFilter.from_dict, content_as_args=True)
+    def post_args(self, last_known_generation, deltas=False,
+                  sync_filter=None):
+        kwargs = {}
+        if deltas:
+            # the source can take documents as patches
+            kwargs['revision_cache'] = self.state.get_revision_cache(
+                self.dbname, self.source_replica_uid)
+        if sync_filter is not None:
+            kwargs['sync_filter'] = sync_filter
         self.sync_exch = self.sync_exchange_class(self.db,
                                                   self.source_replica_uid,
-                                                  last_known_generation)
+                                                  last_known_generation,
+                                                  **kwargs)
+        self._incoming = []
 
     @http_method(content_as_args=True)
-    def post_stream_entry(self, id, rev, content, gen, trans_id):
-        doc = Document(id, rev, content)
-        self.sync_exch.insert_doc_from_source(doc, gen, trans_id)
+    def post_stream_entry(self, id, rev, gen, trans_id, content=None,
+                          base_rev=None, patch=None):
+        if patch is not None:
+            doc = sync.DocumentDelta(id, rev, base_rev, patch)
+        else:
+            doc = Document(id, rev, content)
+        self._incoming.append((doc, gen, trans_id))
+        if len(self._incoming) >= self.batch_size:
+            self._insert_incoming()
+
+    def _insert_incoming(self):
+        if self._incoming:
+            try:
+                # not while the stream is read, or the response sent
+                with self.state.writing(self.dbname):
+                    self.sync_exch.insert_docs_from_source(self._incoming)
+            except errors.BrokenSyncStream:  # a patch did not apply
+                raise BadRequest
+            self._incoming = []
 
     def post_end(self):
         def send_doc(doc, gen, trans_id):
-            entry = dict(id=doc.doc_id, rev=doc.rev, content=doc.get_json(),
-                         gen=gen, trans_id=trans_id)
+            if isinstance(doc, sync.FilteredOutDocument):
+                entry = dict(id=doc.doc_id, rev=doc.rev, filtered_out=True,
+                             gen=gen, trans_id=trans_id)
+            elif isinstance(doc, sync.DocumentDelta):
+                entry = dict(id=doc.doc_id, rev=doc.rev,
+                             base_rev=doc.base_rev, patch=doc.patch,
+                             gen=gen, trans_id=trans_id)
+            else:
+                entry = dict(id=doc.doc_id, rev=doc.rev,
+                             content=doc.get_json(), gen=gen,
+                             trans_id=trans_id)
             self.responder.stream_entry(entry)
+        self._insert_incoming()
         new_gen = self.sync_exch.find_changes_to_return()
         self.responder.content_type = 'application/x-u1db-sync-stream'
+        self.responder.compress = True
         self.responder.start_response(200)
         self.responder.start_stream(),
-        self.responder.stream_entry({"new_generation": new_gen,
-                     "new_transaction_id": self.sync_exch.new_trans_id})
+        res = {"new_generation": new_gen,
+               "new_transaction_id": self.sync_exch.new_trans_id}
+        if self.sync_exch.missing_bases:
+            # to be sent again whole
+            res["missing_bases"] = self.sync_exch.missing_bases
+        self.responder.stream_entry(res)
         new_gen = self.sync_exch.return_docs(send_doc)
         self.responder.end_stream()
         self.responder.finish_response()
@@ -350,38 +755,71 @@ class HTTPResponder(object):
     # a multi document response will put args and documents
     # each on one line of the response body
 
-    def __init__(self, start_response):
+    def __init__(self, start_response, accept_encoding=None,
+                 if_none_match=None):
         self._started = False
         self._stream_state = -1
         self._no_initial_obj = True
         self.sent_response = False
         self._start_response = start_response
+        self._accept_encoding = accept_encoding
+        self._if_none_match = if_none_match
+        self._compressor = None
         self._write = None
         self.content_type = 'application/json'
+        # compress a response of unknown length if the client accepts it
+        self.compress = False
         self.content = []
 
+    def etag_matches(self, etag):
+        """Tell whether the request was conditional on not matching etag."""
+        return utils.etag_matches(self._if_none_match, etag)
+
     def start_response(self, status, obj_dic=None, headers={}):
         """start sending response with optional first json object."""
         if self._started:
             return
         self._started = True
         status_text = httplib.responses[status]
-        self._write = self._start_response('%d %s' % (status, status_text),
-                                         [('content-type', self.content_type),
-                                          ('cache-control', 'no-cache')] +
-                                             headers.items())
+        encoding = None
+        if self.compress and 'content-length' not in headers:
+            encoding = utils.choose_encoding(self._accept_encoding)
+        if encoding is not None:
+            headers = dict(headers, **{'content-encoding': encoding})
+        response_headers = [('cache-control', 'no-cache')]
+        if status != 304:  # not modified responses have no content
+            response_headers.insert(0, ('content-type', self.content_type))
+        write = self._start_response('%d %s' % (status, status_text),
+                                     response_headers + headers.items())
+        if encoding is not None:
+            self._compressor = utils.compressor(encoding)
+            compress = self._compressor.compress
+
+            def write_compressed(data):
+                data = compress(data)
+                if data:
+                    write(data)
+
+            self._write = write_compressed
+        else:
+            self._write = write
         # xxx version in headers
         if obj_dic is not None:
             self._no_initial_obj = False
-            self._write(simplejson.dumps(obj_dic) + "\r\n")
+            self._write(json_codec.dumps(obj_dic) + "\r\n")
 
     def finish_response(self):
         """finish sending response."""
+        if self._compressor is not None:
+            # content goes after what was written, compressed with it
+            compressor, self._compressor = self._compressor, None
+            self.content = [compressor.compress(''.join(self.content)) +
+                            compressor.flush()]
         self.sent_response = True
 
     def send_response_json(self, status=200, headers={}, **kwargs):
         """send and finish response with json object body from keyword args."""
-        content = simplejson.dumps(kwargs) + "\r\n"
+        content = json_codec.dumps(kwargs) + "\r\n"
         self.send_response_content(content, headers=headers, status=status)
 
     def send_response_content(self, content, status=200, headers={}):
@@ -408,7 +846,7 @@ class HTTPResponder(object):
             self._write('\r\n')
         else:
             self._write(',\r\n')
-        self._write(simplejson.dumps(entry))
+        self._write(json_codec.dumps(entry))
 
     def end_stream(self):
         "end stream (array)."
@@ -419,11 +857,25 @@ class HTTPResponder(object):
 class HTTPInvocationByMethodWithBody(object):
     """Invoke methods on a resource."""
 
-    def __init__(self, resource, environ, parameters):
+    def __init__(self, resource, environ, parameters, writing=None):
+        """Create a new HTTPInvocationByMethodWithBody.
+
+        :param writing: None, or a function returning the context to call
+            the method in, once its content is read, see
+            ServerState.writing. Resources taking streams call it
+            themselves around their writes.
+        """
         self.resource = resource
         self.environ = environ
         self.max_request_size = parameters.max_request_size
         self.max_entry_size = parameters.max_entry_size
+        self.writing = writing
+
+    def _call(self, meth, args, body):
+        if self.writing is None:
+            return meth(args, body)
+        with self.writing():
+            return meth(args, body)
 
     def _lookup(self, method):
         try:
@@ -442,25 +894,44 @@ class HTTPInvocationByMethodWithBody(object):
         method = self.environ['REQUEST_METHOD'].lower()
         if method in ('get', 'delete'):
             meth = self._lookup(method)
-            return meth(args, None)
+            return self._call(meth, args, None)
         else:
-            # we expect content-length > 0, reconsider if we move
-            # to support chunked enconding
-            try:
-                content_length = int(self.environ['CONTENT_LENGTH'])
-            except (ValueError, KeyError):
-                raise BadRequest
-            if content_length <= 0:
-                raise BadRequest
-            if content_length > self.max_request_size:
-                raise BadRequest
-            reader = _FencedReader(self.environ['wsgi.input'], content_length,
-                                   self.max_entry_size)
             content_type = self.environ.get('CONTENT_TYPE')
+            rfile = self.environ['wsgi.input']
+            transfer_encoding = self.environ.get('HTTP_TRANSFER_ENCODING', '')
+            if transfer_encoding.lower() == 'chunked':
+                content_length = None
+                if not self.environ.get('wsgi.input_terminated'):
+                    # the server left the chunks for us to decode
+                    rfile = _ChunkedInput(rfile)
+            else:
+                try:
+                    content_length = int(self.environ['CONTENT_LENGTH'])
+                except (ValueError, KeyError):
+                    raise BadRequest
+                if content_length <= 0:
+                    raise BadRequest
+                # sync streams are only limited entry by entry
+                if (content_length > self.max_request_size and
+                    content_type != 'application/x-u1db-sync-stream'):
+                    raise BadRequest
+            reader = _StreamReader(rfile, content_length, self.max_entry_size)
+            content_encoding = self.environ.get('HTTP_CONTENT_ENCODING',
+                                                'identity').lower()
+            if content_encoding in utils.SYNC_ENCODINGS:
+                # limits apply to the decompressed body
+                reader = _StreamReader(
+                    _DecodedInput(reader.read_chunk, content_encoding,
+                                  _StreamReader.MAXCHUNK),
+                    None, self.max_entry_size)
+            elif content_encoding != 'identity':
+                raise BadRequest
             if content_type == 'application/json':
                 meth = self._lookup(method)
-                body = reader.read_chunk(sys.maxint)
-                return meth(args, body)
+                body = reader.read_body(self.max_request_size)
+                if not body:
+                    raise BadRequest
+                return self._call(meth, args, body)
             elif content_type == 'application/x-u1db-sync-stream':
                 meth_args = self._lookup('%s_args' % method)
                 meth_entry = self._lookup('%s_stream_entry' % method)
@@ -489,7 +960,7 @@ class HTTPInvocationByMethodWithBody(object):
 
 class HTTPApp(object):
 
-    # maximum allowed request body size
+    # maximum allowed request body size, except for sync streams
     max_request_size = 15 * 1024 * 1024  # 15Mb
     # maximum allowed entry/line size in request body
     max_entry_size = 10 * 1024 * 1024    # 10Mb
@@ -506,11 +977,22 @@ class HTTPApp(object):
         return resource
 
     def __call__(self, environ, start_response):
-        responder = HTTPResponder(start_response)
+        responder = HTTPResponder(start_response,
+                                  environ.get('HTTP_ACCEPT_ENCODING'),
+                                  environ.get('HTTP_IF_NONE_MATCH'))
         self.request_begin(environ)
         try:
             resource = self._lookup_resource(environ, responder)
-            HTTPInvocationByMethodWithBody(resource, environ, self)()
+            dbname = getattr(resource, 'dbname', None)
+            reading_methods = getattr(resource, 'reading_methods', ('GET',))
+            if (dbname is None or
+                environ['REQUEST_METHOD'] in reading_methods):
+                writing = None
+            else:
+                writing = functools.partial(self.state.writing, dbname)
+            invoke = HTTPInvocationByMethodWithBody(resource, environ, self,
+                                                    writing)
+            invoke()
         except errors.U1DBError, e:
             self.request_u1db_error(environ, e)
             status = http_errors.wire_description_to_status.get(
@@ -527,6 +1009,8 @@ class HTTPApp(object):
             raise
         else:
             self.request_done(environ)
+        finally:
+            self.state.release_databases()
         return responder.content
 
     # hooks for tracing requests
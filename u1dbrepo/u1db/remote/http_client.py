@@ -16,20 +16,27 @@
 
 """Base class to make requests to a remote HTTP server."""
 
+import collections
+import errno
 import httplib
 from oauth import oauth
-import simplejson
+import random
+import select
 import socket
 import ssl
 import sys
+import threading
+import time
 import urlparse
 import urllib
 
 from u1db import (
     errors,
+    json_codec,
     )
 from u1db.remote import (
     http_errors,
+    utils,
     )
 
 from u1db.remote.ssl_match_hostname import (
@@ -80,8 +87,132 @@ class _VerifiedHTTPSConnection(httplib.HTTPSConnection):
             match_hostname(self.sock.getpeercert(), self.host)
 
 
+def _is_dropped(conn):
+    """Tell whether the server closed the idle connection conn."""
+    sock = conn.sock
+    if sock is None:
+        # not connected, connects again on the next request
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+        return True
+    # an idle connection has nothing to read, but its end
+    return bool(readable)
+
+
+def _closed_unused(error, sent):
+    """Tell whether error says the server closed a connection kept alive
+    before taking the request made on it.
+
+    :param sent: Whether the request was sent whole before error.
+    """
+    if isinstance(error, socket.timeout):
+        # the server may just be slow to answer
+        return False
+    if not sent:
+        return True
+    if isinstance(error, httplib.BadStatusLine):
+        # older Pythons report the empty status line as such
+        return (error.line in ('', "''") or
+                error.line.startswith('No status line received'))
+    return (isinstance(error, socket.error) and
+            error.errno == errno.ECONNRESET)
+
+
+class ConnectionPool(object):
+    """Keep-alive connections to a server, shared between threads.
+
+    A connection is used by one thread at a time, and put back once its
+    response has been read whole. Idle connections the server closed in
+    the meantime are dropped when taken again.
+    """
+
+    def __init__(self, make_connection, max_idle=4):
+        """Create a new ConnectionPool.
+
+        :param make_connection: Called to make a new connection.
+        :param max_idle: How many idle connections to keep at most.
+        """
+        self._make_connection = make_connection
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def get(self):
+        """Take an idle connection, or make a new one."""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn = self._idle.pop()
+            if not _is_dropped(conn):
+                return conn
+            conn.close()
+        return self._make_connection()
+
+    def put(self, conn):
+        """Put back a connection taken with get."""
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """Close the idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class RequestMetrics(object):
+    """The latency of the requests made by clients.
+
+    Every request sent is recorded, retries included. The last ones are
+    kept in recent as (method, path, status, seconds, attempt) tuples,
+    where status is None for requests that got no response and attempt
+    counts the retries before the request.
+    """
+
+    keep_recent = 100
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.recent = collections.deque(maxlen=self.keep_recent)
+        # method -> [count, total seconds, max seconds, failures]
+        self._by_method = {}
+
+    def record(self, method, path, status, seconds, attempt=0):
+        with self._lock:
+            self.recent.append((method, path, status, seconds, attempt))
+            totals = self._by_method.setdefault(method, [0, 0.0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] = max(totals[2], seconds)
+            if status is None or status >= 500:
+                totals[3] += 1
+
+    def summary(self):
+        """Return the request count, mean and max seconds, and failures
+        (no response or a 5xx status) per method.
+        """
+        with self._lock:
+            return dict(
+                (method, {'count': count, 'mean': total / count,
+                          'max': slowest, 'failures': failures})
+                for method, (count, total, slowest, failures)
+                in self._by_method.iteritems())
+
+
 class HTTPClientBase(object):
-    """Base class to make requests to a remote HTTP server."""
+    """Base class to make requests to a remote HTTP server.
+
+    Connections are taken from a pool for each request, so that clients
+    can be used from several threads and keep connections alive across
+    requests.
+    """
 
     # by default use HMAC-SHA1 OAuth signature method to not disclose
     # tokens
@@ -90,10 +221,31 @@ class HTTPClientBase(object):
     # attacks for example) one would need HTTPS
     oauth_signature_method = oauth.OAuthSignatureMethod_HMAC_SHA1()
 
+    # Requests failing with 503 are retried up to max_retries times, and so
+    # are the ones failing without a response when they are idempotent.
+    # Others are only retried when the server closed the connection kept
+    # alive for them before taking them: sending them failed, or it closed
+    # without sending a byte. Timeouts leave them maybe applied. The delay
+    # before retrying doubles with each failure from min_backoff up to
+    # max_backoff seconds, and is jittered so that clients turned away
+    # together do not come back together. A 503 asking in its Retry-After
+    # header for a longer delay than max_backoff is not retried.
+    max_retries = 2
+    min_backoff = 0.1
+    max_backoff = 5.0
+    # PUT and DELETE carry the revision they replace, sent again after
+    # succeeding they would fail with a conflict
+    idempotent_methods = ('GET', 'HEAD')
+
     def __init__(self, url):
         self._url = urlparse.urlsplit(url)
-        self._conn = None
+        self._pool = ConnectionPool(self._make_connection)
+        # the connection in use by each thread
+        self._local = threading.local()
+        self.metrics = RequestMetrics()
         self._oauth_creds = None
+        # The codec set with set_json_codec, None for the default.
+        self._json_codec = None
 
     def set_oauth_credentials(self, consumer_key, consumer_secret,
                               token_key, token_secret):
@@ -101,21 +253,125 @@ class HTTPClientBase(object):
             oauth.OAuthConsumer(consumer_key, consumer_secret),
             oauth.OAuthToken(token_key, token_secret))
 
-    def _ensure_connection(self):
-        if self._conn is not None:
-            return
+    def set_json_codec(self, codec):
+        if codec is not None:
+            codec = json_codec.get_codec(codec)
+        self._json_codec = codec
+
+    def _get_json_codec(self):
+        return json_codec.get_codec(self._json_codec)
+
+    def _get_conn(self):
+        return getattr(self._local, 'conn', None)
+
+    def _set_conn(self, conn):
+        self._local.conn = conn
+
+    _conn = property(_get_conn, _set_conn)
+
+    def _make_connection(self):
         if self._url.scheme == 'https':
             connClass = _VerifiedHTTPSConnection
         else:
             connClass = httplib.HTTPConnection
-        self._conn = connClass(self._url.hostname, self._url.port)
+        return connClass(self._url.hostname, self._url.port)
+
+    def _ensure_connection(self):
+        if self._conn is not None:
+            return
+        self._conn = self._pool.get()
+
+    def _release_connection(self, resp):
+        """Put the connection of this thread back in the pool.
+
+        :param resp: The response read on the connection, None if there
+            was none; the connection is closed unless it was read whole.
+        """
+        conn = self._conn
+        if conn is None:
+            return
+        self._conn = None
+        if resp is None or not resp.isclosed():
+            conn.close()
+        self._pool.put(conn)
 
     def close(self):
         if self._conn:
             self._conn.close()
             self._conn = None
+        self._pool.close()
 
-    # xxx retry mechanism?
+    def _retry_delay(self, method, attempt, resp, reused, error, sent):
+        """Return how long to wait before retrying, None not to retry.
+
+        :param sent: Whether the request was sent whole.
+        """
+        if attempt >= self.max_retries:
+            return None
+        if resp is None:
+            # no response, the request may not have been seen at all
+            if not isinstance(error, (socket.error, httplib.HTTPException)):
+                return None
+            if isinstance(error, ssl.SSLError) and not reused:
+                # a failed handshake fails again
+                return None
+            if method not in self.idempotent_methods and not (
+                    reused and _closed_unused(error, sent)):
+                return None
+        elif resp.status != 503:
+            return None
+        delay = min(self.max_backoff, self.min_backoff * 2 ** attempt)
+        delay = random.uniform(delay / 2, delay)
+        if resp is not None:
+            try:
+                retry_after = float(resp.getheader('retry-after'))
+            except (TypeError, ValueError):
+                pass
+            else:
+                if retry_after > self.max_backoff:
+                    return None
+                delay = max(delay, retry_after)
+        return delay
+
+    def _perform(self, method, url_query, send, read, retry=True):
+        """Make a request with a connection from the pool.
+
+        :param send: Called with the connection to send the request.
+        :param read: Called with the response to read it, returning the
+            result.
+        :param retry: Whether the request can be sent again, see
+            max_retries.
+        :return: What read returned.
+        """
+        path = url_query.split('?', 1)[0]
+        attempt = 0
+        while True:
+            self._ensure_connection()
+            conn = self._conn
+            reused = conn.sock is not None
+            resp = status = None
+            sent = False
+            start = time.time()
+            try:
+                send(conn)
+                sent = True
+                resp = conn.getresponse()
+                status = resp.status
+                return read(resp)
+            except Exception, e:
+                exc_info = sys.exc_info()
+                if not retry:
+                    raise
+                delay = self._retry_delay(method, attempt, resp, reused, e,
+                                          sent)
+                if delay is None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+            finally:
+                self.metrics.record(method, path, status,
+                                    time.time() - start, attempt)
+                self._release_connection(resp)
+            attempt += 1
+            time.sleep(delay)
 
     def _error(self, respdic):
         descr = respdic.get("error")
@@ -124,23 +380,26 @@ class HTTPClientBase(object):
             message = respdic.get("message")
             raise exc_cls(message)
 
-    def _response(self):
-        resp = self._conn.getresponse()
+    def _response(self, resp):
         body = resp.read()
         headers = dict(resp.getheaders())
         if resp.status in (200, 201):
             return body, headers
-        elif resp.status in http_errors.ERROR_STATUSES:
+        self._response_error(resp.status, body, headers)
+
+    def _response_error(self, status, body, headers):
+        """Raise the error for an unsuccessful response."""
+        if status in http_errors.ERROR_STATUSES:
             try:
-                respdic = simplejson.loads(body)
+                respdic = self._get_json_codec().loads(body)
             except ValueError:
                 pass
             else:
                 self._error(respdic)
         # special case
-        if resp.status == 503:
+        if status == 503:
             raise errors.Unavailable(body, headers)
-        raise errors.HTTPError(resp.status, body, headers)
+        raise errors.HTTPError(status, body, headers)
 
     def _sign_request(self, method, url_query, params):
         if self._oauth_creds:
@@ -160,9 +419,8 @@ class HTTPClientBase(object):
         else:
             return []
 
-    def _request(self, method, url_parts, params=None, body=None,
-                                                       content_type=None):
-        self._ensure_connection()
+    def _build_url(self, url_parts, params):
+        """Return (url with query, unquoted url, encoded params)."""
         unquoted_url = url_query = self._url.path
         if url_parts:
             if not url_query.endswith('/'):
@@ -178,19 +436,129 @@ class HTTPClientBase(object):
                 key = unicode(key).encode('utf-8')
                 encoded_params[key] = _encode_query_parameter(value)
             url_query += ('?' + urllib.urlencode(encoded_params))
+        return url_query, unquoted_url, encoded_params
+
+    def _request(self, method, url_parts, params=None, body=None,
+                 content_type=None, headers=None):
+        url_query, unquoted_url, encoded_params = self._build_url(url_parts,
+                                                                  params)
         if body is not None and not isinstance(body, basestring):
-            body = simplejson.dumps(body)
+            body = self._get_json_codec().dumps(body)
             content_type = 'application/json'
-        headers = {}
+        headers = dict(headers or {})
         if content_type:
             headers['content-type'] = content_type
-        headers.update(
-            self._sign_request(method, unquoted_url, encoded_params))
-        self._conn.request(method, url_query, body, headers)
-        return self._response()
+
+        def send(conn):
+            # signed again for every attempt, oauth nonces are single use
+            signed_headers = dict(headers)
+            signed_headers.update(
+                self._sign_request(method, unquoted_url, encoded_params))
+            conn.request(method, url_query, body, signed_headers)
+
+        return self._perform(method, url_query, send, self._response)
 
     def _request_json(self, method, url_parts, params=None, body=None,
                                                             content_type=None):
         res, headers = self._request(method, url_parts, params, body,
                                      content_type)
-        return simplejson.loads(res), headers
+        return self._get_json_codec().loads(res), headers
+
+    def _iter_stream(self, args, entries):
+        """Encode a stream, of args and then entries, one line at a time.
+
+        Streams are JSON lists with an element per line, of the format
+        sync_exchange uses.
+        """
+        codec = self._get_json_codec()
+        yield '[\r\n' + codec.dumps(args)
+        for entry in entries:
+            yield ',\r\n' + codec.dumps(entry)
+        yield '\r\n]'
+
+    def _parse_stream(self, lines, entry_cb):
+        """Parse a streamed response, returning its first entry.
+
+        The other entries are handed to entry_cb as soon as their line is
+        parsed; a line is only told apart from the closing ']' by looking at
+        the next one.
+
+        :param lines: An iterable over the lines of the response.
+        """
+        codec = self._get_json_codec()
+        lines = iter(lines)
+        if next(lines, None) != '[':
+            raise errors.BrokenSyncStream
+        res = None
+        comma = False
+        line = None
+        for next_line in lines:
+            if line is not None:
+                if res is None:
+                    line, comma = utils.check_and_strip_comma(line)
+                    res = codec.loads(line)
+                else:
+                    if not comma:  # missing in between comma
+                        raise errors.BrokenSyncStream
+                    line, comma = utils.check_and_strip_comma(line)
+                    entry_cb(codec.loads(line))
+            line = next_line
+        if line != ']':
+            try:
+                partdic = codec.loads(line)
+            except (TypeError, ValueError):
+                pass
+            else:
+                if isinstance(partdic, dict):
+                    self._error(partdic)
+            raise errors.BrokenSyncStream
+        if res is None or comma:  # no first entry, or bad extra comma
+            raise errors.BrokenSyncStream
+        return res
+
+    def _response_lines(self, resp):
+        """Return an iterator over the lines of the streamed body of resp.
+
+        The body is decompressed if needed.
+        """
+        if resp.status not in (200, 201):
+            self._response_error(resp.status, resp.read(),
+                                 dict(resp.getheaders()))
+        read = resp.read
+        content_encoding = resp.getheader('content-encoding', 'identity')
+        if content_encoding in utils.SYNC_ENCODINGS:
+            read = utils.DecompressingReader(read, content_encoding).read
+        elif content_encoding != 'identity':
+            raise errors.BrokenSyncStream
+        return utils.iter_lines(read)
+
+    def _request_stream(self, method, url_parts, params, args, entries,
+                        entry_cb):
+        """Send a stream of args and entries, and parse the one returned.
+
+        :param args: The first entry of the stream sent, or None to send
+            no body.
+        :return: The first entry of the response, the others are handed to
+            entry_cb.
+        """
+        url_query, unquoted_url, encoded_params = self._build_url(url_parts,
+                                                                  params)
+        headers = {'accept-encoding': ', '.join(utils.SYNC_ENCODINGS)}
+        if args is None:
+            body = None
+        else:
+            body = ''.join(self._iter_stream(args, entries))
+            headers['content-type'] = 'application/x-u1db-sync-stream'
+
+        def send(conn):
+            signed_headers = dict(headers)
+            signed_headers.update(
+                self._sign_request(method, unquoted_url, encoded_params))
+            conn.request(method, url_query, body, signed_headers)
+
+        def read(resp):
+            return self._parse_stream(self._response_lines(resp), entry_cb)
+
+        # a 503 comes before any entry, and other failures are not retried
+        # once there is a response, so entry_cb never sees an entry twice
+        return self._perform(method, url_query, send, read)
@@ -16,35 +16,60 @@
 
 """HTTPDatabase to access a remote db over the HTTP API."""
 
-import simplejson
 import uuid
 
 from u1db import (
     Database,
     Document,
     errors,
+    sync,
     )
 from u1db.remote import (
     http_client,
     http_errors,
     http_target,
+    utils,
     )
 
 
 DOCUMENT_DELETED_STATUS = http_errors.wire_description_to_status[
     errors.DOCUMENT_DELETED]
+NOT_MODIFIED_STATUS = 304
 
 
 class HTTPDatabase(http_client.HTTPClientBase, Database):
-    """Implement the Database API to a remote HTTP server."""
+    """Implement the Database API to a remote HTTP server.
+
+    The content of the documents last got or put is kept in a
+    sync.RevisionCache, and documents are only fetched again if their
+    revision changed.
+    """
 
     def __init__(self, url, document_factory=None):
         super(HTTPDatabase, self).__init__(url)
         self._factory = document_factory or Document
+        self._revision_cache = sync.RevisionCache()
 
     def set_document_factory(self, factory):
         self._factory = factory
 
+    def set_revision_cache(self, revision_cache):
+        """Keep the documents got and put in revision_cache.
+
+        :param revision_cache: A sync.RevisionCache, or None to always fetch
+            documents whole.
+        """
+        self._revision_cache = revision_cache
+
+    def _cache(self, doc):
+        if self._revision_cache is not None:
+            self._revision_cache.add(doc)
+
+    def _cached(self, doc_id):
+        if self._revision_cache is None:
+            return None
+        return self._revision_cache.latest(doc_id)
+
     @staticmethod
     def open_database(url, create):
         db = HTTPDatabase(url)
@@ -81,12 +106,18 @@ class HTTPDatabase(http_client.HTTPClientBase, Database):
         res, headers = self._request_json('PUT', ['doc', doc.doc_id], params,
                                           doc.get_json(), 'application/json')
         doc.rev = res['rev']
+        self._cache(doc)
         return res['rev']
 
     def get_doc(self, doc_id, include_deleted=False):
+        cached = self._cached(doc_id)
+        request_headers = {}
+        if cached is not None:
+            request_headers['if-none-match'] = utils.rev_etag(cached[0])
         try:
             res, headers = self._request(
-                'GET', ['doc', doc_id], {"include_deleted": include_deleted})
+                'GET', ['doc', doc_id], {"include_deleted": include_deleted},
+                headers=request_headers)
         except errors.DocumentDoesNotExist:
             return None
         except errors.HTTPError, e:
@@ -94,20 +125,96 @@ class HTTPDatabase(http_client.HTTPClientBase, Database):
                 'x-u1db-rev' in e.headers):
                 res = None
                 headers = e.headers
+            elif (e.status == NOT_MODIFIED_STATUS and cached is not None and
+                  e.headers.get('x-u1db-rev') == cached[0]):
+                res = cached[1]
+                headers = e.headers
             else:
                 raise
         doc_rev = headers['x-u1db-rev']
-        has_conflicts = simplejson.loads(headers['x-u1db-has-conflicts'])
+        has_conflicts = self._get_json_codec().loads(
+            headers['x-u1db-has-conflicts'])
         doc = self._factory(doc_id, doc_rev, res)
         doc.has_conflicts = has_conflicts
+        self._cache(doc)
         return doc
 
+    def get_docs(self, doc_ids, check_for_conflicts=True,
+                 include_deleted=False):
+        docs = []
+        # the contents known for the ids asked for
+        known = {}
+        entries = []
+        for doc_id in doc_ids:
+            entry = {'id': doc_id}
+            cached = self._cached(doc_id)
+            if cached is not None:
+                known[doc_id] = cached
+                entry['known_rev'] = cached[0]
+            entries.append(entry)
+
+        def receive_entry(entry):
+            if entry.get('unchanged'):
+                rev, content = known[entry['id']]
+                if rev != entry['rev']:
+                    raise errors.BrokenSyncStream
+            else:
+                content = entry['content']
+            doc = self._factory(entry['id'], entry['rev'], content)
+            if 'has_conflicts' in entry:
+                doc.has_conflicts = entry['has_conflicts']
+            self._cache(doc)
+            docs.append(doc)
+
+        self._request_stream(
+            'POST', ['docs'], None,
+            {'check_for_conflicts': check_for_conflicts,
+             'include_deleted': include_deleted},
+            entries, receive_entry)
+        return docs
+
+    def put_docs(self, docs):
+        """Put and delete many documents in one request.
+
+        Documents without content are deleted, the others are put, and the
+        revision of each is updated if that succeeds.
+
+        :param docs: A list of Documents.
+        :return: A list with, for each document in order, None if it was
+            stored or the U1DBError it failed with.
+        """
+        entries = []
+        for doc in docs:
+            if doc.doc_id is None:
+                raise errors.InvalidDocId()
+            entry = {'id': doc.doc_id, 'content': doc.get_json()}
+            if doc.rev is not None:
+                entry['rev'] = doc.rev
+            entries.append(entry)
+        results = []
+        self._request_stream('POST', ['bulk'], None, {}, entries,
+                             results.append)
+        if len(results) != len(docs):
+            raise errors.BrokenSyncStream
+        failures = []
+        for doc, result in zip(docs, results):
+            if 'error' in result:
+                exc_cls = errors.wire_description_to_exc.get(
+                    result['error'], errors.U1DBError)
+                failures.append(exc_cls())
+            else:
+                doc.rev = result['rev']
+                self._cache(doc)
+                failures.append(None)
+        return failures
+
     def create_doc(self, content, doc_id=None):
         if doc_id is None:
             doc_id = 'D-%s' % (uuid.uuid4().hex,)
         res, headers = self._request_json('PUT', ['doc', doc_id], {},
                                           content, 'application/json')
         new_doc = self._factory(doc_id, res['rev'], content)
+        self._cache(new_doc)
         return new_doc
 
     def delete_doc(self, doc):
@@ -118,8 +225,101 @@ class HTTPDatabase(http_client.HTTPClientBase, Database):
             ['doc', doc.doc_id], params)
         doc.make_tombstone()
         doc.rev = res['rev']
+        self._cache(doc)
+
+    def create_index(self, index_name, *index_expressions):
+        self._request_json('PUT', ['index', index_name], {},
+                           {'expressions': list(index_expressions)})
+
+    def delete_index(self, index_name):
+        self._request_json('DELETE', ['index', index_name])
+
+    def list_indexes(self):
+        res, headers = self._request_json('GET', ['indexes'])
+        return [(index['name'], index['expressions'])
+                for index in res['indexes']]
+
+    def get_retired_replicas(self):
+        res, headers = self._request_json('GET', ['retired-replicas'])
+        return frozenset(res['replica_uids'])
+
+    def set_retired_replicas(self, replica_uids):
+        self._request_json('PUT', ['retired-replicas'], {},
+                           {'replica_uids': sorted(replica_uids)})
+
+    def _query_index(self, index_name, params, doc_cb):
+        """Query an index, handing documents to doc_cb as they arrive.
+
+        :return: The cursor to get the next documents with, or None.
+        """
+        codec = self._get_json_codec()
+        query = {}
+        for name, value in params.iteritems():
+            if value is None:
+                continue
+            if name in ('key', 'start', 'end'):
+                value = codec.dumps(value)
+            query[name] = value
+
+        def receive_entry(entry):
+            doc_cb(self._factory(entry['id'], entry['rev'],
+                                 entry['content']))
+
+        res = self._request_stream('GET', ['index', index_name], query,
+                                   None, None, receive_entry)
+        return res.get('cursor')
+
+    def get_from_index(self, index_name, *key_values):
+        docs = []
+        self._query_index(index_name, {'key': key_values}, docs.append)
+        return docs
+
+    def get_range_from_index(self, index_name, start_value=None,
+                             end_value=None):
+        if isinstance(start_value, basestring):
+            start_value = (start_value,)
+        if isinstance(end_value, basestring):
+            end_value = (end_value,)
+        docs = []
+        self._query_index(index_name,
+                          {'start': start_value, 'end': end_value},
+                          docs.append)
+        return docs
+
+    def get_index_page(self, index_name, key_values=None, start_value=None,
+                       end_value=None, limit=None, cursor=None):
+        """Return a page of the documents get_from_index or
+        get_range_from_index would return.
+
+        Either query for key_values, or for the range between start_value
+        and end_value.
+
+        :param limit: The number of documents per page, None for all of
+            them.
+        :param cursor: The cursor returned along with the previous page, or
+            None for the first one.
+        :return: (documents, the cursor of the next page or None if this is
+            the last one)
+        """
+        if isinstance(start_value, basestring):
+            start_value = (start_value,)
+        if isinstance(end_value, basestring):
+            end_value = (end_value,)
+        params = {'key': key_values, 'start': start_value, 'end': end_value,
+                  'limit': limit, 'cursor': cursor}
+        docs = []
+        cursor = self._query_index(index_name, params, docs.append)
+        return docs, cursor
+
+    def get_index_keys(self, index_name):
+        res, headers = self._request_json('GET',
+                                          ['index', index_name, 'keys'])
+        return [tuple(key) for key in res['keys']]
 
     def get_sync_target(self):
         st = http_target.HTTPSyncTarget(self._url.geturl())
         st._oauth_creds = self._oauth_creds
+        # share the connections kept alive, and the metrics of requests
+        st._pool = self._pool
+        st.metrics = self.metrics
         return st
@@ -24,11 +24,18 @@ from u1db import (
 # error wire descriptions mapping to HTTP status codes
 wire_description_to_status = dict([
     (errors.InvalidDocId.wire_description, 400),
+    (errors.InvalidReplicaUID.wire_description, 400),
+    (errors.InvalidValueForIndex.wire_description, 400),
+    (errors.InvalidGlobbing.wire_description, 400),
+    (errors.InvalidCursor.wire_description, 400),
+    (errors.IndexDefinitionParseError.wire_description, 400),
     (errors.Unauthorized.wire_description, 401),
     (errors.DatabaseDoesNotExist.wire_description, 404),
     (errors.DocumentDoesNotExist.wire_description, 404),
     (errors.DocumentAlreadyDeleted.wire_description, 404),
+    (errors.IndexDoesNotExist.wire_description, 404),
     (errors.RevisionConflict.wire_description, 409),
+    (errors.IndexNameTakenError.wire_description, 409),
     (errors.Unavailable.wire_description, 503),
 # without matching exception
     (errors.DOCUMENT_DELETED, 404)
@@ -16,14 +16,14 @@
 
 """SyncTarget API implementation to a remote HTTP server."""
 
-import simplejson
+import errno
+import socket
 
 from u1db import (
     Document,
     SyncTarget,
-    )
-from u1db.errors import (
-    BrokenSyncStream,
+    errors,
+    sync,
     )
 from u1db.remote import (
     http_client,
@@ -34,16 +34,60 @@ from u1db.remote import (
 class HTTPSyncTarget(http_client.HTTPClientBase, SyncTarget):
     """Implement the SyncTarget api to a remote HTTP server."""
 
+    # Whether to send the sync stream with chunked transfer encoding: None
+    # to do it if the server said in its get_sync_info response that it
+    # accepts it, True to always do it. Otherwise the stream is encoded once
+    # to compute its content-length and once more to send it. A chunked
+    # stream refused with 400 or 411, eg by a proxy, is sent again that way.
+    chunked_upload = None
+    upload_chunk_size = 65536
+    # Content codings to compress sync streams with, in order of
+    # preference, empty to never compress them. Responses are compressed
+    # if the server supports it; the stream sent is, if the server said in
+    # its get_sync_info response that it accepts one of them.
+    sync_encodings = utils.SYNC_ENCODINGS
+    _upload_encoding = None
+    _upload_chunked = False
+    _revision_cache = None
+    # the retired replicas sent with the last get_sync_info response
+    _retired_replicas = None
+
     @staticmethod
     def connect(url):
         return HTTPSyncTarget(url)
 
+    def set_revision_cache(self, revision_cache):
+        """Exchange documents as patches against the ones in revision_cache.
+
+        :param revision_cache: A sync.RevisionCache, kept across syncs with
+            this target, or None to always exchange documents whole.
+        """
+        self._revision_cache = revision_cache
+
     def get_sync_info(self, source_replica_uid):
         self._ensure_connection()
-        res, _ = self._request_json('GET', ['sync-from', source_replica_uid])
+        res, headers = self._request_json('GET',
+                                          ['sync-from', source_replica_uid])
+        self._upload_encoding = utils.choose_encoding(
+            headers.get('accept-encoding'), self.sync_encodings)
+        self._upload_chunked = 'chunked' in headers.get(
+            'accept-transfer-encoding', '').lower()
+        self._retired_replicas = frozenset(res.get('retired_replicas', ()))
         return (res['target_replica_uid'], res['target_replica_generation'],
                 res['source_replica_generation'], res['source_transaction_id'])
 
+    def get_retired_replicas(self):
+        if self._retired_replicas is None:
+            res, headers = self._request_json('GET', ['retired-replicas'])
+            self._retired_replicas = frozenset(res['replica_uids'])
+        return self._retired_replicas
+
+    def set_retired_replicas(self, replica_uids):
+        replica_uids = frozenset(replica_uids)
+        self._request_json('PUT', ['retired-replicas'], {},
+                           {'replica_uids': sorted(replica_uids)})
+        self._retired_replicas = replica_uids
+
     def record_sync_info(self, source_replica_uid, source_replica_generation,
                          source_transaction_id):
         self._ensure_connection()
@@ -51,64 +95,193 @@ class HTTPSyncTarget(http_client.HTTPClientBase, SyncTarget):
                               {'generation': source_replica_generation,
                                'transaction_id': source_transaction_id})
 
-    def _parse_sync_stream(self, data, return_doc_cb):
-        parts = data.splitlines()  # one at a time
-        if not parts or parts[0] != '[':
-            raise BrokenSyncStream
-        data = parts[1:-1]
-        if data:
-            line, comma = utils.check_and_strip_comma(data[0])
-            res = simplejson.loads(line)
-            for entry in data[1:]:
-                if not comma:  # missing in between comma
-                    raise BrokenSyncStream
-                line, comma = utils.check_and_strip_comma(entry)
-                entry = simplejson.loads(line)
-                doc = Document(entry['id'], entry['rev'], entry['content'])
-                return_doc_cb(doc, entry['gen'], entry['trans_id'])
-        if parts[-1] != ']':
-            try:
-                partdic = simplejson.loads(parts[-1])
-            except ValueError:
-                pass
+    def _parse_sync_stream(self, lines, return_doc_cb):
+        """Parse a sync stream response, returning its first entry.
+
+        Documents are handed to return_doc_cb as soon as their line is
+        parsed, see _parse_stream.
+
+        :param lines: An iterable over the lines of the response.
+        """
+        def receive_entry(entry):
+            if entry.get('filtered_out'):
+                doc = sync.FilteredOutDocument(entry['id'], entry['rev'])
+            elif 'patch' in entry:
+                doc = sync.DocumentDelta(entry['id'], entry['rev'],
+                                         entry['base_rev'], entry['patch'])
             else:
-                if isinstance(partdic, dict):
-                    self._error(partdic)
-            raise BrokenSyncStream
-        if comma:  # bad extra comma
-            raise BrokenSyncStream
-        return res
+                doc = Document(entry['id'], entry['rev'], entry['content'])
+            return_doc_cb(doc, entry['gen'], entry['trans_id'])
 
-    def sync_exchange(self, docs_by_generations, source_replica_uid,
-                      last_known_generation, return_doc_cb):
-        self._ensure_connection()
-        url = '%s/sync-from/%s' % (self._url.path, source_replica_uid)
-        self._conn.putrequest('POST', url)
-        self._conn.putheader('content-type', 'application/x-u1db-sync-stream')
-        for header_name, header_value in self._sign_request('POST', url, {}):
-            self._conn.putheader(header_name, header_value)
-        entries = ['[']
-        size = 1
-
-        def prepare(**dic):
-            entry = comma + '\r\n' + simplejson.dumps(dic)
-            entries.append(entry)
-            return len(entry)
-
-        comma = ''
-        size += prepare(last_known_generation=last_known_generation)
-        comma = ','
-        for doc, gen, trans_id in docs_by_generations:
-            size += prepare(id=doc.doc_id, rev=doc.rev, content=doc.get_json(),
-                            gen=gen, trans_id=trans_id)
-        entries.append('\r\n]')
-        size += len(entries[-1])
-        self._conn.putheader('content-length', str(size))
-        self._conn.endheaders()
+        return self._parse_stream(lines, receive_entry)
+
+    def _iter_sync_stream(self, docs_by_generations, last_known_generation,
+                          deltas=False, sync_filter=None):
+        """Encode the sync stream request one entry at a time.
+
+        :param deltas: Whether to ask for documents as patches.
+        :param sync_filter: A SyncFilter of the documents to return, or None.
+        """
+        args = {'last_known_generation': last_known_generation}
+        if deltas:
+            args['deltas'] = True
+        if sync_filter is not None:
+            args['sync_filter'] = sync_filter.as_dict()
+
+        def entries():
+            for doc, gen, trans_id in docs_by_generations:
+                if isinstance(doc, sync.DocumentDelta):
+                    yield {'id': doc.doc_id, 'rev': doc.rev,
+                           'base_rev': doc.base_rev, 'patch': doc.patch,
+                           'gen': gen, 'trans_id': trans_id}
+                else:
+                    yield {'id': doc.doc_id, 'rev': doc.rev,
+                           'content': doc.get_json(), 'gen': gen,
+                           'trans_id': trans_id}
+
+        return self._iter_stream(args, entries())
+
+    def _send_chunked(self, entries):
+        """Send entries with chunked transfer encoding.
+
+        Entries are gathered into chunks of about upload_chunk_size bytes.
+        """
+        pending = []
+        size = 0
         for entry in entries:
-            self._conn.send(entry)
-        entries = None
-        data, _ = self._response()
-        res = self._parse_sync_stream(data, return_doc_cb)
-        data = None
+            pending.append(entry)
+            size += len(entry)
+            if size >= self.upload_chunk_size:
+                self._conn.send('%x\r\n%s\r\n' % (size, ''.join(pending)))
+                pending = []
+                size = 0
+        if pending:
+            self._conn.send('%x\r\n%s\r\n' % (size, ''.join(pending)))
+        self._conn.send('0\r\n\r\n')
+
+    def sync_exchange(self, docs_by_generations, source_replica_uid,
+                      last_known_generation, return_doc_cb, sync_filter=None):
+        revision_cache = self._revision_cache
+        if revision_cache is None:
+            res = self._sync_exchange(docs_by_generations, source_replica_uid,
+                                      last_known_generation, return_doc_cb,
+                                      sync_filter=sync_filter)
+            return res['new_generation'], res['new_transaction_id']
+        sent_deltas = []
+
+        def deltas_by_generations():
+            for doc, gen, trans_id in docs_by_generations:
+                delta = revision_cache.delta(doc)
+                if delta is not doc:
+                    sent_deltas.append((doc, gen, trans_id))
+                yield delta, gen, trans_id
+
+        # the generation of the last document returned whole, and whether
+        # the ones after it are still to be fetched
+        received = {'gen': last_known_generation, 'incomplete': False}
+
+        def receive_doc(doc, gen, trans_id):
+            if received['incomplete']:
+                return
+            if isinstance(doc, sync.FilteredOutDocument):
+                received['gen'] = gen
+                return_doc_cb(doc, gen, trans_id)
+                return
+            if isinstance(doc, sync.DocumentDelta):
+                base_json = revision_cache.get(doc.doc_id, doc.base_rev)
+                if base_json is None:
+                    received['incomplete'] = True
+                    return
+                doc = doc.apply(base_json)
+            revision_cache.add(doc)
+            received['gen'] = gen
+            return_doc_cb(doc, gen, trans_id)
+
+        res = self._sync_exchange(deltas_by_generations(), source_replica_uid,
+                                  last_known_generation, receive_doc,
+                                  deltas=True, sync_filter=sync_filter)
+        missing_bases = set(res.get('missing_bases', ()))
+        if missing_bases or received['incomplete']:
+            # Fall back to exchanging whole the documents whose base
+            # revision either side did not have.
+            if not received['incomplete']:
+                received['gen'] = res['new_generation']
+            resend = [entry for entry in sent_deltas
+                      if entry[0].doc_id in missing_bases]
+
+            def receive_whole_doc(doc, gen, trans_id):
+                if not isinstance(doc, sync.FilteredOutDocument):
+                    revision_cache.add(doc)
+                return_doc_cb(doc, gen, trans_id)
+
+            res = self._sync_exchange(resend, source_replica_uid,
+                                      received['gen'], receive_whole_doc,
+                                      sync_filter=sync_filter)
         return res['new_generation'], res['new_transaction_id']
+
+    def _sync_exchange(self, docs_by_generations, source_replica_uid,
+                       last_known_generation, return_doc_cb, deltas=False,
+                       sync_filter=None):
+        """Make one sync exchange request and return its first entry."""
+        url = '%s/sync-from/%s' % (self._url.path, source_replica_uid)
+        upload_encoding = self._upload_encoding
+        chunked = self.chunked_upload
+        if chunked is None:
+            chunked = self._upload_chunked
+
+        def iter_sync_stream():
+            entries = self._iter_sync_stream(docs_by_generations,
+                                             last_known_generation, deltas,
+                                             sync_filter)
+            if upload_encoding is not None:
+                entries = utils.iter_compressed(entries, upload_encoding)
+            return entries
+
+        if not isinstance(docs_by_generations, (list, tuple)):
+            # To encode it twice, or send it again if chunked is refused.
+            docs_by_generations = list(docs_by_generations)
+
+        def send(conn):
+            conn.putrequest('POST', url)
+            conn.putheader('content-type', 'application/x-u1db-sync-stream')
+            for header_name, header_value in self._sign_request('POST', url,
+                                                                {}):
+                conn.putheader(header_name, header_value)
+            if self.sync_encodings:
+                conn.putheader('accept-encoding',
+                               ', '.join(self.sync_encodings))
+            if upload_encoding is not None:
+                conn.putheader('content-encoding', upload_encoding)
+            if chunked:
+                conn.putheader('transfer-encoding', 'chunked')
+                conn.endheaders()
+                try:
+                    self._send_chunked(iter_sync_stream())
+                except socket.error, e:
+                    if e.errno not in (errno.EPIPE, errno.ECONNRESET):
+                        raise
+                    # The server may have answered without reading the
+                    # body, eg to refuse it, and closed the connection.
+            else:
+                size = sum(map(len, iter_sync_stream()))
+                conn.putheader('content-length', str(size))
+                conn.endheaders()
+                for entry in iter_sync_stream():
+                    conn.send(entry)
+
+        def read(resp):
+            lines = self._response_lines(resp)
+            return self._parse_sync_stream(lines, return_doc_cb)
+
+        # the exchange is not sent again on failure, as the documents may
+        # have been put already
+        try:
+            return self._perform('POST', url, send, read, retry=False)
+        except errors.HTTPError, e:
+            if not chunked or e.status not in (400, 411):
+                raise
+        # Not all servers and proxies take chunked bodies. Documents put
+        # from a short one are put again as they were.
+        self._upload_chunked = False
+        chunked = False
+        return self._perform('POST', url, send, read, retry=False)
@@ -16,11 +16,12 @@
 """U1DB OAuth authorisation WSGI middleware."""
 import httplib
 from oauth import oauth
-import simplejson
 from urllib import quote
 from wsgiref.util import shift_path_info
 import sys
 
+from u1db import json_codec
+
 
 sign_meth_HMAC_SHA1 = oauth.OAuthSignatureMethod_HMAC_SHA1()
 sign_meth_PLAINTEXT = oauth.OAuthSignatureMethod_PLAINTEXT()
@@ -47,7 +48,7 @@ class OAuthMiddleware(object):
         err = {"error": description}
         if message:
             err['message'] = message
-        return [simplejson.dumps(err)]
+        return [json_codec.dumps(err)]
 
     def __call__(self, environ, start_response):
         if not environ['PATH_INFO'].startswith('/~/'):
@@ -15,18 +15,58 @@
 # along with u1db.  If not, see <http://www.gnu.org/licenses/>.
 
 """State for servers exposing a set of U1DB databases."""
-import os
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    # not on Windows, where a single process serves
+    fcntl = None
 import errno
+import os
+import threading
+import time
+
+from u1db import sync
+from u1db.compat import OrderedDict
+
 
 class ServerState(object):
     """Passed to a Request when it is instantiated.
 
     This is used to track server-side state, such as working-directory, open
     databases, etc.
+
+    Databases are opened once and their handles kept for reuse: a handle is
+    checked out by open_database for the thread calling it, until that
+    thread calls release_databases, at the end of the request. A thread
+    gets back the handle it released last if it is still idle, so a pool of
+    threads each keep using their own. At most
+    max_open_databases handles are kept open, closing the least recently
+    used idle ones, and idle ones are closed after max_idle_time seconds.
     """
 
+    # How many RevisionCaches, one per database and source replica, are
+    # kept for delta sync.
+    max_revision_caches = 100
+    # How many database handles, idle or checked out, are kept open.
+    max_open_databases = 100
+    # How many seconds an idle database handle is kept open.
+    max_idle_time = 300.0
+    # Whether the WSGI server hands chunked request bodies on to the
+    # application, so clients are told they can send sync streams chunked.
+    accept_chunked = False
+
     def __init__(self):
         self._workingdir = None
+        self._lock = threading.Lock()
+        self._revision_caches = OrderedDict()
+        # path => [(db, release time, releasing thread)], the least recently
+        # used path first
+        self._idle = OrderedDict()
+        self._num_open = 0
+        # path => [lock, number of threads using it]
+        self._write_locks = {}
+        self._local = threading.local()
 
     def set_workingdir(self, path):
         self._workingdir = path
@@ -37,30 +77,210 @@ class ServerState(object):
         #       relpath doesn't have '..' in it, etc.
         return self._workingdir + '/' + relpath
 
-    def open_database(self, path):
-        """Open a database at the given location."""
+    def _checked_out(self):
+        """Return the handles checked out by the current thread."""
+        try:
+            return self._local.checked_out
+        except AttributeError:
+            checked_out = self._local.checked_out = {}
+            return checked_out
+
+    def _open_database(self, path, create):
         from u1db.backends import sqlite_backend
         full_path = self._relpath(path)
-        return sqlite_backend.SQLiteDatabase.open_database(full_path,
-                                                           create=False)
+        # handles are checked out by one thread at a time, but not always
+        # the same one
+        return sqlite_backend.SQLiteDatabase.open_database(
+            full_path, create=create, check_same_thread=False)
+
+    def _check_out(self, path, create):
+        checked_out = self._checked_out()
+        db = checked_out.get(path)
+        if db is not None:
+            return db
+        with self._lock:
+            handles = self._idle.get(path)
+            if handles:
+                ident = threading.current_thread().ident
+                for i in range(len(handles) - 1, -1, -1):
+                    if handles[i][2] == ident:
+                        break
+                else:
+                    i = len(handles) - 1
+                db = handles.pop(i)[0]
+                if not handles:
+                    del self._idle[path]
+        if db is None:
+            db = self._open_database(path, create)
+            with self._lock:
+                self._num_open += 1
+        checked_out[path] = db
+        self._close_idle()
+        return db
+
+    def open_database(self, path):
+        """Open a database at the given location.
+
+        The handle is checked out for the current thread, see
+        release_databases.
+        """
+        return self._check_out(path, False)
+
+    def release_databases(self):
+        """Release the database handles checked out by the current thread.
+
+        They are not to be used by it anymore.
+        """
+        checked_out = self._checked_out()
+        now = time.time()
+        ident = threading.current_thread().ident
+        with self._lock:
+            for path, db in checked_out.iteritems():
+                handles = self._idle.pop(path, [])
+                handles.append((db, now, ident))
+                self._idle[path] = handles
+        checked_out.clear()
+        self._close_idle(now)
+
+    def _close_idle(self, now=None, path=None):
+        """Close the idle handles in excess or for too long.
+
+        :param path: Close all the idle handles of path.
+        """
+        if now is None:
+            now = time.time()
+        closing = []
+        with self._lock:
+            if path is not None:
+                closing.extend(db for db, _, _ in self._idle.pop(path, []))
+            while self._idle:
+                oldest_path, handles = next(self._idle.iteritems())
+                db, released, _ = handles[0]
+                if (self._num_open - len(closing) <= self.max_open_databases
+                        and now - released <= self.max_idle_time):
+                    break
+                del handles[0]
+                if not handles:
+                    del self._idle[oldest_path]
+                closing.append(db)
+            self._num_open -= len(closing)
+        for db in closing:
+            db.close()
+
+    def close_idle_databases(self):
+        """Close all the idle database handles, eg when shutting down."""
+        with self._lock:
+            paths = list(self._idle)
+        for path in paths:
+            self._close_idle(path=path)
+
+    def _lock_file_path(self, path):
+        """Return the file to lock for writing to the database at path, or
+        None to not lock one.
+
+        Lock files are kept in a hidden directory, database names start
+        with a letter or digit.
+        """
+        return self._relpath('.locks/' + path)
+
+    @contextmanager
+    def _locking_file(self, path):
+        """Hold an exclusive flock on the lock file of path.
+
+        Other processes serving the same working directory, eg the workers
+        of u1db-serve --workers, wait for it.
+        """
+        lock_file = None
+        lock_file_path = self._lock_file_path(path)
+        if fcntl is not None and lock_file_path is not None:
+            try:
+                os.mkdir(os.path.dirname(lock_file_path))
+            except OSError:
+                # it exists, or there is no directory for the database
+                # either
+                pass
+            try:
+                lock_file = open(lock_file_path, 'a')
+            except IOError:
+                pass
+        if lock_file is None:
+            yield
+            return
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            yield
+        finally:
+            # releases the lock
+            lock_file.close()
+
+    @contextmanager
+    def writing(self, path):
+        """Serialize the threads and processes writing to the database at
+        path.
+
+        SQLite lets a single connection write at a time anyway; waiting
+        here spares the others failing on a locked database. Threads wait
+        on a lock of their own before taking the lock file of the database
+        shared with other processes. It is to be held around writes only,
+        not while reading requests or sending responses.
+        """
+        with self._lock:
+            entry = self._write_locks.get(path)
+            if entry is None:
+                entry = self._write_locks[path] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                with self._locking_file(path):
+                    yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._write_locks[path]
+
+    def get_revision_cache(self, path, replica_uid):
+        """Get the RevisionCache for syncs of the database at the given
+        location with replica_uid.
+
+        Only the max_revision_caches most recently used ones are kept.
+        """
+        key = (path, replica_uid)
+        with self._lock:
+            cache = self._revision_caches.pop(key, None)
+            if cache is None:
+                cache = sync.RevisionCache()
+                if len(self._revision_caches) >= self.max_revision_caches:
+                    self._revision_caches.popitem(last=False)
+            self._revision_caches[key] = cache
+        return cache
 
     def check_database(self, path):
         """Check if the database at the given location exists.
 
         Simply returns if it does or raises DatabaseDoesNotExist.
         """
-        db = self.open_database(path)
-        db.close()
+        self.open_database(path)
 
     def ensure_database(self, path):
         """Ensure database at the given location."""
-        from u1db.backends import sqlite_backend
-        full_path = self._relpath(path)
-        return sqlite_backend.SQLiteDatabase.open_database(full_path,
-                                                           create=True)
+        return self._check_out(path, True)
 
     def delete_database(self, path):
         """Delete database at the given location."""
         from u1db.backends import sqlite_backend
+        db = self._checked_out().pop(path, None)
+        if db is not None:
+            with self._lock:
+                self._num_open -= 1
+            db.close()
+        self._close_idle(path=path)
         full_path = self._relpath(path)
         sqlite_backend.SQLiteDatabase.delete_database(full_path)
+        lock_file_path = self._lock_file_path(path)
+        if lock_file_path is not None:
+            try:
+                os.remove(lock_file_path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
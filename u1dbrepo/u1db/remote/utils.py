@@ -16,8 +16,156 @@
 
 """Utilities for details of the procotol."""
 
+import zlib
+
+from u1db import errors
+
+
+# Content codings usable for sync streams, in order of preference.
+SYNC_ENCODINGS = ('gzip', 'deflate')
+
+# zlib window bits selecting the gzip or the zlib ("deflate") container.
+_WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+    }
+
 
 def check_and_strip_comma(line):
     if line and line[-1] == ',':
         return line[:-1], True
     return line, False
+
+
+def iter_lines(read, chunk_size=65536):
+    """Iterate over the lines of a stream as it is read.
+
+    Lines are split like str.splitlines splits them for the sync stream,
+    without their '\n' or '\r\n' endings, but only chunk_size bytes plus
+    the line being completed are held at any time.
+
+    :param read: A function returning up to chunk_size more bytes, or ''
+        at the end of the stream, eg the read method of a file.
+    """
+    pending = []
+    while True:
+        data = read(chunk_size)
+        if not data:
+            break
+        lines = data.split('\n')
+        if len(lines) == 1:
+            pending.append(data)
+            continue
+        pending.append(lines[0])
+        lines[0] = ''.join(pending)
+        pending = [lines.pop()]
+        for line in lines:
+            if line.endswith('\r'):
+                line = line[:-1]
+            yield line
+    line = ''.join(pending)
+    if line:
+        yield line
+
+
+def choose_encoding(accept_encoding, encodings=SYNC_ENCODINGS):
+    """Pick the content coding to use given an Accept-Encoding header.
+
+    :param accept_encoding: The header value, eg 'gzip;q=0.5, deflate'.
+    :param encodings: The codings we can produce, in order of preference.
+    :return: One of encodings, or None to send the content as is.
+    """
+    qvalues = {}
+    for item in (accept_encoding or '').split(','):
+        params = item.split(';')
+        coding = params[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding] = q
+    best = None
+    best_q = 0.0
+    for coding in encodings:
+        q = qvalues.get(coding, qvalues.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def rev_etag(rev):
+    """Return the entity tag of a document at revision rev."""
+    return '"%s"' % (rev,)
+
+
+def etag_matches(if_none_match, etag):
+    """Tell whether an If-None-Match header lists etag.
+
+    Weak tags match like strong ones, and '*' is not supported.
+    """
+    for item in (if_none_match or '').split(','):
+        item = item.strip()
+        if item.startswith('W/'):
+            item = item[2:]
+        if item == etag:
+            return True
+    return False
+
+
+def compressor(encoding, level=6):
+    """Return a zlib compressor producing the given content coding."""
+    return zlib.compressobj(level, zlib.DEFLATED, _WBITS[encoding])
+
+
+def iter_compressed(pieces, encoding, level=6):
+    """Compress an iterable of strings incrementally.
+
+    Only non-empty output is yielded, the compressor decides when it has
+    gathered enough input to emit some.
+    """
+    compressobj = compressor(encoding, level)
+    for piece in pieces:
+        data = compressobj.compress(piece)
+        if data:
+            yield data
+    yield compressobj.flush()
+
+
+class DecompressingReader(object):
+    """Decompress a gzip or deflate encoded stream as it is read.
+
+    At most size bytes are decompressed by each read, however well the
+    input compresses.
+
+    :param read: A function returning up to chunk_size more encoded bytes,
+        or '' at the end of the stream.
+    """
+
+    def __init__(self, read, encoding, chunk_size=65536):
+        self._read = read
+        self._decompressor = zlib.decompressobj(_WBITS[encoding])
+        self._chunk_size = chunk_size
+        self._done = False
+
+    def read(self, size):
+        decompressor = self._decompressor
+        try:
+            while not self._done:
+                data = decompressor.unconsumed_tail
+                if not data:
+                    data = self._read(self._chunk_size)
+                    if not data:
+                        self._done = True
+                        return decompressor.flush()
+                decoded = decompressor.decompress(data, size)
+                if decoded:
+                    return decoded
+        except zlib.error:
+            raise errors.BrokenSyncStream
+        return ''
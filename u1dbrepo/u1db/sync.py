@@ -15,9 +15,22 @@
 # along with u1db.  If not, see <http://www.gnu.org/licenses/>.
 
 """The synchronization utilities for U1DB."""
+import httplib
 from itertools import izip
+import Queue
+import socket
+import sys
+import threading
+import time
 
 import u1db
+from u1db import (
+    errors,
+    json_codec,
+    json_patch,
+    query_parser,
+    )
+from u1db.compat import OrderedDict
 
 
 class Synchronizer(object):
@@ -27,18 +40,57 @@ class Synchronizer(object):
     to the target, and new items in the target are returned to the source.
     However, it still recognizes that one side is initiating the request. Also,
     at the moment, conflicts are only created in the source.
+
+    Both sides checkpoint their progress in their sync log as they apply
+    documents, batch by batch: the target records the last source generation
+    it applied, which it hands back from get_sync_info, and the source
+    records the last target generation it applied, which it sends as
+    last_known_generation. A sync that was interrupted thus resumes from
+    these checkpoints instead of starting over.
+
+    A push_filter and a pull_filter, see SyncFilter, restrict the documents
+    sent to and those returned by the target. The target keeps the last
+    revision sent of documents moving out of push_filter. When one moving
+    out of pull_filter is held here, the target returns it as a
+    FilteredOutDocument, and it is then fetched with an exchange without
+    the filter.
+
+    Before exchanging documents, the replicas retired on either side are
+    retired on both, see Database.set_retired_replicas: revisions are only
+    compared the same way on both sides if they ignore the same entries.
     """
 
-    def __init__(self, source, sync_target):
+    # The errors of an interrupted exchange, after which sync(resume=True)
+    # resumes it.
+    resumable_errors = (socket.error, httplib.HTTPException,
+                        errors.Unavailable, errors.BrokenSyncStream)
+    # How many times sync(resume=True) resumes before giving up.
+    max_resumes = 5
+
+    # How many documents from the target are put in one go, see
+    # Database._put_docs_if_newer.
+    batch_size = 100
+
+    def __init__(self, source, sync_target, push_filter=None,
+                 pull_filter=None):
         """Create a new Synchronization object.
 
         :param source: A Database
         :param sync_target: A SyncTarget
+        :param push_filter: A SyncFilter of the documents to send, or None.
+        :param pull_filter: A SyncFilter of the documents to return, or None.
         """
         self.source = source
         self.sync_target = sync_target
+        self.push_filter = push_filter
+        self.pull_filter = pull_filter
         self.target_replica_uid = None
         self.num_inserted = 0
+        self._docs_from_target = []
+        # the documents held here which moved out of pull_filter, and the
+        # target generation of the first of them
+        self._filtered_out = set()
+        self._filtered_out_gen = None
 
     def _insert_doc_from_target(self, doc, replica_gen, trans_id):
         """Try to insert synced document from target.
@@ -48,25 +100,70 @@ class Synchronizer(object):
         while the current conflicting value will be stored alongside
         as a conflict. In the process indexes will be updated etc.
 
+        Documents are inserted batch_size at a time, call
+        _flush_docs_from_target once the target returned all of them.
+
         :return: None
         """
+        self._docs_from_target.append((doc, replica_gen, trans_id))
+        if len(self._docs_from_target) >= self.batch_size:
+            self._flush_docs_from_target()
+
+    def _receive_doc_from_target(self, doc, replica_gen, trans_id):
+        """Handle a document returned by a pull_filter exchange."""
+        if isinstance(doc, FilteredOutDocument):
+            held = self.source.get_doc(doc.doc_id)
+            if held is None or held.rev == doc.rev:
+                return
+            self._filtered_out.add(doc.doc_id)
+            if self._filtered_out_gen is None:
+                self._filtered_out_gen = replica_gen
+            return
+        if self._filtered_out:
+            # don't record progress past a document still to fetch
+            replica_gen = trans_id = None
+        self._insert_doc_from_target(doc, replica_gen, trans_id)
+
+    def _fetch_filtered_out(self):
+        """Fetch the documents that moved out of pull_filter."""
+        filtered_out = self._filtered_out
+
+        def receive_doc(doc, replica_gen, trans_id):
+            if doc.doc_id in filtered_out:
+                self._insert_doc_from_target(doc, None, None)
+
+        try:
+            self.sync_target.sync_exchange(
+                [], self.source._replica_uid, self._filtered_out_gen - 1,
+                return_doc_cb=receive_doc)
+        finally:
+            self._flush_docs_from_target()
+
+    def _flush_docs_from_target(self):
+        """Insert the documents from target that are waiting."""
+        if not self._docs_from_target:
+            return
+        docs_by_generation = self._docs_from_target
+        self._docs_from_target = []
+        results = self.source._put_docs_if_newer(
+            docs_by_generation, save_conflict=True,
+            replica_uid=self.target_replica_uid)
         # Increases self.num_inserted depending whether the document
         # was effectively inserted.
-        state, _ = self.source._put_doc_if_newer(doc, save_conflict=True,
-            replica_uid=self.target_replica_uid, replica_gen=replica_gen,
-            replica_trans_id=trans_id)
-        if state == 'inserted':
-            self.num_inserted += 1
-        elif state == 'converged':
-            # magical convergence
-            pass
-        elif state == 'superseded':
-            # we have something newer, will be taken care of at the next sync
-            pass
-        else:
-            assert state == 'conflicted'
-            # The doc was saved as a conflict, so the database was updated
-            self.num_inserted += 1
+        for state, _ in results:
+            if state == 'inserted':
+                self.num_inserted += 1
+            elif state == 'converged':
+                # magical convergence
+                pass
+            elif state == 'superseded':
+                # we have something newer, will be taken care of at the next
+                # sync
+                pass
+            else:
+                assert state == 'conflicted'
+                # The doc was saved as a conflict, so the database was updated
+                self.num_inserted += 1
 
     def _record_sync_info_with_the_target(self, start_generation):
         """Record our new after sync generation with the target if gapless.
@@ -89,18 +186,55 @@ class Synchronizer(object):
             self.sync_target.record_sync_info(
                 self.source._replica_uid, cur_gen, trans_id)
 
-    def sync(self, callback=None):
-        """Synchronize documents between source and target."""
+    def _agree_on_retired_replicas(self):
+        """Retire on both sides the replicas either side retired."""
+        mine = self.source.get_retired_replicas()
+        theirs = self.sync_target.get_retired_replicas()
+        if mine == theirs:
+            return
+        if (self.source._replica_uid in theirs or
+                self.target_replica_uid in mine):
+            raise errors.InvalidReplicaUID(
+                "cannot sync with a replica retired by the other side")
+        both = mine | theirs
+        if theirs != both:
+            self.sync_target.set_retired_replicas(both)
+        if mine != both:
+            self.source.set_retired_replicas(both)
+
+    def sync(self, callback=None, resume=False):
+        """Synchronize documents between source and target.
+
+        :param resume: If True, resume the sync from its checkpoints when it
+            is interrupted by one of resumable_errors, up to max_resumes
+            times. Otherwise the error is raised, and the next sync resumes.
+        """
+        resumes = 0
+        while True:
+            try:
+                return self._sync(callback)
+            except self.resumable_errors:
+                if not resume or resumes >= self.max_resumes:
+                    raise
+            resumes += 1
+            self.num_inserted = 0
+            self.sync_target.close()
+
+    def _sync(self, callback):
         sync_target = self.sync_target
+        self._filtered_out = set()
+        self._filtered_out_gen = None
         # get target identifier, its current generation,
         # and its last-seen database generation for this source
         (self.target_replica_uid, target_gen, target_my_gen,
          target_my_trans_id) = sync_target.get_sync_info(
              self.source._replica_uid)
+        self._agree_on_retired_replicas()
         # what's changed since that generation and this current gen
         self.source.validate_gen_and_trans_id(
             target_my_gen, target_my_trans_id)
-        my_gen, _, changes = self.source.whats_changed(target_my_gen)
+        my_gen, my_trans_id, changes = self.source.whats_changed(
+            target_my_gen)
 
         # this source last-seen database generation for the target
         (target_last_known_gen,
@@ -116,29 +250,488 @@ class Synchronizer(object):
         docs_by_generation = zip(
             docs_to_send, (gen for _, gen, _ in changes),
             (trans for _, _, trans in changes))
+        if self.push_filter is not None:
+            getters = self.push_filter.get_getters(self.source)
+            docs_by_generation = [
+                entry for entry in docs_by_generation
+                if self.push_filter.matches(getters, entry[0])]
+            filtered = len(docs_by_generation) < len(changes)
+            if not docs_by_generation and target_last_known_gen == target_gen:
+                sync_target.record_sync_info(
+                    self.source._replica_uid, my_gen, my_trans_id)
+                return my_gen
+        else:
+            filtered = False
 
         # exchange documents and try to insert the returned ones with
         # the target, return target synced-up-to gen
-        new_gen, new_trans_id = sync_target.sync_exchange(docs_by_generation,
-                        self.source._replica_uid, target_last_known_gen,
-                        return_doc_cb=self._insert_doc_from_target)
+        kwargs = {}
+        if self.pull_filter is not None:
+            kwargs['sync_filter'] = self.pull_filter
+            return_doc_cb = self._receive_doc_from_target
+        else:
+            return_doc_cb = self._insert_doc_from_target
+        try:
+            new_gen, new_trans_id = sync_target.sync_exchange(
+                docs_by_generation, self.source._replica_uid,
+                target_last_known_gen, return_doc_cb=return_doc_cb, **kwargs)
+        finally:
+            # Even if the exchange broke off, what was received is whole and
+            # in order, checkpoint it.
+            self._flush_docs_from_target()
+        if self._filtered_out:
+            self._fetch_filtered_out()
         # record target synced-up-to generation including applying what we sent
         self.source._set_sync_info(
             self.target_replica_uid, new_gen, new_trans_id)
 
+        if filtered:
+            # the changes left out are not to be sent either
+            sync_target.record_sync_info(
+                self.source._replica_uid, my_gen, my_trans_id)
         # if gapless record current reached generation with target
         self._record_sync_info_with_the_target(my_gen)
 
         return my_gen
 
 
+class _TargetJob(object):
+    """The state of syncing with one of the targets of a MultiSynchronizer."""
+
+    def __init__(self, source, sync_target):
+        self.sync_target = sync_target
+        self.synchronizer = Synchronizer(source, sync_target)
+        self.docs_by_generation = []
+        self.target_gen = None
+        self.target_last_known_gen = None
+        self.target_my_gen = None
+        self.target_my_trans_id = None
+        self.failed = False
+        self.result = {'target': sync_target, 'target_replica_uid': None,
+                       'sent': 0, 'received': 0, 'inserted': 0,
+                       'seconds': 0.0, 'error': None}
+
+    def fail(self, exc_info):
+        self.failed = True
+        self.result['error'] = exc_info[1]
+
+
+class MultiSynchronizer(object):
+    """Synchronize one source with many targets concurrently.
+
+    Up to max_workers targets are talked to at the same time. The changes
+    of the source are looked up and its documents read only once, for all
+    the targets. The source is only read and written from the thread
+    calling sync: documents returned by the targets are handed over to it
+    and inserted as a Synchronizer would, at most queue_size of them
+    waiting at any time.
+    """
+
+    max_workers = 4
+    queue_size = 1000
+
+    def __init__(self, source, sync_targets, max_workers=None):
+        """Create a new MultiSynchronizer.
+
+        :param source: A Database
+        :param sync_targets: A list of SyncTargets
+        """
+        self.source = source
+        self.sync_targets = sync_targets
+        if max_workers is not None:
+            self.max_workers = max_workers
+
+    def _start_workers(self, func, jobs):
+        """Call func on each of jobs from at most max_workers threads.
+
+        func must not raise. Every worker returns when it gets None from the
+        queue of jobs, one is queued for each after the jobs.
+
+        :return: (the queue of jobs, the threads), to give to _join_workers.
+        """
+        work = Queue.Queue()
+        for job in jobs:
+            work.put(job)
+
+        def worker():
+            while True:
+                job = work.get()
+                if job is None:
+                    return
+                func(job)
+
+        threads = []
+        for _ in range(min(self.max_workers, len(jobs))):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            work.put(None)
+        return work, threads
+
+    def _join_workers(self, work, threads, events=None):
+        """Wait for the workers started by _start_workers to return.
+
+        With events, the jobs not started yet are dropped, and what the jobs
+        still running put in events is discarded so that they can't block on
+        a full queue: the caller is done with them, having handled what it
+        wanted or failed.
+        """
+        if events is not None:
+            while True:
+                try:
+                    work.get_nowait()
+                except Queue.Empty:
+                    break
+            for thread in threads:
+                work.put(None)
+        for thread in threads:
+            while events is not None and thread.is_alive():
+                try:
+                    events.get(timeout=0.1)
+                except Queue.Empty:
+                    pass
+            thread.join()
+
+    def _get_sync_info(self, job):
+        start = time.time()
+        try:
+            (job.result['target_replica_uid'], job.target_gen,
+             job.target_my_gen, job.target_my_trans_id) = (
+                job.sync_target.get_sync_info(self.source._replica_uid))
+        except Exception:
+            job.fail(sys.exc_info())
+        job.result['seconds'] += time.time() - start
+
+    def _prepare(self, jobs):
+        """Find what to send to each target, with one scan of the source.
+
+        :return: The generation of the source the changes are up to.
+        """
+        source = self.source
+        for job in jobs:
+            if job.failed:
+                continue
+            job.synchronizer.target_replica_uid = (
+                job.result['target_replica_uid'])
+            try:
+                # talks to the target too
+                job.synchronizer._agree_on_retired_replicas()
+            except Exception:
+                job.fail(sys.exc_info())
+                continue
+            try:
+                source.validate_gen_and_trans_id(job.target_my_gen,
+                                                 job.target_my_trans_id)
+            except errors.U1DBError:
+                job.fail(sys.exc_info())
+        jobs = [job for job in jobs if not job.failed]
+        if not jobs:
+            return source._get_generation()
+        my_gen, _, changes = source.whats_changed(
+            min(job.target_my_gen for job in jobs))
+        docs = source.get_docs([doc_id for doc_id, _, _ in changes],
+                               check_for_conflicts=False,
+                               include_deleted=True)
+        docs_by_generation = [(doc, gen, trans_id) for doc, (_, gen, trans_id)
+                              in izip(docs, changes)]
+        for job in jobs:
+            job.docs_by_generation = [
+                entry for entry in docs_by_generation
+                if entry[1] > job.target_my_gen]
+        return my_gen
+
+    def _needs_exchange(self, job):
+        job.target_last_known_gen, _ = self.source._get_sync_gen_info(
+            job.result['target_replica_uid'])
+        return (job.docs_by_generation or
+                job.target_last_known_gen != job.target_gen)
+
+    def _exchange(self, job, events):
+        """Run the sync exchange with one target, reporting to events."""
+
+        def return_doc(doc, gen, trans_id):
+            events.put(('doc', job, (doc, gen, trans_id)))
+
+        job.result['sent'] = len(job.docs_by_generation)
+        start = time.time()
+        try:
+            value = job.sync_target.sync_exchange(
+                job.docs_by_generation, self.source._replica_uid,
+                job.target_last_known_gen, return_doc_cb=return_doc)
+        except Exception:
+            kind, value = 'failed', sys.exc_info()
+        else:
+            kind = 'done'
+        job.result['seconds'] += time.time() - start
+        events.put((kind, job, value))
+
+    def _handle_events(self, events, pending):
+        """Insert what exchanges return until pending of them are over."""
+        while pending:
+            kind, job, value = events.get()
+            if kind == 'doc':
+                job.result['received'] += 1
+                if job.failed:
+                    continue
+                try:
+                    job.synchronizer._insert_doc_from_target(*value)
+                except errors.U1DBError:
+                    job.fail(sys.exc_info())
+                continue
+            pending -= 1
+            if job.failed:
+                continue
+            try:
+                # what was received is whole and in order, checkpoint it
+                job.synchronizer._flush_docs_from_target()
+                if kind == 'done':
+                    self.source._set_sync_info(
+                        job.result['target_replica_uid'], *value)
+                else:
+                    job.fail(value)
+            except errors.U1DBError:
+                job.fail(sys.exc_info())
+
+    def sync(self):
+        """Synchronize documents between the source and all the targets.
+
+        A target failing does not stop the others. Any other error is raised
+        once the exchanges already running are over.
+
+        :return: A list with, for each target in order, a dict of its
+            replica uid, the number of documents sent, received and
+            inserted, the seconds spent waiting for it and the error it
+            failed with, if any.
+        """
+        jobs = [_TargetJob(self.source, sync_target)
+                for sync_target in self.sync_targets]
+        self._join_workers(*self._start_workers(self._get_sync_info, jobs))
+        start_gen = self._prepare(jobs)
+        events = Queue.Queue(self.queue_size)
+        exchanging = [job for job in jobs
+                      if not job.failed and self._needs_exchange(job)]
+        work, threads = self._start_workers(
+            lambda job: self._exchange(job, events), exchanging)
+        try:
+            self._handle_events(events, len(exchanging))
+        finally:
+            self._join_workers(work, threads, events)
+        inserted = [job for job in jobs if job.synchronizer.num_inserted]
+        for job in inserted:
+            job.result['inserted'] = job.synchronizer.num_inserted
+        if len(inserted) == 1 and not inserted[0].failed:
+            # only with a single target could the new documents be known
+            # to it, see Synchronizer._record_sync_info_with_the_target
+            try:
+                inserted[0].synchronizer._record_sync_info_with_the_target(
+                    start_gen)
+            except Exception:
+                inserted[0].fail(sys.exc_info())
+        return [job.result for job in jobs]
+
+
+class SyncFilter(object):
+    """Select the documents a sync exchanges by the keys of an index.
+
+    A document is within the filter when one of the keys the index gives it
+    falls within start_value and end_value, both inclusive, or unbounded
+    when None. As with get_range_from_index, a string is accepted for the
+    tuple of values of a single column index. Eg the documents whose
+    archived field is false are within SyncFilter('archived', '0', '0') for
+    an index defined as 'bool(archived)'. Deletions are always within it.
+
+    The index is looked up in the database the documents are sent from, and
+    the keys are evaluated with the query_parser Getters of its definition.
+    Sync checkpoints do not depend on the filter: when it is widened, the
+    documents that fall within it but did not change since are not sent.
+    """
+
+    def __init__(self, index_name, start_value=None, end_value=None):
+        if isinstance(start_value, basestring):
+            start_value = (start_value,)
+        if isinstance(end_value, basestring):
+            end_value = (end_value,)
+        self.index_name = index_name
+        self.start_value = start_value and tuple(start_value)
+        self.end_value = end_value and tuple(end_value)
+
+    @classmethod
+    def from_dict(cls, value):
+        """Create a SyncFilter from the result of as_dict.
+
+        :raises ValueError: when value is not such a result.
+        """
+        try:
+            index_name = value['index']
+            start_value = value.get('start')
+            end_value = value.get('end')
+        except (KeyError, TypeError, AttributeError):
+            raise ValueError('invalid sync filter: %r' % (value,))
+        if not isinstance(index_name, basestring):
+            raise ValueError('invalid sync filter: %r' % (value,))
+        for bound in (start_value, end_value):
+            if bound is not None and not isinstance(bound, list):
+                raise ValueError('invalid sync filter: %r' % (value,))
+        return cls(index_name, start_value, end_value)
+
+    def as_dict(self):
+        """Return the filter as a dict to be encoded in JSON."""
+        return {'index': self.index_name,
+                'start': self.start_value and list(self.start_value),
+                'end': self.end_value and list(self.end_value)}
+
+    def get_getters(self, db):
+        """Return the Getters of the index definition in db.
+
+        :raises IndexDoesNotExist: when db has no such index.
+        """
+        for index_name, definition in db.list_indexes():
+            if index_name == self.index_name:
+                return query_parser.Parser().parse_all(definition)
+        raise errors.IndexDoesNotExist
+
+    def matches(self, getters, doc):
+        """Tell whether doc is within the filter.
+
+        :param getters: The result of get_getters.
+        """
+        if doc.is_tombstone():
+            return True
+        raw_doc = json_codec.loads(doc.get_json())
+        rows = [()]
+        for getter in getters:
+            values = getter.get(raw_doc)
+            rows = [row + (value,) for row in rows for value in values]
+        for row in rows:
+            if self.start_value is not None and row < self.start_value:
+                continue
+            if self.end_value is not None and row > self.end_value:
+                continue
+            return True
+        return False
+
+
+class FilteredOutDocument(object):
+    """A document revision outside the SyncFilter of a sync exchange.
+
+    It stands for the revision in the documents returned to a source that
+    synced before, which may hold an older revision that was within the
+    filter and is then to fetch this one.
+    """
+
+    def __init__(self, doc_id, rev):
+        self.doc_id = doc_id
+        self.rev = rev
+
+
+class DocumentDelta(object):
+    """A document revision given as a JSON patch against an older one.
+
+    :ivar base_rev: The revision of the document the patch applies to.
+    :ivar patch: The JSON patch, see u1db.json_patch.
+    """
+
+    def __init__(self, doc_id, rev, base_rev, patch):
+        self.doc_id = doc_id
+        self.rev = rev
+        self.base_rev = base_rev
+        self.patch = patch
+
+    def apply(self, base_json):
+        """Return the Document obtained by patching base_json."""
+        try:
+            content = json_patch.apply_patch(json_codec.loads(base_json),
+                                             self.patch)
+        except ValueError:
+            raise errors.BrokenSyncStream
+        return u1db.Document(self.doc_id, self.rev, json_codec.dumps(content))
+
+
+class RevisionCache(object):
+    """The last revision of documents exchanged with one other replica.
+
+    The other replica has held these revisions, so they can serve as bases
+    for DocumentDeltas between the two replicas. Only the size most
+    recently exchanged documents are kept.
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, doc):
+        """Remember doc as exchanged."""
+        self._entries.pop(doc.doc_id, None)
+        content = doc.get_json()
+        if content is None:
+            return
+        self._entries[doc.doc_id] = (doc.rev, content)
+        if len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def latest(self, doc_id):
+        """Return (rev, JSON content) remembered for doc_id, or None."""
+        return self._entries.get(doc_id)
+
+    def get(self, doc_id, rev):
+        """Return the JSON content of doc_id at rev, or None."""
+        entry = self._entries.get(doc_id)
+        if entry is None or entry[0] != rev:
+            return None
+        return entry[1]
+
+    def delta(self, doc):
+        """Remember doc as exchanged, and return what to send for it.
+
+        :return: A DocumentDelta against the remembered revision of the
+            document, or doc itself if there is none or if the patch is not
+            smaller than the content.
+        """
+        entry = self._entries.get(doc.doc_id)
+        self.add(doc)
+        content = doc.get_json()
+        if entry is None or content is None or entry[0] == doc.rev:
+            return doc
+        base_rev, base_json = entry
+        patch = json_patch.make_patch(json_codec.loads(base_json),
+                                      json_codec.loads(content))
+        if len(json_codec.dumps(patch)) >= len(content):
+            return doc
+        return DocumentDelta(doc.doc_id, doc.rev, base_rev, patch)
+
+
 class SyncExchange(object):
-    """Steps and state for carrying through a sync exchange on a target."""
+    """Steps and state for carrying through a sync exchange on a target.
+
+    Documents from the source may come as DocumentDeltas. Their base is
+    looked up in the database, then in revision_cache. When it is missing
+    their id is added to missing_bases, and the source is to send them
+    again whole; until then the source generation is not recorded past
+    them.
+
+    :param revision_cache: A RevisionCache of the documents exchanged with
+        the source, or None. With one, documents are returned as
+        DocumentDeltas where possible.
+    :param sync_filter: A SyncFilter of the documents to return, or None to
+        return them all. Those outside it are left out, or returned as
+        FilteredOutDocuments if the source synced before.
+    """
 
-    def __init__(self, db, source_replica_uid, last_known_generation):
+    def __init__(self, db, source_replica_uid, last_known_generation,
+                 revision_cache=None, sync_filter=None):
         self._db = db
         self.source_replica_uid = source_replica_uid
         self.source_last_known_generation = last_known_generation
+        self._revision_cache = revision_cache
+        self._sync_filter = sync_filter
+        if sync_filter is not None:
+            self._filter_getters = sync_filter.get_getters(db)
+        self.missing_bases = []
         self.seen_ids = {}  # incoming ids not superseded
         self.changes_to_return = None
         self.new_gen = None
@@ -175,26 +768,72 @@ class SyncExchange(object):
         :param source_gen: The source generation of doc.
         :return: None
         """
-        state, at_gen = self._db._put_doc_if_newer(doc, save_conflict=False,
-            replica_uid=self.source_replica_uid, replica_gen=source_gen,
-            replica_trans_id=trans_id)
-        if state == 'inserted':
-            self.seen_ids[doc.doc_id] = at_gen
-        elif state == 'converged':
-            # magical convergence
-            self.seen_ids[doc.doc_id] = at_gen
-        elif state == 'superseded':
-            # we have something newer that we will return
+        self.insert_docs_from_source([(doc, source_gen, trans_id)])
+
+    def insert_docs_from_source(self, docs_by_generation):
+        """Try to insert a batch of synced documents from source.
+
+        Like insert_doc_from_source, but the batch is inserted and the source
+        generation recorded in one go, see Database._put_docs_if_newer.
+
+        :param docs_by_generation: A list of (doc, source_gen, trans_id) in
+            source generation order, doc may be a DocumentDelta.
+        :return: None
+        """
+        resolved = self._resolve_deltas(docs_by_generation)
+        results = self._db._put_docs_if_newer(
+            resolved, save_conflict=False,
+            replica_uid=self.source_replica_uid)
+        for (doc, _, _), (state, at_gen) in izip(resolved, results):
+            if state == 'inserted':
+                self.seen_ids[doc.doc_id] = at_gen
+            elif state == 'converged':
+                # magical convergence
+                self.seen_ids[doc.doc_id] = at_gen
+            elif state == 'superseded':
+                # we have something newer that we will return
+                pass
+            else:
+                # conflict that we will returne
+                assert state == 'conflicted'
+            # for tests
+            self._incoming_trace.append((doc.doc_id, doc.rev))
+        if docs_by_generation:
+            self._db._last_exchange_log['receive'].update({
+                'source_uid': self.source_replica_uid,
+                'source_gen': docs_by_generation[-1][1]
+                })
+
+    def _get_base_json(self, doc_id, base_rev):
+        doc = self._db.get_doc(doc_id, include_deleted=True)
+        if doc is None:
             pass
-        else:
-            # conflict that we will returne
-            assert state == 'conflicted'
-        # for tests
-        self._incoming_trace.append((doc.doc_id, doc.rev))
-        self._db._last_exchange_log['receive'].update({
-            'source_uid': self.source_replica_uid,
-            'source_gen': source_gen
-            })
+        elif doc.rev == base_rev:
+            return doc.get_json()
+        elif doc.has_conflicts:
+            for conflict in self._db.get_doc_conflicts(doc_id):
+                if conflict.rev == base_rev:
+                    return conflict.get_json()
+        if self._revision_cache is not None:
+            return self._revision_cache.get(doc_id, base_rev)
+        return None
+
+    def _resolve_deltas(self, docs_by_generation):
+        resolved = []
+        for doc, gen, trans_id in docs_by_generation:
+            if isinstance(doc, DocumentDelta):
+                base_json = self._get_base_json(doc.doc_id, doc.base_rev)
+                if base_json is None:
+                    self.missing_bases.append(doc.doc_id)
+                    continue
+                doc = doc.apply(base_json)
+            if self.missing_bases:
+                # don't record progress past a document still to come
+                gen = trans_id = None
+            if self._revision_cache is not None:
+                self._revision_cache.add(doc)
+            resolved.append((doc, gen, trans_id))
+        return resolved
 
     def find_changes_to_return(self):
         """Find changes to return.
@@ -232,7 +871,9 @@ class SyncExchange(object):
 
         :param: return_doc_cb(doc, gen, trans_id): is a callback
                 used to return the documents with their last change generation
-                to the target replica.
+                to the target replica. With a revision_cache, documents
+                can be returned as DocumentDeltas, and with a sync_filter as
+                FilteredOutDocuments.
         :return: None
         """
         changes_to_return = self.changes_to_return
@@ -245,36 +886,71 @@ class SyncExchange(object):
         docs_by_gen = izip(
             docs, (gen for _, gen, _ in changes_to_return),
             (trans_id for _, _, trans_id in changes_to_return))
+        revision_cache = self._revision_cache
+        sync_filter = self._sync_filter
+        returned = []
         for doc, gen, trans_id in docs_by_gen:
+            if sync_filter is not None and not sync_filter.matches(
+                    self._filter_getters, doc):
+                if not self.source_last_known_generation:
+                    # the source cannot hold the document
+                    continue
+                doc = FilteredOutDocument(doc.doc_id, doc.rev)
+            elif revision_cache is not None:
+                doc = revision_cache.delta(doc)
+            returned.append(doc)
             return_doc_cb(doc, gen, trans_id)
         # for tests
         self._db._last_exchange_log['return'] = {
-            'docs': [(d.doc_id, d.rev) for d in docs],
+            'docs': [(d.doc_id, d.rev) for d in returned],
             'last_gen': self.new_gen
             }
 
 
+def _batches(iterable, size):
+    """Split iterable into lists of at most size items."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 class LocalSyncTarget(u1db.SyncTarget):
     """Common sync target implementation logic for all local sync targets."""
 
+    # How many incoming documents are inserted in one go, see
+    # SyncExchange.insert_docs_from_source.
+    batch_size = 100
+
     def __init__(self, db):
         self._db = db
         self._trace_hook = None
 
     def sync_exchange(self, docs_by_generations, source_replica_uid,
-                      last_known_generation, return_doc_cb):
+                      last_known_generation, return_doc_cb, sync_filter=None):
         sync_exch = SyncExchange(self._db, source_replica_uid,
-                                 last_known_generation)
+                                 last_known_generation,
+                                 sync_filter=sync_filter)
         if self._trace_hook:
             sync_exch._set_trace_hook(self._trace_hook)
         # 1st step: try to insert incoming docs and record progress
-        for doc, doc_gen, trans_id in docs_by_generations:
-            sync_exch.insert_doc_from_source(doc, doc_gen, trans_id)
+        for batch in _batches(docs_by_generations, self.batch_size):
+            sync_exch.insert_docs_from_source(batch)
         # 2nd step: find changed documents (including conflicts) to return
         new_gen = sync_exch.find_changes_to_return()
         # final step: return docs and record source replica sync point
         sync_exch.return_docs(return_doc_cb)
         return new_gen, sync_exch.new_trans_id
 
+    def get_retired_replicas(self):
+        return self._db.get_retired_replicas()
+
+    def set_retired_replicas(self, replica_uids):
+        self._db.set_retired_replicas(replica_uids)
+
     def _set_trace_hook(self, cb):
         self._trace_hook = cb
@@ -0,0 +1,177 @@
+# Copyright 2012 Canonical Ltd.
+#
+# This file is part of u1db.
+#
+# u1db is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation.
+#
+# u1db is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with u1db.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Synchronize a database in the background as it changes."""
+
+import threading
+import time
+
+from u1db import (
+    errors,
+    sync,
+    )
+
+
+class SyncScheduler(object):
+    """Decide when to synchronize a database with a sync target.
+
+    Local writes are noticed by watching the generation of the database. A
+    burst of writes is synced once it has been quiet for debounce seconds,
+    or max_delay seconds after it began, whichever comes first. Without
+    local writes the target is checked every remote_interval seconds.
+    Before syncing, get_sync_info tells whether either side moved since the
+    last sync, and the exchange is skipped if neither did. Syncs failing
+    with one of retry_errors are retried after a delay that doubles with
+    each failure, from min_backoff up to max_backoff seconds, or after the
+    delay a 503 response asked for in its Retry-After header if longer.
+
+    Call poll regularly, eg from the main loop of an application, or call
+    start to poll from a thread of the scheduler's own; the database must
+    then be usable from that thread.
+    """
+
+    debounce = 2.0
+    max_delay = 30.0
+    remote_interval = 300.0
+    poll_interval = 1.0
+    min_backoff = 1.0
+    max_backoff = 300.0
+    retry_errors = sync.Synchronizer.resumable_errors + (errors.HTTPError,)
+
+    def __init__(self, db, sync_target):
+        """Create a new SyncScheduler.
+
+        :param db: The Database to synchronize.
+        :param sync_target: The SyncTarget to synchronize it with.
+        """
+        self.db = db
+        self.sync_target = sync_target
+        # number of exchanges run, and skipped as nothing had changed
+        self.syncs = 0
+        self.skipped = 0
+        # number of failures in a row, and the last one
+        self.failures = 0
+        self.last_error = None
+        self._seen_gen = db._get_generation()
+        self._synced_gen = None
+        self._burst_start = None
+        self._last_change = None
+        self._last_check = None
+        self._retry_at = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def _due(self):
+        """Return when to sync next, None as soon as possible."""
+        if self._synced_gen is None or self._last_check is None:
+            due = None
+        elif self._burst_start is not None:
+            due = min(self._last_change + self.debounce,
+                      self._burst_start + self.max_delay)
+        else:
+            due = self._last_check + self.remote_interval
+        if self._retry_at is not None and (due is None or
+                                           due < self._retry_at):
+            due = self._retry_at
+        return due
+
+    def poll(self, now=None):
+        """Sync if it is time to.
+
+        :param now: The current time.time(), for tests.
+        :return: The number of seconds after which to poll again.
+        """
+        if now is None:
+            now = time.time()
+        gen = self.db._get_generation()
+        if gen != self._seen_gen:
+            self._seen_gen = gen
+            self._last_change = now
+            if self._burst_start is None:
+                self._burst_start = now
+        due = self._due()
+        if due is None or due <= now:
+            self._sync(now)
+            due = self._due()
+        return max(0.0, min(self.poll_interval, due - now))
+
+    def _moved(self):
+        """Tell whether either side changed since the last sync."""
+        if self._synced_gen is None:
+            return True
+        if self.db._get_generation() != self._synced_gen:
+            return True
+        target_replica_uid, target_gen, _, _ = (
+            self.sync_target.get_sync_info(self.db._replica_uid))
+        known_gen, _ = self.db._get_sync_gen_info(target_replica_uid)
+        return target_gen != known_gen
+
+    def _backoff(self, error):
+        delay = min(self.max_backoff,
+                    self.min_backoff * 2 ** (self.failures - 1))
+        if isinstance(error, errors.Unavailable):
+            try:
+                delay = max(delay, float(error.headers['retry-after']))
+            except (KeyError, TypeError, ValueError):
+                pass
+        return delay
+
+    def _sync(self, now):
+        start_gen = self.db._get_generation()
+        synchronizer = sync.Synchronizer(self.db, self.sync_target)
+        try:
+            if self._moved():
+                synchronizer.sync()
+                self.syncs += 1
+            else:
+                self.skipped += 1
+        except self.retry_errors, e:
+            self.failures += 1
+            self.last_error = e
+            self._retry_at = now + self._backoff(e)
+            return
+        self.failures = 0
+        self._retry_at = None
+        self._burst_start = self._last_change = None
+        self._last_check = now
+        gen = self.db._get_generation()
+        if gen == start_gen + synchronizer.num_inserted:
+            # documents received from the target are not local writes
+            self._synced_gen = self._seen_gen = gen
+        else:
+            # written to while syncing, the next poll notices it
+            self._synced_gen = start_gen
+
+    def start(self):
+        """Poll from a background thread until stop is called."""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread, waiting for a running sync."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._stop.wait(self.poll())
@@ -219,6 +219,10 @@ class ServerStateForTests(server_state.ServerState):
     def delete_database(self, path):
         del self._dbs[path]
 
+    def _lock_file_path(self, path):
+        # the databases are not on disk
+        return None
+
 
 class ResponderForTests(object):
     """Responder for tests."""
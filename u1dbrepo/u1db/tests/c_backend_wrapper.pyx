@@ -708,6 +708,10 @@ cdef class CSyncTarget(object):
             free(trans_id)
         return (safe_str(st_replica_uid), st_gen, source_gen, res_trans_id)
 
+    def get_retired_replicas(self):
+        # The C implementation does not retire replicas.
+        return frozenset()
+
     def record_sync_info(self, source_replica_uid, source_gen, source_trans_id):
         cdef int status
         self._check()
@@ -982,6 +986,14 @@ cdef class CDatabase(object):
         else:
             raise RuntimeError("Unknown _put_doc_if_newer state: %d" % (state,))
 
+    def _put_docs_if_newer(self, docs_by_generation, save_conflict,
+                           replica_uid=None):
+        return [self._put_doc_if_newer(doc, save_conflict,
+                                       replica_uid=replica_uid,
+                                       replica_gen=replica_gen,
+                                       replica_trans_id=replica_trans_id)
+                for doc, replica_gen, replica_trans_id in docs_by_generation]
+
     def get_doc(self, doc_id, include_deleted=False):
         cdef u1db_document *doc = NULL
         deleted = 1 if include_deleted else 0
@@ -1290,6 +1302,10 @@ cdef class CDatabase(object):
             u1db_query_init(self._db, index_name, &query._query))
         return query
 
+    def get_retired_replicas(self):
+        # The C implementation does not retire replicas.
+        return frozenset()
+
     def get_sync_target(self):
         cdef CSyncTarget target
         target = CSyncTarget()
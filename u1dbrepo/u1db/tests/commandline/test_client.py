@@ -16,6 +16,7 @@
 
 import cStringIO
 import os
+import socket
 import sys
 import simplejson
 import subprocess
@@ -23,6 +24,7 @@ import subprocess
 from u1db import (
     errors,
     open as u1db_open,
+    sync,
     tests,
     vectorclock,
     )
@@ -115,6 +117,12 @@ class TestArgs(tests.TestCase):
         self.assertEqual(client.CmdSync, args.subcommand)
         self.assertEqual('source', args.source)
         self.assertEqual('target', args.target)
+        self.assertEqual(False, args.resume)
+
+    def test_sync_resume(self):
+        args = self.parse_args(['sync', '--resume', 'source', 'target'])
+        self.assertEqual(client.CmdSync, args.subcommand)
+        self.assertEqual(True, args.resume)
 
     def test_create_index(self):
         args = self.parse_args(['create-index', 'db', 'index', 'expression'])
@@ -169,6 +177,11 @@ class TestArgs(tests.TestCase):
         self.assertEqual(['rev:1', 'other:1'], args.doc_revs)
         self.assertEqual(None, args.infile)
 
+    def test_rev_stats(self):
+        args = self.parse_args(['rev-stats', 'db'])
+        self.assertEqual(client.CmdRevisionStats, args.subcommand)
+        self.assertEqual('db', args.database)
+
 
 class TestCaseWithDB(tests.TestCase):
     """These next tests are meant to have one class per Command.
@@ -478,6 +491,22 @@ class TestCmdSync(TestCaseWithDB):
         self.assertGetDoc(self.db, 'my-test-id', self.doc2.rev,
                           tests.nested_doc, False)
 
+    def test_sync_resume(self):
+        _sync = sync.Synchronizer._sync
+        calls = []
+
+        def interrupted_sync(syncer, callback):
+            calls.append(callback)
+            if len(calls) == 1:
+                raise socket.error
+            return _sync(syncer, callback)
+        self.patch(sync.Synchronizer, '_sync', interrupted_sync)
+        cmd = self.make_command(client.CmdSync)
+        cmd.run(self.db_path, self.db2_path, resume=True)
+        self.assertEqual(2, len(calls))
+        self.assertGetDoc(self.db2, 'test-id', self.doc.rev, tests.simple_doc,
+                          False)
+
 
 class TestCmdSyncRemote(tests.TestCaseWithServer, TestCaseWithDB):
 
@@ -749,6 +778,27 @@ class TestCmdGetFromIndex(TestCaseWithDB):
                          % self.db_path, cmd.stderr.getvalue())
 
 
+class TestCmdRevisionStats(TestCaseWithDB):
+
+    def test_rev_stats(self):
+        self.db.create_doc(tests.simple_doc, doc_id='my-doc')
+        cmd = self.make_command(client.CmdRevisionStats)
+        retval = cmd.run(self.db_path)
+        self.assertEqual(None, retval)
+        self.assertEqual(
+            'revisions: 1\n'
+            'entries: min 1, median 1, mean 1.0, p90 1, p99 1, max 1\n'
+            'bytes: min 6, median 6, mean 6.0, p90 6, p99 6, max 6\n',
+            cmd.stdout.getvalue())
+        self.assertEqual('', cmd.stderr.getvalue())
+
+    def test_rev_stats_no_db(self):
+        cmd = self.make_command(client.CmdRevisionStats)
+        retval = cmd.run(self.db_path + '__DOES_NOT_EXIST')
+        self.assertEqual(1, retval)
+        self.assertEqual('Database does not exist.\n', cmd.stderr.getvalue())
+
+
 class RunMainHelper(object):
 
     def run_main(self, args, stdin=None):
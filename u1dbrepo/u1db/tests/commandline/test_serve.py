@@ -15,19 +15,63 @@
 # along with u1db.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import signal
 import socket
 import subprocess
 import sys
+import threading
+import urllib2
 
 from u1db import (
     __version__ as _u1db_version,
     open as u1db_open,
+    sync,
     tests,
     )
-from u1db.remote import http_client
+from u1db.backends import inmemory
+from u1db.commandline import serve
+from u1db.remote import (
+    http_client,
+    http_target,
+    )
 from u1db.tests.commandline import safe_close
 
 
+class TestThreadPoolServer(tests.TestCase):
+
+    def test_drain_finishes_requests(self):
+        entered = threading.Event()
+        go = threading.Event()
+
+        def application(environ, start_response):
+            entered.set()
+            go.wait()
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return ['done']
+
+        server = serve.ThreadPoolServer(application, ('127.0.0.1', 0),
+                                        serve.httpserver.WSGIHandler, 2)
+        self.addCleanup(server.server_close)
+        serving = threading.Thread(target=server.serve_until_stopped)
+        serving.start()
+        responses = []
+        url = 'http://127.0.0.1:%s/' % (server.server_address[1],)
+        client = threading.Thread(
+            target=lambda: responses.append(urllib2.urlopen(url).read()))
+        client.start()
+        entered.wait()
+        server.stop()
+        serving.join()
+        draining = threading.Thread(target=server.drain)
+        draining.start()
+        draining.join(0.1)
+        self.assertTrue(draining.is_alive())
+        go.set()
+        draining.join()
+        client.join()
+        self.assertEqual(['done'], responses)
+
+
 class TestU1DBServe(tests.TestCase):
 
     def _get_u1db_serve_path(self):
@@ -99,3 +143,100 @@ class TestU1DBServe(tests.TestCase):
         self.addCleanup(c.close)
         res, _ = c._request_json('GET', [])
         self.assertEqual({}, res)
+
+    def test_sync_chunked_upload(self):
+        tmp_dir = self.createTempDir('u1db-serve-test')
+        db = u1db_open(os.path.join(tmp_dir, 'target.db'), create=True)
+        db.close()
+        p = self.startU1DBServe(['--working-dir', tmp_dir])
+        source = inmemory.InMemoryDatabase('source')
+        doc = source.create_doc('{"key": "value"}')
+        target = http_target.HTTPSyncTarget(self._get_url(p) + 'target.db')
+        self.addCleanup(target.close)
+        sync.Synchronizer(source, target).sync()
+        # the server said it takes chunked uploads
+        self.assertTrue(target._upload_chunked)
+        p.terminate()
+        self.assertEqual(0, p.wait())
+        db = u1db_open(os.path.join(tmp_dir, 'target.db'), create=False)
+        self.addCleanup(db.close)
+        self.assertEqual(doc, db.get_doc(doc.doc_id))
+
+    def _get_url(self, p):
+        starts = 'listening on:'
+        x = p.stdout.readline()
+        self.assertTrue(x.startswith(starts))
+        port = int(x[len(starts):].split(":")[1])
+        return "http://127.0.0.1:%s/" % port
+
+    def assertServing(self, url):
+        c = http_client.HTTPClientBase(url)
+        self.addCleanup(c.close)
+        res, _ = c._request_json('GET', [])
+        self.assertEqual({'version': _u1db_version}, res)
+
+    def test_threads(self):
+        p = self.startU1DBServe(['--threads', '2'])
+        self.assertServing(self._get_url(p))
+        p.terminate()
+        self.assertEqual(0, p.wait())
+
+    def test_workers(self):
+        p = self.startU1DBServe(['--workers', '2', '--threads', '2'])
+        url = self._get_url(p)
+        for i in range(4):
+            self.assertServing(url)
+        p.terminate()
+        self.assertEqual(0, p.wait())
+
+    def test_workers_concurrent_writers(self):
+        tmp_dir = self.createTempDir('u1db-serve-test')
+        db = u1db_open(os.path.join(tmp_dir, 'shared.db'), create=True)
+        db.close()
+        p = self.startU1DBServe(['--working-dir', tmp_dir,
+                                 '--workers', '4', '--threads', '2'])
+        url = self._get_url(p) + 'shared.db'
+        sources = []
+        for i in range(16):
+            source = inmemory.InMemoryDatabase('source%d' % (i,))
+            for j in range(50):
+                source.create_doc('{"n": %d}' % (j,))
+            sources.append(source)
+        failures = []
+
+        def sync_source(source):
+            target = http_target.HTTPSyncTarget(url)
+            try:
+                sync.Synchronizer(source, target).sync()
+            except Exception, e:
+                failures.append(e)
+            finally:
+                target.close()
+
+        threads = [threading.Thread(target=sync_source, args=(source,))
+                   for source in sources]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], failures)
+        p.terminate()
+        self.assertEqual(0, p.wait())
+        db = u1db_open(os.path.join(tmp_dir, 'shared.db'), create=False)
+        self.addCleanup(db.close)
+        self.assertEqual(800, len(db.get_all_docs()[1]))
+
+    def test_workers_reload(self):
+        p = self.startU1DBServe(['--workers', '1'])
+        url = self._get_url(p)
+        self.assertServing(url)
+        p.send_signal(signal.SIGHUP)
+        self.assertServing(url)
+        p.terminate()
+        self.assertEqual(0, p.wait())
+
+    def test_bad_workers(self):
+        p = self.startU1DBServe(['--workers', '0'])
+        _, stderr = p.communicate()
+        self.assertEqual(2, p.returncode)
+        self.assertIn('must be at least 1', stderr)
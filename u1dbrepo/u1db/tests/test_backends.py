@@ -264,21 +264,6 @@ class AllDatabaseTests(tests.DatabaseBaseTests, tests.TestCaseWithServer):
         self.db.put_doc(doc)
         self.assertGetDoc(self.db, doc.doc_id, doc.rev, nested_doc, False)
 
-
-class LocalDatabaseTests(tests.DatabaseBaseTests):
-
-    scenarios = tests.LOCAL_DATABASES_SCENARIOS + tests.C_DATABASE_SCENARIOS
-
-    def test_create_doc_different_ids_diff_db(self):
-        doc1 = self.db.create_doc(simple_doc)
-        db2 = self.create_database('other-uid')
-        doc2 = db2.create_doc(simple_doc)
-        self.assertNotEqual(doc1.doc_id, doc2.doc_id)
-
-    def test_put_doc_refuses_slashes_picky(self):
-        doc = self.make_document('/a', None, simple_doc)
-        self.assertRaises(errors.InvalidDocId, self.db.put_doc, doc)
-
     def test_get_docs(self):
         doc1 = self.db.create_doc(simple_doc)
         doc2 = self.db.create_doc(nested_doc)
@@ -307,9 +292,28 @@ class LocalDatabaseTests(tests.DatabaseBaseTests):
         self.assertEqual([doc2, doc1],
                          self.db.get_docs([doc2.doc_id, doc1.doc_id]))
 
+    def test_get_docs_missing(self):
+        doc1 = self.db.create_doc(simple_doc)
+        self.assertEqual([doc1], self.db.get_docs(['missing', doc1.doc_id]))
+
     def test_get_docs_empty_list(self):
         self.assertEqual([], self.db.get_docs([]))
 
+
+class LocalDatabaseTests(tests.DatabaseBaseTests):
+
+    scenarios = tests.LOCAL_DATABASES_SCENARIOS + tests.C_DATABASE_SCENARIOS
+
+    def test_create_doc_different_ids_diff_db(self):
+        doc1 = self.db.create_doc(simple_doc)
+        db2 = self.create_database('other-uid')
+        doc2 = db2.create_doc(simple_doc)
+        self.assertNotEqual(doc1.doc_id, doc2.doc_id)
+
+    def test_put_doc_refuses_slashes_picky(self):
+        doc = self.make_document('/a', None, simple_doc)
+        self.assertRaises(errors.InvalidDocId, self.db.put_doc, doc)
+
     def test_get_all_docs_empty(self):
         self.assertEqual([], self.db.get_all_docs()[1])
 
@@ -875,9 +879,13 @@ class LocalDatabaseWithConflictsTests(tests.DatabaseBaseTests):
         self.assertRaises(errors.ConflictedDoc, self.db.delete_doc, doc2)
 
 
-class DatabaseIndexTests(tests.DatabaseBaseTests):
+class DatabaseIndexTests(tests.DatabaseBaseTests, tests.TestCaseWithServer):
 
-    scenarios = tests.LOCAL_DATABASES_SCENARIOS + tests.C_DATABASE_SCENARIOS
+    scenarios = tests.LOCAL_DATABASES_SCENARIOS + [
+        ('http', {'do_create_database': http_create_database,
+                  'make_document': tests.create_doc,
+                  'server_def': http_server_def}),
+        ] + tests.C_DATABASE_SCENARIOS
 
     def test_create_index(self):
         self.db.create_index('test-idx', 'name')
@@ -1501,6 +1509,13 @@ class PythonBackendTests(tests.DatabaseBaseTests):
         self.db.set_document_factory(TestAlternativeDocument)
         self.assertIs(None, self.db.get_doc('non-existing'))
 
+    def test__get_doc_rev(self):
+        self.assertIs(None, self.db._get_doc_rev('non-existing'))
+        doc = self.db.create_doc(simple_doc)
+        self.assertEqual(doc.rev, self.db._get_doc_rev(doc.doc_id))
+        self.db.delete_doc(doc)
+        self.assertEqual(doc.rev, self.db._get_doc_rev(doc.doc_id))
+
     def test_get_all_docs_with_factory(self):
         self.db.set_document_factory(TestAlternativeDocument)
         self.db.create_doc(simple_doc)
@@ -1545,6 +1560,118 @@ class PythonBackendTests(tests.DatabaseBaseTests):
             [doc_other], self.db.get_from_index('test-idx', 'altval'))
         self.assertEqual([], self.db.get_from_index('test-idx', 'value'))
 
+    def test_put_doc_if_newer_autoresolve_equal_numbers(self):
+        doc1 = self.db.create_doc('{"x": 1}')
+        # read back with its stored digest, if the backend stores them
+        doc1 = self.db.get_doc(doc1.doc_id)
+        doc = self.make_document(doc1.doc_id, "whatever:1", '{"x": 1.0}')
+        doc._get_digest()
+        state, _ = self.db._put_doc_if_newer(doc, save_conflict=True)
+        self.assertEqual('superseded', state)
+        self.assertFalse(self.db.get_doc(doc1.doc_id).has_conflicts)
+
+    def test_put_doc_drops_retired_replicas(self):
+        doc = self.make_document('my-doc', 'old:3|test:1', simple_doc)
+        self.db._put_doc_if_newer(doc, save_conflict=False)
+        self.db.set_retired_replicas(['old'])
+        doc.set_json(nested_doc)
+        self.db.put_doc(doc)
+        self.assertGetDoc(self.db, 'my-doc', 'test:2', nested_doc, False)
+
+    def test_put_doc_if_newer_ignores_retired_replicas(self):
+        self.db.set_retired_replicas(['old'])
+        doc = self.db.create_doc(simple_doc, doc_id='my-doc')
+        # A peer that still has the entry of the retired replica
+        other = self.make_document('my-doc', 'old:3|test:1|z:1', nested_doc)
+        state, _ = self.db._put_doc_if_newer(other, save_conflict=True)
+        self.assertEqual('inserted', state)
+        self.assertGetDoc(self.db, doc.doc_id, other.rev, nested_doc, False)
+
+    def test_put_doc_if_newer_only_retired_replicas(self):
+        self.db.set_retired_replicas(['old'])
+        doc = self.make_document('my-doc', 'old:3', simple_doc)
+        state, _ = self.db._put_doc_if_newer(doc, save_conflict=True)
+        self.assertEqual('inserted', state)
+        self.assertGetDoc(self.db, 'my-doc', 'old:3', simple_doc, False)
+
+    def test_resolve_doc_drops_retired_replicas(self):
+        doc1 = self.db.create_doc(simple_doc, doc_id='my-doc')
+        doc2 = self.make_document('my-doc', 'old:1', nested_doc)
+        self.db._put_doc_if_newer(doc2, save_conflict=True)
+        self.db.set_retired_replicas(['old'])
+        doc2.set_json(simple_doc)
+        self.db.resolve_doc(doc2, [doc1.rev, 'old:1'])
+        self.assertGetDoc(self.db, 'my-doc', 'test:2', simple_doc, False)
+
+    def test_set_retired_replicas_own_replica(self):
+        self.assertRaises(
+            errors.InvalidReplicaUID, self.db.set_retired_replicas, ['test'])
+
+    def test_get_revision_size_stats_empty(self):
+        stats = self.db.get_revision_size_stats()
+        self.assertEqual(0, stats['revisions'])
+        self.assertEqual(0, stats['entries']['max'])
+        self.assertEqual(0, stats['bytes']['mean'])
+
+    def test_get_revision_size_stats(self):
+        doc = self.db.create_doc(simple_doc)
+        self.db.delete_doc(doc)
+        doc = self.db.create_doc(simple_doc, doc_id='conflicted')
+        self.db._put_doc_if_newer(
+            self.make_document('conflicted', 'a:1|b:1|c:1', nested_doc),
+            save_conflict=True)
+        self.assertEqual({
+            'revisions': 3,
+            'entries': {'min': 1, 'median': 1, 'mean': 5 / 3.0, 'p90': 1,
+                        'p99': 1, 'max': 3},
+            'bytes': {'min': 6, 'median': 6, 'mean': 23 / 3.0, 'p90': 6,
+                      'p99': 6, 'max': 11},
+            }, self.db.get_revision_size_stats())
+
+    def test__put_docs_if_newer_records_sync_info_once(self):
+        calls = []
+        _do_set_sync_info = self.db._do_set_sync_info
+
+        def do_set_sync_info(*args):
+            calls.append(args)
+            _do_set_sync_info(*args)
+        self.patch(self.db, '_do_set_sync_info', do_set_sync_info)
+        doc1 = self.make_document('doc-1', 'other:1', simple_doc)
+        doc2 = self.make_document('doc-2', 'other:1', nested_doc)
+        results = self.db._put_docs_if_newer(
+            [(doc1, 10, 'T-1'), (doc2, 11, 'T-2')], save_conflict=False,
+            replica_uid='other')
+        self.assertEqual([('inserted', 1), ('inserted', 2)], results)
+        self.assertEqual([('other', 11, 'T-2')], calls)
+        self.assertGetDoc(self.db, 'doc-1', 'other:1', simple_doc, False)
+        self.assertGetDoc(self.db, 'doc-2', 'other:1', nested_doc, False)
+
+    def test__put_docs_if_newer_validates_within_batch(self):
+        doc1 = self.make_document('doc-1', 'other:1', simple_doc)
+        doc2 = self.make_document('doc-2', 'other:1', nested_doc)
+        self.assertRaises(
+            errors.InvalidTransactionId, self.db._put_docs_if_newer,
+            [(doc1, 10, 'T-1'), (doc2, 10, 'T-2')], save_conflict=False,
+            replica_uid='other')
+
+    def test_sync_exchange_in_batches(self):
+        batches = []
+        _put_docs_if_newer = self.db._put_docs_if_newer
+
+        def put_docs_if_newer(docs_by_generation, *args, **kwargs):
+            batches.append([doc.doc_id for doc, _, _ in docs_by_generation])
+            return _put_docs_if_newer(docs_by_generation, *args, **kwargs)
+        self.patch(self.db, '_put_docs_if_newer', put_docs_if_newer)
+        st = self.db.get_sync_target()
+        st.batch_size = 2
+        docs_by_gen = [
+            (self.make_document('doc-%d' % i, 'other:1', simple_doc), i,
+             'T-%d' % i) for i in range(1, 4)]
+        st.sync_exchange(docs_by_gen, 'other', last_known_generation=0,
+                         return_doc_cb=lambda *args: None)
+        self.assertEqual([['doc-1', 'doc-2'], ['doc-3']], batches)
+        self.assertEqual((3, 'T-3'), self.db._get_sync_gen_info('other'))
+
 
 # Use a custom loader to apply the scenarios at load time.
 load_tests = tests.load_with_scenarios
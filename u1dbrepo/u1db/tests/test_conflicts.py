@@ -0,0 +1,198 @@
+# Copyright 2012 Canonical Ltd.
+#
+# This file is part of u1db.
+#
+# u1db is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation.
+#
+# u1db is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with u1db.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the conflict resolution policies."""
+
+from u1db import (
+    conflicts,
+    errors,
+    json_codec,
+    tests,
+    )
+from u1db.backends import sqlite_backend
+
+
+def task(title, updated, **fields):
+    fields.update(title=title, updated=updated)
+    return tests.create_doc('doc', 'r:1', json_codec.dumps(fields))
+
+
+class TestLastWriterWins(tests.TestCase):
+
+    def test_latest(self):
+        docs = [task('a', '2012-01-01'), task('b', '2012-01-02'),
+                task('c', '2011-12-31')]
+        policy = conflicts.LastWriterWins('updated')
+        self.assertIs(docs[1], policy(docs))
+
+    def test_equal_values(self):
+        docs = [task('a', '2012-01-01'), task('b', '2012-01-01')]
+        policy = conflicts.LastWriterWins('updated')
+        self.assertIs(docs[0], policy(docs))
+
+    def test_missing_field_and_deleted(self):
+        docs = [tests.create_doc('doc', 'r:1', None),
+                tests.create_doc('doc', 'r:2', '{"title": "a"}'),
+                task('b', '2012-01-01')]
+        policy = conflicts.LastWriterWins('updated')
+        self.assertIs(docs[2], policy(docs))
+
+
+class TestMergeFields(tests.TestCase):
+
+    def test_merge(self):
+        docs = [task('a', '2012-01-01', done=True),
+                task('b', '2012-01-02', tags=['x'])]
+        merged = conflicts.MergeFields()(docs)
+        self.assertEqual({'title': 'a', 'updated': '2012-01-01',
+                          'done': True, 'tags': ['x']},
+                         json_codec.loads(merged.get_json()))
+
+    def test_prefer(self):
+        docs = [task('a', '2012-01-01', done=True),
+                task('b', '2012-01-02', tags=['x'])]
+        merged = conflicts.MergeFields(
+            conflicts.LastWriterWins('updated'))(docs)
+        self.assertEqual({'title': 'b', 'updated': '2012-01-02',
+                          'done': True, 'tags': ['x']},
+                         json_codec.loads(merged.get_json()))
+
+    def test_prefer_none(self):
+        docs = [task('a', '2012-01-01'), task('b', '2012-01-02')]
+        policy = conflicts.MergeFields(lambda docs: None)
+        self.assertIs(None, policy(docs))
+
+    def test_deleted(self):
+        deleted = tests.create_doc('doc', 'r:1', None)
+        doc = task('a', '2012-01-01')
+        self.assertEqual(doc.get_json(),
+                         conflicts.MergeFields()([deleted, doc]).get_json())
+        self.assertIs(deleted, conflicts.MergeFields()([deleted, deleted]))
+
+
+class TestRegistry(tests.TestCase):
+
+    def test_get_policy(self):
+        policy = conflicts.get_policy('last-writer-wins', 'updated')
+        self.assertIsInstance(policy, conflicts.LastWriterWins)
+        self.assertEqual('updated', policy.field)
+        self.assertIsInstance(conflicts.get_policy('merge-fields'),
+                              conflicts.MergeFields)
+
+    def test_register_policy(self):
+        self.patch(conflicts, '_registry', dict(conflicts._registry))
+        conflicts.register_policy('first', lambda: lambda docs: docs[0])
+        docs = [task('a', '2012-01-01'), task('b', '2012-01-02')]
+        self.assertIs(docs[0], conflicts.get_policy('first')(docs))
+
+    def test_unknown_policy(self):
+        self.assertRaises(errors.UnknownConflictPolicy,
+                          conflicts.get_policy, 'no-such-policy')
+
+
+class ConflictPolicyDatabaseTests(tests.DatabaseBaseTests):
+
+    def make_conflict(self, doc_id, content, other_content):
+        doc = self.db.create_doc(content, doc_id=doc_id)
+        other = self.make_document(doc_id, 'other:1', other_content, False)
+        state, _ = self.db._put_doc_if_newer(other, save_conflict=True)
+        self.assertEqual('conflicted', state)
+        return doc, other
+
+    def test_resolve_all_conflicts(self):
+        doc1, other1 = self.make_conflict(
+            'doc-1', '{"updated": 2}', '{"updated": 1}')
+        doc2, other2 = self.make_conflict(
+            'doc-2', '{"updated": 1}', '{"updated": 2}')
+        self.db.create_doc('{"updated": 3}', doc_id='doc-3')
+        self.assertEqual(2, self.db.resolve_all_conflicts(
+            conflicts.LastWriterWins('updated')))
+        self.assertGetDocConflicts(self.db, 'doc-1', [])
+        self.assertGetDocConflicts(self.db, 'doc-2', [])
+        resolved = self.db.get_doc('doc-1')
+        self.assertEqual('{"updated": 2}', resolved.get_json())
+        self.assertFalse(resolved.has_conflicts)
+        # the resolution supersedes all the revisions in conflict
+        for rev in (doc1.rev, other1.rev):
+            self.assertTrue(self.db._get_vcr(resolved.rev).is_newer(
+                self.db._get_vcr(rev)))
+        self.assertEqual('{"updated": 2}',
+                         self.db.get_doc('doc-2').get_json())
+
+    def test_resolve_all_conflicts_left(self):
+        self.make_conflict('doc-1', '{"a": 1}', '{"a": 2}')
+        self.assertEqual(0, self.db.resolve_all_conflicts(
+            lambda docs: None))
+        self.assertEqual(2, len(self.db.get_doc_conflicts('doc-1')))
+
+    def test_resolve_all_conflicts_none(self):
+        self.db.create_doc('{"a": 1}')
+        self.assertEqual(0, self.db.resolve_all_conflicts(
+            conflicts.MergeFields()))
+
+    def test_resolve_all_conflicts_updates_indexes(self):
+        self.db.create_index('by-a', 'a')
+        self.make_conflict('doc-1', '{"a": "x"}', '{"a": "y", "b": 1}')
+        self.db.resolve_all_conflicts(conflicts.MergeFields())
+        self.assertEqual(['doc-1'], [doc.doc_id for doc in
+                                     self.db.get_from_index('by-a', 'y')])
+        self.assertEqual([], self.db.get_from_index('by-a', 'x'))
+
+    def test_set_conflict_policy(self):
+        self.db.set_conflict_policy(conflicts.MergeFields())
+        doc = self.db.create_doc('{"a": 1}', doc_id='doc-1')
+        other = self.make_document('doc-1', 'other:1', '{"b": 2}', False)
+        state, _ = self.db._put_doc_if_newer(other, save_conflict=True)
+        self.assertEqual('conflicted', state)
+        resolved = self.db.get_doc('doc-1')
+        self.assertFalse(resolved.has_conflicts)
+        self.assertEqual({'a': 1, 'b': 2},
+                         json_codec.loads(resolved.get_json()))
+        self.assertTrue(self.db._get_vcr(resolved.rev).is_newer(
+            self.db._get_vcr(doc.rev)))
+
+    def test_set_conflict_policy_not_saved(self):
+        self.db.set_conflict_policy(conflicts.MergeFields())
+        doc = self.db.create_doc('{"a": 1}', doc_id='doc-1')
+        other = self.make_document('doc-1', 'other:1', '{"b": 2}', False)
+        state, _ = self.db._put_doc_if_newer(other, save_conflict=False)
+        self.assertEqual('conflicted', state)
+        self.assertGetDoc(self.db, 'doc-1', doc.rev, '{"a": 1}', False)
+
+
+class TestSQLiteResolveAllConflicts(tests.TestCase):
+
+    def test_one_transaction(self):
+        db = sqlite_backend.SQLitePartialExpandDatabase(':memory:')
+        db._set_replica_uid('test')
+        for doc_id in ('doc-1', 'doc-2'):
+            db.create_doc('{"a": 1}', doc_id=doc_id)
+            other = tests.create_doc(doc_id, 'other:1', '{"a": 2}')
+            db._put_doc_if_newer(other, save_conflict=True)
+        calls = []
+
+        def policy(docs):
+            calls.append(docs[0].doc_id)
+            if len(calls) > 1:
+                raise RuntimeError
+            return docs[0]
+
+        self.assertRaises(RuntimeError, db.resolve_all_conflicts, policy)
+        # the first resolution was rolled back with the failure
+        self.assertEqual(2, len(db.get_doc_conflicts(calls[0])))
+
+
+load_tests = tests.load_with_scenarios
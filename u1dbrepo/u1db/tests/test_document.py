@@ -15,7 +15,7 @@
 # along with u1db.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from u1db import Document
+from u1db import content_digest, Document
 from u1db import errors, tests
 
 
@@ -128,5 +128,97 @@ class TestPyDocument(tests.TestCase):
         doc = self.make_document('id', 'rev', '{"content":""}')
         self.assertRaises(errors.InvalidJSON, doc.set_json, 'is not json')
 
+    def test_from_trusted_json(self):
+        doc = Document._from_trusted_json('id', 'rev', '{"content": ""}')
+        self.assertIsInstance(doc, Document)
+        self.assertEqual(('id', 'rev'), (doc.doc_id, doc.rev))
+        self.assertEqual('{"content": ""}', doc.get_json())
+        self.assertIs(None, doc._parsed)
+        self.assertEqual({"content": ""}, doc.content)
+
+    def test_from_trusted_json_overridden_init(self):
+
+        class ValidatingDocument(Document):
+
+            def __init__(self, doc_id, rev, json, has_conflicts=False):
+                super(ValidatingDocument, self).__init__(
+                    doc_id, rev, json, has_conflicts)
+                self.initialized = True
+
+        doc = ValidatingDocument._from_trusted_json('id', 'rev', '{}')
+        self.assertTrue(doc.initialized)
+        self.assertRaises(
+            errors.InvalidJSON, ValidatingDocument._from_trusted_json,
+            'id', 'rev', 'not json')
+
+    def test_get_content_reuses_validation(self):
+        doc = self.make_document('id', 'rev', '{"content": ""}')
+        parsed = doc._parsed
+        self.assertIs(parsed, doc.content)
+        self.assertIs(None, doc._parsed)
+
+    def test_same_content_as_caches_parsed(self):
+        doc_a = Document._from_trusted_json('a', 'b', '{"key": 1}')
+        doc_b = Document._from_trusted_json('c', 'd', '{"key":1}')
+        self.assertTrue(doc_a.same_content_as(doc_b))
+        self.assertEqual({"key": 1}, doc_a._parsed)
+        self.assertEqual('{"key": 1}', doc_a.get_json())
+
+    def test_same_content_as_digest(self):
+        doc_a = Document._from_trusted_json('a', 'b', '{"key": "value"}')
+        doc_b = Document._from_trusted_json('c', 'd', '{"key":"value"}')
+        doc_a._digest = doc_b._digest = content_digest({"key": "value"})
+        self.assertTrue(doc_a.same_content_as(doc_b))
+        # equal digests spared parsing
+        self.assertIs(None, doc_a._parsed)
+        self.assertIs(None, doc_b._parsed)
+
+    def test_same_content_as_digest_other_side(self):
+        doc_a = Document._from_trusted_json('a', 'b', '{"key": "value"}')
+        doc_a._digest = content_digest({"key": "other"})
+        doc_b = self.make_document('c', 'd', '{"key":"other"}')
+        self.assertTrue(doc_a.same_content_as(doc_b))
+        self.assertIs(None, doc_a._parsed)
+        # kept for storing doc_b
+        self.assertEqual(doc_a._digest, doc_b._digest)
+
+    def test_same_content_as_numbers(self):
+        doc_a = self.make_document('a', 'b', '{"key": [1, 2.5]}')
+        doc_b = self.make_document('c', 'd', '{"key": [1.0, 2.5]}')
+        self.assertTrue(doc_a.same_content_as(doc_b))
+        self.assertEqual(doc_a._digest, doc_b._digest)
+        doc_b.set_json('{"key": [1, 2]}')
+        self.assertFalse(doc_a.same_content_as(doc_b))
+        doc_b.set_json('{"key": [true, 2.5]}')
+        self.assertFalse(doc_a.same_content_as(doc_b))
+
+    def test_get_digest_not_cached_for_content(self):
+        doc = self.make_document('a', 'b', '{"key": "value"}')
+        self.assertEqual(content_digest({"key": "value"}), doc._get_digest())
+        doc.content['key'] = 'other'
+        self.assertEqual(content_digest({"key": "other"}), doc._get_digest())
+        doc.content['key'] = 'value'
+        self.assertEqual(content_digest({"key": "value"}), doc._get_digest())
+
+    def test_content_digest(self):
+        self.assertEqual(content_digest({"a": 1, "b": [u"\xe5"]}),
+                         content_digest({"b": ["\xc3\xa5".decode('utf-8')],
+                                         "a": 1}))
+        self.assertNotEqual(content_digest({"a": 1}),
+                            content_digest({"a": "1"}))
+        self.assertEqual(content_digest({"a": [1, {"b": -0.0}]}),
+                         content_digest({"a": [1.0, {"b": 0}]}))
+        self.assertNotEqual(content_digest({"a": 1}),
+                            content_digest({"a": True}))
+        self.assertNotEqual(content_digest({"a": 1}),
+                            content_digest({"a": 1.5}))
+
+    def test_same_content_as_tombstone(self):
+        doc_a = self.make_document('a', 'b', '{}')
+        doc_b = self.make_document('c', 'd', None)
+        self.assertFalse(doc_a.same_content_as(doc_b))
+        self.assertTrue(doc_b.same_content_as(
+            self.make_document('e', 'f', None)))
+
 
 load_tests = tests.load_with_scenarios
@@ -16,10 +16,13 @@
 
 """Test the WSGI app."""
 
+import contextlib
 import paste.fixture
 import sys
 import simplejson
 import StringIO
+import urllib
+import zlib
 
 from u1db import (
     __version__ as _u1db_version,
@@ -31,18 +34,27 @@ from u1db import (
 from u1db.remote import (
     http_app,
     http_errors,
+    utils,
     )
 
 
-class TestFencedReader(tests.TestCase):
+def gzip_compress(data):
+    return ''.join(utils.iter_compressed([data], 'gzip'))
+
+
+def gzip_decompress(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+class TestStreamReader(tests.TestCase):
 
     def test_init(self):
-        reader = http_app._FencedReader(StringIO.StringIO(""), 25, 100)
+        reader = http_app._StreamReader(StringIO.StringIO(""), 25, 100)
         self.assertEqual(25, reader.remaining)
 
     def test_read_chunk(self):
         inp = StringIO.StringIO("abcdef")
-        reader = http_app._FencedReader(inp, 5, 10)
+        reader = http_app._StreamReader(inp, 5, 10)
         data = reader.read_chunk(2)
         self.assertEqual("ab", data)
         self.assertEqual(2, inp.tell())
@@ -50,7 +62,7 @@ class TestFencedReader(tests.TestCase):
 
     def test_read_chunk_remaining(self):
         inp = StringIO.StringIO("abcdef")
-        reader = http_app._FencedReader(inp, 4, 10)
+        reader = http_app._StreamReader(inp, 4, 10)
         data = reader.read_chunk(9999)
         self.assertEqual("abcd", data)
         self.assertEqual(4, inp.tell())
@@ -58,7 +70,7 @@ class TestFencedReader(tests.TestCase):
 
     def test_read_chunk_nothing_left(self):
         inp = StringIO.StringIO("abc")
-        reader = http_app._FencedReader(inp, 2, 10)
+        reader = http_app._StreamReader(inp, 2, 10)
         reader.read_chunk(2)
         self.assertEqual(2, inp.tell())
         self.assertEqual(0, reader.remaining)
@@ -69,7 +81,7 @@ class TestFencedReader(tests.TestCase):
 
     def test_read_chunk_kept(self):
         inp = StringIO.StringIO("abcde")
-        reader = http_app._FencedReader(inp, 4, 10)
+        reader = http_app._StreamReader(inp, 4, 10)
         reader._kept = "xyz"
         data = reader.read_chunk(2)  # atmost ignored
         self.assertEqual("xyz", data)
@@ -79,7 +91,7 @@ class TestFencedReader(tests.TestCase):
 
     def test_getline(self):
         inp = StringIO.StringIO("abc\r\nde")
-        reader = http_app._FencedReader(inp, 6, 10)
+        reader = http_app._StreamReader(inp, 6, 10)
         reader.MAXCHUNK = 6
         line = reader.getline()
         self.assertEqual("abc\r\n", line)
@@ -87,7 +99,7 @@ class TestFencedReader(tests.TestCase):
 
     def test_getline_exact(self):
         inp = StringIO.StringIO("abcd\r\nef")
-        reader = http_app._FencedReader(inp, 6, 10)
+        reader = http_app._StreamReader(inp, 6, 10)
         reader.MAXCHUNK = 6
         line = reader.getline()
         self.assertEqual("abcd\r\n", line)
@@ -95,14 +107,14 @@ class TestFencedReader(tests.TestCase):
 
     def test_getline_no_newline(self):
         inp = StringIO.StringIO("abcd")
-        reader = http_app._FencedReader(inp, 4, 10)
+        reader = http_app._StreamReader(inp, 4, 10)
         reader.MAXCHUNK = 6
         line = reader.getline()
         self.assertEqual("abcd", line)
 
     def test_getline_many_chunks(self):
         inp = StringIO.StringIO("abcde\r\nf")
-        reader = http_app._FencedReader(inp, 8, 10)
+        reader = http_app._StreamReader(inp, 8, 10)
         reader.MAXCHUNK = 4
         line = reader.getline()
         self.assertEqual("abcde\r\n", line)
@@ -112,7 +124,7 @@ class TestFencedReader(tests.TestCase):
 
     def test_getline_empty(self):
         inp = StringIO.StringIO("")
-        reader = http_app._FencedReader(inp, 0, 10)
+        reader = http_app._StreamReader(inp, 0, 10)
         reader.MAXCHUNK = 4
         line = reader.getline()
         self.assertEqual("", line)
@@ -121,7 +133,7 @@ class TestFencedReader(tests.TestCase):
 
     def test_getline_just_newline(self):
         inp = StringIO.StringIO("\r\n")
-        reader = http_app._FencedReader(inp, 2, 10)
+        reader = http_app._StreamReader(inp, 2, 10)
         reader.MAXCHUNK = 4
         line = reader.getline()
         self.assertEqual("\r\n", line)
@@ -130,16 +142,74 @@ class TestFencedReader(tests.TestCase):
 
     def test_getline_too_large(self):
         inp = StringIO.StringIO("x" * 50)
-        reader = http_app._FencedReader(inp, 50, 25)
+        reader = http_app._StreamReader(inp, 50, 25)
         reader.MAXCHUNK = 4
         self.assertRaises(http_app.BadRequest, reader.getline)
 
     def test_getline_too_large_complete(self):
         inp = StringIO.StringIO("x" * 25 + "\r\n")
-        reader = http_app._FencedReader(inp, 50, 25)
+        reader = http_app._StreamReader(inp, 50, 25)
         reader.MAXCHUNK = 4
         self.assertRaises(http_app.BadRequest, reader.getline)
 
+    def test_read_chunk_unbounded(self):
+        inp = StringIO.StringIO("abcdef")
+        reader = http_app._StreamReader(inp, None, 10)
+        self.assertEqual("abcd", reader.read_chunk(4))
+        self.assertEqual("ef", reader.read_chunk(4))
+        self.assertEqual("", reader.read_chunk(4))
+
+    def test_getline_unbounded(self):
+        inp = StringIO.StringIO("abc\r\nde")
+        reader = http_app._StreamReader(inp, None, 10)
+        reader.MAXCHUNK = 4
+        self.assertEqual("abc\r\n", reader.getline())
+        self.assertEqual("de", reader.getline())
+        self.assertEqual("", reader.getline())
+
+    def test_read_body(self):
+        inp = StringIO.StringIO("abcdef")
+        reader = http_app._StreamReader(inp, None, 2)
+        self.assertEqual("abcdef", reader.read_body(6))
+
+    def test_read_body_too_large(self):
+        inp = StringIO.StringIO("abcdef")
+        reader = http_app._StreamReader(inp, None, 2)
+        self.assertRaises(http_app.BadRequest, reader.read_body, 5)
+
+
+class TestChunkedInput(tests.TestCase):
+
+    def test_read(self):
+        inp = StringIO.StringIO("3\r\nabc\r\n5;ext=1\r\ndefgh\r\n0\r\n\r\n")
+        chunked = http_app._ChunkedInput(inp)
+        self.assertEqual("ab", chunked.read(2))
+        self.assertEqual("c", chunked.read(10))
+        self.assertEqual("defgh", chunked.read(10))
+        self.assertEqual("", chunked.read(10))
+        self.assertEqual("", chunked.read(10))
+        self.assertEqual(inp.len, inp.tell())
+
+    def test_read_trailer(self):
+        inp = StringIO.StringIO("1\r\na\r\n0\r\nX-Foo: bar\r\n\r\n")
+        chunked = http_app._ChunkedInput(inp)
+        self.assertEqual("a", chunked.read(10))
+        self.assertEqual("", chunked.read(10))
+        self.assertEqual(inp.len, inp.tell())
+
+    def test_bad_size(self):
+        chunked = http_app._ChunkedInput(StringIO.StringIO("x\r\nabc\r\n"))
+        self.assertRaises(http_app.BadRequest, chunked.read, 10)
+
+    def test_truncated(self):
+        chunked = http_app._ChunkedInput(StringIO.StringIO("5\r\nab"))
+        self.assertEqual("ab", chunked.read(10))
+        self.assertRaises(http_app.BadRequest, chunked.read, 10)
+
+    def test_missing_chunk_end(self):
+        chunked = http_app._ChunkedInput(StringIO.StringIO("2\r\nabcd"))
+        self.assertRaises(http_app.BadRequest, chunked.read, 10)
+
 
 class TestHTTPMethodDecorator(tests.TestCase):
 
@@ -296,6 +366,172 @@ class TestHTTPInvocationByMethodWithBody(tests.TestCase):
             ['{"entry": "x"}', '{"entry": "y"}'], resource.entries)
         self.assertEqual(['a', 's', 's', 'e'], resource.order)
 
+    def test_put_sync_stream_chunked(self):
+        resource = TestResource()
+        chunks = ['[\r\n{"b"', ': 2},\r\n{"entry": "x"},\r\n{"e',
+                  'ntry": "y"}\r\n]']
+        body = ''.join(['%x\r\n%s\r\n' % (len(chunk), chunk)
+                        for chunk in chunks]) + '0\r\n\r\n'
+        environ = {'QUERY_STRING': 'a=1', 'REQUEST_METHOD': 'PUT',
+                   'wsgi.input': StringIO.StringIO(body),
+                   'HTTP_TRANSFER_ENCODING': 'chunked',
+                   'CONTENT_TYPE': 'application/x-u1db-sync-stream'}
+        invoke = http_app.HTTPInvocationByMethodWithBody(resource, environ,
+                                                         parameters)
+        res = invoke()
+        self.assertEqual('Put/end', res)
+        self.assertEqual({'a': '1', 'b': 2}, resource.args)
+        self.assertEqual(
+            ['{"entry": "x"}', '{"entry": "y"}'], resource.entries)
+
+    def test_put_sync_stream_input_terminated(self):
+        resource = TestResource()
+        body = '[\r\n{"b": 2},\r\n{"entry": "x"}\r\n]'
+        environ = {'QUERY_STRING': 'a=1', 'REQUEST_METHOD': 'PUT',
+                   'wsgi.input': StringIO.StringIO(body),
+                   'wsgi.input_terminated': True,
+                   'HTTP_TRANSFER_ENCODING': 'chunked',
+                   'CONTENT_TYPE': 'application/x-u1db-sync-stream'}
+        invoke = http_app.HTTPInvocationByMethodWithBody(resource, environ,
+                                                         parameters)
+        self.assertEqual('Put/end', invoke())
+        self.assertEqual(['{"entry": "x"}'], resource.entries)
+
+    def test_put_sync_stream_larger_than_max_request_size(self):
+        resource = TestResource()
+        entries = ['{"entry": "%s"}' % (c * 50) for c in 'xyz']
+        body = '[\r\n{"b": 2},\r\n%s\r\n]' % (',\r\n'.join(entries),)
+        environ = {'QUERY_STRING': 'a=1', 'REQUEST_METHOD': 'PUT',
+                   'wsgi.input': StringIO.StringIO(body),
+                   'CONTENT_LENGTH': str(len(body)),
+                   'CONTENT_TYPE': 'application/x-u1db-sync-stream'}
+
+        class params:
+            max_request_size = 100
+            max_entry_size = 100
+
+        invoke = http_app.HTTPInvocationByMethodWithBody(resource, environ,
+                                                         params)
+        self.assertEqual('Put/end', invoke())
+        self.assertEqual(entries, resource.entries)
+
+    def test_put_json_chunked(self):
+        resource = TestResource()
+        body = 'e\r\n{"body": true}\r\n0\r\n\r\n'
+        environ = {'QUERY_STRING': 'a=1', 'REQUEST_METHOD': 'PUT',
+                   'wsgi.input': StringIO.StringIO(body),
+                   'HTTP_TRANSFER_ENCODING': 'chunked',
+                   'CONTENT_TYPE': 'application/json'}
+        invoke = http_app.HTTPInvocationByMethodWithBody(resource, environ,
+                                                         parameters)
+        self.assertEqual('Put', invoke())
+        self.assertEqual('{"body": true}', resource.content)
+
+    def test_put_json_chunked_too_large(self):
+        resource = TestResource()
+        body = 'e\r\n{"body": true}\r\n0\r\n\r\n'
+        environ = {'QUERY_STRING': 'a=1', 'REQUEST_METHOD': 'PUT',
+                   'wsgi.input': StringIO.StringIO(body),
+                   'HTTP_TRANSFER_ENCODING': 'chunked',
+                   'CONTENT_TYPE': 'application/json'}
+
+        class params:
+            max_request_size = 10
+            max_entry_size = 10
+
+        invoke = http_app.HTTPInvocationByMethodWithBody(resource, environ,
+                                                         params)
+        self.assertRaises(http_app.BadRequest, invoke)
+
+    def test_put_sync_stream_gzip(self):
+        resource = TestResource()
+        body = gzip_compress('[\r\n{"b": 2},\r\n{"entry": "x"},\r\n'
+                             '{"entry": "y"}\r\n]')
+        environ = {'QUERY_STRING': 'a=1', 'REQUEST_METHOD': 'PUT',
+                   'wsgi.input': StringIO.StringIO(body),
+                   'CONTENT_LENGTH': str(len(body)),
+                   'HTTP_CONTENT_ENCODING': 'gzip',
+                   'CONTENT_TYPE': 'application/x-u1db-sync-stream'}
+        invoke = http_app.HTTPInvocationByMethodWithBody(resource, environ,
+                                                         parameters)
+        self.assertEqual('Put/end', invoke())
+        self.assertEqual({'a': '1', 'b': 2}, resource.args)
+        self.assertEqual(
+            ['{"entry": "x"}', '{"entry": "y"}'], resource.entries)
+
+    def test_put_sync_stream_deflate_chunked(self):
+        resource = TestResource()
+        data = ''.join(utils.iter_compressed(
+            ['[\r\n{"b": 2},\r\n', '{"entry": "x"}\r\n]'], 'deflate'))
+        chunks = [data[:5], data[5:]]
+        body = ''.join(['%x\r\n%s\r\n' % (len(chunk), chunk)
+                        for chunk in chunks]) + '0\r\n\r\n'
+        environ = {'QUERY_STRING': 'a=1', 'REQUEST_METHOD': 'PUT',
+                   'wsgi.input': StringIO.StringIO(body),
+                   'HTTP_TRANSFER_ENCODING': 'chunked',
+                   'HTTP_CONTENT_ENCODING': 'deflate',
+                   'CONTENT_TYPE': 'application/x-u1db-sync-stream'}
+        invoke = http_app.HTTPInvocationByMethodWithBody(resource, environ,
+                                                         parameters)
+        self.assertEqual('Put/end', invoke())
+        self.assertEqual(['{"entry": "x"}'], resource.entries)
+
+    def test_put_sync_stream_gzip_entry_too_large(self):
+        resource = TestResource()
+        # compresses to much less than max_entry_size
+        body = gzip_compress('[\r\n{"b": 2},\r\n{"entry": "%s"}\r\n]'
+                             % ('x' * 1000,))
+        environ = {'QUERY_STRING': 'a=1', 'REQUEST_METHOD': 'PUT',
+                   'wsgi.input': StringIO.StringIO(body),
+                   'CONTENT_LENGTH': str(len(body)),
+                   'HTTP_CONTENT_ENCODING': 'gzip',
+                   'CONTENT_TYPE': 'application/x-u1db-sync-stream'}
+
+        class params:
+            max_request_size = 500
+            max_entry_size = 500
+
+        invoke = http_app.HTTPInvocationByMethodWithBody(resource, environ,
+                                                         params)
+        self.assertRaises(http_app.BadRequest, invoke)
+
+    def test_put_json_gzip(self):
+        resource = TestResource()
+        body = gzip_compress('{"body": true}')
+        environ = {'QUERY_STRING': 'a=1', 'REQUEST_METHOD': 'PUT',
+                   'wsgi.input': StringIO.StringIO(body),
+                   'CONTENT_LENGTH': str(len(body)),
+                   'HTTP_CONTENT_ENCODING': 'gzip',
+                   'CONTENT_TYPE': 'application/json'}
+        invoke = http_app.HTTPInvocationByMethodWithBody(resource, environ,
+                                                         parameters)
+        self.assertEqual('Put', invoke())
+        self.assertEqual('{"body": true}', resource.content)
+
+    def test_bad_request_broken_gzip(self):
+        resource = TestResource()
+        body = '{"body": true}'
+        environ = {'QUERY_STRING': 'a=1', 'REQUEST_METHOD': 'PUT',
+                   'wsgi.input': StringIO.StringIO(body),
+                   'CONTENT_LENGTH': str(len(body)),
+                   'HTTP_CONTENT_ENCODING': 'gzip',
+                   'CONTENT_TYPE': 'application/json'}
+        invoke = http_app.HTTPInvocationByMethodWithBody(resource, environ,
+                                                         parameters)
+        self.assertRaises(http_app.BadRequest, invoke)
+
+    def test_bad_request_unsupported_content_encoding(self):
+        resource = TestResource()
+        body = '{"body": true}'
+        environ = {'QUERY_STRING': 'a=1', 'REQUEST_METHOD': 'PUT',
+                   'wsgi.input': StringIO.StringIO(body),
+                   'CONTENT_LENGTH': str(len(body)),
+                   'HTTP_CONTENT_ENCODING': 'br',
+                   'CONTENT_TYPE': 'application/json'}
+        invoke = http_app.HTTPInvocationByMethodWithBody(resource, environ,
+                                                         parameters)
+        self.assertRaises(http_app.BadRequest, invoke)
+
     def _put_sync_stream(self, body):
         resource = TestResource()
         environ = {'QUERY_STRING': 'a=1&b=2', 'REQUEST_METHOD': 'PUT',
@@ -499,6 +735,53 @@ class TestHTTPResponder(tests.TestCase):
                           '\r\n]\r\n'], self.response_body)
         self.assertEqual([], responder.content)
 
+    def test_send_stream_compressed(self):
+        responder = http_app.HTTPResponder(self.start_response,
+                                           'gzip;q=0.5, deflate')
+        responder.content_type = "application/x-u1db-multi-json"
+        responder.compress = True
+        responder.start_response(200)
+        responder.start_stream()
+        responder.stream_entry({'entry': 1})
+        responder.end_stream()
+        responder.finish_response()
+        self.assertEqual({'content-type': 'application/x-u1db-multi-json',
+                          'cache-control': 'no-cache',
+                          'content-encoding': 'deflate'}, self.headers)
+        self.assertEqual('[\r\n{"entry": 1}\r\n]\r\n', zlib.decompress(
+            ''.join(self.response_body + responder.content)))
+
+    def test_send_stream_compressed_w_error(self):
+        responder = http_app.HTTPResponder(self.start_response, 'gzip')
+        responder.content_type = "application/x-u1db-multi-json"
+        responder.compress = True
+        responder.start_response(200)
+        responder.start_stream()
+        responder.stream_entry({'entry': 1})
+        responder.send_response_json(503, error="unavailable")
+        self.assertEqual('gzip', self.headers['content-encoding'])
+        body = gzip_decompress(''.join(self.response_body +
+                                       responder.content))
+        self.assertEqual(
+            '[\r\n{"entry": 1},\r\n{"error": "unavailable"}\r\n', body)
+
+    def test_send_response_json_not_compressed(self):
+        responder = http_app.HTTPResponder(self.start_response, 'gzip')
+        responder.compress = True
+        responder.send_response_json(value='success')
+        self.assertNotIn('content-encoding', self.headers)
+        self.assertEqual(['{"value": "success"}\r\n'], responder.content)
+
+    def test_send_stream_not_accepted(self):
+        responder = http_app.HTTPResponder(self.start_response, 'br')
+        responder.compress = True
+        responder.start_response(200)
+        responder.start_stream()
+        responder.end_stream()
+        responder.finish_response()
+        self.assertNotIn('content-encoding', self.headers)
+        self.assertEqual(['[', '\r\n]\r\n'], self.response_body)
+
     def test_send_stream_w_error(self):
         responder = http_app.HTTPResponder(self.start_response)
         responder.content_type = "application/x-u1db-multi-json"
@@ -603,6 +886,26 @@ class TestHTTPApp(tests.TestCase):
         self.assertEqual('application/json', resp.header('content-type'))
         self.assertEqual({'rev': doc.rev}, simplejson.loads(resp.body))
 
+    def test_put_doc_writing(self):
+        calls = []
+        writing = self.state.writing
+
+        @contextlib.contextmanager
+        def witness(path):
+            calls.append(('writing', path))
+            with writing(path):
+                yield
+
+        self.patch(self.state, 'writing', witness)
+        self.patch(self.state, 'release_databases',
+                   lambda: calls.append('release'))
+        self.app.put('/db0/doc/doc1', params='{"x": 1}',
+                     headers={'content-type': 'application/json'})
+        self.assertEqual([('writing', 'db0'), 'release'], calls)
+        del calls[:]
+        self.app.get('/db0/doc/doc1')
+        self.assertEqual(['release'], calls)
+
     def test_put_doc(self):
         doc = self.db0.create_doc('{"x": 1}', doc_id='doc1')
         resp = self.app.put('/db0/doc/doc1?old_rev=%s' % doc.rev,
@@ -641,6 +944,33 @@ class TestHTTPApp(tests.TestCase):
         self.assertEqual(doc.rev, resp.header('x-u1db-rev'))
         self.assertEqual('false', resp.header('x-u1db-has-conflicts'))
 
+    def test_get_doc_etag(self):
+        doc = self.db0.create_doc('{"x": 1}', doc_id='doc1')
+        resp = self.app.get('/db0/doc/%s' % doc.doc_id)
+        self.assertEqual('"%s"' % (doc.rev,), resp.header('etag'))
+
+    def test_get_doc_not_modified(self):
+        doc = self.db0.create_doc('{"x": 1}', doc_id='doc1')
+        self.patch(self.db0, 'get_doc', None)  # the content is not read
+        resp = self.app.get('/db0/doc/%s' % doc.doc_id,
+                            headers={'if-none-match': '"%s"' % (doc.rev,)})
+        self.assertEqual(304, resp.status)
+        self.assertEqual('', resp.body)
+        self.assertEqual('"%s"' % (doc.rev,), resp.header('etag'))
+        self.assertEqual(doc.rev, resp.header('x-u1db-rev'))
+        self.assertEqual('false', resp.header('x-u1db-has-conflicts'))
+
+    def test_get_doc_modified(self):
+        doc = self.db0.create_doc('{"x": 1}', doc_id='doc1')
+        old_rev = doc.rev
+        doc.set_json('{"x": 2}')
+        self.db0.put_doc(doc)
+        resp = self.app.get('/db0/doc/%s' % doc.doc_id,
+                            headers={'if-none-match': '"%s"' % (old_rev,)})
+        self.assertEqual(200, resp.status)
+        self.assertEqual('{"x": 2}', resp.body)
+        self.assertEqual(doc.rev, resp.header('x-u1db-rev'))
+
     def test_get_doc_non_existing(self):
         resp = self.app.get('/db0/doc/not-there', expect_errors=True)
         self.assertEqual(404, resp.status)
@@ -690,6 +1020,189 @@ class TestHTTPApp(tests.TestCase):
         self.assertEqual({"error": "database does not exist"},
                          simplejson.loads(resp.body))
 
+    def test_get_docs(self):
+        doc1 = self.db0.create_doc('{"x": 1}', doc_id='doc1')
+        doc2 = self.db0.create_doc('{"x": 2}', doc_id='doc2')
+        self.db0.delete_doc(doc2)
+        body = "[\r\n{},\r\n%s,\r\n%s,\r\n%s\r\n]" % (
+            '{"id": "doc2"}', '{"id": "missing"}', '{"id": "doc1"}')
+        resp = self.app.post('/db0/docs', params=body,
+                             headers={'content-type':
+                                      'application/x-u1db-sync-stream'})
+        self.assertEqual(200, resp.status)
+        self.assertEqual('application/x-u1db-sync-stream',
+                         resp.header('content-type'))
+        parts = resp.body.splitlines()
+        self.assertEqual(['[', '{},', ']'], [parts[0], parts[1], parts[3]])
+        self.assertEqual({'id': 'doc1', 'rev': doc1.rev,
+                          'content': '{"x": 1}', 'has_conflicts': False},
+                         simplejson.loads(parts[2]))
+
+    def test_get_docs_include_deleted(self):
+        doc = self.db0.create_doc('{"x": 1}', doc_id='doc1')
+        self.db0.delete_doc(doc)
+        body = "[\r\n%s,\r\n%s\r\n]" % (
+            simplejson.dumps({'include_deleted': True,
+                              'check_for_conflicts': False}),
+            '{"id": "doc1"}')
+        resp = self.app.post('/db0/docs', params=body,
+                             headers={'content-type':
+                                      'application/x-u1db-sync-stream'})
+        parts = resp.body.splitlines()
+        self.assertEqual({'id': 'doc1', 'rev': doc.rev, 'content': None},
+                         simplejson.loads(parts[2]))
+
+    def test_get_docs_known_rev(self):
+        doc1 = self.db0.create_doc('{"x": 1}', doc_id='doc1')
+        doc2 = self.db0.create_doc('{"x": 2}', doc_id='doc2')
+        body = "[\r\n{},\r\n%s,\r\n%s\r\n]" % (
+            simplejson.dumps({'id': 'doc1', 'known_rev': doc1.rev}),
+            simplejson.dumps({'id': 'doc2', 'known_rev': 'other:1'}))
+        resp = self.app.post('/db0/docs', params=body,
+                             headers={'content-type':
+                                      'application/x-u1db-sync-stream'})
+        parts = resp.body.splitlines()
+        self.assertEqual({'id': 'doc1', 'rev': doc1.rev, 'unchanged': True,
+                          'has_conflicts': False},
+                         simplejson.loads(parts[2].rstrip(',')))
+        self.assertEqual({'id': 'doc2', 'rev': doc2.rev,
+                          'content': '{"x": 2}', 'has_conflicts': False},
+                         simplejson.loads(parts[3]))
+
+    def test_get_docs_not_writing(self):
+        self.patch(self.state, 'writing', None)
+        resp = self.app.post('/db0/docs', params="[\r\n{}\r\n]",
+                             headers={'content-type':
+                                      'application/x-u1db-sync-stream'})
+        self.assertEqual(200, resp.status)
+
+    def test_bulk(self):
+        doc1 = self.db0.create_doc('{"x": 1}', doc_id='doc1')
+        doc2 = self.db0.create_doc('{"x": 2}', doc_id='doc2')
+        entries = [{'id': 'doc1', 'rev': doc1.rev, 'content': '{"x": 3}'},
+                   {'id': 'doc2', 'rev': doc2.rev},
+                   {'id': 'doc3', 'content': '{"x": 4}'},
+                   {'id': 'doc1', 'rev': doc1.rev, 'content': '{"x": 5}'}]
+        body = "[\r\n{},\r\n%s\r\n]" % ",\r\n".join(
+            map(simplejson.dumps, entries))
+        resp = self.app.post('/db0/bulk', params=body,
+                             headers={'content-type':
+                                      'application/x-u1db-sync-stream'})
+        self.assertEqual(200, resp.status)
+        self.assertEqual('application/x-u1db-sync-stream',
+                         resp.header('content-type'))
+        doc1 = self.db0.get_doc('doc1')
+        self.assertEqual('{"x": 3}', doc1.get_json())
+        doc2 = self.db0.get_doc('doc2', include_deleted=True)
+        self.assertTrue(doc2.is_tombstone())
+        doc3 = self.db0.get_doc('doc3')
+        self.assertEqual('{"x": 4}', doc3.get_json())
+        parts = resp.body.splitlines()
+        self.assertEqual(7, len(parts))
+        self.assertEqual('{},', parts[1])
+        conflict = errors.RevisionConflict.wire_description
+        self.assertEqual(
+            [{'id': 'doc1', 'rev': doc1.rev},
+             {'id': 'doc2', 'rev': doc2.rev},
+             {'id': 'doc3', 'rev': doc3.rev},
+             {'id': 'doc1', 'error': conflict}],
+            [simplejson.loads(part.rstrip(',')) for part in parts[2:6]])
+
+    def test_create_index(self):
+        resp = self.app.put('/db0/index/by-x',
+                            params='{"expressions": ["x", "lower(y)"]}',
+                            headers={'content-type': 'application/json'})
+        self.assertEqual(200, resp.status)
+        self.assertEqual([('by-x', ['x', 'lower(y)'])],
+                         self.db0.list_indexes())
+        resp = self.app.get('/db0/indexes')
+        self.assertEqual(
+            {'indexes': [{'name': 'by-x', 'expressions': ['x', 'lower(y)']}]},
+            simplejson.loads(resp.body))
+
+    def test_get_from_index(self):
+        self.db0.create_index('by-x', 'x')
+        doc1 = self.db0.create_doc('{"x": "a"}')
+        self.db0.create_doc('{"x": "b"}')
+        resp = self.app.get('/db0/index/by-x?key=%s' % (
+            urllib.quote('["a"]'),))
+        self.assertEqual(200, resp.status)
+        self.assertEqual('application/x-u1db-sync-stream',
+                         resp.header('content-type'))
+        parts = resp.body.splitlines()
+        self.assertEqual(['[', '{},', ']'], [parts[0], parts[1], parts[3]])
+        self.assertEqual(
+            {'id': doc1.doc_id, 'rev': doc1.rev, 'content': '{"x": "a"}'},
+            simplejson.loads(parts[2]))
+
+    def test_get_range_from_index_limit(self):
+        self.db0.create_index('by-x', 'x')
+        docs = [self.db0.create_doc('{"x": "%s"}' % (x,))
+                for x in ('a', 'b', 'c', 'd')]
+        resp = self.app.get('/db0/index/by-x?start=%s&limit=2' % (
+            urllib.quote('["b"]'),))
+        parts = resp.body.splitlines()
+        self.assertEqual(5, len(parts))
+        cursor = simplejson.loads(parts[1].rstrip(','))['cursor']
+        self.assertEqual([docs[1].doc_id, docs[2].doc_id],
+                         [simplejson.loads(part.rstrip(','))['id']
+                          for part in parts[2:4]])
+        resp = self.app.get(
+            '/db0/index/by-x?start=%s&limit=2&cursor=%s' % (
+                urllib.quote('["b"]'), urllib.quote(cursor)))
+        parts = resp.body.splitlines()
+        self.assertEqual(4, len(parts))
+        self.assertEqual({}, simplejson.loads(parts[1].rstrip(',')))
+        self.assertEqual(docs[3].doc_id, simplejson.loads(parts[2])['id'])
+
+    def get_index_page(self, cursor=None):
+        query = '/db0/index/by-x?start=%s&limit=2' % (
+            urllib.quote('["a"]'),)
+        if cursor is not None:
+            query += '&cursor=' + urllib.quote(cursor)
+        resp = self.app.get(query, expect_errors=True)
+        parts = resp.body.splitlines()
+        if resp.status != 200:
+            return resp.status, simplejson.loads(resp.body), None
+        return (resp.status,
+                [simplejson.loads(part.rstrip(','))['id']
+                 for part in parts[2:-1]],
+                simplejson.loads(parts[1].rstrip(',')).get('cursor'))
+
+    def test_get_range_from_index_limit_changed(self):
+        self.db0.create_index('by-x', 'x')
+        docs = [self.db0.create_doc('{"x": "%s"}' % (x,))
+                for x in ('b', 'c', 'd', 'e')]
+        status, doc_ids, cursor = self.get_index_page()
+        self.assertEqual([docs[0].doc_id, docs[1].doc_id], doc_ids)
+        # added and removed before the end of the page
+        new1 = self.db0.create_doc('{"x": "a"}')
+        new2 = self.db0.create_doc('{"x": "ba"}')
+        self.db0.delete_doc(docs[0])
+        status, doc_ids, _ = self.get_index_page(cursor)
+        self.assertEqual([docs[2].doc_id, docs[3].doc_id], doc_ids)
+        status, doc_ids, cursor = self.get_index_page()
+        self.assertEqual([new1.doc_id, new2.doc_id], doc_ids)
+        self.db0.delete_doc(new2)
+        self.assertEqual(
+            (400, {'error': errors.InvalidCursor.wire_description}, None),
+            self.get_index_page(cursor))
+
+    def test_get_from_index_bad_query(self):
+        self.db0.create_index('by-x', 'x')
+        for query in ('key=a', 'key=%5B1%5D', 'limit=0', 'cursor=-1',
+                      'cursor=0%3Adoc', 'cursor=x%3Adoc',
+                      'key=%5B%22a%22%5D&start=%5B%22a%22%5D'):
+            resp = self.app.get('/db0/index/by-x?' + query,
+                                expect_errors=True)
+            self.assertEqual(400, resp.status)
+
+    def test_get_index_keys(self):
+        self.db0.create_index('by-x', 'x')
+        self.db0.create_doc('{"x": "a"}')
+        resp = self.app.get('/db0/index/by-x/keys')
+        self.assertEqual({'keys': [['a']]}, simplejson.loads(resp.body))
+
     def test_get_sync_info(self):
         self.db0._set_sync_info('other-id', 1, 'T-transid')
         resp = self.app.get('/db0/sync-from/other-id')
@@ -702,6 +1215,39 @@ class TestHTTPApp(tests.TestCase):
                               source_transaction_id='T-transid'),
                               simplejson.loads(resp.body))
 
+    def test_get_sync_info_retired_replicas(self):
+        self.db0.set_retired_replicas(['old2', 'old1'])
+        resp = self.app.get('/db0/sync-from/other-id')
+        self.assertEqual(['old1', 'old2'],
+                         simplejson.loads(resp.body)['retired_replicas'])
+
+    def test_get_retired_replicas(self):
+        self.db0.set_retired_replicas(['old2', 'old1'])
+        resp = self.app.get('/db0/retired-replicas')
+        self.assertEqual(200, resp.status)
+        self.assertEqual({'replica_uids': ['old1', 'old2']},
+                         simplejson.loads(resp.body))
+
+    def test_put_retired_replicas(self):
+        resp = self.app.put('/db0/retired-replicas',
+                            params='{"replica_uids": ["old"]}',
+                            headers={'content-type': 'application/json'})
+        self.assertEqual(200, resp.status)
+        self.assertEqual(frozenset(['old']), self.db0.get_retired_replicas())
+
+    def test_put_retired_replicas_own_replica(self):
+        resp = self.app.put('/db0/retired-replicas',
+                            params='{"replica_uids": ["db0"]}',
+                            headers={'content-type': 'application/json'},
+                            expect_errors=True)
+        self.assertEqual(400, resp.status)
+        self.assertEqual({'error': 'invalid replica uid'},
+                         simplejson.loads(resp.body))
+
+    def test_get_sync_info_accept_encoding(self):
+        resp = self.app.get('/db0/sync-from/other-id')
+        self.assertEqual('gzip, deflate', resp.header('accept-encoding'))
+
     def test_record_sync_info(self):
         resp = self.app.put('/db0/sync-from/other-id',
             params='{"generation": 2, "transaction_id": "T-transid"}',
@@ -712,6 +1258,32 @@ class TestHTTPApp(tests.TestCase):
         self.assertEqual((2, 'T-transid'),
                          self.db0._get_sync_gen_info('other-id'))
 
+    def test_sync_exchange_writing_per_batch(self):
+        calls = []
+        writing = self.state.writing
+
+        @contextlib.contextmanager
+        def witness(path):
+            calls.append(('writing', path))
+            with writing(path):
+                yield
+            calls.append('written')
+
+        self.patch(self.state, 'writing', witness)
+        self.patch(http_app.SyncResource, 'batch_size', 1)
+        entries = [
+            {'id': 'doc-%d' % i, 'rev': 'replica:1', 'content': '{}',
+             'gen': i, 'trans_id': 'T-%d' % i} for i in range(1, 4)]
+        body = ("[\r\n%s,\r\n" % simplejson.dumps(
+                    {'last_known_generation': 0}) +
+                ",\r\n".join(map(simplejson.dumps, entries)) + "\r\n]\r\n")
+        resp = self.app.post('/db0/sync-from/replica', params=body,
+                             headers={'content-type':
+                                      'application/x-u1db-sync-stream'})
+        self.assertEqual(200, resp.status)
+        # released between the entries read
+        self.assertEqual([('writing', 'db0'), 'written'] * 3, calls)
+
     def test_sync_exchange_send(self):
         entries = {
             10: {'id': 'doc-here', 'rev': 'replica:1', 'content':
@@ -720,6 +1292,7 @@ class TestHTTPApp(tests.TestCase):
                  '{"value": "here2"}', 'gen': 11, 'trans_id': 'T-sed'}
             }
 
+        self.patch(http_app.SyncResource, 'batch_size', 1)
         gens = []
         _do_set_sync_info = self.db0._do_set_sync_info
 
@@ -755,6 +1328,39 @@ class TestHTTPApp(tests.TestCase):
         self.assertEqual('', bits[3])
         self.assertEqual([('replica', 10), ('replica', 11)], gens)
 
+    def test_sync_exchange_send_batched(self):
+        entries = [
+            {'id': 'doc-here', 'rev': 'replica:1', 'content':
+             '{"value": "here"}', 'gen': 10, 'trans_id': 'T-sid'},
+            {'id': 'doc-here2', 'rev': 'replica:1', 'content':
+             '{"value": "here2"}', 'gen': 11, 'trans_id': 'T-sed'},
+            {'id': 'doc-here3', 'rev': 'replica:1', 'content':
+             '{"value": "here3"}', 'gen': 12, 'trans_id': 'T-sod'},
+            ]
+        self.patch(http_app.SyncResource, 'batch_size', 2)
+        gens = []
+        _do_set_sync_info = self.db0._do_set_sync_info
+
+        def set_sync_generation_witness(other_uid, other_gen, other_trans_id):
+            gens.append((other_uid, other_gen, self.db0._get_generation()))
+            _do_set_sync_info(other_uid, other_gen, other_trans_id)
+
+        self.patch(self.db0, '_do_set_sync_info', set_sync_generation_witness)
+        args = dict(last_known_generation=0)
+        body = ("[\r\n" +
+                "%s,\r\n" % simplejson.dumps(args) +
+                ",\r\n".join(map(simplejson.dumps, entries)) +
+                "\r\n]\r\n")
+        resp = self.app.post('/db0/sync-from/replica',
+                            params=body,
+                            headers={'content-type':
+                                     'application/x-u1db-sync-stream'})
+        self.assertEqual(200, resp.status)
+        self.assertEqual([('replica', 11, 2), ('replica', 12, 3)], gens)
+        for entry in entries:
+            self.assertGetDoc(self.db0, entry['id'], entry['rev'],
+                              entry['content'], False)
+
     def test_sync_exchange_send_entry_too_large(self):
         self.http_app.max_request_size = 20000
         self.http_app.max_entry_size = 10000
@@ -807,6 +1413,145 @@ class TestHTTPApp(tests.TestCase):
         self.assertEqual(2, part3['gen'])
         self.assertEqual(']', parts[4])
 
+    def test_sync_exchange_compressed(self):
+        doc = self.db0.create_doc('{"value": "there"}')
+        entry = {'id': 'doc-here', 'rev': 'replica:1', 'content':
+                 '{"value": "here"}', 'gen': 10, 'trans_id': 'T-sid'}
+        body = gzip_compress("[\r\n%s,\r\n%s\r\n]\r\n" % (
+            simplejson.dumps(dict(last_known_generation=0)),
+            simplejson.dumps(entry)))
+        resp = self.app.post('/db0/sync-from/replica',
+                            params=body,
+                            headers={'content-type':
+                                     'application/x-u1db-sync-stream',
+                                     'content-encoding': 'gzip',
+                                     'accept-encoding': 'gzip'})
+        self.assertEqual(200, resp.status)
+        self.assertEqual('gzip', resp.header('content-encoding'))
+        self.assertGetDoc(
+            self.db0, 'doc-here', 'replica:1', '{"value": "here"}', False)
+        parts = gzip_decompress(resp.body).splitlines()
+        self.assertEqual(4, len(parts))
+        self.assertEqual('[', parts[0])
+        self.assertEqual(2, simplejson.loads(
+            parts[1].rstrip(","))['new_generation'])
+        self.assertEqual(doc.doc_id, simplejson.loads(parts[2])['id'])
+        self.assertEqual(']', parts[3])
+
+    def test_sync_exchange_send_delta(self):
+        doc = self.db0.create_doc('{"value": "there", "done": false}')
+        entry = {'id': doc.doc_id, 'rev': 'replica:1|' + doc.rev,
+                 'base_rev': doc.rev, 'gen': 10, 'trans_id': 'T-sid',
+                 'patch': [{'op': 'replace', 'path': '/done', 'value': True}]}
+        missing = {'id': 'doc-missing', 'rev': 'replica:2',
+                   'base_rev': 'replica:1', 'gen': 11, 'trans_id': 'T-sad',
+                   'patch': []}
+        args = dict(last_known_generation=0)
+        body = "[\r\n%s\r\n]\r\n" % ",\r\n".join(
+            map(simplejson.dumps, [args, entry, missing]))
+        resp = self.app.post('/db0/sync-from/replica',
+                            params=body,
+                            headers={'content-type':
+                                     'application/x-u1db-sync-stream'})
+        self.assertEqual(200, resp.status)
+        self.assertGetDoc(self.db0, doc.doc_id, 'replica:1|' + doc.rev,
+                          '{"done": true, "value": "there"}', False)
+        parts = resp.body.splitlines()
+        self.assertEqual(['doc-missing'], simplejson.loads(
+            parts[1].rstrip(','))['missing_bases'])
+        self.assertEqual((10, 'T-sid'), self.db0._get_sync_gen_info('replica'))
+
+    def test_sync_exchange_send_bad_patch(self):
+        doc = self.db0.create_doc('{"value": "there"}')
+        entry = {'id': doc.doc_id, 'rev': 'replica:1|' + doc.rev,
+                 'base_rev': doc.rev, 'gen': 10, 'trans_id': 'T-sid',
+                 'patch': [{'op': 'remove', 'path': '/done'}]}
+        args = dict(last_known_generation=0)
+        body = "[\r\n%s,\r\n%s\r\n]\r\n" % (simplejson.dumps(args),
+                                              simplejson.dumps(entry))
+        resp = self.app.post('/db0/sync-from/replica',
+                            params=body,
+                            headers={'content-type':
+                                     'application/x-u1db-sync-stream'},
+                            expect_errors=True)
+        self.assertEqual(400, resp.status)
+
+    def test_sync_exchange_receive_delta(self):
+        doc = self.db0.create_doc('{"value": "there", "notes": "%s"}'
+                                  % ('x' * 100,))
+        self.state.get_revision_cache('db0', 'replica').add(doc)
+        doc.set_json('{"value": "here", "notes": "%s"}' % ('x' * 100,))
+        self.db0.put_doc(doc)
+        args = dict(last_known_generation=0, deltas=True)
+        body = "[\r\n%s\r\n]" % simplejson.dumps(args)
+        resp = self.app.post('/db0/sync-from/replica',
+                            params=body,
+                            headers={'content-type':
+                                     'application/x-u1db-sync-stream'})
+        self.assertEqual(200, resp.status)
+        parts = resp.body.splitlines()
+        self.assertEqual(4, len(parts))
+        entry = simplejson.loads(parts[2])
+        self.assertNotIn('content', entry)
+        self.assertEqual(doc.rev, entry['rev'])
+        self.assertEqual(
+            [{'op': 'replace', 'path': '/value', 'value': 'here'}],
+            entry['patch'])
+
+    def test_sync_exchange_receive_filtered(self):
+        self.db0.create_index('done', 'bool(done)')
+        doc1 = self.db0.create_doc('{"value": "there", "done": false}')
+        doc2 = self.db0.create_doc('{"value": "here", "done": true}')
+        args = dict(last_known_generation=1,
+                    sync_filter={'index': 'done', 'start': ['0'],
+                                 'end': ['0']})
+        body = "[\r\n%s\r\n]" % simplejson.dumps(args)
+        resp = self.app.post('/db0/sync-from/replica',
+                            params=body,
+                            headers={'content-type':
+                                     'application/x-u1db-sync-stream'})
+        self.assertEqual(200, resp.status)
+        parts = resp.body.splitlines()
+        self.assertEqual(4, len(parts))
+        self.assertEqual({'id': doc2.doc_id, 'rev': doc2.rev,
+                          'filtered_out': True, 'gen': 2,
+                          'trans_id': self.db0._get_transaction_log()[-1][1]},
+                         simplejson.loads(parts[2]))
+        args['last_known_generation'] = 0
+        body = "[\r\n%s\r\n]" % simplejson.dumps(args)
+        resp = self.app.post('/db0/sync-from/replica',
+                            params=body,
+                            headers={'content-type':
+                                     'application/x-u1db-sync-stream'})
+        parts = resp.body.splitlines()
+        self.assertEqual(4, len(parts))
+        self.assertEqual(doc1.doc_id,
+                         simplejson.loads(parts[2].rstrip(','))['id'])
+
+    def test_sync_exchange_bad_filter(self):
+        args = dict(last_known_generation=0,
+                    sync_filter={'start': ['0']})
+        body = "[\r\n%s\r\n]" % simplejson.dumps(args)
+        resp = self.app.post('/db0/sync-from/replica',
+                            params=body,
+                            headers={'content-type':
+                                     'application/x-u1db-sync-stream'},
+                            expect_errors=True)
+        self.assertEqual(400, resp.status)
+
+    def test_sync_exchange_filter_missing_index(self):
+        args = dict(last_known_generation=0,
+                    sync_filter={'index': 'done', 'start': ['0']})
+        body = "[\r\n%s\r\n]" % simplejson.dumps(args)
+        resp = self.app.post('/db0/sync-from/replica',
+                            params=body,
+                            headers={'content-type':
+                                     'application/x-u1db-sync-stream'},
+                            expect_errors=True)
+        self.assertEqual(404, resp.status)
+        self.assertEqual({'error': 'nonexistent index'},
+                         simplejson.loads(resp.body))
+
     def test_sync_exchange_error_in_stream(self):
         args = dict(last_known_generation=0)
         body = "[\r\n%s\r\n]" % simplejson.dumps(args)
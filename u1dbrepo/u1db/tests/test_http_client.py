@@ -16,8 +16,12 @@
 
 """Tests for HTTPDatabase"""
 
+import BaseHTTPServer
+import errno
+import httplib
 from oauth import oauth
 import simplejson
+import socket
 from wsgiref import simple_server
 
 from u1db import (
@@ -276,3 +280,214 @@ class TestHTTPClientBase(tests.TestCaseWithServer):
         params = {'y': 'foo'}
         self.assertRaises(errors.Unauthorized, cli._request, 'GET',
                           ['doc', 'oauth'], params)
+
+
+class FakeConnection(object):
+
+    sock = None
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestConnectionPool(tests.TestCase):
+
+    def make_connection(self):
+        conn = FakeConnection()
+        self.made.append(conn)
+        return conn
+
+    def setUp(self):
+        super(TestConnectionPool, self).setUp()
+        self.made = []
+        self.pool = http_client.ConnectionPool(self.make_connection,
+                                               max_idle=1)
+
+    def test_reuses_idle(self):
+        conn = self.pool.get()
+        self.pool.put(conn)
+        self.assertIs(conn, self.pool.get())
+        self.assertEqual(1, len(self.made))
+
+    def test_max_idle(self):
+        conn1 = self.pool.get()
+        conn2 = self.pool.get()
+        self.assertIsNot(conn1, conn2)
+        self.pool.put(conn1)
+        self.pool.put(conn2)
+        self.assertFalse(conn1.closed)
+        self.assertTrue(conn2.closed)
+
+    def test_drops_closed_by_server(self):
+        server_sock, client_sock = tests.socket_pair()
+        self.addCleanup(client_sock.close)
+        conn = self.pool.get()
+        conn.sock = client_sock
+        self.pool.put(conn)
+        server_sock.close()
+        other = self.pool.get()
+        self.assertIsNot(conn, other)
+        self.assertTrue(conn.closed)
+
+    def test_close(self):
+        conn = self.pool.get()
+        self.pool.put(conn)
+        self.pool.close()
+        self.assertTrue(conn.closed)
+        self.assertIsNot(conn, self.pool.get())
+
+
+class TestRequestMetrics(tests.TestCase):
+
+    def test_record(self):
+        metrics = http_client.RequestMetrics()
+        metrics.record('GET', '/db/doc/a', 200, 0.5)
+        metrics.record('GET', '/db/doc/b', 503, 1.5)
+        metrics.record('GET', '/db/doc/b', 200, 1.0, 1)
+        metrics.record('PUT', '/db/doc/a', None, 2.0)
+        self.assertEqual(
+            [('GET', '/db/doc/a', 200, 0.5, 0),
+             ('GET', '/db/doc/b', 503, 1.5, 0),
+             ('GET', '/db/doc/b', 200, 1.0, 1),
+             ('PUT', '/db/doc/a', None, 2.0, 0)], list(metrics.recent))
+        self.assertEqual(
+            {'GET': {'count': 3, 'mean': 1.0, 'max': 1.5, 'failures': 1},
+             'PUT': {'count': 1, 'mean': 2.0, 'max': 2.0, 'failures': 1}},
+            metrics.summary())
+
+
+class TestRetryDelay(tests.TestCase):
+
+    def setUp(self):
+        super(TestRetryDelay, self).setUp()
+        self.cli = http_client.HTTPClientBase('http://127.0.0.1:12345/db')
+
+    def retried(self, method, error, reused=True, sent=True):
+        return self.cli._retry_delay(
+            method, 0, None, reused, error, sent) is not None
+
+    def test_idempotent(self):
+        self.assertTrue(self.retried('GET', socket.timeout()))
+        self.assertTrue(self.retried(
+            'GET', socket.error(errno.ECONNREFUSED, 'refused'), False))
+        self.assertTrue(self.retried('GET', httplib.BadStatusLine('junk')))
+        self.assertFalse(self.retried('GET', ValueError()))
+
+    def test_not_idempotent_sending_failed(self):
+        error = socket.error(errno.EPIPE, 'broken pipe')
+        self.assertTrue(self.retried('PUT', error, sent=False))
+        self.assertFalse(self.retried('PUT', error, reused=False,
+                                      sent=False))
+
+    def test_not_idempotent_closed_before_response(self):
+        self.assertTrue(self.retried(
+            'POST', httplib.BadStatusLine('No status line received - the'
+                                          ' server has closed the'
+                                          ' connection')))
+        self.assertTrue(self.retried('POST', httplib.BadStatusLine('')))
+        self.assertTrue(self.retried(
+            'POST', socket.error(errno.ECONNRESET, 'reset')))
+        self.assertFalse(self.retried(
+            'POST', socket.error(errno.ECONNRESET, 'reset'), reused=False))
+
+    def test_not_idempotent_maybe_applied(self):
+        self.assertFalse(self.retried('POST', socket.timeout()))
+        self.assertFalse(self.retried('POST', socket.timeout(), sent=False))
+        self.assertFalse(self.retried('DELETE', httplib.BadStatusLine('x')))
+        self.assertFalse(self.retried(
+            'PUT', socket.error(errno.ETIMEDOUT, 'timed out')))
+
+
+class TestHTTPClientBaseKeepAlive(tests.TestCaseWithServer):
+
+    def setUp(self):
+        super(TestHTTPClientBaseKeepAlive, self).setUp()
+        # (status, headers, close connection after) to answer with, in turn
+        self.responses = []
+        self.requests = []
+
+    def server_def(self):
+        test = self
+
+        def make_server(host_port, handler, state):
+            return BaseHTTPServer.HTTPServer(host_port, handler)
+
+        class req_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass  # suppress
+
+            def respond(self):
+                test.requests.append((self.command, self.client_address))
+                length = int(self.headers.get('content-length', 0))
+                self.rfile.read(length)
+                if test.responses:
+                    status, headers, close = test.responses.pop(0)
+                else:
+                    status, headers, close = 200, {}, False
+                body = '{"ok": true}'
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('content-length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                # without telling the client
+                self.close_connection = int(close)
+
+            do_GET = do_POST = respond
+
+        return make_server, req_handler, "shutdown", "http"
+
+    def getClient(self):
+        self.startServer()
+        cli = http_client.HTTPClientBase(self.getURL('dbase'))
+        self.addCleanup(cli.close)
+        cli.min_backoff = 0.001
+        return cli
+
+    def test_keeps_connection_alive(self):
+        cli = self.getClient()
+        self.assertEqual({'ok': True},
+                         cli._request_json('GET', ['doc', 'a'])[0])
+        cli._request_json('GET', ['doc', 'b'])
+        self.assertEqual(2, len(self.requests))
+        self.assertEqual(1, len(set(addr for _, addr in self.requests)))
+        self.assertIs(None, cli._conn)
+
+    def test_reconnects_when_closed(self):
+        self.responses.append((200, {}, True))
+        cli = self.getClient()
+        cli._request_json('POST', ['doc'], body={})
+        cli._request_json('POST', ['doc'], body={})
+        self.assertEqual(2, len(set(addr for _, addr in self.requests)))
+
+    def test_retries_unavailable(self):
+        self.responses.append((503, {}, False))
+        cli = self.getClient()
+        self.assertEqual({'ok': True},
+                         cli._request_json('POST', ['doc'], body={})[0])
+        self.assertEqual(2, len(self.requests))
+        self.assertEqual([('POST', '/dbase/doc', 503, 0),
+                          ('POST', '/dbase/doc', 200, 1)],
+                         [(method, path, status, attempt)
+                          for method, path, status, _, attempt
+                          in cli.metrics.recent])
+
+    def test_gives_up_retrying(self):
+        self.responses.extend([(503, {}, False)] * 2)
+        cli = self.getClient()
+        cli.max_retries = 1
+        self.assertRaises(errors.Unavailable,
+                          cli._request_json, 'GET', ['doc', 'a'])
+        self.assertEqual(2, len(self.requests))
+
+    def test_retry_after_too_long(self):
+        self.responses.append((503, {'retry-after': '60'}, False))
+        cli = self.getClient()
+        self.assertRaises(errors.Unavailable,
+                          cli._request_json, 'GET', ['doc', 'a'])
+        self.assertEqual(1, len(self.requests))
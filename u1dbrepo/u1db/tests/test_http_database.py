@@ -43,8 +43,9 @@ class TestHTTPDatabaseSimpleOperations(tests.TestCase):
         self.response_val = None
 
         def _request(method, url_parts, params=None, body=None,
-                                                     content_type=None):
+                     content_type=None, headers=None):
             self.got = method, url_parts, params, body, content_type
+            self.got_headers = headers
             if isinstance(self.response_val, Exception):
                 raise self.response_val
             return self.response_val
@@ -111,6 +112,36 @@ class TestHTTPDatabaseSimpleOperations(tests.TestCase):
             ('GET', ['doc', 'doc-id'], {'include_deleted': False}, None, None),
             self.got)
 
+    def test_get_doc_cached(self):
+        self.response_val = '{"v": 2}', {'x-u1db-rev': 'doc-rev',
+                                         'x-u1db-has-conflicts': 'false'}
+        self.db.get_doc('doc-id')
+        self.assertEqual({}, self.got_headers)
+        self.response_val = errors.HTTPError(
+            304, '', {'x-u1db-rev': 'doc-rev',
+                      'x-u1db-has-conflicts': 'true'})
+        doc = self.db.get_doc('doc-id')
+        self.assertEqual({'if-none-match': '"doc-rev"'}, self.got_headers)
+        self.assertEqual('{"v": 2}', doc.get_json())
+        self.assertEqual('doc-rev', doc.rev)
+        self.assertTrue(doc.has_conflicts)
+
+    def test_get_doc_not_cached(self):
+        self.db.set_revision_cache(None)
+        self.response_val = '{"v": 2}', {'x-u1db-rev': 'doc-rev',
+                                         'x-u1db-has-conflicts': 'false'}
+        self.db.get_doc('doc-id')
+        self.db.get_doc('doc-id')
+        self.assertEqual({}, self.got_headers)
+
+    def test_put_doc_cached(self):
+        self.response_val = {'rev': 'doc-rev'}, {}
+        self.db.put_doc(Document('doc-id', None, '{"v": 1}'))
+        self.response_val = errors.HTTPError(
+            304, '', {'x-u1db-rev': 'doc-rev',
+                      'x-u1db-has-conflicts': 'false'})
+        self.assertGetDoc(self.db, 'doc-id', 'doc-rev', '{"v": 1}', False)
+
     def test_get_doc_non_existing(self):
         self.response_val = errors.DocumentDoesNotExist()
         self.assertIs(None, self.db.get_doc('not-there'))
@@ -239,3 +270,69 @@ class TestHTTPDatabaseIntegration(tests.TestCaseWithServer):
         db.put_doc(doc)
         self.assertGetDoc(db0, '%fff', doc.rev, '{}', False)
         self.assertGetDoc(db, '%fff', doc.rev, '{}', False)
+
+    def test_put_docs(self):
+        db0 = self.request_state._create_database('db0')
+        doc1 = db0.create_doc('{"v": 1}', doc_id='doc1')
+        doc2 = db0.create_doc('{"v": 2}', doc_id='doc2')
+        db = http_database.HTTPDatabase.open_database(self.getURL('db0'),
+                                                      create=False)
+        new1 = Document('doc1', doc1.rev, '{"v": 3}')
+        gone2 = Document('doc2', doc2.rev, None)
+        new3 = Document('doc3', None, '{"v": 4}')
+        stale1 = Document('doc1', doc1.rev, '{"v": 5}')
+        failures = db.put_docs([new1, gone2, new3, stale1])
+        self.assertEqual([None, None, None], failures[:3])
+        self.assertIsInstance(failures[3], errors.RevisionConflict)
+        self.assertEqual(doc1.rev, stale1.rev)
+        self.assertGetDoc(db0, 'doc1', new1.rev, '{"v": 3}', False)
+        self.assertGetDocIncludeDeleted(db0, 'doc2', gone2.rev, None, False)
+        self.assertGetDoc(db0, 'doc3', new3.rev, '{"v": 4}', False)
+        self.assertEqual([new1, new3],
+                         db.get_docs(['doc1', 'doc2', 'doc3']))
+
+    def test_get_index_page(self):
+        db0 = self.request_state._create_database('db0')
+        db0.create_index('by-key', 'key')
+        docs = [db0.create_doc('{"key": "%s"}' % (key,))
+                for key in ('a', 'b', 'c', 'd', 'e')]
+        db = http_database.HTTPDatabase.open_database(self.getURL('db0'),
+                                                      create=False)
+        page, cursor = db.get_index_page('by-key', start_value='b',
+                                         limit=2)
+        self.assertEqual(docs[1:3], page)
+        page, cursor = db.get_index_page('by-key', start_value='b',
+                                         limit=2, cursor=cursor)
+        self.assertEqual(docs[3:5], page)
+        self.assertIs(None, cursor)
+        self.assertEqual(
+            (docs[2:3], None),
+            db.get_index_page('by-key', key_values=('c',), limit=2))
+
+    def test_get_doc_not_modified(self):
+        db0 = self.request_state._create_database('db0')
+        db = http_database.HTTPDatabase.open_database(self.getURL('db0'),
+                                                      create=False)
+        doc = db.create_doc('{"v": 1}', doc_id='doc1')
+        self.patch(db0, 'get_doc', None)  # only revisions are read
+        self.assertGetDoc(db, 'doc1', doc.rev, '{"v": 1}', False)
+
+    def test_get_docs_known_revs(self):
+        db0 = self.request_state._create_database('db0')
+        db = http_database.HTTPDatabase.open_database(self.getURL('db0'),
+                                                      create=False)
+        doc1 = db.create_doc('{"v": 1}', doc_id='doc1')
+        doc2 = db0.create_doc('{"v": 2}', doc_id='doc2')
+        got = []
+        parse_stream = db._parse_stream
+
+        def witness_stream(lines, entry_cb):
+            def witness(entry):
+                got.append(entry)
+                entry_cb(entry)
+            return parse_stream(lines, witness)
+
+        self.patch(db, '_parse_stream', witness_stream)
+        self.assertEqual([doc1, doc2], db.get_docs(['doc1', 'doc2']))
+        self.assertTrue(got[0].get('unchanged'))
+        self.assertFalse(got[1].get('unchanged'))
@@ -45,9 +45,206 @@ class TestInMemoryDatabaseInternals(tests.TestCase):
     def test__get_replica_uid(self):
         self.assertEqual('test', self.db._replica_uid)
 
+    def test__latest_changes(self):
+        doc1 = self.db.create_doc(simple_doc)
+        doc2 = self.db.create_doc(simple_doc)
+        self.db.put_doc(doc1)
+        self.assertEqual([(doc2.doc_id, 2), (doc1.doc_id, 3)],
+                         [(doc_id, gen) for doc_id, (gen, _)
+                          in self.db._latest_changes.items()])
+
+    def test_trim_transaction_log(self):
+        doc1 = self.db.create_doc(simple_doc)
+        doc2 = self.db.create_doc(simple_doc)
+        self.db.put_doc(doc1)
+        log = self.db._get_transaction_log()
+        self.db.trim_transaction_log(2)
+        self.assertEqual(log[2:], self.db._get_transaction_log())
+        self.assertEqual(3, self.db._get_generation())
+        self.assertEqual((3, log[2][1]), self.db._get_generation_info())
+        self.assertEqual(
+            (3, log[2][1], [(doc2.doc_id, 2, log[1][1]),
+                            (doc1.doc_id, 3, log[2][1])]),
+            self.db.whats_changed(0))
+        self.db.validate_gen_and_trans_id(2, log[1][1])
+        self.db.validate_gen_and_trans_id(3, log[2][1])
+        self.assertRaises(errors.InvalidGeneration,
+                          self.db.validate_gen_and_trans_id, 1, log[0][1])
+        self.assertRaises(errors.InvalidTransactionId,
+                          self.db.validate_gen_and_trans_id, 2, log[0][1])
+
+    def test_trim_transaction_log_keeps_latest(self):
+        self.db.create_doc(simple_doc)
+        log = self.db._get_transaction_log()
+        self.db.trim_transaction_log(5)
+        self.assertEqual(log, self.db._get_transaction_log())
+        doc = self.db.create_doc(simple_doc)
+        self.assertEqual(2, self.db._get_generation())
+        self.db.trim_transaction_log(5)
+        self.assertEqual([(doc.doc_id, self.db._get_generation_info()[1])],
+                         self.db._get_transaction_log())
+
+    def test_delete_index_releases_ordinals(self):
+        self.db.create_index('idx', 'key')
+        self.db.create_index('idx2', 'key')
+        doc = self.db.create_doc(simple_doc)
+        self.db.delete_index('idx')
+        self.assertEqual([doc.doc_id], self.db._doc_ordinals._ordinals.keys())
+        self.db.delete_index('idx2')
+        self.assertEqual({}, self.db._doc_ordinals._ordinals)
+
+
+class TestInMemorySnapshot(tests.TestCase):
+
+    def setUp(self):
+        super(TestInMemorySnapshot, self).setUp()
+        self.db = inmemory.InMemoryDatabase('test')
+        self.path = self.createTempDir() + '/snapshot'
+
+    def reload(self):
+        self.db.save_snapshot(self.path)
+        return inmemory.InMemoryDatabase.load_snapshot(self.path)
+
+    def test_round_trip(self):
+        self.db.create_index('idx', 'key')
+        doc1 = self.db.create_doc(simple_doc)
+        doc2 = self.db.create_doc(u'{"key": "v\xe5lue"}')
+        self.db.delete_doc(doc2)
+        doc3 = self.db.create_doc('{"key": "other"}')
+        self.db._put_doc_if_newer(
+            self.make_document(doc3.doc_id, 'other:1', '{"key": "alt"}',
+                               False), save_conflict=True)
+        self.db._set_sync_info('other', 5, 'T-sync')
+        self.db.trim_transaction_log(1)
+        db = self.reload()
+        self.assertEqual('test', db._replica_uid)
+        self.assertEqual(self.db._get_transaction_log(),
+                         db._get_transaction_log())
+        self.assertEqual(self.db.whats_changed(), db.whats_changed())
+        self.assertEqual((5, 'T-sync'), db._get_sync_gen_info('other'))
+        self.assertEqual(sorted(self.db.get_all_docs(True)[1]),
+                         sorted(db.get_all_docs(True)[1]))
+        self.assertEqual(self.db.get_doc_conflicts(doc3.doc_id),
+                         db.get_doc_conflicts(doc3.doc_id))
+        self.assertEqual([('idx', ['key'])], db.list_indexes())
+        self.assertEqual([doc1], db.get_from_index('idx', 'value'))
+        self.assertEqual(
+            [(doc3.doc_id, 'other:1')],
+            [(doc.doc_id, doc.rev) for doc in db.get_from_index('idx', 'alt')])
+        self.assertEqual([], db.get_from_index('idx', 'other'))
+        # and it still works as a database
+        doc4 = db.create_doc(simple_doc)
+        self.assertEqual(
+            sorted([doc1, doc4]), sorted(db.get_from_index('idx', 'value')))
+        self.assertEqual(self.db._get_generation() + 1, db._get_generation())
+
+    def test_round_trip_deleted_conflict(self):
+        doc = self.db.create_doc(simple_doc)
+        self.db.delete_doc(doc)
+        self.db._put_doc_if_newer(
+            self.make_document(doc.doc_id, 'other:1', '{"key": "alt"}',
+                               False), save_conflict=True)
+        conflicts = self.db.get_doc_conflicts(doc.doc_id)
+        self.assertTrue([c for c in conflicts if c.is_tombstone()])
+        db = self.reload()
+        self.assertEqual(conflicts, db.get_doc_conflicts(doc.doc_id))
+
+    def test_round_trip_free_ordinals(self):
+        self.db.create_index('idx', 'key')
+        doc1 = self.db.create_doc(simple_doc)
+        doc2 = self.db.create_doc(simple_doc)
+        self.db.delete_doc(doc1)
+        db = self.reload()
+        self.assertEqual({doc2.doc_id: 1}, db._doc_ordinals._ordinals)
+        doc3 = db.create_doc(simple_doc)
+        self.assertEqual({doc3.doc_id: 0, doc2.doc_id: 1},
+                         db._doc_ordinals._ordinals)
+
+    def test_contents_loaded_lazily(self):
+        doc = self.db.create_doc(simple_doc)
+        db = self.reload()
+        self.assertIsInstance(dict.__getitem__(db._docs, doc.doc_id)[1],
+                              inmemory.MappedContent)
+        self.assertEqual(doc, db.get_doc(doc.doc_id))
+        self.assertEqual(simple_doc,
+                         dict.__getitem__(db._docs, doc.doc_id)[1])
+
+    def test_save_loaded_snapshot(self):
+        doc = self.db.create_doc(simple_doc)
+        db = self.reload()
+        db.save_snapshot(self.path)
+        db = inmemory.InMemoryDatabase.load_snapshot(self.path)
+        self.assertEqual(doc, db.get_doc(doc.doc_id))
+
+    def test_load_invalid_snapshot(self):
+        open(self.path, 'wb').close()
+        self.assertRaises(errors.InvalidSnapshot,
+                          inmemory.InMemoryDatabase.load_snapshot, self.path)
+        with open(self.path, 'wb') as f:
+            f.write('not a snapshot, not at all, no')
+        self.assertRaises(errors.InvalidSnapshot,
+                          inmemory.InMemoryDatabase.load_snapshot, self.path)
+
+
+class TestPostingList(tests.TestCase):
+
+    def test_add_remove(self):
+        postings = inmemory.PostingList()
+        postings.add(3, 10)
+        postings.add(1, 10)
+        postings.add(3, 10)
+        self.assertEqual(2, len(postings))
+        self.assertEqual([1, 3], list(postings))
+        postings.remove(3, 10)
+        self.assertEqual([1], list(postings))
+        self.assertRaises(KeyError, postings.remove, 3, 10)
+
+    def test_switches_to_bitmap_when_dense(self):
+        postings = inmemory.PostingList()
+        capacity = 1000
+        for ordinal in range(0, capacity, 2):
+            postings.add(ordinal, capacity)
+        self.assertIsNot(None, postings._bitmap)
+        self.assertEqual(range(0, capacity, 2), list(postings))
+        postings.add(capacity + 7, capacity + 8)
+        self.assertEqual(range(0, capacity, 2) + [capacity + 7],
+                         list(postings))
+        postings.remove(0, capacity + 8)
+        self.assertEqual(range(2, capacity, 2) + [capacity + 7],
+                         list(postings))
+        self.assertRaises(KeyError, postings.remove, 0, capacity + 8)
+
+    def test_state(self):
+        postings = inmemory.PostingList()
+        postings.add(3, 10)
+        postings.add(1, 10)
+        restored = inmemory.PostingList.from_state(postings.get_state())
+        self.assertEqual([1, 3], list(restored))
+        for ordinal in range(1000):
+            postings.add(ordinal, 1000)
+        restored = inmemory.PostingList.from_state(postings.get_state())
+        self.assertIsNot(None, restored._bitmap)
+        self.assertEqual(range(1000), list(restored))
+        self.assertEqual(1000, len(restored))
+
+    def test_switches_back_to_list_when_sparse(self):
+        postings = inmemory.PostingList()
+        for ordinal in range(100):
+            postings.add(ordinal, 100)
+        self.assertIsNot(None, postings._bitmap)
+        for ordinal in range(1, 100):
+            postings.remove(ordinal, 100000)
+        self.assertIs(None, postings._bitmap)
+        self.assertEqual([0], list(postings))
+
 
 class TestInMemoryIndex(tests.TestCase):
 
+    def assertIndexValues(self, expected, idx):
+        self.assertEqual(expected, dict(
+            (key, idx._to_doc_ids(postings))
+            for key, postings in idx._values.iteritems()))
+
     def test_has_name_and_definition(self):
         idx = inmemory.InMemoryIndex('idx-name', ['key'])
         self.assertEqual('idx-name', idx._name)
@@ -74,27 +271,70 @@ class TestInMemoryIndex(tests.TestCase):
     def test_update_ignores_None(self):
         idx = inmemory.InMemoryIndex('idx-name', ['nokey'])
         idx.add_json('doc-id', simple_doc)
-        self.assertEqual({}, idx._values)
+        self.assertIndexValues({}, idx)
 
     def test_update_adds_entry(self):
         idx = inmemory.InMemoryIndex('idx-name', ['key'])
         idx.add_json('doc-id', simple_doc)
-        self.assertEqual({'value': ['doc-id']}, idx._values)
+        self.assertIndexValues({'value': ['doc-id']}, idx)
 
     def test_remove_json(self):
         idx = inmemory.InMemoryIndex('idx-name', ['key'])
         idx.add_json('doc-id', simple_doc)
-        self.assertEqual({'value': ['doc-id']}, idx._values)
+        self.assertIndexValues({'value': ['doc-id']}, idx)
         idx.remove_json('doc-id', simple_doc)
-        self.assertEqual({}, idx._values)
+        self.assertIndexValues({}, idx)
 
     def test_remove_json_multiple(self):
         idx = inmemory.InMemoryIndex('idx-name', ['key'])
         idx.add_json('doc-id', simple_doc)
         idx.add_json('doc2-id', simple_doc)
-        self.assertEqual({'value': ['doc-id', 'doc2-id']}, idx._values)
+        self.assertIndexValues({'value': ['doc-id', 'doc2-id']}, idx)
+        idx.remove_json('doc-id', simple_doc)
+        self.assertIndexValues({'value': ['doc2-id']}, idx)
+
+    def test_add_json_interns_doc_ids(self):
+        idx = inmemory.InMemoryIndex('idx-name', ['key', 'other'])
+        idx.add_json('doc-id', '{"key": "value", "other": "x"}')
+        idx.add_json('doc2-id', '{"key": "value", "other": "y"}')
+        idx.remove_json('doc-id', '{"key": "value", "other": "x"}')
+        idx.add_json('doc-id', '{"key": "value", "other": "z"}')
+        self.assertEqual({'doc-id': 0, 'doc2-id': 1},
+                         idx._doc_ordinals._ordinals)
+        self.assertEqual(['doc2-id', 'doc-id'], idx.lookup(['value', '*']))
+
+    def test_remove_json_recycles_ordinals(self):
+        idx = inmemory.InMemoryIndex('idx-name', ['key'])
+        idx.add_json('doc-id', simple_doc)
+        idx.add_json('doc2-id', simple_doc)
         idx.remove_json('doc-id', simple_doc)
-        self.assertEqual({'value': ['doc2-id']}, idx._values)
+        self.assertEqual({'doc2-id': 1}, idx._doc_ordinals._ordinals)
+        idx.add_json('doc3-id', simple_doc)
+        self.assertEqual({'doc3-id': 0, 'doc2-id': 1},
+                         idx._doc_ordinals._ordinals)
+        self.assertEqual(2, len(idx._doc_ordinals))
+        self.assertEqual(['doc3-id', 'doc2-id'], idx.lookup(['value']))
+
+    def test_shared_doc_ordinals(self):
+        doc_ordinals = inmemory.DocOrdinals()
+        idx = inmemory.InMemoryIndex('idx-name', ['key'], doc_ordinals)
+        idx2 = inmemory.InMemoryIndex('idx2-name', ['key'], doc_ordinals)
+        idx.add_json('doc-id', simple_doc)
+        idx2.add_json('doc2-id', simple_doc)
+        idx2.add_json('doc-id', simple_doc)
+        self.assertEqual(['doc-id', 'doc2-id'], idx2.lookup(['value']))
+        self.assertEqual(2, len(doc_ordinals))
+        idx2.remove_json('doc-id', simple_doc)
+        self.assertEqual({'doc-id': 0, 'doc2-id': 1}, doc_ordinals._ordinals)
+        idx2.release_ordinals()
+        self.assertEqual({'doc-id': 0}, doc_ordinals._ordinals)
+
+    def test_add_json_deduplicates_keys(self):
+        idx = inmemory.InMemoryIndex('idx-name', ['key'])
+        idx.add_json('doc-id', '{"key": ["value", "value"]}')
+        self.assertIndexValues({'value': ['doc-id']}, idx)
+        idx.remove_json('doc-id', '{"key": ["value", "value"]}')
+        self.assertIndexValues({}, idx)
 
     def test_keys(self):
         idx = inmemory.InMemoryIndex('idx-name', ['key'])
@@ -112,6 +352,38 @@ class TestInMemoryIndex(tests.TestCase):
         idx.add_json('doc2-id', simple_doc)
         self.assertEqual(['doc-id', 'doc2-id'], idx.lookup(['value']))
 
+    def test_sorted_keys_maintained(self):
+        idx = inmemory.InMemoryIndex('idx-name', ['key'])
+        idx.add_json('doc-id', '{"key": "c"}')
+        idx.add_json('doc2-id', '{"key": "a"}')
+        idx.add_json('doc3-id', '{"key": "b"}')
+        idx.add_json('doc4-id', '{"key": "a"}')
+        self.assertEqual(['a', 'b', 'c'], idx._sorted_keys)
+        idx.remove_json('doc3-id', '{"key": "b"}')
+        self.assertEqual(['a', 'c'], idx._sorted_keys)
+        idx.remove_json('doc2-id', '{"key": "a"}')
+        self.assertEqual(['a', 'c'], idx._sorted_keys)
+
+    def test_lookup_prefix(self):
+        idx = inmemory.InMemoryIndex('idx-name', ['key'])
+        idx.add_json('doc-id', '{"key": "abc"}')
+        idx.add_json('doc2-id', '{"key": "b"}')
+        idx.add_json('doc3-id', '{"key": "ab"}')
+        idx.add_json('doc4-id', '{"key": "a"}')
+        self.assertEqual(['doc3-id', 'doc-id'], idx.lookup(['ab*']))
+        self.assertEqual([], idx.lookup(['c*']))
+
+    def test_lookup_range(self):
+        idx = inmemory.InMemoryIndex('idx-name', ['key'])
+        for i, key in enumerate(['e', 'a', 'c', 'b', 'd']):
+            idx.add_json('doc%d-id' % i, '{"key": "%s"}' % key)
+        self.assertEqual(['doc3-id', 'doc2-id', 'doc4-id'],
+                         idx.lookup_range(('b',), ('d',)))
+        self.assertEqual(['doc4-id', 'doc0-id'],
+                         idx.lookup_range(('cc',), None))
+        self.assertEqual(['doc1-id', 'doc3-id'],
+                         idx.lookup_range(None, ('b',)))
+
     def test__find_non_wildcards(self):
         idx = inmemory.InMemoryIndex('idx-name', ['k1', 'k2', 'k3'])
         self.assertEqual(-1, idx._find_non_wildcards(('a', 'b', 'c')))
@@ -0,0 +1,161 @@
+# Copyright 2012 Canonical Ltd.
+#
+# This file is part of u1db.
+#
+# u1db is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation.
+#
+# u1db is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with u1db.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the JSON codec registry."""
+
+import json
+
+from u1db import (
+    Document,
+    errors,
+    json_codec,
+    tests,
+    )
+from u1db.backends import inmemory
+
+
+class CountingCodec(json_codec.JSONCodec):
+
+    def __init__(self, name='counting', accelerated=False):
+        super(CountingCodec, self).__init__(
+            name, self._loads, self._dumps, accelerated)
+        self.calls = []
+
+    def _loads(self, s):
+        self.calls.append('loads')
+        return json.loads(s)
+
+    def _dumps(self, obj, **kwargs):
+        self.calls.append('dumps')
+        return json.dumps(obj, **kwargs)
+
+
+def unavailable():
+    raise ImportError('not here')
+
+
+class TestJSONCodec(tests.TestCase):
+
+    def setUp(self):
+        super(TestJSONCodec, self).setUp()
+        saved = (json_codec._registry.copy(),
+                 list(json_codec._decoder_preference),
+                 list(json_codec._encoder_preference),
+                 json_codec._loaded.copy(),
+                 json_codec._default_choice,
+                 json_codec._default)
+        self.addCleanup(self.restore, *saved)
+
+    def restore(self, registry, decoders, encoders, loaded, choice, default):
+        json_codec._registry.clear()
+        json_codec._registry.update(registry)
+        json_codec._decoder_preference[:] = decoders
+        json_codec._encoder_preference[:] = encoders
+        json_codec._loaded.clear()
+        json_codec._loaded.update(loaded)
+        json_codec._default_choice = choice
+        json_codec._default = default
+
+    def test_builtin_codecs(self):
+        self.assertEqual(['simplejson', 'json'],
+                         json_codec.available_codecs())
+        for name in json_codec.available_codecs():
+            codec = json_codec.get_codec(name)
+            self.assertEqual(name, codec.name)
+            self.assertEqual({'key': [1, None]}, codec.loads(
+                codec.dumps({'key': [1, None]})))
+            self.assertRaises(ValueError, codec.loads, '{"key":')
+
+    def test_get_codec_codec(self):
+        codec = CountingCodec()
+        self.assertIs(codec, json_codec.get_codec(codec))
+
+    def test_get_codec_unknown(self):
+        self.assertRaises(
+            errors.UnknownJSONCodec, json_codec.get_codec, 'no-such-codec')
+
+    def test_get_codec_unavailable(self):
+        json_codec.register_codec('unavailable', unavailable)
+        self.assertNotIn('unavailable', json_codec.available_codecs())
+        self.assertRaises(
+            errors.UnknownJSONCodec, json_codec.get_codec, 'unavailable')
+
+    def test_default_prefers_accelerated(self):
+        json_codec.register_codec('slow', lambda: CountingCodec('slow'), 0, 0)
+        self.assertNotEqual('slow', json_codec.get_codec().name)
+        json_codec.register_codec(
+            'fast', lambda: CountingCodec('fast', accelerated=True), 0, 0)
+        self.assertEqual('fast', json_codec.get_codec().name)
+
+    def test_default_mixes_decoder_and_encoder(self):
+        json_codec.register_codec(
+            'decoder', lambda: CountingCodec('decoder', True), 0, None)
+        json_codec.register_codec(
+            'encoder', lambda: CountingCodec('encoder', True), None, 0)
+        self.assertEqual('decoder/encoder', json_codec.get_codec().name)
+
+    def test_default_falls_back(self):
+        json_codec._registry.clear()
+        del json_codec._decoder_preference[:]
+        del json_codec._encoder_preference[:]
+        json_codec.register_codec('unavailable', unavailable)
+        json_codec.register_codec('slow', lambda: CountingCodec('slow'))
+        self.assertEqual('slow', json_codec.get_codec().name)
+
+    def test_set_default_codec(self):
+        codec = CountingCodec()
+        json_codec.set_default_codec(codec)
+        self.assertEqual('{"a": 1}', json_codec.dumps({'a': 1}))
+        self.assertEqual({'a': 1}, json_codec.loads('{"a": 1}'))
+        self.assertEqual(['dumps', 'loads'], codec.calls)
+        # Registering more codecs keeps the explicit choice.
+        json_codec.register_codec(
+            'fast', lambda: CountingCodec('fast', accelerated=True), 0, 0)
+        self.assertIs(codec, json_codec.get_codec())
+        json_codec.set_default_codec(None)
+        self.assertEqual('fast', json_codec.get_codec().name)
+
+    def test_dumps_kwargs(self):
+        self.assertEqual(
+            '{\n    "a": 1\n}', json_codec.dumps({'a': 1}, indent=4))
+
+    def test_document_class_codec(self):
+        codec = CountingCodec()
+
+        class CodecDocument(Document):
+            pass
+        CodecDocument.codec = codec
+
+        doc = CodecDocument('id', 'rev', '{"a": 1}')
+        self.assertEqual(['loads'], codec.calls)
+        doc.content = {'a': 2}
+        self.assertEqual('{"a": 2}', doc.get_json())
+        self.assertEqual(['loads', 'dumps'], codec.calls)
+        self.assertRaises(
+            errors.InvalidJSON, CodecDocument, 'id', 'rev', 'not json')
+
+    def test_database_codec(self):
+        db = inmemory.InMemoryDatabase('test')
+        db.create_index('idx', 'key')
+        codec = CountingCodec()
+        db.set_json_codec(codec)
+        db.create_doc('{"key": "value"}')
+        self.assertEqual(['loads'], codec.calls)
+        db.create_index('idx2', 'key')
+        self.assertEqual(['loads', 'loads'], codec.calls)
+        db.set_json_codec(None)
+        db.create_doc('{"key": "value"}')
+        self.assertEqual(['loads', 'loads'], codec.calls)
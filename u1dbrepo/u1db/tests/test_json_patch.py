@@ -0,0 +1,97 @@
+# Copyright 2012 Canonical Ltd.
+#
+# This file is part of u1db.
+#
+# u1db is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation.
+#
+# u1db is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with u1db.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for JSON patches."""
+
+import copy
+
+from u1db import (
+    json_patch,
+    tests,
+    )
+
+
+class TestJSONPatch(tests.TestCase):
+
+    def assertRoundTrip(self, old, new):
+        patch = json_patch.make_patch(old, new)
+        self.assertEqual(new, json_patch.apply_patch(copy.deepcopy(old),
+                                                     patch))
+        return patch
+
+    def test_no_change(self):
+        self.assertEqual([], self.assertRoundTrip({'a': [1, {'b': 2}]},
+                                                  {'a': [1, {'b': 2}]}))
+
+    def test_replace_field(self):
+        self.assertEqual([{'op': 'replace', 'path': '/done', 'value': True}],
+                         self.assertRoundTrip({'title': 'x', 'done': False},
+                                              {'title': 'x', 'done': True}))
+
+    def test_add_and_remove_fields(self):
+        patch = self.assertRoundTrip({'a': 1, 'b': 2}, {'b': 2, 'c': 3})
+        self.assertEqual(
+            [{'op': 'remove', 'path': '/a'},
+             {'op': 'add', 'path': '/c', 'value': 3}], patch)
+
+    def test_nested(self):
+        patch = self.assertRoundTrip({'a': {'b': {'c': 1, 'd': 2}}},
+                                     {'a': {'b': {'c': 1, 'd': 3}}})
+        self.assertEqual(
+            [{'op': 'replace', 'path': '/a/b/d', 'value': 3}], patch)
+
+    def test_arrays_are_replaced(self):
+        patch = self.assertRoundTrip({'tags': ['a', 'b']},
+                                     {'tags': ['a', 'c']})
+        self.assertEqual(
+            [{'op': 'replace', 'path': '/tags', 'value': ['a', 'c']}], patch)
+
+    def test_types_matter(self):
+        self.assertEqual(1, len(self.assertRoundTrip({'a': 1}, {'a': True})))
+        self.assertEqual(1, len(self.assertRoundTrip({'a': 1}, {'a': 1.0})))
+
+    def test_types_matter_in_arrays(self):
+        for old, new in [([1], [1.0]), ([1], [True]), ([[0]], [[False]]),
+                         ([{'b': 1}], [{'b': 1.0}])]:
+            self.assertEqual(
+                [{'op': 'replace', 'path': '/a', 'value': new}],
+                self.assertRoundTrip({'a': old}, {'a': new}))
+        self.assertEqual([], self.assertRoundTrip({'a': [{'b': [1]}]},
+                                                  {'a': [{'b': [1]}]}))
+
+    def test_escaped_keys(self):
+        patch = self.assertRoundTrip({'a/b': 1, 'c~d': 1},
+                                     {'a/b': 2, 'c~d': 2})
+        self.assertEqual(
+            set(['/a~1b', '/c~0d']), set(op['path'] for op in patch))
+
+    def test_replace_whole(self):
+        self.assertEqual([{'op': 'replace', 'path': '', 'value': [1]}],
+                         self.assertRoundTrip({'a': 1}, [1]))
+
+    def test_apply_invalid(self):
+        for patch in [[{'op': 'move', 'path': '/a', 'from': '/b'}],
+                      [{'op': 'remove', 'path': '/x'}],
+                      [{'op': 'replace', 'path': '/x', 'value': 1}],
+                      [{'op': 'add', 'path': '/x/y', 'value': 1}],
+                      [{'op': 'add', 'path': '/a/y', 'value': 1}],
+                      [{'op': 'add', 'path': '/x'}],
+                      [{'op': 'add', 'path': 'x', 'value': 1}],
+                      [{'op': 'remove', 'path': ''}],
+                      [{'path': '/a'}],
+                      ['add']]:
+            self.assertRaises(ValueError, json_patch.apply_patch, {'a': 1},
+                              patch)
@@ -28,6 +28,7 @@ from u1db.remote import (
     http_app,
     http_target,
     oauth_middleware,
+    utils,
     )
 
 
@@ -41,65 +42,95 @@ class TestHTTPSyncTargetBasics(tests.TestCase):
         self.assertEqual('/', remote_target._url.path)
 
 
+class TestSendingSyncStream(tests.TestCase):
+
+    def test_send_chunked(self):
+        sent = []
+
+        class FakeConnection(object):
+
+            def send(self, data):
+                sent.append(data)
+
+        tgt = http_target.HTTPSyncTarget("http://foo/foo")
+        tgt._conn = FakeConnection()
+        tgt.upload_chunk_size = 4
+        tgt._send_chunked(['ab', 'cd', 'efghij', 'k'])
+        self.assertEqual(
+            ['4\r\nabcd\r\n', '6\r\nefghij\r\n', '1\r\nk\r\n',
+             '0\r\n\r\n'], sent)
+
+
 class TestParsingSyncStream(tests.TestCase):
 
-    def test_wrong_start(self):
+    def parse(self, data, return_doc_cb=None):
         tgt = http_target.HTTPSyncTarget("http://foo/foo")
+        return tgt._parse_sync_stream(data.splitlines(), return_doc_cb)
 
-        self.assertRaises(errors.BrokenSyncStream,
-                          tgt._parse_sync_stream, "{}\r\n]", None)
+    def test_wrong_start(self):
+        self.assertRaises(errors.BrokenSyncStream, self.parse, "{}\r\n]")
 
-        self.assertRaises(errors.BrokenSyncStream,
-                          tgt._parse_sync_stream, "\r\n{}\r\n]", None)
+        self.assertRaises(errors.BrokenSyncStream, self.parse, "\r\n{}\r\n]")
 
-        self.assertRaises(errors.BrokenSyncStream,
-                          tgt._parse_sync_stream, "", None)
+        self.assertRaises(errors.BrokenSyncStream, self.parse, "")
 
     def test_wrong_end(self):
-        tgt = http_target.HTTPSyncTarget("http://foo/foo")
-
-        self.assertRaises(errors.BrokenSyncStream,
-                          tgt._parse_sync_stream, "[\r\n{}", None)
+        self.assertRaises(errors.BrokenSyncStream, self.parse, "[\r\n{}")
 
-        self.assertRaises(errors.BrokenSyncStream,
-                          tgt._parse_sync_stream, "[\r\n", None)
+        self.assertRaises(errors.BrokenSyncStream, self.parse, "[\r\n")
 
     def test_missing_comma(self):
-        tgt = http_target.HTTPSyncTarget("http://foo/foo")
-
         self.assertRaises(errors.BrokenSyncStream,
-                          tgt._parse_sync_stream,
+                          self.parse,
                           '[\r\n{}\r\n{"id": "i", "rev": "r", '
-                          '"content": "c", "gen": 3}\r\n]', None)
+                          '"content": "c", "gen": 3}\r\n]')
 
     def test_extra_comma(self):
-        tgt = http_target.HTTPSyncTarget("http://foo/foo")
-
-        self.assertRaises(errors.BrokenSyncStream,
-                          tgt._parse_sync_stream, "[\r\n{},\r\n]", None)
+        self.assertRaises(errors.BrokenSyncStream, self.parse, "[\r\n{},\r\n]")
 
         self.assertRaises(errors.BrokenSyncStream,
-                          tgt._parse_sync_stream,
+                          self.parse,
                           '[\r\n{},\r\n{"id": "i", "rev": "r", '
                           '"content": "{}", "gen": 3, "trans_id": "T-sid"}'
                           ',\r\n]',
                           lambda doc, gen, trans_id: None)
 
     def test_error_in_stream(self):
-        tgt = http_target.HTTPSyncTarget("http://foo/foo")
-
         self.assertRaises(errors.Unavailable,
-                          tgt._parse_sync_stream,
+                          self.parse,
                           '[\r\n{"new_generation": 0},'
-                          '\r\n{"error": "unavailable"}\r\n', None)
+                          '\r\n{"error": "unavailable"}\r\n')
 
         self.assertRaises(errors.Unavailable,
-                          tgt._parse_sync_stream,
-                          '[\r\n{"error": "unavailable"}\r\n', None)
+                          self.parse,
+                          '[\r\n{"error": "unavailable"}\r\n')
 
         self.assertRaises(errors.BrokenSyncStream,
-                          tgt._parse_sync_stream,
-                          '[\r\n{"error": "?"}\r\n', None)
+                          self.parse,
+                          '[\r\n{"error": "?"}\r\n')
+
+    def test_no_new_generation(self):
+        self.assertRaises(errors.BrokenSyncStream, self.parse, "[\r\n]")
+
+    def test_returns_docs_as_parsed(self):
+        seen = []
+
+        def lines():
+            yield '['
+            yield '{"new_generation": 2},'
+            yield ('{"id": "i", "rev": "r", "content": "{}", "gen": 1,'
+                   ' "trans_id": "T-1"},')
+            yield ('{"id": "j", "rev": "r", "content": "{}", "gen": 2,'
+                   ' "trans_id": "T-2"}')
+            # the first document was handed over before the stream ended
+            self.assertEqual(['i'], seen)
+            yield ']'
+
+        tgt = http_target.HTTPSyncTarget("http://foo/foo")
+        res = tgt._parse_sync_stream(
+            lines(), lambda doc, gen, trans_id: seen.append(doc.doc_id))
+        self.assertEqual({'new_generation': 2}, res)
+        self.assertEqual(['i', 'j'], seen)
 
 
 def http_server_def():
@@ -176,6 +207,29 @@ class TestRemoteSyncTargets(tests.TestCaseWithServer):
         self.assertEqual(('test', 0, 1, 'T-transid'),
                          remote_target.get_sync_info('other-id'))
 
+    def test_get_sync_info_upload_encoding(self):
+        self.startServer()
+        self.request_state._create_database('test')
+        remote_target = self.getSyncTarget('test')
+        remote_target.get_sync_info('other-id')
+        self.assertEqual('gzip', remote_target._upload_encoding)
+        remote_target.sync_encodings = ('deflate',)
+        remote_target.get_sync_info('other-id')
+        self.assertEqual('deflate', remote_target._upload_encoding)
+        remote_target.sync_encodings = ()
+        remote_target.get_sync_info('other-id')
+        self.assertIs(None, remote_target._upload_encoding)
+
+    def test_get_sync_info_upload_chunked(self):
+        self.startServer()
+        self.request_state._create_database('test')
+        remote_target = self.getSyncTarget('test')
+        remote_target.get_sync_info('other-id')
+        self.assertFalse(remote_target._upload_chunked)
+        self.request_state.accept_chunked = True
+        remote_target.get_sync_info('other-id')
+        self.assertTrue(remote_target._upload_chunked)
+
     def test_record_sync_info(self):
         self.startServer()
         db = self.request_state._create_database('test')
@@ -201,6 +255,96 @@ class TestRemoteSyncTargets(tests.TestCaseWithServer):
         self.assertGetDoc(
             db, 'doc-here', 'replica:1', '{"value": "here"}', False)
 
+    def test_sync_exchange_send_from_iterator(self):
+        self.startServer()
+        db = self.request_state._create_database('test')
+        remote_target = self.getSyncTarget('test')
+
+        def docs_by_generation():
+            for i in range(1, 4):
+                yield (self.make_document('doc-%d' % i, 'replica:1',
+                                          '{"value": %d}' % i),
+                       i, 'T-%d' % i)
+        new_gen, trans_id = remote_target.sync_exchange(
+                docs_by_generation(), 'replica', last_known_generation=0,
+                return_doc_cb=None)
+        self.assertEqual(3, new_gen)
+        self.assertGetDoc(db, 'doc-3', 'replica:1', '{"value": 3}', False)
+
+    def check_sync_exchange_both_ways(self, remote_target):
+        decompressed = []
+        read = utils.DecompressingReader.read
+
+        def read_witness(reader, size):
+            data = read(reader, size)
+            decompressed.append(data)
+            return data
+
+        self.patch(utils.DecompressingReader, 'read', read_witness)
+        db = self.request_state._create_database('test')
+        db.create_doc('{"value": "there"}', doc_id='doc-there')
+        remote_target.get_sync_info('replica')
+        other_docs = []
+
+        def receive_doc(doc, gen, trans_id):
+            other_docs.append((doc.doc_id, doc.rev, doc.get_json()))
+
+        docs = [(self.make_document('doc-%d' % i, 'replica:1',
+                                    '{"value": %d}' % i), i, 'T-%d' % i)
+                for i in range(1, 4)]
+        new_gen, trans_id = remote_target.sync_exchange(
+                docs, 'replica', last_known_generation=0,
+                return_doc_cb=receive_doc)
+        self.assertEqual(4, new_gen)
+        self.assertGetDoc(db, 'doc-3', 'replica:1', '{"value": 3}', False)
+        self.assertEqual(['doc-there'], [doc[0] for doc in other_docs])
+        return ''.join(decompressed)
+
+    def test_sync_exchange_compressed(self):
+        self.startServer()
+        self.request_state.accept_chunked = True
+        remote_target = self.getSyncTarget('test')
+        decompressed = self.check_sync_exchange_both_ways(remote_target)
+        # both the sent and the returned streams were compressed
+        self.assertIn('"doc-3"', decompressed)
+        self.assertIn('"doc-there"', decompressed)
+
+    def test_sync_exchange_compressed_not_chunked(self):
+        self.startServer()
+        remote_target = self.getSyncTarget('test')
+        remote_target.chunked_upload = False
+        remote_target.sync_encodings = ('deflate',)
+        decompressed = self.check_sync_exchange_both_ways(remote_target)
+        self.assertIn('"doc-3"', decompressed)
+        self.assertIn('"doc-there"', decompressed)
+
+    def test_sync_exchange_chunked_refused(self):
+        self.startServer()
+        application = self.server.get_app()
+        transfer_encodings = []
+
+        def refuse_chunked(environ, start_response):
+            transfer_encoding = environ.get('HTTP_TRANSFER_ENCODING')
+            transfer_encodings.append(transfer_encoding)
+            if transfer_encoding == 'chunked':
+                start_response('411 Length Required',
+                               [('content-type', 'text/plain')])
+                return ['length required']
+            return application(environ, start_response)
+
+        self.server.set_app(refuse_chunked)
+        remote_target = self.getSyncTarget('test')
+        remote_target.chunked_upload = True
+        self.check_sync_exchange_both_ways(remote_target)
+        self.assertEqual([None, 'chunked', None], transfer_encodings)
+
+    def test_sync_exchange_not_compressed(self):
+        self.startServer()
+        remote_target = self.getSyncTarget('test')
+        remote_target.sync_encodings = ()
+        self.assertEqual('',
+                         self.check_sync_exchange_both_ways(remote_target))
+
     def test_sync_exchange_send_failure_and_retry_scenario(self):
         self.startServer()
 
@@ -210,18 +354,16 @@ class TestRemoteSyncTargets(tests.TestCaseWithServer):
         self.patch(self.server.RequestHandlerClass, 'get_stderr',
                    blackhole_getstderr)
         db = self.request_state._create_database('test')
-        _put_doc_if_newer = db._put_doc_if_newer
+        _put_doc_vcr_if_newer = db._put_doc_vcr_if_newer
         trigger_ids = ['doc-here2']
 
-        def bomb_put_doc_if_newer(doc, save_conflict,
-                                  replica_uid=None, replica_gen=None,
-                                  replica_trans_id=None):
+        def bomb_put_doc_vcr_if_newer(doc, doc_vcr, cur_doc, cur_vcr,
+                                      save_conflict):
             if doc.doc_id in trigger_ids:
                 raise Exception
-            return _put_doc_if_newer(doc, save_conflict=save_conflict,
-                replica_uid=replica_uid, replica_gen=replica_gen,
-                replica_trans_id=replica_trans_id)
-        self.patch(db, '_put_doc_if_newer', bomb_put_doc_if_newer)
+            return _put_doc_vcr_if_newer(doc, doc_vcr, cur_doc, cur_vcr,
+                                         save_conflict)
+        self.patch(db, '_put_doc_vcr_if_newer', bomb_put_doc_vcr_if_newer)
         remote_target = self.getSyncTarget('test')
         other_changes = []
 
@@ -16,6 +16,10 @@
 
 """Tests for protocol details utils."""
 
+import cStringIO
+import zlib
+
+from u1db import errors
 from u1db.tests import TestCase
 from u1db.remote import utils
 
@@ -34,3 +38,91 @@ class TestUtils(TestCase):
         line, comma = utils.check_and_strip_comma("")
         self.assertFalse(comma)
         self.assertEqual("", line)
+
+    def test_iter_lines(self):
+        data = cStringIO.StringIO('[\r\n{"a": 1},\r\n{"b": 2}\r\n]\r\n')
+        self.assertEqual(['[', '{"a": 1},', '{"b": 2}', ']'],
+                         list(utils.iter_lines(data.read, 3)))
+
+    def test_iter_lines_no_final_newline(self):
+        data = cStringIO.StringIO('[\r\n]')
+        self.assertEqual(['[', ']'], list(utils.iter_lines(data.read, 1)))
+
+    def test_iter_lines_empty(self):
+        data = cStringIO.StringIO('')
+        self.assertEqual([], list(utils.iter_lines(data.read)))
+
+    def test_iter_lines_reads_lazily(self):
+        reads = []
+
+        def read(size):
+            reads.append(size)
+            return ['abc\r\n', 'def\r\n', ''][len(reads) - 1]
+        lines = utils.iter_lines(read, 5)
+        self.assertEqual('abc', lines.next())
+        self.assertEqual([5], reads)
+
+    def test_choose_encoding(self):
+        self.assertEqual('gzip', utils.choose_encoding('gzip, deflate'))
+        self.assertEqual('gzip', utils.choose_encoding('deflate, gzip'))
+        self.assertEqual('deflate', utils.choose_encoding('Deflate'))
+        self.assertEqual('deflate',
+                         utils.choose_encoding('gzip;q=0.5, deflate'))
+        self.assertEqual('deflate', utils.choose_encoding('*, gzip;q=0'))
+        self.assertEqual('gzip', utils.choose_encoding('gzip, deflate',
+                                                       ('gzip',)))
+
+    def test_choose_encoding_none(self):
+        self.assertIs(None, utils.choose_encoding(None))
+        self.assertIs(None, utils.choose_encoding(''))
+        self.assertIs(None, utils.choose_encoding('identity, br'))
+        self.assertIs(None, utils.choose_encoding('gzip;q=0'))
+        self.assertIs(None, utils.choose_encoding('gzip;q=x'))
+        self.assertIs(None, utils.choose_encoding('gzip, deflate', ()))
+
+    def test_etag_matches(self):
+        etag = utils.rev_etag('replica:1')
+        self.assertEqual('"replica:1"', etag)
+        self.assertTrue(utils.etag_matches('"replica:1"', etag))
+        self.assertTrue(utils.etag_matches('"other:2", W/"replica:1"', etag))
+        self.assertFalse(utils.etag_matches('"replica:2"', etag))
+        self.assertFalse(utils.etag_matches('*', etag))
+        self.assertFalse(utils.etag_matches(None, etag))
+
+    def test_iter_compressed_gzip(self):
+        data = ''.join(utils.iter_compressed(['[\r\n', '{"a": 1}', ']'],
+                                             'gzip'))
+        self.assertEqual('\x1f\x8b', data[:2])
+        self.assertEqual('[\r\n{"a": 1}]',
+                         zlib.decompress(data, 16 + zlib.MAX_WBITS))
+
+    def test_iter_compressed_deflate(self):
+        data = ''.join(utils.iter_compressed(['[\r\n', ']'], 'deflate'))
+        self.assertEqual('[\r\n]', zlib.decompress(data))
+
+    def test_decompressing_reader(self):
+        for encoding in utils.SYNC_ENCODINGS:
+            data = cStringIO.StringIO(''.join(
+                utils.iter_compressed(['[\r\n', '{"a": 1}\r\n', ']'],
+                                      encoding)))
+            reader = utils.DecompressingReader(data.read, encoding, 3)
+            self.assertEqual(['[', '{"a": 1}', ']'],
+                             list(utils.iter_lines(reader.read, 4)))
+
+    def test_decompressing_reader_bounds_reads(self):
+        data = cStringIO.StringIO(''.join(
+            utils.iter_compressed(['x' * 100000], 'gzip')))
+        reader = utils.DecompressingReader(data.read, 'gzip')
+        sizes = []
+        while True:
+            decoded = reader.read(1000)
+            if not decoded:
+                break
+            sizes.append(len(decoded))
+        self.assertEqual(100000, sum(sizes))
+        self.assertEqual(1000, max(sizes))
+
+    def test_decompressing_reader_broken(self):
+        data = cStringIO.StringIO('not compressed at all')
+        reader = utils.DecompressingReader(data.read, 'gzip')
+        self.assertRaises(errors.BrokenSyncStream, reader.read, 10)
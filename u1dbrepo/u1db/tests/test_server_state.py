@@ -17,9 +17,12 @@
 """Tests for server state object."""
 
 import os
+import threading
+import time
 
 from u1db import (
     errors,
+    sync,
     tests,
     )
 from u1db.remote import (
@@ -90,3 +93,175 @@ class TestServerState(tests.TestCase):
         self.state.set_workingdir(tempdir)
         self.assertRaises(errors.DatabaseDoesNotExist,
                           self.state.delete_database, 'test.db')
+
+    def test_get_revision_cache(self):
+        cache = self.state.get_revision_cache('db', 'replica')
+        self.assertIsInstance(cache, sync.RevisionCache)
+        self.assertIs(cache, self.state.get_revision_cache('db', 'replica'))
+        self.assertIsNot(cache, self.state.get_revision_cache('db', 'other'))
+        self.assertIsNot(cache,
+                         self.state.get_revision_cache('db2', 'replica'))
+
+    def test_get_revision_cache_least_recently_used_dropped(self):
+        self.state.max_revision_caches = 2
+        cache_a = self.state.get_revision_cache('db', 'a')
+        cache_b = self.state.get_revision_cache('db', 'b')
+        self.state.get_revision_cache('db', 'a')
+        self.state.get_revision_cache('db', 'c')
+        self.assertIs(cache_a, self.state.get_revision_cache('db', 'a'))
+        self.assertIsNot(cache_b, self.state.get_revision_cache('db', 'b'))
+
+
+class TestServerStateDatabasePool(tests.TestCase):
+
+    def setUp(self):
+        super(TestServerStateDatabasePool, self).setUp()
+        self.state = server_state.ServerState()
+        self.state.set_workingdir(self.createTempDir())
+        self.opened = []
+        open_database = self.state._open_database
+
+        def _open_database(path, create):
+            db = open_database(path, create)
+            self.opened.append(path)
+            return db
+
+        self.state._open_database = _open_database
+        for path in ('a.db', 'b.db', 'c.db'):
+            self.state.ensure_database(path)
+            self.state.release_databases()
+        del self.opened[:]
+
+    def test_reused(self):
+        db = self.state.open_database('a.db')
+        self.assertIs(db, self.state.open_database('a.db'))
+        self.state.release_databases()
+        self.assertIs(db, self.state.open_database('a.db'))
+        self.assertEqual([], self.opened)
+
+    def test_checked_out_once(self):
+        db = self.state.open_database('a.db')
+        other = []
+        thread = threading.Thread(
+            target=lambda: other.append(self.state.open_database('a.db')))
+        thread.start()
+        thread.join()
+        self.assertIsNot(db, other[0])
+        self.assertEqual(['a.db'], self.opened)
+
+    def test_used_from_other_threads(self):
+        db = self.state.open_database('a.db')
+        doc = db.create_doc('{}')
+        self.state.release_databases()
+        found = []
+
+        def get_doc():
+            db = self.state.open_database('a.db')
+            found.append(db.get_doc(doc.doc_id))
+            self.state.release_databases()
+
+        thread = threading.Thread(target=get_doc)
+        thread.start()
+        thread.join()
+        self.assertEqual([doc], found)
+        self.assertEqual([], self.opened)
+
+    def test_pinned_to_thread(self):
+        db = self.state.open_database('a.db')
+        other = []
+        checked_out = threading.Event()
+        released = threading.Event()
+
+        def use_db():
+            other.append(self.state.open_database('a.db'))
+            checked_out.set()
+            released.wait()
+            self.state.release_databases()
+
+        thread = threading.Thread(target=use_db)
+        thread.start()
+        checked_out.wait()
+        self.state.release_databases()
+        released.set()
+        thread.join()
+        # the other thread released its handle last
+        self.assertIs(db, self.state.open_database('a.db'))
+
+    def test_max_open_databases(self):
+        self.state.max_open_databases = 2
+        self.state.release_databases()
+        self.assertEqual(2, self.state._num_open)
+        self.assertEqual(['b.db', 'c.db'], list(self.state._idle))
+        self.state.open_database('a.db')
+        self.assertEqual(['a.db'], self.opened)
+        self.assertEqual(['c.db'], list(self.state._idle))
+
+    def test_max_idle_time(self):
+        self.state.max_idle_time = 10
+        self.state._close_idle(time.time() + 20)
+        self.assertEqual(0, self.state._num_open)
+        self.assertEqual([], list(self.state._idle))
+
+    def test_delete_database(self):
+        self.state.open_database('a.db')
+        self.state.delete_database('a.db')
+        self.state.delete_database('b.db')
+        self.assertEqual(['c.db'], list(self.state._idle))
+        self.assertEqual(1, self.state._num_open)
+        self.assertRaises(errors.DatabaseDoesNotExist,
+                          self.state.open_database, 'b.db')
+
+    def test_close_idle_databases(self):
+        self.state.open_database('a.db')
+        self.state.close_idle_databases()
+        self.assertEqual([], list(self.state._idle))
+        self.assertEqual(1, self.state._num_open)
+
+    def test_writing(self):
+        events = []
+
+        def write():
+            with self.state.writing('a.db'):
+                events.append('other')
+
+        with self.state.writing('a.db'):
+            thread = threading.Thread(target=write)
+            thread.start()
+            thread.join(0.1)
+            events.append('first')
+        thread.join()
+        self.assertEqual(['first', 'other'], events)
+        self.assertEqual({}, self.state._write_locks)
+
+    def test_writing_other_process(self):
+        # another ServerState has its own thread locks, like the one of
+        # another process
+        other_state = server_state.ServerState()
+        other_state.set_workingdir(self.state._workingdir)
+        events = []
+
+        def write():
+            with other_state.writing('a.db'):
+                events.append('other')
+
+        with self.state.writing('a.db'):
+            thread = threading.Thread(target=write)
+            thread.start()
+            thread.join(0.1)
+            events.append('first')
+        thread.join()
+        self.assertEqual(['first', 'other'], events)
+        self.assertEqual(['a.db'], os.listdir(
+            os.path.join(self.state._workingdir, '.locks')))
+
+    def test_delete_database_lock_file(self):
+        with self.state.writing('a.db'):
+            self.state.delete_database('a.db')
+        self.assertEqual([], os.listdir(
+            os.path.join(self.state._workingdir, '.locks')))
+        # created again with the database
+        self.state.ensure_database('a.db')
+        with self.state.writing('a.db'):
+            pass
+        self.assertEqual(['a.db'], os.listdir(
+            os.path.join(self.state._workingdir, '.locks')))
@@ -23,12 +23,14 @@ import threading
 from sqlite3 import dbapi2
 
 from u1db import (
+    content_digest,
     errors,
     tests,
     query_parser,
     )
 from u1db.backends import sqlite_backend
 from u1db.tests.test_backends import TestAlternativeDocument
+from u1db.tests.test_json_codec import CountingCodec
 
 
 simple_doc = '{"key": "value"}'
@@ -108,7 +110,7 @@ class TestSQLitePartialExpandDatabase(tests.TestCase):
         c = raw_db.cursor()
         c.execute("SELECT * FROM u1db_config")
         config = dict([(r[0], r[1]) for r in c.fetchall()])
-        self.assertEqual({'sql_schema': '0', 'replica_uid': 'test',
+        self.assertEqual({'sql_schema': '2', 'replica_uid': 'test',
                           'index_storage': 'expand referenced'}, config)
 
         # These tables must exist, though we don't care what is in them yet
@@ -119,6 +121,249 @@ class TestSQLitePartialExpandDatabase(tests.TestCase):
         c.execute("SELECT * FROM conflicts")
         c.execute("SELECT * FROM index_definitions")
 
+    def test_content_digest_stored(self):
+        doc = self.db.create_doc(nested_doc)
+        c = self.db._get_sqlite_handle().cursor()
+        c.execute("SELECT content_digest FROM document WHERE doc_id = ?",
+                  (doc.doc_id,))
+        digest = content_digest(
+            {"sub": {"doc": "underneath"}, "key": "value"})
+        self.assertEqual([(digest,)], c.fetchall())
+        self.assertEqual(digest, self.db.get_doc(doc.doc_id)._digest)
+        self.db.delete_doc(doc)
+        c.execute("SELECT content_digest FROM document WHERE doc_id = ?",
+                  (doc.doc_id,))
+        self.assertEqual([(None,)], c.fetchall())
+
+    def test_conflict_content_digest_stored(self):
+        doc = self.db.create_doc(simple_doc, doc_id='my-doc')
+        self.db._put_doc_if_newer(
+            self.db._factory('my-doc', 'other:1', nested_doc),
+            save_conflict=True)
+        c = self.db._get_sqlite_handle().cursor()
+        c.execute("SELECT doc_rev, content_digest FROM conflicts")
+        self.assertEqual([(doc.rev, content_digest({"key": "value"}))],
+                         c.fetchall())
+        self.assertEqual(content_digest({"key": "value"}),
+                         self.db._get_conflicts('my-doc')[0]._digest)
+
+    def test_upgrade_schema_0(self):
+        temp_dir = self.createTempDir(prefix='u1db-test-')
+        path = temp_dir + '/schema-0.sqlite'
+        db_handle = dbapi2.connect(path)
+        c = db_handle.cursor()
+        for table in ['document', 'conflicts']:
+            c.execute("CREATE TABLE %s (doc_id TEXT, doc_rev TEXT,"
+                      " content TEXT)" % (table,))
+        c.execute("CREATE TABLE u1db_config (name TEXT PRIMARY KEY,"
+                  " value TEXT)")
+        c.executemany("INSERT INTO u1db_config VALUES (?, ?)",
+                      [('sql_schema', '0'), ('replica_uid', 'test'),
+                       ('index_storage', 'expand referenced')])
+        c.execute("INSERT INTO document VALUES ('my-doc', 'test:1', ?)",
+                  (simple_doc,))
+        db_handle.commit()
+        db_handle.close()
+        db = sqlite_backend.SQLiteDatabase.open_database(path, create=False)
+        self.addCleanup(db.close)
+        c = db._get_sqlite_handle().cursor()
+        self.assertEqual('2', db._get_schema_version(c))
+        doc = db._get_doc('my-doc')
+        self.assertIs(None, doc._digest)
+        self.assertTrue(doc.same_content_as(
+            self.db._factory('my-doc', 'other:1', simple_doc)))
+        # The column was added to conflicts as well
+        c.execute("SELECT content_digest FROM conflicts")
+
+    def test_upgrade_schema_1(self):
+        temp_dir = self.createTempDir(prefix='u1db-test-')
+        path = temp_dir + '/schema-1.sqlite'
+        db = sqlite_backend.SQLitePartialExpandDatabase(path)
+        doc = db.create_doc('{"key": 1.0}')
+        c = db._get_sqlite_handle().cursor()
+        # as computed before numbers were made canonical
+        c.execute("UPDATE document SET content_digest = 'old'")
+        c.execute("UPDATE u1db_config SET value = '1'"
+                  " WHERE name = 'sql_schema'")
+        db._get_sqlite_handle().commit()
+        db.close()
+        db = sqlite_backend.SQLiteDatabase.open_database(path, create=False)
+        self.addCleanup(db.close)
+        c = db._get_sqlite_handle().cursor()
+        self.assertEqual('2', db._get_schema_version(c))
+        self.assertIs(None, db._get_doc(doc.doc_id)._digest)
+        self.assertTrue(db._get_doc(doc.doc_id).same_content_as(
+            db._factory(doc.doc_id, 'other:1', '{"key": 1}')))
+
+    def get_stored_revs(self, db):
+        c = db._get_sqlite_handle().cursor()
+        c.execute("SELECT doc_rev FROM document UNION ALL"
+                  " SELECT doc_rev FROM conflicts")
+        return sorted([r[0] for r in c.fetchall()])
+
+    def test_compact_revisions(self):
+        doc = self.db.create_doc(simple_doc, doc_id='my-doc')
+        self.db._put_doc_if_newer(
+            self.db._factory('my-doc', 'other-replica:1', nested_doc),
+            save_conflict=True)
+        self.db.set_compact_revisions(True)
+        c = self.db._get_sqlite_handle().cursor()
+        c.execute("SELECT replica_uid, short_id FROM replica_ids")
+        short_ids = dict(c.fetchall())
+        self.assertEqual(['other-replica', 'test'], sorted(short_ids))
+        self.assertEqual(
+            sorted(['%s:1' % (short_ids['other-replica'],),
+                    '%s:1' % (short_ids['test'],)]),
+            self.get_stored_revs(self.db))
+        self.assertEqual(
+            ['other-replica:1', doc.rev],
+            [d.rev for d in self.db.get_doc_conflicts('my-doc')])
+        self.db.resolve_doc(self.db._factory('my-doc', None, simple_doc),
+                            ['other-replica:1', doc.rev])
+        resolved = self.db.get_doc('my-doc')
+        self.assertEqual('other-replica:1|test:2', resolved.rev)
+        self.assertFalse(resolved.has_conflicts)
+        self.db.set_compact_revisions(False)
+        self.assertEqual(['other-replica:1|test:2'],
+                         self.get_stored_revs(self.db))
+        self.assertEqual(resolved.rev, self.db.get_doc('my-doc').rev)
+
+    def test_compact_revisions_reopen(self):
+        temp_dir = self.createTempDir(prefix='u1db-test-')
+        path = temp_dir + '/compact.sqlite'
+        db = sqlite_backend.SQLitePartialExpandDatabase(path)
+        db._set_replica_uid('test')
+        db.set_compact_revisions(True)
+        doc = db.create_doc(simple_doc)
+        db.close()
+        db = sqlite_backend.SQLiteDatabase.open_database(path, create=False)
+        self.addCleanup(db.close)
+        self.assertEqual(doc.rev, db.get_doc(doc.doc_id).rev)
+        self.assertEqual([doc], db.get_all_docs()[1])
+
+    def test_compact_revisions_other_connection(self):
+        temp_dir = self.createTempDir(prefix='u1db-test-')
+        path = temp_dir + '/compact.sqlite'
+        db = sqlite_backend.SQLitePartialExpandDatabase(path)
+        self.addCleanup(db.close)
+        db._set_replica_uid('test')
+        other = sqlite_backend.SQLiteDatabase.open_database(path,
+                                                            create=False)
+        self.addCleanup(other.close)
+        db.set_compact_revisions(True)
+        doc = other.create_doc(simple_doc)
+        c = db._get_sqlite_handle().cursor()
+        c.execute("SELECT short_id FROM replica_ids WHERE replica_uid = ?",
+                  ('test',))
+        self.assertEqual(['%s:1' % (c.fetchone()[0],)],
+                         self.get_stored_revs(db))
+        self.assertEqual(doc, db.get_doc(doc.doc_id))
+        db.set_compact_revisions(False)
+        doc2 = other.create_doc(simple_doc)
+        self.assertEqual(sorted([doc.rev, doc2.rev]),
+                         self.get_stored_revs(db))
+        self.assertEqual(doc2, db.get_doc(doc2.doc_id))
+
+    def test_compact_revisions_decode_uncompacted(self):
+        doc = self.db.create_doc(simple_doc)
+        self.db.set_compact_revisions(True)
+        c = self.db._get_sqlite_handle().cursor()
+        # as stored before connections checked the encoding when writing
+        c.execute("UPDATE document SET doc_rev = ?", (doc.rev,))
+        self.assertEqual(doc.rev, self.db.get_doc(doc.doc_id).rev)
+        c.execute("UPDATE document SET doc_rev = ?",
+                  ('%s:1|unknown:1' % (self.db._get_short_id('test'),),))
+        self.assertRaises(errors.InvalidRevision, self.db.get_doc,
+                          doc.doc_id)
+
+    def test_retired_replicas_reopen(self):
+        temp_dir = self.createTempDir(prefix='u1db-test-')
+        path = temp_dir + '/retired.sqlite'
+        db = sqlite_backend.SQLitePartialExpandDatabase(path)
+        db._set_replica_uid('test')
+        db.set_retired_replicas(['old1', 'old2'])
+        db.close()
+        db = sqlite_backend.SQLiteDatabase.open_database(path, create=False)
+        self.addCleanup(db.close)
+        self.assertEqual(frozenset(['old1', 'old2']),
+                         db.get_retired_replicas())
+        doc = db._factory('my-doc', 'old1:1|test:1', simple_doc)
+        db._put_doc_if_newer(doc, save_conflict=False)
+        db.put_doc(doc)
+        self.assertEqual('test:2', doc.rev)
+
+    def test_retired_replicas_other_connection(self):
+        temp_dir = self.createTempDir(prefix='u1db-test-')
+        path = temp_dir + '/retired.sqlite'
+        db = sqlite_backend.SQLitePartialExpandDatabase(path)
+        self.addCleanup(db.close)
+        db._set_replica_uid('test')
+        other = sqlite_backend.SQLiteDatabase.open_database(path,
+                                                            create=False)
+        self.addCleanup(other.close)
+        db.set_retired_replicas(['old'])
+        db.create_doc(simple_doc, doc_id='my-doc')
+        # other still has an entry for old, which is ignored
+        doc = other._factory('my-doc', 'old:1|test:1|z:1', nested_doc)
+        state, _ = other._put_doc_if_newer(doc, save_conflict=True)
+        self.assertEqual('inserted', state)
+        self.assertEqual(frozenset(['old']), other.get_retired_replicas())
+
+    def test_compact_revisions_allocation_rolled_back(self):
+        self.db.set_compact_revisions(True)
+        handle = self.db._get_sqlite_handle()
+        doc = self.db._factory('my-doc', 'other-replica:1', simple_doc)
+
+        def fail():
+            raise ZeroDivisionError
+        self.db._get_generation = fail
+        self.assertRaises(ZeroDivisionError, self.db._put_doc_if_newer, doc,
+                          save_conflict=False)
+        del self.db._get_generation
+        self.assertIs(None, self.db.get_doc('my-doc'))
+        self.db._put_doc_if_newer(doc, save_conflict=False)
+        c = handle.cursor()
+        c.execute("SELECT replica_uid FROM replica_ids")
+        self.assertEqual([('other-replica',)], c.fetchall())
+        self.assertEqual('other-replica:1', self.db.get_doc('my-doc').rev)
+
+    def test_compact_revisions_allocation_committed(self):
+        self.db.set_compact_revisions(True)
+        doc = self.db._factory('my-doc', 'other-replica:1', simple_doc)
+
+        def fail():
+            raise ZeroDivisionError
+        self.db._get_generation = fail
+        self.assertRaises(ZeroDivisionError, self.db._put_doc_if_newer, doc,
+                          save_conflict=False)
+        del self.db._get_generation
+        # not committed, still checked
+        self.assertEqual(set(['other-replica']),
+                         self.db._allocated_replica_uids)
+        self.db._put_doc_if_newer(doc, save_conflict=False)
+        self.db.put_doc(doc)
+        # committed, short ids are taken from the cache from now on
+        self.assertEqual(set(), self.db._allocated_replica_uids)
+        self.assertEqual(['other-replica', 'test'],
+                         sorted(self.db._short_ids))
+
+    def test__put_docs_if_newer_rolls_back_batch(self):
+        doc1 = self.db._factory('doc-1', 'other-replica:1', simple_doc)
+        doc2 = self.db._factory('doc-2', 'other-replica:1', simple_doc)
+        _put_doc_vcr_if_newer = self.db._put_doc_vcr_if_newer
+
+        def put_doc_vcr_if_newer(doc, *args):
+            if doc.doc_id == 'doc-2':
+                raise ZeroDivisionError
+            return _put_doc_vcr_if_newer(doc, *args)
+        self.db._put_doc_vcr_if_newer = put_doc_vcr_if_newer
+        self.assertRaises(
+            ZeroDivisionError, self.db._put_docs_if_newer,
+            [(doc1, 1, 'T-1'), (doc2, 2, 'T-2')], save_conflict=False,
+            replica_uid='other-replica')
+        self.assertIs(None, self.db.get_doc('doc-1'))
+        self.assertEqual((0, ''), self.db._get_sync_gen_info('other-replica'))
+
     def test__parse_index(self):
         self.db = sqlite_backend.SQLitePartialExpandDatabase(':memory:')
         g = self.db._parse_index_definition('fieldname')
@@ -159,6 +404,15 @@ class TestSQLitePartialExpandDatabase(tests.TestCase):
         self.db.create_index('test-idx', "key")
         self.assertEqual([('test-idx', ["key"])], self.db.list_indexes())
 
+    def test_create_index_json_codec(self):
+        codec = CountingCodec()
+        self.db.set_json_codec(codec)
+        self.db.create_doc(simple_doc)
+        self.db.create_index('test-idx', "key")
+        self.assertEqual(['loads', 'loads'], codec.calls)
+        self.assertEqual(
+            1, len(self.db.get_from_index('test-idx', 'value')))
+
     def test_create_index_multiple_fields(self):
         self.db.create_index('test-idx', "key", "key2")
         self.assertEqual([('test-idx', ["key", "key2"])],
@@ -17,10 +17,15 @@
 """The Synchronization class for U1DB."""
 
 import os
+import socket
+import threading
+import time
 from wsgiref import simple_server
 
 from u1db import (
     errors,
+    json_codec,
+    json_patch,
     sync,
     tests,
     vectorclock,
@@ -29,6 +34,7 @@ from u1db.backends import (
     inmemory,
     )
 from u1db.remote import (
+    http_app,
     http_target,
     )
 
@@ -907,6 +913,687 @@ class DatabaseSyncTests(tests.DatabaseBaseTests):
         self.sync(self.db1, self.db2, trace_hook=put_hook)
 
 
+class InterruptedSyncTarget(inmemory.InMemorySyncTarget):
+    """Break the connection after sending or returning a few documents."""
+
+    def __init__(self, db, send_limit=None, return_limit=None):
+        super(InterruptedSyncTarget, self).__init__(db)
+        self.send_limit = send_limit
+        self.return_limit = return_limit
+        self.received = []
+        self.returned = []
+
+    def sync_exchange(self, docs_by_generations, source_replica_uid,
+                      last_known_generation, return_doc_cb):
+        def receive():
+            for i, entry in enumerate(docs_by_generations):
+                if i == self.send_limit:
+                    self.send_limit = None
+                    raise socket.error
+                self.received.append(entry[0].doc_id)
+                yield entry
+
+        def return_doc(doc, gen, trans_id):
+            if len(self.returned) == self.return_limit:
+                self.return_limit = None
+                raise socket.error
+            self.returned.append(doc.doc_id)
+            return_doc_cb(doc, gen, trans_id)
+        return super(InterruptedSyncTarget, self).sync_exchange(
+            receive(), source_replica_uid, last_known_generation, return_doc)
+
+
+class TestResumableSync(tests.TestCase):
+
+    def setUp(self):
+        super(TestResumableSync, self).setUp()
+        self.patch(sync.Synchronizer, 'batch_size', 2)
+        self.patch(sync.LocalSyncTarget, 'batch_size', 2)
+        self.db1 = inmemory.InMemoryDatabase('test1')
+        self.db2 = inmemory.InMemoryDatabase('test2')
+        for i in range(5):
+            self.db1.create_doc(simple_doc, doc_id='doc-1%d' % i)
+            self.db2.create_doc(simple_doc, doc_id='doc-2%d' % i)
+
+    def test_resumes_sending(self):
+        st = InterruptedSyncTarget(self.db2, send_limit=3)
+        syncer = sync.Synchronizer(self.db1, st)
+        self.assertRaises(socket.error, syncer.sync)
+        # the first batch was checkpointed
+        self.assertEqual((2, self.db1._get_transaction_log()[1][1]),
+                         self.db2._get_sync_gen_info('test1'))
+        sync.Synchronizer(self.db1, st).sync()
+        self.assertEqual(
+            ['doc-10', 'doc-11', 'doc-12', 'doc-12', 'doc-13', 'doc-14'],
+            st.received)
+        self.assertEqual(10, len(self.db2.get_all_docs()[1]))
+        self.assertEqual(10, len(self.db1.get_all_docs()[1]))
+
+    def test_resumes_returning(self):
+        st = InterruptedSyncTarget(self.db2, return_limit=3)
+        syncer = sync.Synchronizer(self.db1, st)
+        self.assertRaises(socket.error, syncer.sync)
+        # what was returned before the interruption was applied
+        self.assertEqual((3, self.db2._get_transaction_log()[2][1]),
+                         self.db1._get_sync_gen_info('test2'))
+        sync.Synchronizer(self.db1, st).sync()
+        self.assertEqual(
+            ['doc-20', 'doc-21', 'doc-22', 'doc-23', 'doc-24'],
+            st.returned[:5])
+        # What either side received in the interrupted exchange is echoed
+        # back once, and converges.
+        self.assertEqual(['doc-20', 'doc-21', 'doc-22'], st.received[5:])
+        self.assertEqual(
+            ['doc-10', 'doc-11', 'doc-12', 'doc-13', 'doc-14'],
+            st.returned[5:])
+        self.assertEqual(10, self.db1._get_generation())
+        self.assertEqual(10, self.db2._get_generation())
+
+    def test_sync_resume(self):
+        st = InterruptedSyncTarget(self.db2, send_limit=3, return_limit=2)
+        sync.Synchronizer(self.db1, st).sync(resume=True)
+        self.assertEqual(10, len(self.db1.get_all_docs()[1]))
+        self.assertEqual(10, len(self.db2.get_all_docs()[1]))
+        self.assertEqual(
+            ['doc-20', 'doc-21', 'doc-22', 'doc-23', 'doc-24'],
+            st.returned[:5])
+        self.assertEqual(10, self.db1._get_generation())
+
+    def test_sync_resume_gives_up(self):
+        self.patch(sync.Synchronizer, 'max_resumes', 0)
+        st = InterruptedSyncTarget(self.db2, send_limit=3)
+        self.assertRaises(
+            socket.error, sync.Synchronizer(self.db1, st).sync, resume=True)
+
+
+class CountingSyncTarget(inmemory.InMemorySyncTarget):
+    """Keep track of the exchanges running at the same time."""
+
+    def __init__(self, db, tracker):
+        super(CountingSyncTarget, self).__init__(db)
+        self.tracker = tracker
+        self.exchanges = 0
+
+    def sync_exchange(self, docs_by_generations, source_replica_uid,
+                      last_known_generation, return_doc_cb):
+        with self.tracker['lock']:
+            self.tracker['running'] += 1
+            self.tracker['max'] = max(self.tracker['max'],
+                                      self.tracker['running'])
+        self.exchanges += 1
+        try:
+            time.sleep(0.01)
+            return super(CountingSyncTarget, self).sync_exchange(
+                docs_by_generations, source_replica_uid,
+                last_known_generation, return_doc_cb)
+        finally:
+            with self.tracker['lock']:
+                self.tracker['running'] -= 1
+
+
+class TestMultiSynchronizer(tests.TestCase):
+
+    def setUp(self):
+        super(TestMultiSynchronizer, self).setUp()
+        self.source = inmemory.InMemoryDatabase('source')
+        self.tracker = {'lock': threading.Lock(), 'running': 0, 'max': 0}
+        self.dbs = []
+        self.targets = []
+        for i in range(4):
+            db = inmemory.InMemoryDatabase('target%d' % i)
+            db.create_doc(simple_doc, doc_id='doc-target%d' % i)
+            self.dbs.append(db)
+            self.targets.append(CountingSyncTarget(db, self.tracker))
+        self.source.create_doc(simple_doc, doc_id='doc-source')
+
+    def test_sync(self):
+        results = sync.MultiSynchronizer(self.source, self.targets).sync()
+        self.assertEqual(['target0', 'target1', 'target2', 'target3'],
+                         [r['target_replica_uid'] for r in results])
+        for result, target in zip(results, self.targets):
+            self.assertIs(target, result['target'])
+            self.assertEqual((1, 1, 1, None),
+                             (result['sent'], result['received'],
+                              result['inserted'], result['error']))
+            self.assertTrue(result['seconds'] > 0)
+        self.assertEqual(5, len(self.source.get_all_docs()[1]))
+        for db in self.dbs:
+            self.assertGetDoc(db, 'doc-source', 'source:1', simple_doc,
+                              False)
+            self.assertEqual(db._get_generation_info(),
+                             self.source._get_sync_gen_info(db._replica_uid))
+
+    def test_sync_bounded_workers(self):
+        sync.MultiSynchronizer(self.source, self.targets,
+                               max_workers=2).sync()
+        self.assertEqual(2, self.tracker['max'])
+        self.assertEqual([1, 1, 1, 1], [t.exchanges for t in self.targets])
+
+    def test_sync_scans_source_once(self):
+        calls = []
+        whats_changed = self.source.whats_changed
+        get_docs = self.source.get_docs
+
+        def whats_changed_witness(old_generation):
+            calls.append(('whats_changed', old_generation))
+            return whats_changed(old_generation)
+
+        def get_docs_witness(doc_ids, **kwargs):
+            calls.append(('get_docs', list(doc_ids)))
+            return get_docs(doc_ids, **kwargs)
+
+        self.patch(self.source, 'whats_changed', whats_changed_witness)
+        self.patch(self.source, 'get_docs', get_docs_witness)
+        sync.MultiSynchronizer(self.source, self.targets).sync()
+        self.assertEqual([('whats_changed', 0),
+                          ('get_docs', ['doc-source'])], calls)
+
+    def test_sync_sends_each_target_its_changes(self):
+        sync.MultiSynchronizer(self.source, self.targets[:2]).sync()
+        doc = self.source.create_doc(simple_doc, doc_id='doc-new')
+        results = sync.MultiSynchronizer(self.source, self.targets).sync()
+        # the first two targets were already sent doc-source
+        self.assertEqual([3, 3, 4, 4], [r['sent'] for r in results])
+        for db in self.dbs:
+            self.assertGetDoc(db, 'doc-new', doc.rev, simple_doc, False)
+
+    def test_sync_writes_source_from_calling_thread(self):
+        threads = set()
+        put_docs_if_newer = self.source._put_docs_if_newer
+
+        def put_docs_if_newer_witness(*args, **kwargs):
+            threads.add(threading.current_thread())
+            return put_docs_if_newer(*args, **kwargs)
+
+        self.patch(self.source, '_put_docs_if_newer',
+                   put_docs_if_newer_witness)
+        sync.MultiSynchronizer(self.source, self.targets).sync()
+        self.assertEqual(set([threading.current_thread()]), threads)
+
+    def test_sync_target_failure(self):
+        def broken_exchange(*args, **kwargs):
+            raise socket.error
+
+        self.patch(self.targets[1], 'sync_exchange', broken_exchange)
+        results = sync.MultiSynchronizer(self.source, self.targets).sync()
+        self.assertIsInstance(results[1]['error'], socket.error)
+        self.assertEqual([None, None, None],
+                         [results[i]['error'] for i in (0, 2, 3)])
+        self.assertIs(None, self.source.get_doc('doc-target1'))
+        self.assertIs(None, self.dbs[1].get_doc('doc-source'))
+        self.assertGetDoc(self.dbs[2], 'doc-source', 'source:1', simple_doc,
+                          False)
+
+    def test_sync_source_error_stops_workers(self):
+        self.patch(sync.MultiSynchronizer, 'queue_size', 1)
+        for db in self.dbs:
+            for i in range(5):
+                db.create_doc(simple_doc)
+        started = []
+        start_workers = sync.MultiSynchronizer._start_workers
+
+        def start_workers_witness(multi, func, jobs):
+            work, threads = start_workers(multi, func, jobs)
+            started.extend(threads)
+            return work, threads
+
+        def broken_insert(*args):
+            raise RuntimeError
+
+        self.patch(sync.MultiSynchronizer, '_start_workers',
+                   start_workers_witness)
+        self.patch(sync.Synchronizer, '_insert_doc_from_target',
+                   broken_insert)
+        self.assertRaises(
+            RuntimeError, sync.MultiSynchronizer(
+                self.source, self.targets, max_workers=2).sync)
+        self.assertEqual([], [t for t in started if t.is_alive()])
+        # the exchanges not started yet were dropped
+        self.assertEqual([0, 0], [t.exchanges for t in self.targets[2:]])
+
+    def test_sync_nothing_to_exchange(self):
+        sync.MultiSynchronizer(self.source, self.targets).sync()
+        for db in self.dbs:
+            sync.Synchronizer(self.source, db.get_sync_target()).sync()
+        results = sync.MultiSynchronizer(self.source, self.targets).sync()
+        self.assertEqual([(0, 0)] * 4,
+                         [(r['sent'], r['received']) for r in results])
+        self.assertEqual([1, 1, 1, 1], [t.exchanges for t in self.targets])
+
+    def test_sync_records_gapless_with_single_target(self):
+        results = sync.MultiSynchronizer(self.source, self.targets[:1]).sync()
+        self.assertEqual(1, results[0]['inserted'])
+        self.assertEqual(self.source._get_generation_info(),
+                         self.dbs[0]._get_sync_gen_info('source'))
+        sync.MultiSynchronizer(self.source, self.targets[1:3]).sync()
+        # only what was sent is known to either target
+        self.assertEqual(4, self.source._get_generation())
+        self.assertEqual(2, self.dbs[1]._get_sync_gen_info('source')[0])
+        self.assertEqual(2, self.dbs[2]._get_sync_gen_info('source')[0])
+
+
+def task_json(title, done=False):
+    return json_codec.dumps({'title': title, 'done': done,
+                             'notes': 'Some longer notes. ' * 20})
+
+
+class TestRevisionCache(tests.TestCase):
+
+    def test_add_get(self):
+        cache = sync.RevisionCache()
+        cache.add(tests.create_doc('doc-id', 'test:1', simple_doc))
+        self.assertEqual(1, len(cache))
+        self.assertEqual(simple_doc, cache.get('doc-id', 'test:1'))
+        self.assertIs(None, cache.get('doc-id', 'test:2'))
+        self.assertIs(None, cache.get('other-id', 'test:1'))
+
+    def test_add_tombstone(self):
+        cache = sync.RevisionCache()
+        cache.add(tests.create_doc('doc-id', 'test:1', simple_doc))
+        cache.add(tests.create_doc('doc-id', 'test:2', None))
+        self.assertEqual(0, len(cache))
+
+    def test_least_recently_added_dropped(self):
+        cache = sync.RevisionCache(2)
+        for doc_id in ['a', 'b', 'a', 'c']:
+            cache.add(tests.create_doc(doc_id, 'test:1', simple_doc))
+        self.assertEqual(2, len(cache))
+        self.assertIs(None, cache.get('b', 'test:1'))
+        self.assertEqual(simple_doc, cache.get('a', 'test:1'))
+
+    def test_delta(self):
+        cache = sync.RevisionCache()
+        doc = tests.create_doc('doc-id', 'test:1', task_json('a'))
+        self.assertIs(doc, cache.delta(doc))
+        doc2 = tests.create_doc('doc-id', 'test:2', task_json('a', True))
+        delta = cache.delta(doc2)
+        self.assertIsInstance(delta, sync.DocumentDelta)
+        self.assertEqual(('doc-id', 'test:2', 'test:1'),
+                         (delta.doc_id, delta.rev, delta.base_rev))
+        self.assertEqual(
+            [{'op': 'replace', 'path': '/done', 'value': True}], delta.patch)
+        self.assertEqual(doc2.get_json(), cache.get('doc-id', 'test:2'))
+
+    def test_delta_not_smaller(self):
+        cache = sync.RevisionCache()
+        cache.add(tests.create_doc('doc-id', 'test:1', '{"a": 1}'))
+        doc = tests.create_doc('doc-id', 'test:2', '{"b": 1}')
+        self.assertIs(doc, cache.delta(doc))
+
+    def test_delta_same_rev_or_tombstone(self):
+        cache = sync.RevisionCache()
+        doc = tests.create_doc('doc-id', 'test:1', task_json('a'))
+        cache.add(doc)
+        self.assertIs(doc, cache.delta(doc))
+        tombstone = tests.create_doc('doc-id', 'test:2', None)
+        self.assertIs(tombstone, cache.delta(tombstone))
+
+    def test_document_delta_apply(self):
+        delta = sync.DocumentDelta(
+            'doc-id', 'test:2', 'test:1',
+            [{'op': 'replace', 'path': '/key', 'value': 'other'}])
+        doc = delta.apply(simple_doc)
+        self.assertEqual(('doc-id', 'test:2'), (doc.doc_id, doc.rev))
+        self.assertEqual({'key': 'other'}, json_codec.loads(doc.get_json()))
+
+    def test_document_delta_apply_broken(self):
+        delta = sync.DocumentDelta('doc-id', 'test:2', 'test:1',
+                                   [{'op': 'remove', 'path': '/nokey'}])
+        self.assertRaises(errors.BrokenSyncStream, delta.apply, simple_doc)
+
+
+class TestSyncExchangeDeltas(tests.TestCase):
+
+    def setUp(self):
+        super(TestSyncExchangeDeltas, self).setUp()
+        self.db = inmemory.InMemoryDatabase('test')
+        self.cache = sync.RevisionCache()
+        self.sync_exch = sync.SyncExchange(self.db, 'other', 0,
+                                           revision_cache=self.cache)
+
+    def make_delta(self, doc_id, rev, base_rev, title, done):
+        return sync.DocumentDelta(doc_id, rev, base_rev, json_patch.make_patch(
+            json_codec.loads(task_json(title)),
+            json_codec.loads(task_json(title, done))))
+
+    def test_insert_delta_against_current(self):
+        doc = self.db.create_doc(task_json('a'), doc_id='doc-id')
+        delta = self.make_delta('doc-id', 'other:1|test:1', doc.rev, 'a', True)
+        self.sync_exch.insert_docs_from_source([(delta, 1, 'T-1')])
+        self.assertGetDoc(self.db, 'doc-id', 'other:1|test:1',
+                          task_json('a', True), False)
+        self.assertEqual((1, 'T-1'), self.db._get_sync_gen_info('other'))
+        self.assertEqual([], self.sync_exch.missing_bases)
+        self.assertEqual(task_json('a', True),
+                         self.cache.get('doc-id', 'other:1|test:1'))
+
+    def test_insert_delta_against_conflict(self):
+        self.db.create_doc(task_json('a'), doc_id='doc-id')
+        self.db._put_doc_if_newer(
+            tests.create_doc('doc-id', 'third:1', task_json('c')),
+            save_conflict=True)
+        self.assertEqual('third:1', self.db.get_doc('doc-id').rev)
+        # the patch is against the conflicted revision
+        delta = self.make_delta('doc-id', 'other:1|test:1|third:1', 'test:1',
+                                'a', True)
+        self.sync_exch.insert_docs_from_source([(delta, 1, 'T-1')])
+        self.assertEqual([], self.sync_exch.missing_bases)
+        self.assertGetDoc(self.db, 'doc-id', 'other:1|test:1|third:1',
+                          task_json('a', True), False)
+
+    def test_insert_delta_against_cached(self):
+        self.cache.add(tests.create_doc('doc-id', 'other:1',
+                                          task_json('a')))
+        delta = self.make_delta('doc-id', 'other:2', 'other:1', 'a', True)
+        self.sync_exch.insert_docs_from_source([(delta, 1, 'T-1')])
+        self.assertGetDoc(self.db, 'doc-id', 'other:2', task_json('a', True),
+                          False)
+
+    def test_insert_delta_missing_base(self):
+        docs_by_generation = [
+            (tests.create_doc('doc-1', 'other:1', simple_doc), 1, 'T-1'),
+            (self.make_delta('doc-2', 'other:2', 'other:1', 'a', True),
+             2, 'T-2'),
+            (tests.create_doc('doc-3', 'other:1', simple_doc), 3, 'T-3'),
+            ]
+        self.sync_exch.insert_docs_from_source(docs_by_generation)
+        self.assertEqual(['doc-2'], self.sync_exch.missing_bases)
+        self.assertIs(None, self.db.get_doc('doc-2'))
+        self.assertGetDoc(self.db, 'doc-3', 'other:1', simple_doc, False)
+        # the source generation is only recorded up to the missing document
+        self.assertEqual((1, 'T-1'), self.db._get_sync_gen_info('other'))
+        # until it is sent whole
+        sync_exch = sync.SyncExchange(self.db, 'other', 0)
+        sync_exch.insert_docs_from_source([
+            (tests.create_doc('doc-2', 'other:2', task_json('a', True)),
+             2, 'T-2')])
+        self.assertEqual((2, 'T-2'), self.db._get_sync_gen_info('other'))
+
+    def test_return_docs_as_deltas(self):
+        doc = self.db.create_doc(task_json('a'), doc_id='doc-id')
+        self.cache.add(doc)
+        doc.set_json(task_json('a', True))
+        self.db.put_doc(doc)
+        other = self.db.create_doc(task_json('b'))
+        returned = []
+        self.sync_exch.find_changes_to_return()
+        self.sync_exch.return_docs(
+            lambda doc, gen, trans_id: returned.append(doc))
+        self.assertIsInstance(returned[0], sync.DocumentDelta)
+        self.assertEqual('test:1', returned[0].base_rev)
+        self.assertEqual(doc.rev, returned[0].rev)
+        self.assertEqual(other.rev, returned[1].rev)
+        self.assertEqual(task_json('b'), returned[1].get_json())
+
+    def test_return_docs_without_cache(self):
+        doc = self.db.create_doc(task_json('a'), doc_id='doc-id')
+        sync_exch = sync.SyncExchange(self.db, 'other', 0)
+        returned = []
+        sync_exch.find_changes_to_return()
+        sync_exch.return_docs(lambda doc, gen, trans_id: returned.append(doc))
+        self.assertEqual([doc], returned)
+
+
+class TestDeltaSync(tests.TestCaseWithServer):
+    """Sync with an HTTPSyncTarget exchanging documents as patches."""
+
+    server_def = staticmethod(http_server_def)
+
+    def setUp(self):
+        super(TestDeltaSync, self).setUp()
+        self.startServer()
+        self.db1 = inmemory.InMemoryDatabase('test1')
+        self.db2 = self.request_state._create_database('test2')
+        self.st = http_target.HTTPSyncTarget(self.getURL('test2'))
+        self.cache = sync.RevisionCache()
+        self.st.set_revision_cache(self.cache)
+        self.applied = []
+        apply = sync.DocumentDelta.apply
+
+        def apply_witness(delta, base_json):
+            self.applied.append(delta.doc_id)
+            return apply(delta, base_json)
+
+        self.patch(sync.DocumentDelta, 'apply', apply_witness)
+        self.doc1 = self.db1.create_doc(task_json('a'), doc_id='doc-1')
+        self.doc2 = self.db2.create_doc(task_json('b'), doc_id='doc-2')
+        self.sync()
+        self.assertEqual([], self.applied)
+
+    def sync(self):
+        return sync.Synchronizer(self.db1, self.st).sync()
+
+    def test_send_delta(self):
+        self.doc1.set_json(task_json('a', True))
+        self.db1.put_doc(self.doc1)
+        self.sync()
+        self.assertEqual(['doc-1'], self.applied)
+        self.assertGetDoc(self.db2, 'doc-1', self.doc1.rev,
+                          task_json('a', True), False)
+
+    def test_receive_delta(self):
+        self.doc2.set_json(task_json('b', True))
+        self.db2.put_doc(self.doc2)
+        self.sync()
+        self.assertEqual(['doc-2'], self.applied)
+        self.assertGetDoc(self.db1, 'doc-2', self.doc2.rev,
+                          task_json('b', True), False)
+
+    def test_send_delta_missing_base(self):
+        self.patch(sync.SyncExchange, '_get_base_json',
+                   lambda self, doc_id, base_rev: None)
+        self.doc1.set_json(task_json('a', True))
+        self.db1.put_doc(self.doc1)
+        self.sync()
+        self.assertEqual([], self.applied)
+        self.assertGetDoc(self.db2, 'doc-1', self.doc1.rev,
+                          task_json('a', True), False)
+        self.assertEqual(self.db1._get_generation_info(),
+                         self.db2._get_sync_gen_info('test1'))
+
+    def test_receive_delta_missing_base(self):
+        self.cache._entries.clear()
+        self.doc2.set_json(task_json('b', True))
+        self.db2.put_doc(self.doc2)
+        doc3 = self.db2.create_doc(task_json('c'))
+        self.sync()
+        self.assertEqual([], self.applied)
+        self.assertGetDoc(self.db1, 'doc-2', self.doc2.rev,
+                          task_json('b', True), False)
+        self.assertGetDoc(self.db1, doc3.doc_id, doc3.rev, task_json('c'),
+                          False)
+        self.assertEqual(self.db2._get_generation_info(),
+                         self.db1._get_sync_gen_info('test2'))
+
+
+class TestSyncFilter(tests.TestCase):
+
+    def setUp(self):
+        super(TestSyncFilter, self).setUp()
+        self.db = inmemory.InMemoryDatabase('test')
+        self.db.create_index('done', 'bool(done)')
+        self.db.create_index('title-done', 'title', 'bool(done)')
+
+    def matches(self, sync_filter, content):
+        getters = sync_filter.get_getters(self.db)
+        return sync_filter.matches(getters,
+                                   tests.create_doc('doc', 'r:1', content))
+
+    def test_matches(self):
+        sync_filter = sync.SyncFilter('done', '0', '0')
+        self.assertTrue(self.matches(sync_filter, task_json('a')))
+        self.assertFalse(self.matches(sync_filter, task_json('a', True)))
+        self.assertFalse(self.matches(sync_filter, '{}'))
+
+    def test_matches_range(self):
+        sync_filter = sync.SyncFilter('title-done', ('b', '0'), ('c', '0'))
+        self.assertFalse(self.matches(sync_filter, task_json('a')))
+        self.assertTrue(self.matches(sync_filter, task_json('b')))
+        self.assertTrue(self.matches(sync_filter, task_json('b', True)))
+        self.assertTrue(self.matches(sync_filter, task_json('c')))
+        self.assertFalse(self.matches(sync_filter, task_json('c', True)))
+
+    def test_matches_unbounded(self):
+        sync_filter = sync.SyncFilter('done', '1')
+        self.assertFalse(self.matches(sync_filter, task_json('a')))
+        self.assertTrue(self.matches(sync_filter, task_json('a', True)))
+        sync_filter = sync.SyncFilter('done', end_value='0')
+        self.assertTrue(self.matches(sync_filter, task_json('a')))
+        self.assertFalse(self.matches(sync_filter, task_json('a', True)))
+
+    def test_matches_tombstone(self):
+        sync_filter = sync.SyncFilter('done', '0', '0')
+        self.assertTrue(self.matches(sync_filter, None))
+
+    def test_get_getters_missing_index(self):
+        sync_filter = sync.SyncFilter('archived', '0', '0')
+        self.assertRaises(errors.IndexDoesNotExist,
+                          sync_filter.get_getters, self.db)
+
+    def test_as_dict(self):
+        sync_filter = sync.SyncFilter('title-done', ('b', '0'))
+        self.assertEqual({'index': 'title-done', 'start': ['b', '0'],
+                          'end': None}, sync_filter.as_dict())
+        sync_filter = sync.SyncFilter.from_dict(sync_filter.as_dict())
+        self.assertEqual('title-done', sync_filter.index_name)
+        self.assertEqual(('b', '0'), sync_filter.start_value)
+        self.assertIs(None, sync_filter.end_value)
+
+    def test_from_dict_invalid(self):
+        for value in (None, [], {}, {'index': 1}, {'index': 'done',
+                                                   'start': 'x'}):
+            self.assertRaises(ValueError, sync.SyncFilter.from_dict, value)
+
+
+class TestFilteredSync(tests.TestCase):
+    """Sync with a push_filter and a pull_filter of not done tasks."""
+
+    def setUp(self):
+        super(TestFilteredSync, self).setUp()
+        self.db1 = inmemory.InMemoryDatabase('test1')
+        self.db2 = self.make_target_db()
+        for db in (self.db1, self.db2):
+            db.create_index('done', 'bool(done)')
+        self.st = self.make_sync_target()
+
+    def make_target_db(self):
+        return inmemory.InMemoryDatabase('test2')
+
+    def make_sync_target(self):
+        return self.db2.get_sync_target()
+
+    def sync(self):
+        sync_filter = sync.SyncFilter('done', '0', '0')
+        return sync.Synchronizer(self.db1, self.st, push_filter=sync_filter,
+                                 pull_filter=sync_filter).sync()
+
+    def test_push(self):
+        doc1 = self.db1.create_doc(task_json('a'))
+        doc2 = self.db1.create_doc(task_json('b', True))
+        self.sync()
+        self.assertGetDoc(self.db2, doc1.doc_id, doc1.rev, task_json('a'),
+                          False)
+        self.assertIs(None, self.db2.get_doc(doc2.doc_id))
+        # the target is up to date with the changes left out
+        self.assertEqual(self.db1._get_generation_info(),
+                         self.db2._get_sync_gen_info('test1'))
+
+    def test_push_only_filtered_out(self):
+        self.db1.create_doc(task_json('a', True))
+        self.sync()
+        self.assertEqual([], self.db2.get_all_docs()[1])
+        self.assertEqual(self.db1._get_generation_info(),
+                         self.db2._get_sync_gen_info('test1'))
+
+    def test_push_moving_out(self):
+        doc = self.db1.create_doc(task_json('a'))
+        self.sync()
+        rev = doc.rev
+        doc.set_json(task_json('a', True))
+        self.db1.put_doc(doc)
+        self.sync()
+        # the target keeps the last revision sent
+        self.assertGetDoc(self.db2, doc.doc_id, rev, task_json('a'), False)
+
+    def test_push_deleted(self):
+        doc = self.db1.create_doc(task_json('a'))
+        self.sync()
+        self.db1.delete_doc(doc)
+        self.sync()
+        self.assertGetDocIncludeDeleted(self.db2, doc.doc_id, doc.rev, None,
+                                        False)
+
+    def test_pull(self):
+        doc1 = self.db2.create_doc(task_json('a'))
+        doc2 = self.db2.create_doc(task_json('b', True))
+        self.sync()
+        self.assertGetDoc(self.db1, doc1.doc_id, doc1.rev, task_json('a'),
+                          False)
+        self.assertIs(None, self.db1.get_doc(doc2.doc_id))
+        self.assertEqual(self.db2._get_generation_info(),
+                         self.db1._get_sync_gen_info('test2'))
+
+    def test_pull_moving_out(self):
+        doc1 = self.db2.create_doc(task_json('a'))
+        self.sync()
+        doc1.set_json(task_json('a', True))
+        self.db2.put_doc(doc1)
+        doc2 = self.db2.create_doc(task_json('b', True))
+        doc3 = self.db2.create_doc(task_json('c'))
+        self.sync()
+        # fetched as the older revision held was within the filter
+        self.assertGetDoc(self.db1, doc1.doc_id, doc1.rev,
+                          task_json('a', True), False)
+        self.assertIs(None, self.db1.get_doc(doc2.doc_id))
+        self.assertGetDoc(self.db1, doc3.doc_id, doc3.rev, task_json('c'),
+                          False)
+        self.assertEqual(self.db2._get_generation_info(),
+                         self.db1._get_sync_gen_info('test2'))
+
+    def test_pull_moving_out_interrupted(self):
+        doc1 = self.db2.create_doc(task_json('a'))
+        self.sync()
+        gen, trans_id = self.db1._get_sync_gen_info('test2')
+        doc1.set_json(task_json('a', True))
+        self.db2.put_doc(doc1)
+        self.db2.create_doc(task_json('b'))
+
+        def fail(*args):
+            raise errors.Unavailable
+        self.patch(sync.Synchronizer, '_fetch_filtered_out', fail)
+        self.assertRaises(errors.Unavailable, self.sync)
+        # no progress is recorded past the document to fetch
+        self.assertEqual((gen, trans_id),
+                         self.db1._get_sync_gen_info('test2'))
+
+    def test_pull_missing_index(self):
+        self.db2.delete_index('done')
+        self.db2.create_doc(task_json('a'))
+        self.assertRaises(errors.IndexDoesNotExist, self.sync)
+
+
+class TestFilteredHTTPSync(tests.TestCaseWithServer, TestFilteredSync):
+    """Sync with filters and an HTTPSyncTarget."""
+
+    server_def = staticmethod(http_server_def)
+
+    def make_target_db(self):
+        self.startServer()
+        return self.request_state._create_database('test2')
+
+    def make_sync_target(self):
+        return http_target.HTTPSyncTarget(self.getURL('test2'))
+
+
+class TestFilteredDeltaSync(TestFilteredHTTPSync):
+    """Sync with filters and an HTTPSyncTarget exchanging patches."""
+
+    def make_sync_target(self):
+        st = super(TestFilteredDeltaSync, self).make_sync_target()
+        st.set_revision_cache(sync.RevisionCache())
+        return st
+
+
 class TestDbSync(tests.TestCaseWithServer):
     """Test db.sync remote sync shortcut"""
 
@@ -929,6 +1616,57 @@ class TestDbSync(tests.TestCaseWithServer):
                           False)
 
 
+class TestRetiredReplicasSync(tests.TestCaseWithServer):
+    """Sync between a client and a server only one of which retired old."""
+
+    server_def = staticmethod(http_server_def)
+
+    def setUp(self):
+        super(TestRetiredReplicasSync, self).setUp()
+        self.startServer()
+        self.srv = self.request_state._create_database('srv')
+        self.old = inmemory.InMemoryDatabase('old')
+        self.db = inmemory.InMemoryDatabase('a')
+        self.doc = self.old.create_doc(tests.simple_doc, doc_id='doc')
+        self.sync(self.old)
+        self.sync(self.db)
+
+    def sync(self, db):
+        target = http_target.HTTPSyncTarget(self.getURL('srv'))
+        self.addCleanup(target.close)
+        return sync.Synchronizer(db, target).sync()
+
+    def test_client_retired(self):
+        self.db.set_retired_replicas(['old'])
+        doc = self.db.get_doc('doc')
+        doc.set_json(tests.nested_doc)
+        self.db.put_doc(doc)
+        self.assertEqual('a:1', doc.rev)
+        self.sync(self.db)
+        self.assertEqual(frozenset(['old']), self.srv.get_retired_replicas())
+        self.assertGetDoc(self.srv, 'doc', 'a:1', tests.nested_doc, False)
+        self.assertGetDoc(self.db, 'doc', 'a:1', tests.nested_doc, False)
+
+    def test_server_retired(self):
+        self.srv.set_retired_replicas(['old'])
+        doc = self.srv.get_doc('doc')
+        doc.set_json(tests.nested_doc)
+        self.srv.put_doc(doc)
+        self.assertEqual('srv:1', doc.rev)
+        self.sync(self.db)
+        self.assertEqual(frozenset(['old']), self.db.get_retired_replicas())
+        self.assertGetDoc(self.db, 'doc', 'srv:1', tests.nested_doc, False)
+        # the client creates revisions without old from now on
+        doc = self.db.get_doc('doc')
+        self.db.put_doc(doc)
+        self.assertEqual('a:1|srv:1', doc.rev)
+
+    def test_retired_other_side(self):
+        self.db.set_retired_replicas(['srv'])
+        self.assertRaises(errors.InvalidReplicaUID, self.sync, self.db)
+        self.assertEqual(frozenset(), self.srv.get_retired_replicas())
+
+
 class TestRemoteSyncIntegration(tests.TestCaseWithServer):
     """Integration tests for the most common sync scenario local -> remote"""
 
@@ -941,6 +1679,8 @@ class TestRemoteSyncIntegration(tests.TestCaseWithServer):
         self.db2 = self.request_state._create_database('test2')
 
     def test_sync_tracks_generations_incrementally(self):
+        self.patch(sync.Synchronizer, 'batch_size', 1)
+        self.patch(http_app.SyncResource, 'batch_size', 1)
         doc11 = self.db1.create_doc('{"a": 1}')
         doc12 = self.db1.create_doc('{"a": 2}')
         doc21 = self.db2.create_doc('{"b": 1}')
@@ -980,5 +1720,40 @@ class TestRemoteSyncIntegration(tests.TestCaseWithServer):
                           ('test1', 4, [doc11.doc_id, doc12.doc_id])],
                          progress2)
 
+    def test_sync_tracks_generations_per_batch(self):
+        doc11 = self.db1.create_doc('{"a": 1}')
+        doc12 = self.db1.create_doc('{"a": 2}')
+        doc21 = self.db2.create_doc('{"b": 1}')
+        doc22 = self.db2.create_doc('{"b": 2}')
+        progress1 = []
+        progress2 = []
+        _do_set_sync_info = self.db1._do_set_sync_info
+
+        def set_sync_generation_witness1(other_uid, other_gen, trans_id):
+            progress1.append((other_uid, other_gen,
+                [d for d, t in self.db1._get_transaction_log()[2:]]))
+            _do_set_sync_info(other_uid, other_gen, trans_id)
+        self.patch(self.db1, '_do_set_sync_info',
+                   set_sync_generation_witness1)
+
+        _do_set_sync_info2 = self.db2._do_set_sync_info
+
+        def set_sync_generation_witness2(other_uid, other_gen, trans_id):
+            progress2.append((other_uid, other_gen,
+                [d for d, t in self.db2._get_transaction_log()[2:]]))
+            _do_set_sync_info2(other_uid, other_gen, trans_id)
+        self.patch(self.db2, '_do_set_sync_info',
+                   set_sync_generation_witness2)
+
+        db2_url = self.getURL('test2')
+        self.db1.sync(db2_url)
+
+        self.assertEqual([('test2', 2, [doc21.doc_id, doc22.doc_id]),
+                          ('test2', 4, [doc21.doc_id, doc22.doc_id])],
+                         progress1)
+        self.assertEqual([('test1', 2, [doc11.doc_id, doc12.doc_id]),
+                          ('test1', 4, [doc11.doc_id, doc12.doc_id])],
+                         progress2)
+
 
 load_tests = tests.load_with_scenarios
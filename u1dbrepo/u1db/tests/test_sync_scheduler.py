@@ -0,0 +1,160 @@
+# Copyright 2012 Canonical Ltd.
+#
+# This file is part of u1db.
+#
+# u1db is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation.
+#
+# u1db is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with u1db.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the sync scheduler."""
+
+import socket
+import time
+
+from u1db import (
+    errors,
+    sync_scheduler,
+    tests,
+    )
+from u1db.backends import inmemory
+
+
+class FlakySyncTarget(inmemory.InMemorySyncTarget):
+    """Count calls, and fail them with the errors in self.errors."""
+
+    def __init__(self, db):
+        super(FlakySyncTarget, self).__init__(db)
+        self.errors = []
+        self.calls = []
+
+    def get_sync_info(self, source_replica_uid):
+        self.calls.append('get_sync_info')
+        if self.errors:
+            raise self.errors.pop(0)
+        return super(FlakySyncTarget, self).get_sync_info(source_replica_uid)
+
+    def sync_exchange(self, *args, **kwargs):
+        self.calls.append('sync_exchange')
+        return super(FlakySyncTarget, self).sync_exchange(*args, **kwargs)
+
+
+class TestSyncScheduler(tests.TestCase):
+
+    def setUp(self):
+        super(TestSyncScheduler, self).setUp()
+        self.db = inmemory.InMemoryDatabase('source')
+        self.target_db = inmemory.InMemoryDatabase('target')
+        self.st = FlakySyncTarget(self.target_db)
+        self.scheduler = sync_scheduler.SyncScheduler(self.db, self.st)
+        self.scheduler.debounce = 2.0
+        self.scheduler.max_delay = 10.0
+        self.scheduler.remote_interval = 60.0
+        self.scheduler.poll_interval = 1.0
+        # the first poll syncs right away
+        self.scheduler.poll(0.0)
+        self.assertEqual(1, self.scheduler.syncs)
+        self.st.calls = []
+
+    def test_debounce(self):
+        self.db.create_doc(tests.simple_doc)
+        self.assertEqual(1.0, self.scheduler.poll(100.0))
+        self.db.create_doc(tests.simple_doc)
+        self.scheduler.poll(101.0)
+        self.scheduler.poll(102.0)
+        self.assertEqual([], self.st.calls)
+        self.scheduler.poll(103.0)
+        self.assertEqual(2, self.scheduler.syncs)
+        self.assertEqual(2, len(self.target_db.get_all_docs()[1]))
+
+    def test_max_delay(self):
+        for now in range(100, 110):
+            self.db.create_doc(tests.simple_doc)
+            self.scheduler.poll(float(now))
+        self.assertEqual([], self.st.calls)
+        self.db.create_doc(tests.simple_doc)
+        self.scheduler.poll(110.0)
+        self.assertEqual(2, self.scheduler.syncs)
+        self.assertEqual(11, len(self.target_db.get_all_docs()[1]))
+
+    def test_skip_when_nothing_moved(self):
+        self.scheduler.poll(59.0)
+        self.assertEqual([], self.st.calls)
+        self.scheduler.poll(60.0)
+        self.assertEqual(['get_sync_info'], self.st.calls)
+        self.assertEqual((1, 1), (self.scheduler.syncs,
+                                  self.scheduler.skipped))
+
+    def test_sync_when_target_moved(self):
+        doc = self.target_db.create_doc(tests.simple_doc)
+        self.scheduler.poll(60.0)
+        self.assertEqual(2, self.scheduler.syncs)
+        self.assertGetDoc(self.db, doc.doc_id, doc.rev, tests.simple_doc,
+                          False)
+        # what the target sent is not mistaken for a local write
+        self.st.calls = []
+        self.scheduler.poll(61.0)
+        self.scheduler.poll(63.0)
+        self.assertEqual([], self.st.calls)
+
+    def test_backoff(self):
+        self.db.create_doc(tests.simple_doc)
+        self.scheduler.poll(100.0)
+        self.st.errors = [errors.Unavailable(), errors.HTTPError(500),
+                          socket.error()]
+        self.scheduler.poll(102.0)
+        self.assertEqual(1, self.scheduler.failures)
+        self.assertIsInstance(self.scheduler.last_error, errors.Unavailable)
+        self.scheduler.poll(102.5)
+        self.scheduler.poll(103.0)
+        self.assertEqual(2, self.scheduler.failures)
+        self.scheduler.poll(104.5)
+        self.scheduler.poll(105.0)
+        self.assertEqual(3, self.scheduler.failures)
+        self.assertEqual(1, self.scheduler.syncs)
+        self.scheduler.poll(108.5)
+        self.assertEqual(1, self.scheduler.syncs)
+        self.scheduler.poll(109.0)
+        self.assertEqual(0, self.scheduler.failures)
+        self.assertEqual(2, self.scheduler.syncs)
+
+    def test_backoff_bounded(self):
+        self.scheduler.max_backoff = 5.0
+        self.scheduler.failures = 10
+        self.assertEqual(5.0, self.scheduler._backoff(socket.error()))
+
+    def test_backoff_retry_after(self):
+        self.scheduler.failures = 1
+        self.assertEqual(30.0, self.scheduler._backoff(
+            errors.Unavailable(headers={'retry-after': '30'})))
+        self.assertEqual(1.0, self.scheduler._backoff(
+            errors.Unavailable(headers={'retry-after': 'soon'})))
+
+    def test_other_errors_raise(self):
+        self.db.create_doc(tests.simple_doc)
+        self.scheduler.poll(100.0)
+        self.st.errors = [errors.InvalidGeneration()]
+        self.assertRaises(errors.InvalidGeneration, self.scheduler.poll,
+                          102.0)
+
+    def test_start_stop(self):
+        self.scheduler.poll_interval = 0.01
+        self.scheduler.debounce = 0.0
+        self.scheduler.start()
+        try:
+            self.db.create_doc(tests.simple_doc)
+            for _ in range(500):
+                if self.target_db.get_all_docs()[1]:
+                    break
+                time.sleep(0.01)
+        finally:
+            self.scheduler.stop()
+        self.assertEqual(1, len(self.target_db.get_all_docs()[1]))
+        self.assertIs(None, self.scheduler._thread)
@@ -16,7 +16,7 @@
 
 """VectorClockRev helper class tests."""
 
-from u1db import tests, vectorclock
+from u1db import errors, tests, vectorclock
 
 try:
     from u1db.tests import c_backend_wrapper
@@ -118,4 +118,81 @@ class TestVectorClockRev(tests.TestCase):
         self.assertMaximize('a:1|c:2|e:3', 'b:3|d:4|f:5',
                             'a:1|b:3|c:2|d:4|e:3|f:5')
 
+
+class TestVectorClockRevCaches(tests.TestCase):
+
+    def test_parse_cache_shared(self):
+        vcr1 = vectorclock.VectorClockRev('b:2|a:1')
+        vcr2 = vectorclock.VectorClockRev('b:2|a:1')
+        vcr1.increment('a')
+        self.assertEqual('a:2|b:2', vcr1.as_str())
+        self.assertEqual('a:1|b:2', vcr2.as_str())
+        self.assertEqual('a:1|b:2', vectorclock.VectorClockRev(
+            'b:2|a:1').as_str())
+
+    def test_parse_cache_bounded(self):
+        self.patch(vectorclock, '_parse_cache', {})
+        self.patch(vectorclock, '_PARSE_CACHE_SIZE', 2)
+        for i in range(5):
+            vectorclock.VectorClockRev('test:%d' % (i,))
+        self.assertEqual(2, len(vectorclock._parse_cache))
+
+    def test_keeps_string_type(self):
+        self.assertIsInstance(
+            vectorclock.VectorClockRev('test:1').as_str(), str)
+        self.assertIsInstance(
+            vectorclock.VectorClockRev(u'test:1').as_str(), unicode)
+        self.assertIsInstance(
+            vectorclock.VectorClockRev('test:1').as_str(), str)
+
+    def test_interns_replica_uids(self):
+        uid = ''.join(['replica', '-', 'uid'])
+        vcr1 = vectorclock.VectorClockRev(uid + ':1')
+        vcr2 = vectorclock.VectorClockRev('other:1|' + uid + ':2')
+        vcr3 = vectorclock.VectorClockRev(None)
+        vcr3.increment(''.join(['replica-', 'uid']))
+        self.assertIs(vcr1._values.keys()[0], [
+            key for key in vcr2._values if key != 'other'][0])
+        self.assertIs(vcr1._values.keys()[0], vcr3._values.keys()[0])
+
+
+class TestCompactRevCodec(tests.TestCase):
+
+    def setUp(self):
+        super(TestCompactRevCodec, self).setUp()
+        self.short_ids = {}
+        self.codec = vectorclock.CompactRevCodec(
+            self.get_short_id, self.get_replica_uid)
+
+    def get_short_id(self, replica_uid):
+        return self.short_ids.setdefault(
+            replica_uid, str(len(self.short_ids)))
+
+    def get_replica_uid(self, short_id):
+        for replica_uid, value in self.short_ids.items():
+            if value == short_id:
+                return replica_uid
+        return None
+
+    def test_round_trip(self):
+        self.assertEqual('0:3|1:1', self.codec.encode('replica-a:1|other:3'))
+        self.assertEqual({'other': '0', 'replica-a': '1'}, self.short_ids)
+        self.assertEqual('other:3|replica-a:1', self.codec.decode('0:3|1:1'))
+        self.assertEqual('other:1', self.codec.decode('0:1'))
+
+    def test_None(self):
+        self.assertIs(None, self.codec.encode(None))
+        self.assertIs(None, self.codec.decode(None))
+
+    def test_decode_uncompacted(self):
+        self.short_ids['a'] = '0'
+        self.assertEqual('x:2|y:1', self.codec.decode('y:1|x:2'))
+        self.assertRaises(errors.InvalidRevision, self.codec.decode,
+                          '0:1|x:2')
+
+    def test_decode_sorts(self):
+        self.short_ids.update({'b': '0', 'a': '1'})
+        self.assertEqual('a:2|b:1', self.codec.decode('0:1|1:2'))
+
+
 load_tests = tests.load_with_scenarios
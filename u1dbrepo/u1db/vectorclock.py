@@ -16,6 +16,57 @@
 
 """VectorClockRev helper class."""
 
+from u1db import errors
+
+
+# Parsed revisions, (type, rev string) => (sorted ((replica_uid, counter),
+# ...), canonical rev string). Revisions are parsed over and over during sync
+# and conflict handling, while only a few of them are live at a time. The
+# type is part of the keys so that str and unicode revisions stay the type
+# they were given as.
+_parse_cache = {}
+_PARSE_CACHE_SIZE = 2048
+# The replica uid strings in use, so that parsed revisions share them rather
+# than each holding a copy of the same 32 hex digits. Keyed like _parse_cache.
+_replica_uids = {}
+_REPLICA_UIDS_SIZE = 4096
+
+
+def intern_replica_uid(replica_uid):
+    """Return the shared copy of replica_uid."""
+    key = (replica_uid.__class__, replica_uid)
+    try:
+        return _replica_uids[key]
+    except KeyError:
+        if len(_replica_uids) >= _REPLICA_UIDS_SIZE:
+            _replica_uids.clear()
+        _replica_uids[key] = replica_uid
+        return replica_uid
+
+
+def _format(items):
+    return '|'.join(['%s:%d' % item for item in items])
+
+
+def _parse(value):
+    """Parse a rev string, returning (items, canonical rev string)."""
+    key = (value.__class__, value)
+    try:
+        return _parse_cache[key]
+    except KeyError:
+        pass
+    items = []
+    for replica_info in value.split('|'):
+        replica_uid, counter = replica_info.split(':')
+        items.append((intern_replica_uid(replica_uid), int(counter)))
+    items.sort()
+    items = tuple(items)
+    result = (items, _format(items))
+    if len(_parse_cache) >= _PARSE_CACHE_SIZE:
+        _parse_cache.popitem()
+    _parse_cache[key] = result
+    return result
+
 
 class VectorClockRev(object):
     """Track vector clocks for multiple replica ids.
@@ -28,27 +79,31 @@ class VectorClockRev(object):
     something greater than the current value.
     """
 
+    __slots__ = ('_values', '_str')
+
     def __init__(self, value):
-        self._values = self._expand(value)
+        if value is None:
+            self._values = {}
+            self._str = ''
+        else:
+            items, self._str = _parse(value)
+            self._values = dict(items)
 
     def __repr__(self):
         s = self.as_str()
         return '%s(%s)' % (self.__class__.__name__, s)
 
     def as_str(self):
-        s = '|'.join(['%s:%d' % (m, r) for m, r
-                      in sorted(self._values.items())])
-        return s
+        if self._str is None:
+            self._str = _format(sorted(self._values.iteritems()))
+        return self._str
 
     def _expand(self, value):
         result = {}
         if value is None:
             return result
-        for replica_info in value.split('|'):
-            replica_uid, counter = replica_info.split(':')
-            counter = int(counter)
-            result[replica_uid] = counter
-        return result
+        items, _ = _parse(value)
+        return dict(items)
 
     def is_newer(self, other):
         """Is this VectorClockRev strictly newer than other.
@@ -58,18 +113,20 @@ class VectorClockRev(object):
         if not other._values:
             return True
         this_is_newer = False
-        other_expand = dict(other._values)
+        other_values = other._values
         for key, value in self._values.iteritems():
-            if key in other_expand:
-                other_value = other_expand.pop(key)
-                if other_value > value:
-                    return False
-                elif other_value < value:
-                    this_is_newer = True
-            else:
+            other_value = other_values.get(key)
+            if other_value is None:
                 this_is_newer = True
-        if other_expand:
+            elif other_value > value:
+                return False
+            elif other_value < value:
+                this_is_newer = True
+        if len(other_values) > len(self._values):
             return False
+        for key in other_values:
+            if key not in self._values:
+                return False
         return this_is_newer
 
     def increment(self, replica_uid):
@@ -77,13 +134,82 @@ class VectorClockRev(object):
 
         :return: A string representing the new vector clock value
         """
+        replica_uid = intern_replica_uid(replica_uid)
         self._values[replica_uid] = self._values.get(replica_uid, 0) + 1
+        self._str = None
+
+    def prune(self, replica_uids):
+        """Drop the entries of replica_uids from this vector clock."""
+        values = self._values
+        for replica_uid in replica_uids:
+            if replica_uid in values:
+                del values[replica_uid]
+                self._str = None
 
     def maximize(self, other_vcr):
         for replica_uid, counter in other_vcr._values.iteritems():
             if replica_uid not in self._values:
                 self._values[replica_uid] = counter
+                self._str = None
             else:
                 this_counter = self._values[replica_uid]
                 if this_counter < counter:
                     self._values[replica_uid] = counter
+                    self._str = None
+
+
+class CompactRevCodec(object):
+    """Translate revisions to and from a compact form for storage.
+
+    The compact form replaces every replica uid in a revision by a short id,
+    eg 'replica-a:3|replica-b:1' is stored as '1f0a3c9e:3|77b0d2e1:1'. The
+    short ids only mean something to the database that allocated them, so
+    revisions must always be decoded before leaving it.
+
+    :param get_short_id: A function returning the short id of a replica uid,
+        allocating it if needed.
+    :param get_replica_uid: A function returning the replica uid for a short
+        id, or None if it is not one. Short ids must never be reused for
+        another replica uid.
+    """
+
+    _CACHE_SIZE = 2048
+
+    def __init__(self, get_short_id, get_replica_uid):
+        self._get_short_id = get_short_id
+        self._get_replica_uid = get_replica_uid
+        self._decoded = {}
+
+    def encode(self, rev):
+        if rev is None:
+            return None
+        items, _ = _parse(rev)
+        get_short_id = self._get_short_id
+        return _format([(get_short_id(replica_uid), counter)
+                        for replica_uid, counter in items])
+
+    def decode(self, compact_rev):
+        if compact_rev is None:
+            return None
+        try:
+            return self._decoded[compact_rev]
+        except KeyError:
+            pass
+        items = []
+        unknown = 0
+        for replica_info in compact_rev.split('|'):
+            short_id, counter = replica_info.split(':')
+            replica_uid = self._get_replica_uid(short_id)
+            if replica_uid is None:
+                # it may have been stored before revisions were compacted
+                replica_uid = short_id
+                unknown += 1
+            items.append((intern_replica_uid(replica_uid), int(counter)))
+        if 0 < unknown < len(items):
+            raise errors.InvalidRevision(compact_rev)
+        items.sort()
+        rev = _format(items)
+        if len(self._decoded) >= self._CACHE_SIZE:
+            self._decoded.popitem()
+        self._decoded[compact_rev] = rev
+        return rev